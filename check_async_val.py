@@ -0,0 +1,64 @@
+"""
+Check the async_val worker evaluates the snapshots of a finetuned model: builds the trainer's network for the trained_on
+classes and resets its classes to the finetuning ones as train_yolov3.py's main does, snapshots its parameters, and runs
+the worker's evaluate on the snapshot, with its network built as the worker builds it, on a batch of random images. Takes
+the model flags of train_yolov3.py, eg. on the CPU:
+
+python check_async_val.py
+python check_async_val.py --window 3,1 --k_join_type max --k_join_pos late
+"""
+from __future__ import division
+from __future__ import print_function
+
+from absl import app, flags, logging
+from absl.flags import FLAGS
+from collections import namedtuple
+import mxnet as mx
+
+from metrics.pascalvoc import VOCMApMetric
+from train_yolov3 import get_net, get_val_net, snapshot_evaluator
+from utils.checkpoint import snapshot_params
+
+flags.DEFINE_integer('num_trained_on_classes', 80,
+                     'The number of classes of the model finetuned from.')
+flags.DEFINE_integer('num_train_classes', 30,
+                     'The number of classes finetuned to.')
+
+# stands in for a dataset, the networks only need its classes
+_Classes = namedtuple('_Classes', ['classes'])
+
+
+def main(_argv):
+    FLAGS.window = [int(s) for s in FLAGS.window]
+    FLAGS.conv_types = [int(s) for s in FLAGS.conv_types]
+    FLAGS.hier = [int(s) for s in FLAGS.hier]
+    if FLAGS.window[0] == 1:
+        FLAGS.k_join_type, FLAGS.k_join_pos = None, None
+    FLAGS.trained_on = 'check'  # any dataset, the worker only tests it's set
+    FLAGS.resume = ''
+    FLAGS.pretrained_cnn = False  # the parameters are random, so don't download the pretrained ones
+    ctx = [mx.cpu()]
+
+    trained_on_dataset = _Classes(['trained_on_{}'.format(c) for c in range(FLAGS.num_trained_on_classes)])
+    train_dataset = _Classes(['train_{}'.format(c) for c in range(FLAGS.num_train_classes)])
+
+    if FLAGS.window[0] > 1:
+        x = mx.nd.random_uniform(shape=(1, FLAGS.window[0], 3, FLAGS.data_shape, FLAGS.data_shape))
+    else:
+        x = mx.nd.random_uniform(shape=(1, 3, FLAGS.data_shape, FLAGS.data_shape))
+    y = mx.nd.array([[[10, 20, 200, 220, 0, 0]]])
+
+    # the trainer's network, as in main
+    net, _, _ = get_net(trained_on_dataset, ctx)
+    net.reset_class(train_dataset.classes)
+    net(x)  # initializes the deferred parameters
+    params = snapshot_params(net)
+
+    evaluate = snapshot_evaluator(get_val_net(train_dataset, trained_on_dataset, ctx), [(x, y)], [(x, y)],
+                                  VOCMApMetric(iou_thresh=0.5, class_names=train_dataset.classes), ctx)
+    names, values = evaluate(params, True)
+    logging.info('The worker evaluated the snapshot of the finetuned network: {}={}'.format(names[-1], values[-1]))
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,238 @@
+"""
+Check every model variant hybridizes and exports as a static graph: builds each configuration reachable through the
+yolo3_darknet53, yolo3_3ddarknet and yolo3_mobilenet flags, checks its hybridized (static_alloc, static_shape) output
+equals its imperative output, exports it to symbol+params, checks the exported graph gives the same detections, and
+reports the speedup of the hybridized model. eg. for a couple of configurations on the first GPU:
+
+python check_hybrid.py --configs base,hier,mult_out --gpus 0
+
+With --onnx each configuration is also exported to ONNX, and ONNX Runtime's detections before NMS are checked against
+the hybridized model's and timed, eg. on the CPU:
+
+python check_hybrid.py --configs base,corr_late,temp,noback --onnx
+"""
+from __future__ import division
+from __future__ import print_function
+
+from absl import app, flags, logging
+from absl.flags import FLAGS
+from collections import OrderedDict
+import mxnet as mx
+from mxnet import gluon
+import os
+import time
+
+from models.definitions.fuse import check_equivalence
+from models.definitions.yolo.wrappers import yolo3_darknet53, yolo3_3ddarknet, yolo3_no_backbone, yolo3_mobilenet, \
+    yolo3_mobilenet_v2
+from utils.onnx_export import export_onnx
+
+# name: (the wrapper, its keyword arguments, the number of frames in the input, 0 for the darknet stage features)
+CONFIGS = OrderedDict([
+    ('base', (yolo3_darknet53, dict(k=1), 1)),
+    ('k_cat_early', (yolo3_darknet53, dict(k=3, k_join_type='cat', k_join_pos='early'), 3)),
+    ('k_max_late', (yolo3_darknet53, dict(k=3, k_join_type='max', k_join_pos='late'), 3)),
+    ('k_max_late_3d', (yolo3_darknet53, dict(k=3, k_join_type='max', k_join_pos='late', block_conv_type='3'), 3)),
+    ('corr_early', (yolo3_darknet53, dict(k=3, corr_pos='early', corr_d=4), 3)),
+    ('corr_late', (yolo3_darknet53, dict(k=3, corr_pos='late', corr_d=4), 3)),
+    ('rnn_late', (yolo3_darknet53, dict(k=3, k_join_type='max', k_join_pos='late', rnn_pos='late'), 3)),
+    ('rnn_out', (yolo3_darknet53, dict(k=3, rnn_pos='out'), 3)),
+    ('motion_flownet', (yolo3_darknet53, dict(k=3, motion_stream='flownet', add_type='add'), 3)),
+    ('motion_r21d', (yolo3_darknet53, dict(k=9, motion_stream='r21d', add_type='add'), 9)),
+    ('new_model', (yolo3_darknet53, dict(k=3, new_model=True, k_join_type='max', k_join_pos='late'), 3)),
+    ('hier', (yolo3_darknet53, dict(k=9, new_model=True, hierarchical=[3, 3, 1, 1, 1], h_join_type='max'), 9)),
+    ('hier_conv', (yolo3_darknet53, dict(k=9, new_model=True, hierarchical=[3, 3, 1, 1, 1], h_join_type='conv'), 9)),
+    ('temp', (yolo3_darknet53, dict(k=5, temporal=True), 5)),
+    ('mult_out', (yolo3_darknet53, dict(k=5, t_out=True), 5)),
+    ('mult_out_corr', (yolo3_darknet53, dict(k=5, t_out=True, corr_d=4), 5)),
+    ('3ddarknet', (yolo3_3ddarknet, dict(conv_types=[3, 3, 3, 3, 3, 3]), 3)),
+    ('noback', (yolo3_no_backbone, dict(), 0)),
+    ('mobilenet', (yolo3_mobilenet, dict(k=1), 1)),
+    ('mobilenet0.25', (yolo3_mobilenet, dict(k=1, multiplier=0.25), 1)),
+    ('mobilenet_k_max_late', (yolo3_mobilenet, dict(k=3, k_join_type='max', k_join_pos='late'), 3)),
+    ('mobilenet_corr_late', (yolo3_mobilenet, dict(k=3, corr_pos='late', corr_d=4), 3)),
+    ('mobilenet_rnn_late', (yolo3_mobilenet, dict(k=3, k_join_type='max', k_join_pos='late', rnn_pos='late'), 3)),
+    ('mobilenet_mult_out', (yolo3_mobilenet, dict(k=5, t_out=True), 5)),
+    ('mobilenetv2', (yolo3_mobilenet_v2, dict(k=1), 1)),
+    ('mobilenetv2_k_cat_early', (yolo3_mobilenet_v2, dict(k=3, k_join_type='cat', k_join_pos='early'), 3)),
+])
+
+flags.DEFINE_list('configs', list(CONFIGS.keys()),
+                  'The configurations to check, from: {}.'.format(', '.join(CONFIGS.keys())))
+flags.DEFINE_integer('data_shape', 416,
+                     'Input data shape, the rnn configurations only support 416.')
+flags.DEFINE_integer('num_classes', 30,
+                     'The number of classes.')
+flags.DEFINE_integer('repeats', 5,
+                     'The number of forward passes to time for each of the imperative and hybridized models.')
+flags.DEFINE_float('rtol', 1e-3,
+                   'The relative tolerance between the hybridized and imperative outputs.')
+flags.DEFINE_float('atol', 1e-4,
+                   'The absolute tolerance between the hybridized and imperative outputs.')
+flags.DEFINE_string('save_dir', os.path.join('models', 'exported'),
+                    'Directory to export the symbols and params to, empty to not export.')
+flags.DEFINE_boolean('onnx', False,
+                     'Also export to ONNX and check ONNX Runtime gives the same detections before NMS, and time it.')
+flags.DEFINE_list('gpus', [],
+                  'GPU ID to use, empty for the CPU.')
+
+
+def get_inputs(name, frames, ctx):
+    """
+    Get the random inputs for a configuration, (1, 3, H, W), or (1, frames, 3, H, W) for a temporal one, or
+    (1, 3, frames, H, W) for the 3D darknet, or the three darknet stage features for the model without a backbone
+
+    Args:
+        name (str): the configuration name
+        frames (int): the number of frames the configuration takes
+        ctx: the context
+
+    Returns:
+        list of mxnet.nd.NDArray: the inputs
+    """
+    if frames == 0:
+        shapes = [(1, c, FLAGS.data_shape // s, FLAGS.data_shape // s) for c, s in [(256, 8), (512, 16), (1024, 32)]]
+    elif name == '3ddarknet':
+        shapes = [(1, 3, frames, FLAGS.data_shape, FLAGS.data_shape)]
+    elif frames > 1:
+        shapes = [(1, frames, 3, FLAGS.data_shape, FLAGS.data_shape)]
+    else:
+        shapes = [(1, 3, FLAGS.data_shape, FLAGS.data_shape)]
+    return [mx.nd.random_normal(shape=shape, ctx=ctx) for shape in shapes]
+
+
+def time_forward(net, xs, repeats):
+    """
+    Time the forward passes of a network, after one untimed pass that builds and plans the graph if hybridized
+
+    Args:
+        net: the network
+        xs (list): the inputs
+        repeats (int): the number of passes to time
+
+    Returns:
+        the outputs of the first pass
+        float: the mean seconds per pass
+    """
+    outputs = net(*xs)
+    mx.nd.waitall()
+    tic = time.time()
+    for _ in range(repeats):
+        net(*xs)
+    mx.nd.waitall()
+    return outputs, (time.time() - tic) / max(repeats, 1)
+
+
+def check_onnx(net, xs, reference):
+    """
+    Export a network to ONNX and check ONNX Runtime's outputs match the reference, on the CPU
+
+    Args:
+        net: the network
+        xs (list): the inputs
+        reference: the network's outputs with the NMS switched off
+
+    Returns:
+        float: ONNX Runtime's mean seconds per pass
+    """
+    import onnxruntime
+
+    model = export_onnx(net, [x.shape for x in xs])
+    session = onnxruntime.InferenceSession(model.SerializeToString(), providers=['CPUExecutionProvider'])
+    feed = {i.name: x.asnumpy() for i, x in zip(session.get_inputs(), xs)}
+    outputs = session.run(None, feed)
+    tic = time.time()
+    for _ in range(FLAGS.repeats):
+        session.run(None, feed)
+    seconds = (time.time() - tic) / max(FLAGS.repeats, 1)
+    check_equivalence(reference, [mx.nd.array(o) for o in outputs], rtol=FLAGS.rtol, atol=FLAGS.atol)
+    return seconds
+
+
+def check_config(name, ctx):
+    """
+    Check a configuration hybridizes to the same outputs and exports, see the module docstring
+
+    Args:
+        name (str): the configuration name
+        ctx: the context
+
+    Returns:
+        dict: the imperative and hybridized seconds per pass, the symbol file if exported, and ONNX Runtime's seconds
+              per pass or why its check failed if checked
+    """
+    wrapper, kwargs, frames = CONFIGS[name]
+    if frames > 0:
+        kwargs = dict(kwargs, pretrained_base=False)
+    net = wrapper([str(c) for c in range(FLAGS.num_classes)], **kwargs)
+    net.initialize(ctx=ctx)
+    net.collect_params().reset_ctx(ctx)
+    xs = get_inputs(name, frames, ctx)
+
+    # compare the detections before NMS, as near tied scores can reorder them
+    net.set_nms(nms_thresh=-1, pre_nms_topk=-1)
+    imperative, imperative_time = time_forward(net, xs, FLAGS.repeats)
+    net.hybridize(static_alloc=True, static_shape=True)
+    hybridized, hybridized_time = time_forward(net, xs, FLAGS.repeats)
+    check_equivalence(imperative, hybridized, rtol=FLAGS.rtol, atol=FLAGS.atol)
+
+    result = {'imperative': imperative_time, 'hybridized': hybridized_time, 'symbol': None, 'onnx': None}
+    if FLAGS.onnx:
+        try:  # an op ONNX can't express is reported with the result, rather than failing the hybridization check
+            result['onnx'] = check_onnx(net, xs, hybridized)
+        except Exception as e:
+            result['onnx'] = str(e)
+
+    if FLAGS.save_dir:
+        net.set_nms(nms_thresh=0.45, nms_topk=400, pre_nms_topk=400)
+        detections = net(*xs)  # builds the graph to export, with the NMS
+        path = os.path.join(FLAGS.save_dir, name)
+        net.export(path)
+        inputs = ['data'] if len(xs) == 1 else ['data{}'.format(i) for i in range(len(xs))]
+        imported = gluon.SymbolBlock.imports(path + '-symbol.json', inputs, path + '-0000.params', ctx=ctx)
+        check_equivalence(detections, imported(*xs), rtol=FLAGS.rtol, atol=FLAGS.atol)
+        result['symbol'] = path + '-symbol.json'
+    return result
+
+
+def main(_argv):
+    ctx = mx.gpu(int(FLAGS.gpus[0])) if FLAGS.gpus else mx.cpu()
+    if FLAGS.save_dir:
+        os.makedirs(FLAGS.save_dir, exist_ok=True)
+
+    failed = list()
+    onnx_failed = list()
+    for name in FLAGS.configs:
+        if name not in CONFIGS:
+            raise ValueError('Unknown configuration {}, choose from {}'.format(name, ', '.join(CONFIGS.keys())))
+        try:
+            result = check_config(name, ctx)
+        except Exception as e:  # report every configuration rather than stopping at the first failure
+            logging.error('{:<16} FAILED: {}'.format(name, e))
+            failed.append(name)
+            continue
+        logging.info('{:<16} imperative {:8.1f}ms  hybridized {:8.1f}ms  speedup {:5.2f}x  {}'.format(
+            name, 1000 * result['imperative'], 1000 * result['hybridized'],
+            result['imperative'] / max(result['hybridized'], 1e-9),
+            'exported to ' + result['symbol'] if result['symbol'] else 'not exported'))
+        if isinstance(result['onnx'], float):
+            logging.info('{:<16} onnxruntime {:7.1f}ms  speedup over hybridized {:5.2f}x'.format(
+                name, 1000 * result['onnx'], result['hybridized'] / max(result['onnx'], 1e-9)))
+        elif result['onnx'] is not None:
+            logging.error('{:<16} ONNX FAILED: {}'.format(name, result['onnx']))
+            onnx_failed.append(name)
+
+    if onnx_failed:
+        logging.error('{} of {} configurations failed the ONNX check: {}'.format(
+            len(onnx_failed), len(FLAGS.configs), ', '.join(onnx_failed)))
+    if failed:
+        logging.error('{} of {} configurations failed: {}'.format(len(failed), len(FLAGS.configs), ', '.join(failed)))
+        return 1
+    if onnx_failed:
+        return 1
+    logging.info('All {} configurations hybridize to the same outputs'.format(len(FLAGS.configs)))
+    return 0
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,115 @@
+"""
+Check the 3D and (2+1)D backbones stream: for each configuration, streams the frames of a random clip through the
+temporal convolutions of its backbone, each caching its inputs (see models/definitions/temporal_cache.py), checks the
+streamed slices equal running the backbone's temporal layers on the whole clip at once, and reports the time per frame
+of streaming against running the windowed model for every frame. eg. on the CPU:
+
+python check_stream.py --configs 3ddarknet,motion_r21d --frames 16
+"""
+from __future__ import division
+from __future__ import print_function
+
+from absl import app, flags, logging
+from absl.flags import FLAGS
+from collections import OrderedDict
+import mxnet as mx
+import numpy as np
+import time
+
+from models.definitions.temporal_cache import Darknet3DStream, DarknetR21DStream, check_temporal_stream
+from models.definitions.yolo.streaming import StreamingYOLO3D
+from models.definitions.yolo.wrappers import yolo3_darknet53, yolo3_3ddarknet
+
+# name: (the wrapper, its keyword arguments, the number of frames in a window)
+CONFIGS = OrderedDict([
+    ('3ddarknet', (yolo3_3ddarknet, dict(conv_types=[3, 3, 3, 3, 3, 3]), 3)),
+    ('3ddarknet_early', (yolo3_3ddarknet, dict(conv_types=[3, 3, 3, 2, 2, 2]), 3)),
+    ('21ddarknet', (yolo3_3ddarknet, dict(conv_types=[21, 21, 21, 21, 21, 21]), 3)),
+    ('motion_r21d', (yolo3_darknet53, dict(k=9, motion_stream='r21d', add_type='add'), 9)),
+    ('motion_r21d_cat', (yolo3_darknet53, dict(k=9, motion_stream='r21d'), 9)),
+])
+
+flags.DEFINE_list('configs', list(CONFIGS.keys()),
+                  'The configurations to check, from: {}.'.format(', '.join(CONFIGS.keys())))
+flags.DEFINE_integer('data_shape', 416,
+                     'Input data shape.')
+flags.DEFINE_integer('frames', 16,
+                     'The number of frames in the clip to stream.')
+flags.DEFINE_integer('num_classes', 30,
+                     'The number of classes.')
+flags.DEFINE_float('rtol', 1e-3,
+                   'The relative tolerance between the streamed and whole clip outputs.')
+flags.DEFINE_float('atol', 1e-4,
+                   'The absolute tolerance between the streamed and whole clip outputs.')
+flags.DEFINE_list('gpus', [],
+                  'GPU ID to use, empty for the CPU.')
+
+
+def check_config(name, ctx):
+    """
+    Check a configuration streams to the same slices as the whole clip, and time it, see the module docstring
+
+    Args:
+        name (str): the configuration name
+        ctx: the context
+
+    Returns:
+        dict: the windowed and streamed seconds per frame
+    """
+    wrapper, kwargs, k = CONFIGS[name]
+    net = wrapper([str(c) for c in range(FLAGS.num_classes)], pretrained_base=False, **kwargs)
+    net.initialize(ctx=ctx)
+    net.collect_params().reset_ctx(ctx)
+
+    clip = mx.nd.random_normal(shape=(1, 3, FLAGS.frames, FLAGS.data_shape, FLAGS.data_shape), ctx=ctx)
+    if hasattr(net, 'ts_model'):
+        stream = DarknetR21DStream(net.ts_model, k)
+        window = mx.nd.random_normal(shape=(1, k, 3, FLAGS.data_shape, FLAGS.data_shape), ctx=ctx)
+    else:
+        stream = Darknet3DStream(net.d_model, k)
+        window = mx.nd.random_normal(shape=(1, 3, k, FLAGS.data_shape, FLAGS.data_shape), ctx=ctx)
+    check_temporal_stream(stream.blocks, stream.taps, clip, rtol=FLAGS.rtol, atol=FLAGS.atol)
+
+    net(window)  # untimed, as the first pass allocates
+    mx.nd.waitall()
+    tic = time.time()
+    for _ in range(FLAGS.frames):
+        net(window)
+    mx.nd.waitall()
+    windowed = (time.time() - tic) / FLAGS.frames
+
+    engine = StreamingYOLO3D(net, ctx=ctx, data_shape=FLAGS.data_shape, window=(k, 1))
+    frames = np.random.randint(0, 256, size=(FLAGS.frames, FLAGS.data_shape, FLAGS.data_shape, 3)).astype('uint8')
+    detected = [t for frame in frames for t, _ in engine.step(frame)]
+    detected += [t for t, _ in engine.flush()]
+    if detected != list(range(FLAGS.frames)):
+        raise ValueError('Detected on frames {} of the {} streamed'.format(detected, FLAGS.frames))
+    return {'windowed': windowed, 'streamed': engine.stats['seconds'] / engine.stats['frames']}
+
+
+def main(_argv):
+    ctx = mx.gpu(int(FLAGS.gpus[0])) if FLAGS.gpus else mx.cpu()
+
+    failed = list()
+    for name in FLAGS.configs:
+        if name not in CONFIGS:
+            raise ValueError('Unknown configuration {}, choose from {}'.format(name, ', '.join(CONFIGS.keys())))
+        try:
+            result = check_config(name, ctx)
+        except Exception as e:  # report every configuration rather than stopping at the first failure
+            logging.error('{:<16} FAILED: {}'.format(name, e))
+            failed.append(name)
+            continue
+        logging.info('{:<16} windowed {:8.1f}ms/frame  streamed {:8.1f}ms/frame  speedup {:5.2f}x'.format(
+            name, 1000 * result['windowed'], 1000 * result['streamed'],
+            result['windowed'] / max(result['streamed'], 1e-9)))
+
+    if failed:
+        logging.error('{} of {} configurations failed: {}'.format(len(failed), len(FLAGS.configs), ', '.join(failed)))
+        return 1
+    logging.info('All {} configurations stream to the same slices as the whole clip'.format(len(FLAGS.configs)))
+    return 0
+
+
+if __name__ == '__main__':
+    app.run(main)
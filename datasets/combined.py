@@ -33,7 +33,7 @@ class CombinedDetection(VisionDataset):
         self._validation = validation
         self._inference = inference
         self._samples = self._load_samples()
-        self.sample_ids = list(self._samples.keys())
+        self.sample_ids = np.arange(len(self._samples), dtype=np.int64)
         self._classes, self.wn_classes, self._dataset_class_map, self.parents = self._get_classes()
         self.hier_level = hier_level
 
@@ -94,7 +94,7 @@ class CombinedDetection(VisionDataset):
         return self._classes
 
     def get_sample_ids(self):
-        return self.sample_ids
+        return self.sample_ids.tolist()
 
     def generate_branches(self):
         branches = dict()
@@ -223,11 +223,35 @@ class CombinedDetection(VisionDataset):
         return clsss
 
     def _load_samples(self):
-        samples = dict()
+        """
+        Build the (dataset_idx, dataset_sample_idx) table of all samples, as an array so it's shared between workers
+
+        Returns:
+            numpy.ndarray: of shape (num_samples, 2)
+        """
+        lengths = [len(dataset) for dataset in self._datasets]
+        dataset_idxs = np.repeat(np.arange(len(self._datasets), dtype=np.int64), lengths)
+        sample_idxs = np.concatenate([np.arange(n, dtype=np.int64) for n in lengths] + [np.zeros((0,), np.int64)])
+        return np.stack([dataset_idxs, sample_idxs], axis=1)
+
+    def sample_groups(self):
+        """
+        Get the group of each sample for stratifying subsets, the groups of the datasets that have them (eg. video
+        clips), otherwise one group per dataset
+
+        Returns:
+            numpy.ndarray: the group of each sample
+        """
+        groups = list()
+        offset = 0
         for dataset_idx, dataset in enumerate(self._datasets):
-            for idx in range(len(dataset)):
-                samples[len(samples)] = (dataset_idx, idx)
-        return samples
+            if hasattr(dataset, 'sample_groups'):
+                dataset_groups = np.asarray(dataset.sample_groups(), dtype=np.int64)
+            else:
+                dataset_groups = np.zeros(len(dataset), dtype=np.int64)
+            groups.append(dataset_groups + offset)
+            offset += int(dataset_groups.max()) + 1 if len(dataset_groups) else 0
+        return np.concatenate(groups + [np.zeros((0,), np.int64)])  # the samples are in dataset order
 
     def im_shapes(self, sid):
         dataset_idx, dataset_sample_idx = self._samples[sid]
@@ -315,7 +339,7 @@ class CombinedDetection(VisionDataset):
             done_imgs = set()
             annotations = list()
             for idx in tqdm(range(len(self)), desc='generating coco eval'):
-                sample_id = self.sample_ids[idx]
+                sample_id = int(self.sample_ids[idx])
                 filename = self.sample_path(idx)
                 width, height = self.im_shapes(sid=sample_id)
 
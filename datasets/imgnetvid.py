@@ -4,6 +4,7 @@ from absl import app, flags, logging
 from gluoncv.data.base import VisionDataset
 import json
 import math
+import multiprocessing
 import mxnet as mx
 import numpy as np
 import os
@@ -37,7 +38,6 @@ class ImageNetVidDetection(VisionDataset):
         """
         super(ImageNetVidDetection, self).__init__(root)
         self.name = 'vid'
-        self._im_shapes = {}
         self.root = os.path.expanduser(root)
         self._transform = transform
         assert len(splits) == 1, logging.error('Can only take one split currently as otherwise conflicting image ids')
@@ -51,6 +51,7 @@ class ImageNetVidDetection(VisionDataset):
             allow_empty = True  # allow true if getting video volumes, prevent empties when doing framewise only
         self._allow_empty = allow_empty
         self._windows = None
+        self._motion_ious = None
         self._features_dir = features_dir  # if specified load in features rather than images
 
         # setup a few paths
@@ -61,23 +62,31 @@ class ImageNetVidDetection(VisionDataset):
         # setup the class index map
         self.index_map = index_map or dict(zip(self.wn_classes, range(self.num_class)))
         
-        # load the samples
-        self.samples = self._load_samples()
-        self.all_samples = self.samples.copy()
+        # load the frame and clip tables (and the windows), these are kept as numpy arrays rather than python objects
+        # so forked dataloader workers share them rather than each getting a copy-on-write copy
+        self._load_samples()
+        self._im_shapes = np.full((len(self._frame_ids), 2), np.nan)
 
         # only do every n frames
         assert every >= 1
+        self._frame_mask = np.ones(len(self._frame_ids), dtype=bool)
         if every != 1:
-            self.samples = self._only_every(self.samples, every)
+            self._frame_mask = self._only_every(every)
 
-        # generate a sorted list of the sample ids
-        self.sample_ids = sorted(list(self.samples.keys()))
+        # generate a sorted array of the sample ids
+        if self._videos:
+            self.sample_ids = np.arange(len(self._clip_names), dtype=np.int64)
+            self._rows = None
+        else:
+            self.sample_ids = np.sort(self._frame_ids[self._frame_mask])
+            self._rows = self._rows_of(self.sample_ids)
 
-        for idx in range(len(self)):  # popultate self._im_shapes
-            self._load_label(idx)
+        for row in np.where(self._frame_mask)[0]:  # popultate self._im_shapes
+            self._load_row_label(row)
 
         if not allow_empty:  # remove empty samples if desired
-            self.samples, self.sample_ids = self._remove_empties()
+            self.sample_ids = self._remove_empties()
+            self._rows = self._rows_of(self.sample_ids)
 
     def __str__(self):
         return '\n\n' + self.__class__.__name__ + '\n'
@@ -112,18 +121,21 @@ class ImageNetVidDetection(VisionDataset):
 
     @property
     def motion_ious(self):
-        path = os.path.join(self.root, '{}_motion_ious.json'.format(self._splits[0][1]))
-        if not os.path.exists(path):
-            generate_motion_ious()
+        """
+        Gets the per-box motion ious of the split, generating them from the annotations if necessary
 
-        with open(path, 'r') as f:
-            motion_ious = json.load(f)
-        
-        # filter only the samples in the set
-        # motion_ious = np.array([v for k, v in motion_ious.items() if int(k) in self.sample_ids])
-        # motion_ious = np.array([motion_ious[str(k)] for k in self.sample_ids])
+        Returns:
+            MotionIoUTable : a table indexed by sample id
+        """
+        if self._motion_ious is None:
+            year, split = self._splits[0]
+            path = motion_ious_path(self.root, split, year)
+            if os.path.exists(path):
+                self._motion_ious = MotionIoUTable.load(path)
+            else:
+                self._motion_ious = generate_motion_ious(self.root, split, year)
 
-        return motion_ious
+        return self._motion_ious
 
     def __len__(self):
         return len(self.sample_ids)
@@ -145,11 +157,10 @@ class ImageNetVidDetection(VisionDataset):
             label = self._load_label(idx)[:, :-1]  # remove track id
             if self._window_size > 1:  # lets load the temporal window
                 imgs = None
-                window_sample_ids = self._windows[self.sample_ids[idx]]
 
-                # go through the sample ids for the window
-                for sid in window_sample_ids:
-                    img_path = self._image_path.format(*self.samples[sid])
+                # go through the frames of the window
+                for row in self._windows[self._rows[idx]]:
+                    img_path = self._row_path(row)
                     img = mx.image.imread(img_path)
                     file_id = os.path.join(img_path.split(os.sep)[-2], img_path.split(os.sep)[-1][:-5])
                     f1 = mx.nd.array(np.load(os.path.join(self._features_dir, file_id + '_F1.npy')))
@@ -193,36 +204,7 @@ class ImageNetVidDetection(VisionDataset):
             label = self._load_label(idx)[:, :-1]  # remove track id
 
             if self._window_size > 1:  # lets load the temporal window
-                imgs = list()
-                lbls = list()
-                window_sample_ids = self._windows[self.sample_ids[idx]]
-                window_sample_ids = window_sample_ids[:self._window_size]
-
-                # go through the sample ids for the window
-                for sid in window_sample_ids:
-                    img_path = self._image_path.format(*self.all_samples[sid])
-                    img = mx.image.imread(img_path)
-                    lbl = None
-                    if self._mult_out:
-                        lbl = self._load_label(self.sample_ids.index(sid))[:, :-1]
-
-                    if self._transform is not None:  # transform each image in the window
-                        img, lbl = self._transform(img, lbl)
-
-                    lbls.append(lbl)
-                    imgs.append(img)  # speedup using list instead of concat
-                    # if imgs is None:
-                    #     # imgs = img  # is the first frame in the window
-                    #     imgs = mx.nd.expand_dims(img, axis=0)  # is the first frame in the window
-                    # else:
-                    #     # imgs = mx.ndarray.concatenate([imgs, img], axis=2)  # isn't first frame, concat to the window
-                    #     imgs = mx.nd.concatenate([imgs, mx.nd.expand_dims(img, axis=0)], axis=0)
-
-                img = mx.nd.stack(*imgs)
-                if self._mult_out:
-                    label = lbls
-                elif self._transform is not None:
-                    _, label = self._transform(img, label)
+                img, label = self._load_window(self._rows[idx])
 
             else:  # window size is 1, so just load one image
                 img = mx.image.imread(img_path, 1)
@@ -245,15 +227,12 @@ class ImageNetVidDetection(VisionDataset):
             else:
                 return img, label
         else:
-            sample_id = self.sample_ids[idx]
-            sample = self.samples[sample_id]
             vid = list()
             labels = list()
-            for frame_id in sample[2]:  # for each frame in the video
+            for row in self._clip_rows(self.sample_ids[idx]):  # for each frame in the video
                 # load the frame and the label
-                img_id = (sample[0], sample[1], frame_id)
-                img_path = self._image_path.format(*img_id)
-                label = self._load_label(self.sample_ids.index(sample_id), frame_id=frame_id)
+                img_path = self._row_path(row)
+                label = self._load_row_label(row)
                 img = mx.image.imread(img_path, 1)
 
                 # transform the image and label
@@ -284,73 +263,247 @@ class ImageNetVidDetection(VisionDataset):
             else:
                 return vid, labels
 
+    def _load_window(self, row):
+        """
+        Load the temporal window of frames around a frame in the frame table
+
+        Args:
+            row (int): the row in the frame table of the window centre
+
+        Returns:
+            mxnet.NDArray: the window of frames
+            numpy.ndarray or list: the label of the centre frame, or a list of labels per frame if mult_out
+        """
+        imgs = list()
+        lbls = list()
+
+        # go through the frames of the window
+        for w_row in self._windows[row]:
+            img = mx.image.imread(self._row_path(w_row))
+            lbl = None
+            if self._mult_out:
+                lbl = self._load_row_label(w_row)[:, :-1]
+
+            if self._transform is not None:  # transform each image in the window
+                img, lbl = self._transform(img, lbl)
+
+            lbls.append(lbl)
+            imgs.append(img)  # speedup using list instead of concat
+
+        img = mx.nd.stack(*imgs)
+        if self._mult_out:
+            return img, lbls
+
+        label = self._load_row_label(row)[:, :-1]  # remove track id
+        if self._transform is not None:
+            _, label = self._transform(img, label)
+        return img, label
+
+    def window_schedule(self, stride=None):
+        """
+        Schedule windows that tile each clip so every sample frame is predicted by a multi output (mult_out) model
+
+        Windows are clamped at the clip boundaries in the same way as self._windows. With stride equal to the window
+        size (default) each sample frame is kept from exactly one window, preferring the output nearest the window
+        centre when the clamping repeats a frame. A smaller stride overlaps the windows, so frames are kept from all
+        of the windows they fall in and the duplicate predictions need merging
+
+        Args:
+            stride (int): the number of window outputs between consecutive windows (default is None, the window size)
+
+        Returns:
+            numpy.ndarray: the frame table rows of the window centres, of shape (n,)
+            numpy.ndarray: boolean mask of the window outputs to keep, of shape (n, k)
+        """
+        assert self._window_size > 1 and not self._videos
+        k = self._window_size
+        half = int(k / 2.0)
+        step = self._window_step
+        stride = stride or k
+        overlap = stride < k
+
+        needed = np.zeros(len(self._frame_ids), dtype=bool)
+        needed[self._rows] = True
+        priority = np.argsort(np.abs(np.arange(k) - half), kind='stable')
+
+        centres = list()
+        keep = list()
+        sample_rows = np.sort(self._rows)
+        clip_bounds = np.searchsorted(sample_rows, self._clip_starts)
+        for clip in range(len(self._clip_names)):
+            rows = sample_rows[clip_bounds[clip]:clip_bounds[clip+1]]  # the sample frames of this clip
+            if len(rows) == 0:
+                continue
+            last = self._clip_starts[clip+1] - 1
+            covered = np.zeros(len(rows), dtype=bool)
+
+            anchor = rows[0]
+            while True:
+                # put the anchor at the first output, unless it's not in that window or is the only sample frame in it
+                centre = min(anchor + half * step, last)
+                window = self._windows[centre]
+                if anchor not in window or needed[np.unique(window)].sum() < 2:
+                    centre = anchor
+                    window = self._windows[centre]
+
+                mask = np.zeros(k, dtype=bool)
+                for pos in priority:
+                    r = window[pos]
+                    if not needed[r] or (window[mask] == r).any():
+                        continue
+                    ri = np.searchsorted(rows, r)
+                    if overlap or not covered[ri]:
+                        mask[pos] = True
+                        covered[ri] = True
+
+                centres.append(centre)
+                keep.append(mask)
+
+                # the next anchor is the frame stride outputs on when overlapping, but no later than the first
+                # uncovered frame
+                uncovered = np.where(~covered)[0]
+                if len(uncovered) == 0:
+                    break
+                first_uncovered = rows[uncovered[0]]
+                ahead = np.searchsorted(rows, anchor + stride * step)
+                if overlap and ahead < len(rows):
+                    anchor = min(rows[ahead], first_uncovered)
+                else:
+                    anchor = first_uncovered
+
+        return np.array(centres, dtype=np.int64), np.array(keep, dtype=bool).reshape(-1, k)
+
     def get_label(self, sid):
-        return self._load_label(self.sample_ids.index(sid))[:, :-1]
+        return self._load_row_label(self._rows_of(sid))[:, :-1]
 
     def get_sample_ids(self):
+        """
+        Get the sample ids, the frame ids (int) as listed in the ImageSets, or the frame ids of each window for a
+        multi output model, or the clip names (str) for videos. The sample_ids attribute holds the frame ids, or the
+        clips' indexes into the clip names, as a numpy array
+
+        Returns:
+            list: the sample ids
+        """
+        if self._videos:
+            return self._clip_names[self.sample_ids].tolist()
         if self._window_size > 1 and self._mult_out:
-            sids = list()
-            for sid in self.sample_ids:
-                window_sample_ids = self._windows[sid]
-                window_sample_ids = window_sample_ids[:self._window_size]
-                sids.append(window_sample_ids)
-            return sids
+            return self._frame_ids[self._windows[self._rows]].tolist()
         else:
-            return self.sample_ids
+            return self.sample_ids.tolist()
 
     def sample_path(self, idx):
         if self._videos:
-            sample = self.samples[self.sample_ids[idx]]
-            return os.path.join(sample[0], sample[1], sample[2])
+            clip = self.sample_ids[idx]
+            return os.path.join(self._splits[0][1], self._clip_names[clip])
 
         if self._mult_out:
-            img_paths = list()
-
             assert self._window_size > 1
 
-            window_sample_ids = self._windows[self.sample_ids[idx]]
-            window_sample_ids = window_sample_ids[:self._window_size]
+            return self.window_paths(idx)
 
-            # go through the sample ids for the window
-            for sid in window_sample_ids:
-                img_paths.append(self._image_path.format(*self.all_samples[sid]))
+        return self._row_path(self._rows[idx])
 
-            return img_paths
+    def window_paths(self, idx):
+        return self.row_window_paths(self._rows[idx])
 
-        return self._image_path.format(*self.samples[self.sample_ids[idx]])
+    def row_window_paths(self, row):
+        return [self._row_path(w_row) for w_row in self._windows[row]]
 
-    def window_paths(self, idx):
-        window_sample_ids = self._windows[self.sample_ids[idx]]
+    def _row_sample(self, row):
+        """
+        Get the sample tuple of a frame in the frame table
+
+        Args:
+            row (int): the row in the frame table
+
+        Returns:
+            tuple: (split, clip_name, frame_name) eg. ('val', 'ILSVRC2015_val_00000000', '000000')
+        """
+        return self._splits[0][1], self._clip_names[self._frame_clips[row]], self._frame_names[row]
+
+    def _row_path(self, row):
+        return self._image_path.format(*self._row_sample(row))
+
+    def _rows_of(self, sample_ids):
+        """
+        Get the frame table rows of frame sample ids
+
+        Args:
+            sample_ids (int or numpy.ndarray): the sample id(s) as listed in the ImageSets
+
+        Returns:
+            int or numpy.ndarray: the row(s) in the frame table
+
+        Raises:
+            KeyError: if a sample id isn't in the frame table
+        """
+        sample_ids = np.asarray(sample_ids, dtype=np.int64)
+        pos = np.searchsorted(self._sorted_frame_ids, sample_ids)
+        clipped = np.minimum(pos, len(self._sorted_frame_ids) - 1)
+        found = (pos < len(self._sorted_frame_ids)) & (self._sorted_frame_ids[clipped] == sample_ids)
+        if not np.all(found):
+            raise KeyError(np.atleast_1d(sample_ids)[~np.atleast_1d(found)].tolist())
+        return self._id_order[pos]
+
+    def _clip_rows(self, clip):
+        """
+        Get the frame table rows of a clip, only including those kept after the every filtering
+
+        Args:
+            clip (int): the index of the clip
 
-        paths = [self._image_path.format(*self.all_samples[sid])for sid in window_sample_ids]
-        return paths
+        Returns:
+            numpy.ndarray: the rows in the frame table
+        """
+        rows = np.arange(self._clip_starts[clip], self._clip_starts[clip+1])
+        return rows[self._frame_mask[rows]]
 
-    def _only_every(self, samples, every):
+    def clip_frame_paths(self):
+        """
+        Get the paths of every frame of the clips the samples come from, ignoring the every filtering, for
+        processing whole clips in order (eg. keyframe detection with box propagation)
+
+        Returns:
+            list: a list of clips, each a list of its frame paths in order
+        """
         if self._videos:
-            for k, v in samples.items():
-                frame_ids = list()
-                frame_nums = list()
-                for i, frame_id in enumerate(v[2]):
-                    if int(int(frame_id)) % every == 0:
-                        frame_ids.append(frame_id)
-                        frame_nums.append(v[3][i])
-                samples[k][2] = frame_ids
-                samples[k][3] = frame_nums
-            return samples
+            clips = self.sample_ids
         else:
-            cutback_samples = dict()
-            for k, v in samples.items():
-                if int(v[-1]) % every == 0:
-                    cutback_samples[k] = v  # add it
+            clips = np.unique(self._frame_clips[self._rows])
+
+        return [[self._row_path(row) for row in range(self._clip_starts[clip], self._clip_starts[clip+1])]
+                for clip in clips]
+
+    def sample_groups(self):
+        """
+        Get the clip each sample comes from, for stratifying subsets of the samples
+
+        Returns:
+            numpy.ndarray: the clip index of each sample
+        """
+        if self._videos:
+            return self.sample_ids
+        return self._frame_clips[self._rows]
+
+    def _only_every(self, every):
+        """
+        Get a mask over the frame table keeping only every ?th frame of each video
+
+        Args:
+            every (int): keep frames whose number is divisible by this
 
-            return cutback_samples
+        Returns:
+            numpy.ndarray: boolean mask of shape (num_frames,)
+        """
+        return self._frame_names.astype(np.int64) % every == 0
 
     def _remove_empties(self):
         """
         removes empty samples from the set
 
         Returns:
-            list: of the sample ids of non-empty samples
+            numpy.ndarray: of the sample ids of non-empty samples
         """
 
         assert not self._videos, logging.error("Can't exclude non-empty samples for videos")
@@ -367,13 +520,13 @@ class ImageNetVidDetection(VisionDataset):
             good_sample_ids = list()
             removed = 0
             n_boxes = 0
-            for sid in tqdm(self.sample_ids, desc="Removing images that have 0 boxes"):
-                n_boxes_in_sample = len(self._load_label(self.sample_ids.index(sid)))
+            for idx, sid in enumerate(tqdm(self.sample_ids, desc="Removing images that have 0 boxes")):
+                n_boxes_in_sample = len(self._load_label(idx))
                 if n_boxes_in_sample < 1:
                     removed += 1
                 else:
                     n_boxes += n_boxes_in_sample
-                    good_sample_ids.append(sid)
+                    good_sample_ids.append(int(sid))
 
             str_ = "Removed {} out of {} images, leaving {} with {} boxes over {} classes.\n".format(
                 removed, len(self.sample_ids), len(good_sample_ids), n_boxes, len(self.classes))
@@ -385,146 +538,94 @@ class ImageNetVidDetection(VisionDataset):
             with open(not_empty_stats_file, 'w') as f:
                 f.write(str_)
 
-        # remake the samples dict
-        good_samples = dict()
-        for sid in good_sample_ids:
-            good_samples[sid] = self.samples[sid]
-
-        return good_samples, good_sample_ids
+        # only keep the good ids that are in the current set
+        good_sample_ids = np.array(good_sample_ids, dtype=np.int64)
+        return np.sort(good_sample_ids[np.isin(good_sample_ids, self.sample_ids)])
 
     def _load_samples(self):
         """
-        Load the samples of this dataset using the settings supplied
+        Load the frame and clip tables of this dataset using the settings supplied
 
-        Returns:
-            dict : a dict of either video (videos=True) or frame (videos=False) samples
+        Sets:
+            _frame_ids (numpy.ndarray): the ImageSets id of every frame, grouped by clip in file order
+            _frame_clips (numpy.ndarray): the index into _clip_names of every frame
+            _frame_names (numpy.ndarray): the frame name of every frame eg. '000000'
+            _clip_names (numpy.ndarray): the sorted clip names eg. 'ILSVRC2015_val_00000000'
+            _clip_starts (numpy.ndarray): the first frame row of each clip, of shape (num_clips+1,)
+            _windows (numpy.ndarray): the frame rows of the temporal window around every frame (num_frames, k)
 
         """
-        ids = list()
+        frame_paths = list()
+        frame_ids = list()
         for year, split in self._splits:
 
             # load the splits file
             logging.info("Loading splits from: {}".format(os.path.join(self.root, 'ImageSets', 'VID', split + '.txt')))
             with open(os.path.join(self.root, 'ImageSets', 'VID', split + '.txt'), 'r') as f:
-                ids_ = [(int(line.split()[1]), self.root, split, line.split()[0]) for line in f.readlines()]
+                ids_ = [line.split() for line in f.readlines()]
 
             # use only the 2015 samples
             if year == 2015:
-                ids_ = [id_ for id_ in ids_ if 'ILSVRC2015' in id_[-1]]
-
-            ids += ids_
-
-        # Build a dictionary of videos {vid_id: (path str, split str, vid_id str, frames list, frame_ids list), ...}
-        videos = dict()
-        past_vid_id = ''
-        frames = None
-        frame_ids = None
-        past_id = None
-        for i, id_ in enumerate(ids):
-            vid_id = id_[3][:-7]
-            frame = id_[3][-6:]
-
-            if i == 0:  # fist iteration - set the variables
-                past_id = id_
-                frames = [frame]
-                frame_ids = [id_[0]]
-                past_vid_id = vid_id
-
-            elif i == len(ids)-1:  # last iteration - add the last video
-                # if self._frames < 1:  # cut down per video
-                #     frames = [frames[i] for i in range(0, len(frames), int(1 / self._frames))]
-                #     frame_ids = [frame_ids[i] for i in range(0, len(frame_ids), int(1 / self._frames))]
-                # elif self._frames > 1:  # cut down per video
-                #     frames = [frames[i] for i in range(0, len(frames), int(math.ceil(len(frames) / self._frames)))]
-                #     frame_ids = [frame_ids[i] for i in
-                #                  range(0, len(frame_ids), int(math.ceil(len(frames) / self._frames)))]
-
-                videos[vid_id] = [id_[2], vid_id, frames, frame_ids]
-
-            else:
-                if vid_id != past_vid_id:  # new video - add it
-
-                    # if self._frames < 1:  # cut down per video
-                    #     frames = [frames[i] for i in range(0, len(frames), int(1/self._frames))]
-                    #     frame_ids = [frame_ids[i] for i in range(0, len(frame_ids), int(1/self._frames))]
-                    # elif self._frames > 1:  # cut down per video
-                    #     frames = [frames[i] for i in range(0, len(frames), int(math.ceil(len(frames)/self._frames)))]
-                    #     frame_ids = [frame_ids[i] for i in
-                    #                  range(0, len(frame_ids), int(math.ceil(len(frames)/self._frames)))]
-
-                    videos[past_vid_id] = [past_id[2], past_vid_id, frames, frame_ids]
-
-                    past_id = id_
-                    frames = [frame]
-                    frame_ids = [id_[0]]
-                    past_vid_id = vid_id
-
-                else:  # same video - just append the frames
-                    frames.append(frame)
-                    frame_ids.append(id_[0])
-
-        # if we want samples to be full videos, return the dictionary of videos
-        if self._videos:
-            return videos
-        else:  # we want frames, or windows of frames
-
-            # reconstruct the frame samples from vid video samples
-            frames = dict()
-            for video in videos.values():
-                for frame_name, frame_id in zip(video[2], video[3]):
-                    # (split, clip_name, frame_name) eg. ('val', 'ILSVRC2015_val_00000000', '000000')
-                    frames[frame_id] = (video[0], video[1], frame_name)
-
-            # build a temporal window of frames around each sample, adheres to the 'self._frames param' only containing
-            # frames that are in the cut down set... so step is actually step*the_dataset_step
-            if self._window_size > 1:
-                self._windows = dict()
-
-                for video in videos.values():  # lock to only getting frames from the same video
-                    frame_ids = video[3]  # get the list of frame ids
-
-                    for i in range(len(frame_ids)):  # for each frame in this video
-                        window = list()  # setup a new window (will hold the frame_ids)
-
-                        window_size = int(self._window_size / 2.0)  # halves and floors it
-
-                        # lets step back through the video and get the frame_ids
-                        for back_i in range(window_size*self._window_step, self._window_step-1, -self._window_step):
-                            window.append(frame_ids[max(0, i-back_i)])  # will add first frame to pad if window too big
-
-                        # add the current frame
-                        window.append(frame_ids[i])
-
-                        # lets step forward and add future frame_ids
-                        for forward_i in range(self._window_step, window_size*self._window_step+1, self._window_step):
-                            if len(window) == self._window_size:
-                                break  # only triggered if self._window_size is even, we disregard last frame
-                            # will add last frame to pad if window too big
-                            window.append(frame_ids[min(len(frame_ids)-1, i+forward_i)])
-
-                        # add the window frame ids to a dict to be used in the get() function
-                        self._windows[frame_ids[i]] = window
-
-            return frames
+                ids_ = [id_ for id_ in ids_ if 'ILSVRC2015' in id_[0]]
+
+            frame_paths += [id_[0] for id_ in ids_]
+            frame_ids += [int(id_[1]) for id_ in ids_]
+
+        frame_paths = np.array(frame_paths)
+        frame_ids = np.array(frame_ids, dtype=np.int64)
+
+        # pool the clip names and group the frames by clip, keeping the file order within each clip
+        self._clip_names, frame_clips = np.unique(np.char.rpartition(frame_paths, '/')[:, 0], return_inverse=True)
+        order = np.argsort(frame_clips, kind='stable')
+        self._frame_ids = frame_ids[order]
+        self._frame_clips = frame_clips[order].astype(np.int32)
+        self._frame_names = np.char.rpartition(frame_paths[order], '/')[:, 2]
+        self._clip_starts = np.searchsorted(self._frame_clips, np.arange(len(self._clip_names)+1)).astype(np.int64)
+
+        # for looking up rows by sample id
+        self._id_order = np.argsort(self._frame_ids, kind='stable')
+        self._sorted_frame_ids = self._frame_ids[self._id_order]
+
+        # build a temporal window of frames around each frame, clamped to the first and last frame of its clip so
+        # windows too big for the clip are padded by repeating the end frames. If self._window_size is even we
+        # disregard the last frame. Windows are built on all frames, so the step is not affected by every
+        if self._window_size > 1 and not self._videos:
+            rows = np.arange(len(self._frame_ids), dtype=np.int64)
+            first = self._clip_starts[self._frame_clips]
+            last = self._clip_starts[self._frame_clips + 1] - 1
+            offsets = (np.arange(self._window_size) - int(self._window_size / 2.0)) * self._window_step
+            windows = np.clip(rows[:, None] + offsets[None, :], first[:, None], last[:, None])
+            self._windows = windows.astype(np.int32)
 
     def _load_label(self, idx, frame_id=None):
         """
         Parse the xml annotation files for a sample
 
         Args:
-            sid (int): the sample id
+            idx (int): the sample index
             frame_id (str): needed if videos=True, will get the label for this particular frame
 
         Returns:
             numpy.ndarray : labels of shape (n, 6) - [[xmin, ymin, xmax, ymax, cls_id, trk_id], ...]
         """
-        sample_id = self.sample_ids[idx]
-        sample = self.all_samples[sample_id]
-
-        anno_path = self._annotations_path.format(*sample)
         if self._videos:
             assert frame_id is not None
-            anno_path = self._annotations_path.format(*(sample[0], sample[1], frame_id))
+            rows = self._clip_rows(self.sample_ids[idx])
+            return self._load_row_label(rows[self._frame_names[rows] == frame_id][0])
+
+        return self._load_row_label(self._rows[idx])
+
+    def _load_row_label(self, row):
+        """
+        Parse the xml annotation file for a frame in the frame table
+
+        Args:
+            row (int): the row in the frame table
+
+        Returns:
+            numpy.ndarray : labels of shape (n, 6) - [[xmin, ymin, xmax, ymax, cls_id, trk_id], ...]
+        """
+        anno_path = self._annotations_path.format(*self._row_sample(row))
 
         if not os.path.exists(anno_path):
             return np.array([[-1, -1, -1, -1, -1, -1]])
@@ -535,8 +636,8 @@ class ImageNetVidDetection(VisionDataset):
         height = float(size.find('height').text)
 
         # store the shapes for later usage
-        if sample_id not in self._im_shapes:
-            self._im_shapes[sample_id] = (width, height)
+        if np.isnan(self._im_shapes[row, 0]):
+            self._im_shapes[row] = (width, height)
 
         label = []
         for obj in root.iter('object'):
@@ -603,13 +704,13 @@ class ImageNetVidDetection(VisionDataset):
         return x
 
     def image_size(self, sample_id):
-        if len(self._im_shapes) == 0:
-            for sid in tqdm(self.sample_ids, desc="populating im_shapes"):
-                self._load_label(self.sample_ids.index(sid))
-        return self._im_shapes[sample_id]
+        row = self._rows_of(sample_id)
+        if np.isnan(self._im_shapes[row, 0]):
+            self._load_row_label(row)
+        return tuple(self._im_shapes[row])
 
     def im_shapes(self, sample_id):
-        return self._im_shapes[sample_id]
+        return tuple(self._im_shapes[self._rows_of(sample_id)])
 
     def stats(self):
         """
@@ -628,21 +729,16 @@ class ImageNetVidDetection(VisionDataset):
         vid_instances = [set() for _ in range(len(self.classes))]  # used to store the vid+track instances per class
 
         for idx in tqdm(range(len(self.sample_ids)), desc="Calculating stats"):
-            sample_id = self.sample_ids[idx]
-            vid_id = self.samples[sample_id][1]
-            vids.add(vid_id)
-
             if self._videos:
-                for frame_id in self.samples[sample_id][2]:
-                    n_frames += 1
-                    for box in self._load_label(idx, frame_id):
-                        if int(box[4]) < 0:  # not actually a box
-                            continue
-                        n_boxes[int(box[4])] += 1
-                        vid_instances[int(box[4])].add(vid_id+str(box[-1]))  # add the track id
+                rows = self._clip_rows(self.sample_ids[idx])
             else:
+                rows = [self._rows[idx]]
+
+            for row in rows:
+                vid_id = self._clip_names[self._frame_clips[row]]
+                vids.add(vid_id)
                 n_frames += 1
-                for box in self._load_label(idx):
+                for box in self._load_row_label(row):
                     if int(box[4]) < 0:  # not actually a box
                         continue
                     n_boxes[int(box[4])] += 1
@@ -689,9 +785,10 @@ class ImageNetVidDetection(VisionDataset):
         done_imgs = set()
         annotations = list()
         for idx in range(len(self)):
-            sample_id = self.sample_ids[idx]
-            filename = self._image_path.format(*self.samples[sample_id])
-            width, height = self._im_shapes[sample_id]
+            sample_id = int(self.sample_ids[idx])
+            row = self._rows[idx]
+            filename = self._row_path(row)
+            width, height = self._im_shapes[row]
 
             if sample_id not in done_imgs:
                 done_imgs.add(sample_id)
@@ -715,75 +812,250 @@ class ImageNetVidDetection(VisionDataset):
         return self._coco_path
 
 
-def iou(bb, bbgt):
+class MotionIoUTable(object):
+    """
+    Compact lookup of the per-box motion IoUs of a split, stored as a flat array of values with per-sample offsets
+    """
+
+    def __init__(self, sample_ids, offsets, values):
+        """
+        Args:
+            sample_ids (numpy.ndarray): sorted sample ids of shape (n,)
+            offsets (numpy.ndarray): start of each samples values in values, of shape (n+1,)
+            values (numpy.ndarray): the concatenated motion ious of every sample
+        """
+        self.sample_ids = sample_ids
+        self.offsets = offsets
+        self.values = values
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['sample_ids'], data['offsets'], data['values'])
+
+    def save(self, path):
+        # write to a temporary file first so a partially written table is never picked up
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, sample_ids=self.sample_ids, offsets=self.offsets, values=self.values)
+        os.replace(tmp_path, path)
+
+    def _position(self, sample_id):
+        pos = np.searchsorted(self.sample_ids, int(sample_id))
+        if pos >= len(self.sample_ids) or self.sample_ids[pos] != int(sample_id):
+            raise KeyError(sample_id)
+        return pos
+
+    def __len__(self):
+        return len(self.sample_ids)
+
+    def __contains__(self, sample_id):
+        try:
+            self._position(sample_id)
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, sample_id):
+        pos = self._position(sample_id)
+        return self.values[self.offsets[pos]:self.offsets[pos+1]]
+
+    def gather(self, sample_ids):
+        """
+        Get the concatenated motion ious of a list of samples
+
+        Args:
+            sample_ids (list): the sample ids
+
+        Returns:
+            numpy.ndarray: the motion ious of all boxes in the samples, in order
+
+        Raises:
+            KeyError: if a sample id isn't in the table
+        """
+        sample_ids = np.asarray(sample_ids, dtype=np.int64)
+        pos = np.searchsorted(self.sample_ids, sample_ids)
+        found = pos < len(self.sample_ids)
+        found[found] = self.sample_ids[pos[found]] == sample_ids[found]
+        if not found.all():
+            raise KeyError(sample_ids[~found].tolist())
+        starts = self.offsets[pos]
+        lengths = self.offsets[pos+1] - starts
+        # build the flat index of every value belonging to the requested samples
+        idx = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return self.values[idx]
+
+
+class ImageNetVidWindowSchedule(mx.gluon.data.Dataset):
+    """Windows tiling the clips of an ImageNetVidDetection, so a mult_out model predicts every frame once."""
+
+    def __init__(self, dataset, stride=None):
+        """
+        Args:
+            dataset (ImageNetVidDetection): the frame dataset, with a window size > 1 and mult_out=True
+            stride (int): the number of window outputs between consecutive windows (default is None, the window size)
+        """
+        self._dataset = dataset
+        self.centres, self.keep = dataset.window_schedule(stride)
+
+    def __len__(self):
+        return len(self.centres)
+
+    def __getitem__(self, idx):
+        img, label = self._dataset._load_window(self.centres[idx])
+        return img, label, idx
+
+    def window_paths(self, idx):
+        return self._dataset.row_window_paths(self.centres[idx])
+
+
+def _parse_track_boxes(anno_path, wn_classes):
     """
-    Single box IoU calculation function for generate_motion_ious
+    Parse the boxes and track ids of a single annotation file, without touching the image
 
     Args:
-        bb: bounding box 1
-        bbgt: bounding box 2
+        anno_path (str): the path to the .xml
+        wn_classes (set): the classes to keep
 
     Returns:
-        float: the IoU between the two boxes
+        numpy.ndarray: boxes of shape (n, 4)
+        numpy.ndarray: track ids of shape (n,)
     """
-    ov = 0
-    iw = np.min((bb[2], bbgt[2])) - np.max((bb[0], bbgt[0])) + 1
-    ih = np.min((bb[3], bbgt[3])) - np.max((bb[1], bbgt[1])) + 1
-    if iw > 0 and ih > 0:
-        # compute overlap as area of intersection / area of union
-        intersect = iw * ih
-        ua = (bb[2] - bb[0] + 1.) * (bb[3] - bb[1] + 1.) + \
-             (bbgt[2] - bbgt[0] + 1.) * \
-             (bbgt[3] - bbgt[1] + 1.) - intersect
-        ov = intersect / ua
-    return ov
-
-
-def generate_motion_ious():
+    if not os.path.exists(anno_path):
+        return np.zeros((0, 4)), np.zeros((0,), dtype=np.int64)
+
+    root = et.parse(anno_path).getroot()
+    size = root.find('size')
+    width = float(size.find('width').text)
+    height = float(size.find('height').text)
+
+    boxes = list()
+    trk_ids = list()
+    for obj in root.iter('object'):
+        if obj.find('name').text.strip().lower() not in wn_classes:
+            continue
+        xml_box = obj.find('bndbox')
+        box = [float(xml_box.find(k).text) for k in ['xmin', 'ymin', 'xmax', 'ymax']]
+        boxes.append(ImageNetVidDetection._validate_label(*box, width, height, anno_path))
+        trk_ids.append(int(obj.find('trackid').text))
+
+    return np.array(boxes, dtype=np.float64).reshape(-1, 4), np.array(trk_ids, dtype=np.int64)
+
+
+def _clip_motion_ious(args):
     """
-    Used to generate motion_ious .json files matching that of imagenet_vid_groundtruth_motion_iou.mat from FGFA
-    Except these are keyed on the image ids listed beside each frame in the ImageSets
+    Calculate the motion ious for every frame of a single clip, vectorised per track
+
+    The motion iou of a box is the mean IoU with the same track in the frames up to ±10 away, matching that of
+    imagenet_vid_groundtruth_motion_iou.mat from FGFA
+
+    Args:
+        args (tuple): (list of annotation paths in frame order, set of wn_classes, frame range)
 
-    Note This script is relatively intensive
-    
     Returns:
-        None
+        list: of numpy.ndarrays, the motion ious of each frame (in annotation box order, [0.0] if no boxes)
+    """
+    anno_paths, wn_classes, frame_range = args
+    n_frames = len(anno_paths)
+
+    # flatten the clip into (frame, track, box) rows
+    frame_idxs, trk_ids, boxes = list(), list(), list()
+    for f, anno_path in enumerate(anno_paths):
+        f_boxes, f_trk_ids = _parse_track_boxes(anno_path, wn_classes)
+        frame_idxs.append(np.full(len(f_trk_ids), f, dtype=np.int64))
+        trk_ids.append(f_trk_ids)
+        boxes.append(f_boxes)
+    frame_idxs = np.concatenate(frame_idxs)
+    trk_ids = np.concatenate(trk_ids)
+    boxes = np.concatenate(boxes)
+
+    row_ious = np.full(len(trk_ids), np.nan)
+    for trk_id in np.unique(trk_ids):
+        if trk_id < 0:
+            continue
+        rows = np.where(trk_ids == trk_id)[0]
+
+        # only the first box of a track per frame is matched against
+        frames, first = np.unique(frame_idxs[rows], return_index=True)
+        track = np.full((n_frames, 4), np.nan)
+        track[frames] = boxes[rows[first]]
+
+        iou_sum = np.zeros(n_frames)
+        iou_cnt = np.zeros(n_frames)
+        for d in range(1, frame_range+1):  # compare each frame with the frame d ahead, and credit both
+            a, b = track[:-d], track[d:]
+            iw = np.minimum(a[:, 2], b[:, 2]) - np.maximum(a[:, 0], b[:, 0]) + 1
+            ih = np.minimum(a[:, 3], b[:, 3]) - np.maximum(a[:, 1], b[:, 1]) + 1
+            inter = np.where((iw > 0) & (ih > 0), iw * ih, 0.0)
+            union = (a[:, 2] - a[:, 0] + 1.) * (a[:, 3] - a[:, 1] + 1.) + \
+                    (b[:, 2] - b[:, 0] + 1.) * (b[:, 3] - b[:, 1] + 1.) - inter
+            valid = ~np.isnan(union)
+            ious = np.where(valid, inter / np.where(valid, union, 1.0), 0.0)
+            iou_sum[:-d] += ious
+            iou_sum[d:] += ious
+            iou_cnt[:-d] += valid
+            iou_cnt[d:] += valid
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            row_ious[rows] = (iou_sum / iou_cnt)[frame_idxs[rows]]  # nan if the track is never seen nearby
+
+    frame_ious = list()
+    for f in range(n_frames):
+        f_rows = (frame_idxs == f) & (trk_ids > -1)
+        frame_ious.append(row_ious[f_rows] if f_rows.any() else np.zeros((1,)))  # frames with no boxes get 0.0
+    return frame_ious
+
+
+def motion_ious_path(root, split, year):
+    """The path of the motion IoU table of a split, by year as 2015 keeps only the ILSVRC2015 clips"""
+    return os.path.join(root, '{}_{}_motion_ious.npz'.format(split, year))
+
+
+def generate_motion_ious(root=os.path.join('datasets', 'ImageNetVID', 'ILSVRC'), split='val', year=2017,
+                         frame_range=10, num_workers=None):
+    """
+    Used to generate a motion ious table matching that of imagenet_vid_groundtruth_motion_iou.mat from FGFA
+    Except these are keyed on the image ids listed beside each frame in the ImageSets
+
+    Only the annotation files are read, clips are processed in parallel and the result is saved as a compact .npz
 
+    Args:
+        root (str): root file path of the dataset (default is 'datasets/ImageNetVID/ILSVRC')
+        split (str): the split to generate for (default is 'val')
+        year (int): the year of the split, 2015 keeps only the ILSVRC2015 clips (default is 2017)
+        frame_range (int): the number of frames either side to compare against (default is 10)
+        num_workers (int): the number of processes to use, None uses all cpus (default is None)
+
+    Returns:
+        MotionIoUTable: the generated table
     """
-    for split in ['train', 'val']:
-        dataset = ImageNetVidDetection(splits=[(2017, split)], allow_empty=True, videos=True)
-    
-        all_ious = {}  # using dict for better removing of elements on loading based on sample_id
-        sample_id = 1  # messy but works
-        for idx in tqdm(range(len(dataset)), desc="Generation motion iou groundtruth"):
-            _, video = dataset[idx]
-            for frame in range(len(video)):
-                frame_ious = []
-                for box_idx in range(len(video[frame])):
-                    trk_id = video[frame][box_idx][5]
-                    if trk_id > -1:
-                        ious = []
-                        for i in range(-10, 11):
-                            frame_c = frame + i
-                            if 0 <= frame_c < len(video) and i != 0:
-                                for c_box_idx in range(len(video[frame_c])):
-                                    c_trk_id = video[frame_c][c_box_idx][5]
-                                    if trk_id == c_trk_id:
-                                        a = video[frame][box_idx]
-                                        b = video[frame_c][c_box_idx]
-                                        ious.append(iou(a, b))
-                                        break
-    
-                        frame_ious.append(np.mean(ious))
-
-                if frame_ious:  # if this frame has no boxes we add a 0.0
-                    all_ious[sample_id] = frame_ious
-                else:
-                    all_ious[sample_id] = [0.0]
-                sample_id += 1
-    
-        with open(os.path.join(dataset.root, '{}_motion_ious.json'.format(split)), 'w') as f:
-            json.dump(all_ious, f)
+    annotations_path = os.path.join(root, 'Annotations', 'VID', split, '{}.xml')
+    with open(os.path.join('datasets', 'names', 'imagenetvid_wn.names'), 'r') as f:
+        wn_classes = set(line.strip() for line in f.readlines())
+
+    # group the frames by clip, keeping the order of the ImageSets file
+    clips = dict()
+    with open(os.path.join(root, 'ImageSets', 'VID', split + '.txt'), 'r') as f:
+        for line in f.readlines():
+            frame_path, sample_id = line.split()
+            if year == 2015 and 'ILSVRC2015' not in frame_path:
+                continue
+            clips.setdefault(frame_path[:-7], list()).append((int(sample_id), annotations_path.format(frame_path)))
+
+    jobs = [([p for _, p in frames], wn_classes, frame_range) for frames in clips.values()]
+    with multiprocessing.Pool(num_workers) as pool:
+        clip_ious = list(tqdm(pool.imap(_clip_motion_ious, jobs, chunksize=8), total=len(jobs),
+                              desc="Generating {} motion iou groundtruth".format(split)))
+
+    sample_ids = np.array([sid for frames in clips.values() for sid, _ in frames], dtype=np.int64)
+    frame_ious = [ious for frames in clip_ious for ious in frames]
+    order = np.argsort(sample_ids, kind='stable')
+    lengths = np.array([len(frame_ious[i]) for i in order], dtype=np.int64)
+    table = MotionIoUTable(sample_ids[order],
+                           np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+                           np.concatenate([frame_ious[i] for i in order]).astype(np.float32))
+
+    table.save(motion_ious_path(root, split, year))
+    return table
 
 
 if __name__ == '__main__':
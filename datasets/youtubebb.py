@@ -73,11 +73,15 @@ class YouTubeBBDetection(VisionDataset):
         # setup the class index map
         self.index_map = index_map or dict(zip(self.class_ids, range(self.num_class)))
 
-        # load the samples
-        self._samples = self._load_items(splits)
+        # load the frame, clip and annotation tables (and the windows), these are kept as numpy arrays rather than
+        # python objects so forked dataloader workers share them rather than each getting a copy-on-write copy
+        self._load_items(splits)
 
-        # generate a sorted list of the sample ids
-        self._sample_ids = sorted(list(self._samples.keys()))
+        # samples are either clips or rows in the frame table, see get_sample_ids for their string ids
+        if self._videos:
+            self._sample_ids = np.arange(len(self._clip_names), dtype=np.int64)
+        else:
+            self._sample_ids = np.arange(len(self._frame_names), dtype=np.int64)
 
     def __str__(self):
         return '\n\n' + self.__class__.__name__ + '\n' + self.stats()[0] + '\n'
@@ -141,6 +145,21 @@ class YouTubeBBDetection(VisionDataset):
     def __len__(self):
         return len(self._sample_ids)
 
+    def get_sample_ids(self):
+        """
+        Get the string id of each sample, the clip id 'youtube_id,class_id,object_id' of a clip or the clip id and the
+        frame name 'youtube_id,class_id,object_id,frame' of a frame. Internally samples are indexed by their row in the
+        clip or frame table instead
+
+        Returns:
+            list: the sample ids as str
+        """
+        if self._videos:
+            return self._clip_names[self._sample_ids].tolist()
+        rows = self._sample_ids
+        return [clip + ',' + frame for clip, frame in zip(self._clip_names[self._frame_clips[rows]].tolist(),
+                                                          self._frame_names[rows].tolist())]
+
     def __getitem__(self, idx):
         """
         Get a sample from the dataset
@@ -160,8 +179,8 @@ class YouTubeBBDetection(VisionDataset):
             if self._window_size > 1:
                 imgs = None
                 window = self._windows[self._sample_ids[idx]]
-                for sid in window:
-                    img_path = self._image_path.format(*self._samples[sid])
+                for row in window:
+                    img_path = self._row_path(row)
                     img = mx.image.imread(img_path)
 
                     if self._transform is not None:  # transform each image in the window
@@ -193,14 +212,11 @@ class YouTubeBBDetection(VisionDataset):
             else:
                 return img, label
         else:
-            sample_id = self._sample_ids[idx]
-            sample = self._samples[sample_id]
             vid = None
             labels = None
-            for frame in sample[3]:
-                img_id = (sample[0], sample[1], os.path.join(sample[2], frame))
-                img_path = self._image_path.format(*img_id)
-                label = self._load_label(idx, frame=frame)
+            for row in self._clip_rows(self._sample_ids[idx]):
+                img_path = self._row_path(row)
+                label = self._load_row_label(row)
                 img = mx.image.imread(img_path, 1)
                 if self._transform is not None:
                     img, label = self._transform(img, label)
@@ -220,12 +236,35 @@ class YouTubeBBDetection(VisionDataset):
             return vid, labels
 
     def sample_path(self, idx):
-        sample_id = self.sample_ids[idx]
-        sample = self.samples[sample_id]
         if self._videos:
             return NotImplementedError  # todo return clip path/name
 
-        return self._image_path.format(*[sample_id.split(',')[0], sample_id.split(',')[-1]])
+        return self._row_path(self._sample_ids[idx])
+
+    def _row_path(self, row):
+        """
+        Get the image path of a frame in the frame table, frames are stored under the youtube id not the clip id
+
+        Args:
+            row (int): the row in the frame table
+
+        Returns:
+            str: the image path
+        """
+        clip_name = self._clip_names[self._frame_clips[row]]
+        return self._image_path.format(*[clip_name.split(',')[0], self._frame_names[row]])
+
+    def _clip_rows(self, clip):
+        """
+        Get the frame table rows of a clip
+
+        Args:
+            clip (int): the index of the clip
+
+        Returns:
+            numpy.ndarray: the rows in the frame table
+        """
+        return np.arange(self._clip_starts[clip], self._clip_starts[clip+1])
 
     def download(self, ids):
         # todo consider how to do this all better...
@@ -451,65 +490,66 @@ class YouTubeBBDetection(VisionDataset):
                     if frame_id not in frames:
                         del videos[vid_id][frame_id]
 
-        if self._videos:
-            return videos
-
-        if self._window_size > 1:
-            self._windows = dict()
-
-            for vid_id in videos:  # lock to only getting frames from the same video
-                frame_ids = [vid_id+','+frame_id for frame_id in sorted(videos[vid_id].keys())]
-                for i in range(len(frame_ids)):  # for each frame in this video
-                    window = list()  # setup a new window (will hold the frame_ids)
-
-                    window_size = int(self._window_size / 2.0)  # halves and floors it
-
-                    # lets step back through the video and get the frame_ids
-                    for back_i in range(window_size*self._window_step, self._window_step-1, -self._window_step):
-                        window.append(frame_ids[max(0, i-back_i)])  # will add first frame to pad if window too big
-
-                    # add the current frame
-                    window.append(frame_ids[i])
-
-                    # lets step forward and add future frame_ids
-                    for forw_i in range(self._window_step, window_size*self._window_step+1, self._window_step):
-                        if len(window) == self._window_size:
-                            break  # only triggered if self._window_size is even, we disregard last frame
-                        window.append(frame_ids[min(len(frame_ids)-1, i+forw_i)])  # will add last frame to pad if window too big
-
-                    # add the window frame ids to a dict to be used in the get() function
-                    self._windows[frame_ids[i]] = window
-
-        # make a frames dict as each sample is a frame not a video
-        frames = dict()
-        for vid_id in videos:
-            for frame_id in videos[vid_id].keys():
-                frames[vid_id+','+frame_id] = videos[vid_id][frame_id]
-        return frames
+        # flatten the videos into a frame table (grouped by clip, frames sorted) and an annotation table
+        self._clip_names = np.array(sorted(videos.keys()))
+        frame_clips, frame_names, ann_counts, anns = list(), list(), list(), list()
+        for clip, vid_id in enumerate(self._clip_names):
+            for frame_id in sorted(videos[vid_id].keys()):
+                frame_clips.append(clip)
+                frame_names.append(frame_id)
+                ann_counts.append(len(videos[vid_id][frame_id]))
+                anns += videos[vid_id][frame_id]
+        del videos
+
+        self._frame_clips = np.array(frame_clips, dtype=np.int32)
+        self._frame_names = np.array(frame_names)
+        self._clip_starts = np.searchsorted(self._frame_clips, np.arange(len(self._clip_names)+1)).astype(np.int64)
+        self._ann_starts = np.concatenate([[0], np.cumsum(ann_counts)]).astype(np.int64)
+
+        # rows are [class_id, class_name, object_id, presence, xmin, xmax, ymin, ymax]
+        self._ann_cls = np.array([int(obj[0]) for obj in anns], dtype=np.int32)
+        self._ann_trk = np.array([int(obj[2]) for obj in anns], dtype=np.int32)
+        self._ann_absent = np.array([obj[3] == 'absent' for obj in anns], dtype=bool)
+        self._ann_boxes = np.array([[float(obj[4]), float(obj[6]), float(obj[5]), float(obj[7])] for obj in anns],
+                                   dtype=np.float32).reshape(-1, 4)
+
+        # build a temporal window of frames around each frame, clamped to the first and last frame of its clip so
+        # windows too big for the clip are padded by repeating the end frames. If self._window_size is even we
+        # disregard the last frame
+        if not self._videos and self._window_size > 1:
+            rows = np.arange(len(self._frame_names), dtype=np.int64)
+            first = self._clip_starts[self._frame_clips]
+            last = self._clip_starts[self._frame_clips + 1] - 1
+            offsets = (np.arange(self._window_size) - int(self._window_size / 2.0)) * self._window_step
+            windows = np.clip(rows[:, None] + offsets[None, :], first[:, None], last[:, None])
+            self._windows = windows.astype(np.int32)
 
     def _load_label(self, idx, frame=None):
         """Just get the label data from the cache."""
 
-        sample_id = self._sample_ids[idx]
-        sample = self._samples[sample_id]
-
         if self._videos:
             assert frame is not None
-            sample = sample[frame]
+            rows = self._clip_rows(self._sample_ids[idx])
+            return self._load_row_label(rows[self._frame_names[rows] == frame][0])
+
+        return self._load_row_label(self._sample_ids[idx])
+
+    def _load_row_label(self, row):
+        """Get the label data of a frame in the frame table from the annotation table."""
+
+        sample_id = self._clip_names[self._frame_clips[row]] + ',' + self._frame_names[row]
+        class_ids = self.class_ids
 
         label = []
-        for obj in sample:
-            cls_id = int(obj[0])
-            if cls_id not in self.class_ids:
+        for ai in range(self._ann_starts[row], self._ann_starts[row+1]):
+            cls_id = int(self._ann_cls[ai])
+            if cls_id not in class_ids:
                 continue
             cls_id = self.index_map[cls_id]
-            trk_id = int(obj[2])
-            xmin = float(obj[4])
-            ymin = float(obj[6])
-            xmax = float(obj[5])
-            ymax = float(obj[7])  # todo these should be pixels not percentages
+            trk_id = int(self._ann_trk[ai])
+            xmin, ymin, xmax, ymax = [float(v) for v in self._ann_boxes[ai]]  # todo these should be pixels not percentages
 
-            if obj[3] == 'absent' or xmin < 0 or xmax < 0 or ymin < 0 or ymax < 0:  # no box
+            if self._ann_absent[ai] or xmin < 0 or xmax < 0 or ymin < 0 or ymax < 0:  # no box
                 continue
 
             xmin, ymin, xmax, ymax = self._validate_label(xmin, ymin, xmax, ymax, sample_id)
@@ -580,20 +620,20 @@ class YouTubeBBDetection(VisionDataset):
         n_samples = len(self._sample_ids)
         n_boxes = [0]*len(self.classes)
         n_instances = [0]*len(self.classes)
-        past_vid_id = ''
+        past_vid_id = -1
         for idx in tqdm(range(len(self._sample_ids))):
-            sample_id = self._sample_ids[idx]
-            vid_id = sample_id
-            if not self._videos:
-                vid_id = ','.join(sample_id.split(',')[:-1])  # remove frame_id
+            if self._videos:
+                vid_id = self._sample_ids[idx]
+            else:
+                vid_id = self._frame_clips[self._sample_ids[idx]]
 
             if vid_id != past_vid_id:
                 vid_instances = []
                 past_vid_id = vid_id
                 n_videos += 1
             if self._videos:
-                for frame in self._samples[sample_id].keys():
-                    for box in self._load_label(idx, frame):
+                for row in self._clip_rows(vid_id):
+                    for box in self._load_row_label(row):
                         n_boxes[int(box[4])] += 1
                         if int(box[5]) not in vid_instances:
                             vid_instances.append(int(box[5]))
@@ -4,21 +4,24 @@ from __future__ import print_function
 from absl import app, flags, logging
 from absl.flags import FLAGS
 import cv2
+from functools import partial
 import glob
 from gluoncv.model_zoo import get_model
 from gluoncv.data.batchify import Tuple, Stack, Pad
 import mxnet as mx
 from mxnet import gluon
 import logging
+import multiprocessing
 import numpy as np
 import os
 import random
+import time
 from tqdm import tqdm
 
 from datasets.pascalvoc import VOCDetection
 from datasets.mscoco import COCODetection
 from datasets.imgnetdet import ImageNetDetection
-from datasets.imgnetvid import ImageNetVidDetection
+from datasets.imgnetvid import ImageNetVidDetection, ImageNetVidWindowSchedule
 from datasets.detectset import DetectSet
 from datasets.combined import CombinedDetection
 
@@ -26,11 +29,12 @@ from metrics.pascalvoc import VOCMApMetric
 from metrics.mscoco import COCODetectionMetric
 from metrics.imgnetvid import VIDDetectionMetric
 
-from models.definitions.yolo.transforms import YOLO3VideoInferenceTransform
-from models.definitions.yolo.wrappers import yolo3_darknet53, yolo3_3ddarknet
-
+from utils.artefact import ONNX_FILE, ArtefactTransform, CompiledDetector, export_artefact, input_shape, load_spec
 from utils.general import as_numpy
 from utils.image import cv_plot_bbox
+from utils.loader_tuning import autotune_loader, tuning_key
+from utils.onnx_export import OnnxDetector, export_onnx
+from utils.propagate import KeyframeSelector, get_propagator
 from utils.video import video_to_frames
 
 # disable autotune
@@ -40,8 +44,15 @@ logging.basicConfig(level=logging.INFO)
 
 flags.DEFINE_string('model_path', 'yolo3_darknet53_voc_best.params',
                     'Path to the detection model to use')
+flags.DEFINE_string('artefact', None,
+                    'Detect with the model artefact in this directory, made with --export_artefact, rather than '
+                    'building the model from the flags. Its data_shape, window and mult_out replace the flags.')
+flags.DEFINE_string('export_artefact', None,
+                    'Export the model built from the flags and model_path to this directory as an artefact, holding '
+                    'its graph, params, input shape, classes, nms and preprocessing, then exit.')
 flags.DEFINE_string('network', 'darknet53',
-                    'Base network name: darknet53')
+                    'Base network name: darknet53, or mobilenet1.0, mobilenet0.75, mobilenet0.5, mobilenet0.25 or '
+                    'mobilenetv2_ with the same multipliers, which support the k_join, corr, rnn and mult_out options')
 flags.DEFINE_list('dataset', ['voc'],
                   'Dataset or .jpg image or .mp4 video or .txt image/video list.')
 flags.DEFINE_string('trained_on', '',
@@ -72,6 +83,13 @@ flags.DEFINE_string('block_conv_type', '2',
                     "convolution type for the YOLO blocks: '2'2D, '3':3D or '21':2+1D, must be used with 'late' joining")
 flags.DEFINE_string('rnn_pos', None,
                     "position of RNN, currently only supports 'late' or 'out")
+flags.DEFINE_boolean('rnn_bi', True,
+                     'Bidirectional RNNs, --nornn_bi for a model trained with unidirectional ones.')
+flags.DEFINE_boolean('stream', False,
+                     'Stream each clip through a model with unidirectional RNNs (--nornn_bi), or a 3D darknet '
+                     '(conv_types) or r21d motion stream backbone, computing each frame once and carrying the RNN '
+                     'states or caching the temporal conv inputs between frames rather than running every window, '
+                     'saving the accuracy and frames/sec to compare with the windowed model.')
 flags.DEFINE_string('corr_pos', None,
                     "position of correlation features calculation, currently only supports 'early' or 'late")
 flags.DEFINE_integer('corr_d', 4,
@@ -110,10 +128,61 @@ flags.DEFINE_list('gpus', [0],
 flags.DEFINE_integer('num_workers', 8,
                      'The number of workers should be picked so that it’s equal to number of cores on your machine'
                      ' for max parallelization.')
+flags.DEFINE_boolean('nd_only', False,
+                     'Do not hybridize the model.')
+flags.DEFINE_integer('pre_nms_topk', 400,
+                     'Each output layer decodes only its top scoring box and class candidates into detections for '
+                     'NMS, rather than every box for every class, so NMS cost doesn\'t grow with the classes. The '
+                     'detections are the same while it\'s at least the NMS topk of 400. -1 decodes every candidate.')
+flags.DEFINE_enum('backend', 'mxnet', ['mxnet', 'onnxruntime'],
+                  'The runtime to detect with: mxnet, or onnxruntime to export the model to ONNX and run it with ONNX '
+                  'Runtime on the CPU, applying the NMS outside the graph. With --export_artefact the artefact also '
+                  'holds the ONNX model, for --artefact with this backend.')
+flags.DEFINE_integer('onnx_threads', 0,
+                     'The number of threads ONNX Runtime runs each op on, 0 for its default.')
+flags.DEFINE_boolean('fuse_bn', False,
+                     'Fold the BatchNorms into the convolutions before detecting, removing a pass over every feature '
+                     'map per layer, checking the outputs stay the same on a random input.')
+flags.DEFINE_string('channel_spec', None,
+                    'The channel spec JSON of a pruned model (see prune_yolo3.py), to build the model to before '
+                    'loading model_path.')
+flags.DEFINE_integer('prefetch', -1,
+                     'The number of batches the loader workers prefetch, -1 is twice num_workers.')
+flags.DEFINE_boolean('thread_pool', False,
+                     'Use threads for the loader workers rather than processes.')
+flags.DEFINE_boolean('autotune_loader', False,
+                     'Tune num_workers, prefetch and thread_pool for the loader by timing it on its own over the '
+                     'dataset, caching the settings for the dataset, window, data_shape and host in '
+                     'autotune_cache. Logs the samples/sec ceiling of the input pipeline.')
+flags.DEFINE_integer('autotune_batches', 20,
+                     'The number of batches autotune_loader times for each setting.')
+flags.DEFINE_string('autotune_cache', os.path.join('models', 'loader_tuning.json'),
+                    'The json file of the autotune_loader settings.')
 flags.DEFINE_boolean('new_model', False,
                      'Use features Yolo (new) or stages Yolo (old)?')
 flags.DEFINE_integer('offset', 0,
                      'If mult_out specified this selects the offset to test. Can be -2, -1, 0, 1, 2')
+flags.DEFINE_boolean('schedule_windows', False,
+                     'If mult_out specified, tile each clip with windows so every frame is predicted by one forward '
+                     'pass rather than running a window for every frame.')
+flags.DEFINE_integer('window_stride', 0,
+                     'If schedule_windows specified, the number of outputs between windows. 0 is the window size, '
+                     'smaller overlaps the windows and merges the duplicate predictions with nms.')
+flags.DEFINE_list('keyframe_intervals', [],
+                  'Run the detector only on keyframes and propagate the boxes to the frames in between, for each of '
+                  'these keyframe intervals, saving the accuracy vs frames/sec curve. Empty runs on every frame.')
+flags.DEFINE_string('keyframe_mode', 'fixed',
+                    "How to pick keyframes: 'fixed' every interval or 'adaptive' on frame difference and confidence, "
+                    "with the interval as the maximum gap")
+flags.DEFINE_string('propagator', 'flow',
+                    "How to propagate between keyframes: the boxes with 'flow' (opencv), 'template' (opencv) or "
+                    "'flownet', or the backbone features with 'features' (FlowNetS warping, only the heads run)")
+flags.DEFINE_float('keyframe_diff_thresh', 0.1,
+                   'If adaptive, the mean absolute frame difference from the last keyframe that triggers a keyframe.')
+flags.DEFINE_float('keyframe_conf_thresh', 0.3,
+                   'If adaptive, the top propagated box score below which a keyframe is triggered.')
+flags.DEFINE_float('propagate_decay', 0.95,
+                   'The per frame score decay of propagated boxes.')
 flags.DEFINE_integer('hier_level', 10,
                      'What is the hierarchical level cutoff for dets and eval 0,1,2,3,4,5,6?')
 
@@ -169,12 +238,22 @@ def get_dataset(dataset_name):
     return dataset
 
 
-def get_dataloader(dataset, batch_size):
+def get_dataloader(dataset, batch_size, num_workers=None, prefetch=None, thread_pool=None,
+                   mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
     width, height = FLAGS.data_shape, FLAGS.data_shape
     batchify_fn = Tuple(Stack(), Pad(pad_val=-1), Stack())
-    loader = gluon.data.DataLoader(dataset.transform(YOLO3VideoInferenceTransform(width, height)),
-                                   batch_size, False, last_batch='keep', num_workers=FLAGS.num_workers,
-                                   batchify_fn=batchify_fn)
+    num_workers = FLAGS.num_workers if num_workers is None else num_workers
+    if prefetch is None:
+        prefetch = FLAGS.prefetch if FLAGS.prefetch >= 0 else None
+    thread_pool = FLAGS.thread_pool if thread_pool is None else thread_pool
+    if FLAGS.artefact:  # preprocess without the model definitions
+        transform = ArtefactTransform(FLAGS.data_shape, mean=mean, std=std)
+    else:
+        from models.definitions.yolo.transforms import YOLO3VideoInferenceTransform
+        transform = YOLO3VideoInferenceTransform(width, height, mean=mean, std=std)
+    loader = gluon.data.DataLoader(dataset.transform(transform),
+                                   batch_size, False, last_batch='keep', num_workers=num_workers,
+                                   batchify_fn=batchify_fn, prefetch=prefetch, thread_pool=thread_pool)
     return loader
 
 
@@ -195,13 +274,61 @@ def get_metric(dataset, metric_name, data_shape, save_dir, class_map=None):
     return metric
 
 
-def detect(net, dataset, loader, ctx, max_do=-1):
-    net.collect_params().reset_ctx(ctx)
-    net.set_nms(nms_thresh=0.45, nms_topk=400)
-    # net.hybridize()
+def get_net(classes, model_path):
+    # the model definitions are only imported to build the model, detecting from an artefact doesn't need them
+    from models.definitions.fuse import fuse_for_inference
+    from models.definitions.prune import apply_channel_spec, load_channel_spec
+    from models.definitions.yolo.wrappers import yolo3_darknet53, yolo3_3ddarknet, YOLO3_MOBILENETS
+
+    # net_name = '_'.join(('yolo3', FLAGS.network, 'custom'))
+    # net = get_model(net_name, root='models', pretrained_base=True, classes=classes)
+    if FLAGS.network == 'darknet53':
+        if FLAGS.conv_types[0] is 2:
+            net = yolo3_darknet53(classes,
+                                  k=FLAGS.window[0], k_join_type=FLAGS.k_join_type, k_join_pos=FLAGS.k_join_pos,
+                                  block_conv_type=FLAGS.block_conv_type, rnn_pos=FLAGS.rnn_pos,
+                                  corr_pos=FLAGS.corr_pos, corr_d=FLAGS.corr_d, motion_stream=FLAGS.motion_stream,
+                                  agnostic=FLAGS.model_agnostic, add_type=FLAGS.stream_gating,
+                                  new_model=FLAGS.new_model,
+                                  hierarchical=FLAGS.hier, h_join_type=FLAGS.h_join_type, temporal=FLAGS.temp,
+                                  t_out=FLAGS.mult_out, rnn_bi=FLAGS.rnn_bi)
+        else:
+            net = yolo3_3ddarknet(classes, conv_types=FLAGS.conv_types)
+    elif FLAGS.network in YOLO3_MOBILENETS:
+        yolo3_mobilenet, multiplier = YOLO3_MOBILENETS[FLAGS.network]
+        net = yolo3_mobilenet(classes, multiplier=multiplier, pretrained_base=False,
+                              k=FLAGS.window[0], k_join_type=FLAGS.k_join_type, k_join_pos=FLAGS.k_join_pos,
+                              block_conv_type=FLAGS.block_conv_type, rnn_pos=FLAGS.rnn_pos,
+                              corr_pos=FLAGS.corr_pos, corr_d=FLAGS.corr_d, agnostic=FLAGS.model_agnostic,
+                              t_out=FLAGS.mult_out, rnn_bi=FLAGS.rnn_bi)
+    else:
+        raise NotImplementedError('Backbone CNN model {} not implemented.'.format(FLAGS.network))
+    if FLAGS.channel_spec:
+        apply_channel_spec(net, load_channel_spec(FLAGS.channel_spec))
+    net.initialize()
+    if FLAGS.window[0] > 1:
+        x = mx.nd.random_normal(shape=(1, FLAGS.window[0], 3, FLAGS.data_shape, FLAGS.data_shape))
+    else:
+        x = mx.nd.random_normal(shape=(1, 3, FLAGS.data_shape, FLAGS.data_shape))
+    net.summary(x)
+    net.load_parameters(model_path)
+    if FLAGS.fuse_bn:
+        net.set_nms(nms_thresh=-1, pre_nms_topk=-1)  # compare the detections in a fixed order, detect sets the nms
+        fuse_for_inference(net, x)
+
+    return net
+
+
+def detect(net, dataset, loader, ctx, max_do=-1, schedule=None):
+    if not isinstance(net, (CompiledDetector, OnnxDetector)):  # these are already set up, with their nms
+        net.collect_params().reset_ctx(ctx)
+        net.set_nms(nms_thresh=0.45, nms_topk=400, pre_nms_topk=FLAGS.pre_nms_topk)
+        if not FLAGS.nd_only:
+            net.hybridize(static_alloc=True, static_shape=True)
     boxes = dict()
-    if FLAGS.mult_out:
+    if FLAGS.mult_out and schedule is None:
         boxes = [dict(), dict(), dict(), dict(), dict()]
+    counts = dict()  # the number of windows each frame is predicted in, when scheduled
     if max_do < 0:
         max_do = len(dataset)
     c = 0
@@ -232,7 +359,25 @@ def detect(net, dataset, loader, ctx, max_do=-1):
 
             for id, score, box, sidx in zip(*[as_numpy(x) for x in [det_ids, det_scores, det_bboxes, sidxs]]):
 
-                if FLAGS.mult_out:
+                if schedule is not None:
+                    files = schedule.window_paths(int(sidx))
+
+                    for offset in np.where(schedule.keep[int(sidx)])[0]:  # only the outputs this window is used for
+                        file = files[offset]
+                        counts[file] = counts.get(file, 0) + 1
+
+                        valid_pred = np.where(id[offset].flat >= 0)[0]  # get the boxes that have a class assigned
+                        box_o = box[offset, valid_pred, :] / batch[0].shape[-1]  # normalise boxes
+                        id_o = id[offset].flat[valid_pred].astype(int)
+                        score_o = score[offset].flat[valid_pred]
+
+                        for id_, box_, score_ in zip(id_o, box_o, score_o):
+                            if file in boxes:
+                                boxes[file].append([id_, score_] + list(box_))
+                            else:
+                                boxes[file] = [[id_, score_] + list(box_)]
+
+                elif FLAGS.mult_out:
                     files = dataset.window_paths(int(sidx))
 
                     for offset, file in enumerate(files):
@@ -269,14 +414,322 @@ def detect(net, dataset, loader, ctx, max_do=-1):
             if c > max_do:
                 break
 
+    if schedule is not None:
+        boxes = merge_window_predictions(boxes, counts, nms_thresh=0.45)
+
     return boxes
 
 
-def save_predictions(save_dir, dataset, boxes, overwrite=True, max_do=-1, agnostic=False):
+def decode_detections(ids, scores, bboxes):
+    """
+    Convert the detections of a single frame into the prediction format
+
+    Args:
+        ids: the class ids (1, N, 1) from the model
+        scores: the scores (1, N, 1) from the model
+        bboxes: the boxes (1, N, 4) from the model, in pixels of the model input
+
+    Returns:
+        list: the predictions [[cls, score, xmin, ymin, xmax, ymax], ...] with normalised boxes
+    """
+    id, score, box = [as_numpy(x)[0] for x in [ids, scores, bboxes]]
+    valid_pred = np.where(id.flat >= 0)[0]  # get the boxes that have a class assigned
+    box = box[valid_pred, :].clip(0, FLAGS.data_shape) / FLAGS.data_shape  # normalise boxes
+    id = id.flat[valid_pred].astype(int)
+    score = score.flat[valid_pred]
+    return [[id_, score_] + list(box_) for id_, box_, score_ in zip(id, box, score)]
+
+
+def detect_keyframes(net, dataset, ctx, selector, propagator, max_do=-1):
+    """
+    Detect on the keyframes of every clip and propagate the boxes to the frames in between
+
+    Args:
+        net: the single frame detection model
+        dataset: the video dataset, must have clip_frame_paths()
+        ctx: the contexts, only the first is used as frames are processed in order
+        selector (KeyframeSelector): picks the keyframes
+        propagator (BoxPropagator): carries the boxes between frames
+        max_do (int): the maximum number of clips to process, -1 is all (default is -1)
+
+    Returns:
+        dict: the predictions per image path [[cls, score, xmin, ymin, xmax, ymax], ...]
+        dict: the number of frames and keyframes processed, and the seconds spent processing them (excluding loading)
+    """
+    ctx = ctx[0]
+    net.collect_params().reset_ctx(ctx)
+    net.set_nms(nms_thresh=0.45, nms_topk=400, pre_nms_topk=FLAGS.pre_nms_topk)
+    if not FLAGS.nd_only:
+        net.hybridize(static_alloc=True, static_shape=True)
+    from models.definitions.yolo.transforms import YOLO3VideoInferenceTransform
+    transform = YOLO3VideoInferenceTransform(FLAGS.data_shape, FLAGS.data_shape)
+
+    clips = dataset.clip_frame_paths()
+    if max_do >= 0:
+        clips = clips[:max_do]
+
+    boxes = dict()
+    stats = {'frames': 0, 'keyframes': 0, 'seconds': 0.0}
+    for clip in tqdm(clips, desc="Detecting on keyframes"):
+        selector.reset()
+        propagator.reset()
+        prev, prev_frame = None, None
+        for img_path in clip:
+            frame = cv2.cvtColor(cv2.imread(img_path), cv2.COLOR_BGR2RGB)
+
+            tic = time.time()
+            keyframe = selector(frame, prev)
+            if keyframe:
+                img, _ = transform(mx.nd.array(frame, dtype='uint8'), np.zeros((1, 6)))
+                boxes[img_path] = decode_detections(*net(img.expand_dims(0).as_in_context(ctx)))
+                stats['keyframes'] += 1
+            else:
+                boxes[img_path] = propagator(prev_frame, frame, prev)
+            stats['seconds'] += time.time() - tic
+            stats['frames'] += 1
+
+            selector.update(frame, boxes[img_path], keyframe)
+            prev, prev_frame = boxes[img_path], frame
+
+    return boxes, stats
+
+
+def detect_streaming(net, dataset, ctx, engine, max_do=-1):
+    """
+    Detect on every frame of every clip, streaming the frames through a model with unidirectional RNNs or temporal
+    convolutions
+
+    Args:
+        net: the YOLOV3T model with rnn_pos set, built with rnn_bi=False, or the 3D or r21d backbone model
+        dataset: the video dataset, must have clip_frame_paths()
+        ctx: the contexts, only the first is used as frames are processed in order
+        engine (StreamingYOLO or StreamingYOLO3D): the streaming inference engine
+        max_do (int): the maximum number of clips to process, -1 is all (default is -1)
+
+    Returns:
+        dict: the predictions per image path [[cls, score, xmin, ymin, xmax, ymax], ...]
+        dict: the number of frames processed and the seconds spent detecting on them (excluding loading)
+    """
+    net.collect_params().reset_ctx(ctx[0])
+    net.set_nms(nms_thresh=0.45, nms_topk=400, pre_nms_topk=FLAGS.pre_nms_topk)
+
+    clips = dataset.clip_frame_paths()
+    if max_do >= 0:
+        clips = clips[:max_do]
+
+    boxes = dict()
+    engine.reset_stats()
+    for clip in tqdm(clips, desc="Detecting streamed"):
+        engine.reset()
+        for img_path in clip:
+            frame = cv2.cvtColor(cv2.imread(img_path), cv2.COLOR_BGR2RGB)
+            for t, dets in engine.step(frame):
+                boxes[clip[t]] = decode_detections(*dets)
+        for t, dets in engine.flush():
+            boxes[clip[t]] = decode_detections(*dets)
+
+    return boxes, dict(engine.stats)
+
+
+def stream_results(net, dataset, ctx, save_dir, class_map=None):
+    """
+    Stream the clips through the model, see detect_streaming, and save the predictions, the metrics and the
+    frames/sec, to compare with the windowed model's results
+
+    Args:
+        net: the YOLOV3T model with rnn_pos set, built with rnn_bi=False, or the 3D or r21d backbone model
+        dataset: the video dataset to detect and evaluate on
+        ctx: the contexts
+        save_dir (str): the directory to save the results in
+        class_map (list): maps the dataset classes to the model classes (default is None)
+    """
+    from models.definitions.yolo.streaming import StreamingYOLO, StreamingYOLO3D
+
+    if FLAGS.rnn_pos is not None:
+        engine = StreamingYOLO(net, ctx=ctx[0], data_shape=FLAGS.data_shape, window=FLAGS.window)
+    else:
+        engine = StreamingYOLO3D(net, ctx=ctx[0], data_shape=FLAGS.data_shape, window=FLAGS.window)
+    predictions, stats = detect_streaming(net, dataset, ctx, engine, max_do=FLAGS.max_do)
+    fps = stats['frames'] / max(stats['seconds'], 1e-9)
+    logging.info("Streamed {} frames at {:.2f} frames/sec".format(stats['frames'], fps))
+
+    stream_dir = os.path.join(save_dir, 'stream')
+    save_predictions(stream_dir, dataset, predictions, agnostic=FLAGS.model_agnostic)
+
+    metric_names = FLAGS.metrics if 'vid' in FLAGS.metrics else FLAGS.metrics + ['vid']
+    metrics = [get_metric(dataset, metric_name, FLAGS.data_shape, stream_dir, class_map=class_map)
+               for metric_name in metric_names]
+    results = evaluate(metrics, dataset, predictions)
+
+    for metric_name, (names, values) in zip(metric_names, results):
+        with open(os.path.join(stream_dir, metric_name + '.txt'), 'w') as f:
+            for k, v in zip(names, values):
+                f.write('{} {}\n'.format(k, v))
+    with open(os.path.join(stream_dir, 'stream.txt'), 'w') as f:
+        f.write('frames {} fps {:.2f}\n'.format(stats['frames'], fps))
+        f.write(results[metric_names.index('vid')][1][0] + '\n')
+    print('streamed fps {:.2f}'.format(fps))
+    print(results[metric_names.index('vid')][1][0])
+
+
+def detect_feature_flow(net, dataset, ctx, selector, engine, max_do=-1):
+    """
+    Detect on every frame of every clip, running the backbone on the keyframes and warping its features to the
+    frames in between with flow
+
+    Args:
+        net: the YOLOV3 or YOLOV3T detection model
+        dataset: the video dataset, must have clip_frame_paths()
+        ctx: the contexts, only the first is used as frames are processed in order
+        selector (KeyframeSelector): picks the keyframes
+        engine (FeatureFlowYOLO): the feature flow inference engine
+        max_do (int): the maximum number of clips to process, -1 is all (default is -1)
+
+    Returns:
+        dict: the predictions per image path [[cls, score, xmin, ymin, xmax, ymax], ...]
+        dict: the number of frames and keyframes processed, and the seconds spent on the backbone, the warping and the
+              heads (excluding loading)
+    """
+    net.collect_params().reset_ctx(ctx[0])
+    net.set_nms(nms_thresh=0.45, nms_topk=400, pre_nms_topk=FLAGS.pre_nms_topk)
+
+    clips = dataset.clip_frame_paths()
+    if max_do >= 0:
+        clips = clips[:max_do]
+
+    boxes = dict()
+    engine.reset_stats()
+    for clip in tqdm(clips, desc="Detecting with feature flow"):
+        selector.reset()
+        engine.reset()
+        prev = None
+        for img_path in clip:
+            frame = cv2.cvtColor(cv2.imread(img_path), cv2.COLOR_BGR2RGB)
+            keyframe = selector(frame, prev)
+            detections = engine.step(frame, keyframe)
+            for t, dets in detections:
+                boxes[clip[t]] = decode_detections(*dets)
+            if detections:
+                prev = boxes[clip[detections[-1][0]]]  # the latest detections, which lag with temporal models
+            selector.update(frame, prev or [], keyframe)
+
+        for t, dets in engine.flush():
+            boxes[clip[t]] = decode_detections(*dets)
+
+    stats = dict(engine.stats)
+    stats['seconds'] = stats['key_seconds'] + stats['warp_seconds'] + stats['head_seconds']
+    return boxes, stats
+
+
+def keyframe_curve(net, dataset, ctx, save_dir, intervals, class_map=None):
+    """
+    Run keyframe detection with propagation for a number of keyframe intervals, saving the predictions and metrics of
+    each and a curve file of the accuracy (with the VID motion ranges) vs the frames/sec
+
+    Args:
+        net: the single frame detection model
+        dataset: the video dataset to detect and evaluate on
+        ctx: the contexts
+        save_dir (str): the directory to save the results in
+        intervals (list): the keyframe intervals to run
+        class_map (list): maps the dataset classes to the model classes (default is None)
+    """
+    if FLAGS.propagator == 'features':
+        from models.definitions.flownet.flownet import get_flownet
+        from models.definitions.yolo.feature_flow import FeatureFlowYOLO
+
+        engine = FeatureFlowYOLO(net, get_flownet('S', pretrained=True, ctx=ctx[0]), ctx=ctx[0],
+                                 data_shape=FLAGS.data_shape, window=FLAGS.window)
+    else:
+        propagator = get_propagator(FLAGS.propagator, ctx=ctx[0], decay=FLAGS.propagate_decay)
+    name = 'keyframe_{}_{}'.format(FLAGS.keyframe_mode, FLAGS.propagator)
+
+    curve = list()
+    for interval in intervals:
+        selector = KeyframeSelector(interval=interval, mode=FLAGS.keyframe_mode,
+                                    diff_thresh=FLAGS.keyframe_diff_thresh, conf_thresh=FLAGS.keyframe_conf_thresh)
+        if FLAGS.propagator == 'features':
+            predictions, stats = detect_feature_flow(net, dataset, ctx, selector, engine, max_do=FLAGS.max_do)
+        else:
+            predictions, stats = detect_keyframes(net, dataset, ctx, selector, propagator, max_do=FLAGS.max_do)
+        fps = stats['frames'] / max(stats['seconds'], 1e-9)
+        key_ratio = stats['keyframes'] / max(stats['frames'], 1)
+        logging.info("Keyframe interval {}: {:.2f} frames/sec with {:.1f}% keyframes".format(interval, fps,
+                                                                                          100 * key_ratio))
+        latency = ''
+        if FLAGS.propagator == 'features':  # per frame latency of each part in ms
+            latency = ' latency_key {:.2f} latency_warp {:.2f} latency_head {:.2f}'.format(
+                1000 * stats['key_seconds'] / max(stats['keyframes'], 1),
+                1000 * stats['warp_seconds'] / max(stats['frames'] - stats['keyframes'], 1),
+                1000 * stats['head_seconds'] / max(stats['frames'], 1))
+
+        interval_dir = os.path.join(save_dir, '{}_{}'.format(name, interval))
+        save_predictions(interval_dir, dataset, predictions, agnostic=FLAGS.model_agnostic)
+
+        metric_names = FLAGS.metrics if 'vid' in FLAGS.metrics else FLAGS.metrics + ['vid']
+        metrics = [get_metric(dataset, metric_name, FLAGS.data_shape, interval_dir, class_map=class_map)
+                   for metric_name in metric_names]
+        results = evaluate(metrics, dataset, predictions)
+
+        for metric_name, (names, values) in zip(metric_names, results):
+            with open(os.path.join(interval_dir, metric_name + '.txt'), 'w') as f:
+                for k, v in zip(names, values):
+                    f.write('{} {}\n'.format(k, v))
+        curve.append((interval, fps, key_ratio, latency, results[metric_names.index('vid')][1][0]))
+
+    # the vid summary holds the mAP for each motion range, showing where propagation breaks down on fast motion
+    with open(os.path.join(save_dir, name + '_curve.txt'), 'w') as f:
+        for interval, fps, key_ratio, latency, summary in curve:
+            print('interval {} fps {:.2f} keyframes {:.4f}{}'.format(interval, fps, key_ratio, latency))
+            print(summary)
+            f.write('interval {} fps {:.2f} keyframes {:.4f}{}\n'.format(interval, fps, key_ratio, latency))
+            f.write(summary + '\n')
+
+
+def merge_window_predictions(predictions, counts, nms_thresh=0.45):
+    """
+    Merge the predictions of frames that were predicted by more than one overlapping window with class-wise nms
+
+    Args:
+        predictions (dict): the predictions per image path [[cls, score, xmin, ymin, xmax, ymax], ...]
+        counts (dict): the number of windows that predicted each image path
+        nms_thresh (float): the IoU above which lower scoring boxes of the same class are removed (default is 0.45)
+
+    Returns:
+        dict: the merged predictions
+    """
+    for img_path, boxes in predictions.items():
+        if counts.get(img_path, 1) < 2:
+            continue
+
+        boxes = sorted(boxes, key=lambda x: x[1], reverse=True)
+        coords = np.array([box[2:] for box in boxes])
+        clss = np.array([box[0] for box in boxes])
+        suppressed = np.zeros(len(boxes), dtype=bool)
+        for i in range(len(boxes)):
+            if suppressed[i]:
+                continue
+            # normalised coords so no +1 on the widths and heights
+            iw = np.minimum(coords[i, 2], coords[i+1:, 2]) - np.maximum(coords[i, 0], coords[i+1:, 0])
+            ih = np.minimum(coords[i, 3], coords[i+1:, 3]) - np.maximum(coords[i, 1], coords[i+1:, 1])
+            inter = np.maximum(iw, 0) * np.maximum(ih, 0)
+            union = (coords[i, 2] - coords[i, 0]) * (coords[i, 3] - coords[i, 1]) + \
+                    (coords[i+1:, 2] - coords[i+1:, 0]) * (coords[i+1:, 3] - coords[i+1:, 1]) - inter
+            ov = inter / np.maximum(union, np.finfo(np.float64).eps)
+            suppressed[i+1:] |= (ov > nms_thresh) & (clss[i+1:] == clss[i])
+
+        predictions[img_path] = [box for box, sup in zip(boxes, suppressed) if not sup]
+
+    return predictions
+
+
+def save_predictions(save_dir, dataset, boxes, overwrite=True, max_do=-1, agnostic=False, scheduled=False):
     if agnostic:
         save_dir = os.path.join(save_dir, 'pred_ag')
     else:
         save_dir = os.path.join(save_dir, 'pred')
+    if scheduled:  # one prediction per frame, so save per frame rather than per offset
+        save_dir += '_sched'
 
     if not overwrite and os.path.exists(save_dir):
         logging.info("Ground truth and prediction files already exist")
@@ -288,7 +741,7 @@ def save_predictions(save_dir, dataset, boxes, overwrite=True, max_do=-1, agnost
 
     for idx in tqdm(range(min(len(dataset), max_do)), desc="Saving out prediction .txts"):
 
-        if FLAGS.mult_out:
+        if FLAGS.mult_out and not scheduled:
             img_paths = dataset.window_paths(idx)
 
             for offset, img_path in enumerate(img_paths):
@@ -306,6 +759,8 @@ def save_predictions(save_dir, dataset, boxes, overwrite=True, max_do=-1, agnost
         else:
 
             img_path = dataset.sample_path(idx)
+            if scheduled:  # the sample frame is the centre of its window
+                img_path = img_path[int(len(img_path)/2)]
 
             if dataset.name == 'comb':
                 dataset_idx, dataset_sample_idx = dataset._samples[dataset.sample_ids[idx]]
@@ -330,11 +785,13 @@ def save_predictions(save_dir, dataset, boxes, overwrite=True, max_do=-1, agnost
                         f.write("{},{},{},{},{},{},{}\n".format(img_path, box[0], box[1], box[2], box[3], box[4], box[5]))
 
 
-def load_predictions(save_dir, dataset, max_do=-1, metric=None, agnostic=False):
+def load_predictions(save_dir, dataset, max_do=-1, metric=None, agnostic=False, scheduled=False):
     if agnostic:
         save_dir = os.path.join(save_dir, 'pred_ag')
     else:
         save_dir = os.path.join(save_dir, 'pred')
+    if scheduled:
+        save_dir += '_sched'
 
     if metric is None:
         if not os.path.exists(save_dir):
@@ -345,7 +802,7 @@ def load_predictions(save_dir, dataset, max_do=-1, metric=None, agnostic=False):
             logging.error("Predictions directory does not exist {}".format(os.path.join(save_dir, 'metric')))
             return None
 
-    if FLAGS.mult_out:
+    if FLAGS.mult_out and not scheduled:
         boxes = [dict(), dict(), dict(), dict(), dict()]
         for idx in tqdm(range(min(len(dataset), max_do)), desc="Loading in prediction .txts"):
 
@@ -393,6 +850,8 @@ def load_predictions(save_dir, dataset, max_do=-1, metric=None, agnostic=False):
 
         for idx in tqdm(range(min(len(dataset), max_do)), desc="Loading in prediction .txts"):
             img_path = dataset.sample_path(idx)
+            if scheduled:
+                img_path = img_path[int(len(img_path)/2)]
 
             if dataset.name == 'comb':
                 dataset_idx, dataset_sample_idx = dataset._samples[dataset.sample_ids[idx]]
@@ -657,12 +1116,13 @@ def video_of_worst(video_path, frames_dir, summary_file=None, fps=4):
 
 
 def evaluate(metrics, dataset, predictions):
+    sample_ids = dataset.get_sample_ids()  # built as a list on each call, so only once
     for idx in tqdm(range(len(dataset)), desc="Updating metrics with predictions"):
 
         img_path = dataset.sample_path(idx)
-        sid = dataset.get_sample_ids()[idx]
+        sid = sample_ids[idx]
         if FLAGS.mult_out:
-            sid = dataset.get_sample_ids()[idx][FLAGS.offset+2]
+            sid = sample_ids[idx][FLAGS.offset+2]
             img_path = img_path[FLAGS.offset + 2]
 
         if img_path in predictions:
@@ -800,11 +1260,23 @@ def main(_argv):
     if FLAGS.motion_stream == 'flownet':
         FLAGS.data_shape = 384  # cause 416 is a nasty shape
 
+    artefact_spec = None
+    if FLAGS.artefact:  # the artefact knows what input it takes
+        artefact_spec = load_spec(FLAGS.artefact)
+        FLAGS.data_shape = artefact_spec['data_shape']
+        FLAGS.window = [artefact_spec['window'], FLAGS.window[1]]
+        FLAGS.mult_out = artefact_spec['mult_out']
+
     FLAGS.dataset = FLAGS.dataset[0]
 
     if FLAGS.window[0] > 1:
         assert FLAGS.dataset == 'vid', 'If using window size >1 you can only use the vid dataset'
 
+    scheduled = FLAGS.mult_out and FLAGS.schedule_windows
+    if scheduled and FLAGS.offset != 0:
+        logging.warning("schedule_windows gives a prediction for every frame, so the offset is set to 0")
+        FLAGS.offset = 0
+
     # if we aren't given a full path, assume the file is in 'models/save_prefix' directory
     if len(os.path.split(FLAGS.model_path)[0]) > 0:
         model_path = FLAGS.model_path
@@ -812,7 +1284,7 @@ def main(_argv):
         model_path = os.path.join('models', FLAGS.save_prefix, FLAGS.model_path)
 
     # check model exists
-    if not os.path.exists(model_path):
+    if not FLAGS.artefact and not os.path.exists(model_path):
         logging.error("Model doesn't appear where it's expected: {}".format(model_path))
 
     # get dataset
@@ -824,6 +1296,16 @@ def main(_argv):
     else:
         trained_on_dataset = dataset
 
+    if FLAGS.export_artefact:
+        config = {name: FLAGS[name].value for name in [
+            'network', 'model_path', 'window', 'k_join_type', 'k_join_pos', 'block_conv_type', 'rnn_pos', 'corr_pos',
+            'corr_d', 'motion_stream', 'stream_gating', 'conv_types', 'h_join_type', 'hier', 'mult_out', 'temp',
+            'new_model', 'model_agnostic', 'fuse_bn', 'rnn_bi']}
+        export_artefact(get_net(trained_on_dataset.classes, model_path), FLAGS.export_artefact,
+                        trained_on_dataset.classes, FLAGS.data_shape, window=FLAGS.window[0], mult_out=FLAGS.mult_out,
+                        pre_nms_topk=FLAGS.pre_nms_topk, config=config, onnx=FLAGS.backend == 'onnxruntime')
+        return
+
     # fix for tiny datasets of 1 or few elements
     batch_size = FLAGS.batch_size
     if len(dataset) < batch_size:
@@ -836,7 +1318,7 @@ def main(_argv):
 
     # contexts
     ctx = [mx.gpu(int(i)) for i in gpus]
-    ctx = ctx if ctx else [mx.cpu()]
+    ctx = ctx if ctx and FLAGS.backend == 'mxnet' else [mx.cpu()]  # onnxruntime runs on the cpu
 
     max_do = FLAGS.max_do
     if max_do < 0:
@@ -850,6 +1332,29 @@ def main(_argv):
         save_dir = os.path.join('models', 'experiments', FLAGS.save_prefix, FLAGS.save_dir)
     os.makedirs(save_dir, exist_ok=True)
 
+    if FLAGS.keyframe_intervals:  # detect on keyframes only and propagate, for each interval
+        assert FLAGS.dataset == 'vid', 'Keyframe detection needs the clips of the vid dataset'
+        assert not FLAGS.artefact, 'Keyframe detection needs the model built from the flags, not an artefact'
+        assert FLAGS.backend == 'mxnet', 'Keyframe detection runs the model in parts, so only with mxnet'
+        assert not FLAGS.mult_out, 'Keyframe detection needs a single output model'
+        assert FLAGS.window[0] == 1 or FLAGS.propagator == 'features', \
+            'Only feature propagation supports temporal models'
+        class_map = get_class_map(trained_on_dataset, dataset) if FLAGS.trained_on else None
+        keyframe_curve(get_net(trained_on_dataset.classes, model_path), dataset, ctx, save_dir,
+                       [int(i) for i in FLAGS.keyframe_intervals], class_map=class_map)
+        return
+
+    if FLAGS.stream:  # stream the clips through a model with unidirectional rnns or temporal convs, each frame once
+        assert FLAGS.dataset == 'vid', 'Streaming needs the clips of the vid dataset'
+        assert FLAGS.backend == 'mxnet' and not FLAGS.artefact, \
+            'Streaming keeps state between frames, so needs the model built from the flags with mxnet'
+        assert (FLAGS.rnn_pos is not None and not FLAGS.rnn_bi) or FLAGS.conv_types[0] != 2 or \
+            FLAGS.motion_stream == 'r21d', \
+            'Streaming needs an rnn_pos model built with --nornn_bi, a 3D darknet or an r21d motion stream'
+        class_map = get_class_map(trained_on_dataset, dataset) if FLAGS.trained_on else None
+        stream_results(get_net(trained_on_dataset.classes, model_path), dataset, ctx, save_dir, class_map=class_map)
+        return
+
     # attempt to load predictions
 
     per_sample_metric = None
@@ -859,40 +1364,50 @@ def main(_argv):
         per_sample_metric = get_metric(dataset, 'voc', FLAGS.data_shape, save_dir,
                                        class_map=get_class_map(trained_on_dataset, dataset))
     predictions = load_predictions(save_dir, dataset, max_do=max_do, metric=per_sample_metric,
-                                   agnostic=FLAGS.model_agnostic)
+                                   agnostic=FLAGS.model_agnostic, scheduled=scheduled)
 
     if predictions is None:  # id not exist detect and make
         # dataloader
-        loader = get_dataloader(dataset, batch_size)
+        schedule = None
+        if scheduled:
+            schedule = ImageNetVidWindowSchedule(dataset, stride=FLAGS.window_stride or None)
+            logging.info("Scheduled {} windows for {} frames".format(len(schedule), len(dataset)))
+        loader_dataset = schedule if schedule is not None else dataset
+
+        preprocess = dict()
+        if artefact_spec is not None:
+            preprocess = {'mean': artefact_spec['mean'], 'std': artefact_spec['std']}
+
+        if FLAGS.autotune_loader:  # time the loader on its own over the real data, or use the cached settings
+            key = tuning_key(mode='detect', dataset=FLAGS.dataset, window=FLAGS.window, data_shape=FLAGS.data_shape,
+                             batch_size=batch_size, scheduled=scheduled)
+            tuned = autotune_loader(partial(get_dataloader, loader_dataset, batch_size, **preprocess), key,
+                                    FLAGS.autotune_cache, multiprocessing.cpu_count(), FLAGS.autotune_batches)
+            FLAGS.num_workers, FLAGS.prefetch, FLAGS.thread_pool = \
+                tuned['num_workers'], tuned['prefetch'], tuned['thread_pool']
+
+        loader = get_dataloader(loader_dataset, batch_size, **preprocess)
 
         # setup network
-        # net_name = '_'.join(('yolo3', FLAGS.network, 'custom'))
-        # net = get_model(net_name, root='models', pretrained_base=True, classes=trained_on_dataset.classes)
-        if FLAGS.network == 'darknet53':
-            if FLAGS.conv_types[0] is 2:
-                net = yolo3_darknet53(trained_on_dataset.classes,
-                                      k=FLAGS.window[0], k_join_type=FLAGS.k_join_type, k_join_pos=FLAGS.k_join_pos,
-                                      block_conv_type=FLAGS.block_conv_type, rnn_pos=FLAGS.rnn_pos,
-                                      corr_pos=FLAGS.corr_pos, corr_d=FLAGS.corr_d, motion_stream=FLAGS.motion_stream,
-                                      agnostic=FLAGS.model_agnostic, add_type=FLAGS.stream_gating,
-                                      new_model=FLAGS.new_model,
-                                      hierarchical=FLAGS.hier, h_join_type=FLAGS.h_join_type, temporal=FLAGS.temp,
-                                      t_out=FLAGS.mult_out)
-            else:
-                net = yolo3_3ddarknet(trained_on_dataset.classes, conv_types=FLAGS.conv_types)
-        else:
-            raise NotImplementedError('Backbone CNN model {} not implemented.'.format(FLAGS.network))
-        net.initialize()
-        if FLAGS.window[0] > 1:
-            net.summary(mx.nd.random_normal(shape=(1, FLAGS.window[0], 3, FLAGS.data_shape, FLAGS.data_shape)))
+        if FLAGS.backend == 'onnxruntime' and FLAGS.artefact:
+            net = OnnxDetector(os.path.join(FLAGS.artefact, ONNX_FILE), nms=artefact_spec['nms'],
+                               num_threads=FLAGS.onnx_threads)
+        elif FLAGS.backend == 'onnxruntime':  # exported for the batch size, it's padded up to that
+            shape = (batch_size,) + input_shape(FLAGS.data_shape, FLAGS.window[0])
+            net = OnnxDetector(export_onnx(get_net(trained_on_dataset.classes, model_path), [shape]),
+                               num_threads=FLAGS.onnx_threads)
+        elif FLAGS.artefact:
+            net = CompiledDetector(FLAGS.artefact, ctx=ctx, batch_size=batch_size)
         else:
-            net.summary(mx.nd.random_normal(shape=(1, 3, FLAGS.data_shape, FLAGS.data_shape)))
-        net.load_parameters(model_path)
+            net = get_net(trained_on_dataset.classes, model_path)
 
-        predictions = detect(net, dataset, loader, ctx, max_do=max_do)  # todo fix det thresh
-        save_predictions(save_dir, dataset, predictions, agnostic=FLAGS.model_agnostic)
+        if schedule is not None:
+            predictions = detect(net, schedule, loader, ctx, max_do=max_do, schedule=schedule)
+        else:
+            predictions = detect(net, dataset, loader, ctx, max_do=max_do)  # todo fix det thresh
+        save_predictions(save_dir, dataset, predictions, agnostic=FLAGS.model_agnostic, scheduled=scheduled)
 
-    if FLAGS.mult_out:
+    if FLAGS.mult_out and not scheduled:
         predictions = predictions[FLAGS.offset+2]
 
     if isinstance(FLAGS.dataset, list) and len(FLAGS.dataset) > 1:
@@ -0,0 +1,79 @@
+"""
+Launch data parallel training over several local processes with a distributed kvstore, eg. 4 CPU processes:
+
+python launch_dist.py -n 4 -- python train_yolov3.py --dataset vid --kvstore dist_sync --gpus ''
+
+Starts the kvstore scheduler and servers, then the workers running the command with the DMLC environment variables
+set. For several machines use the same command with MXNet's tools/launch.py (eg. --launcher ssh -H hosts), which sets
+the same environment on each machine.
+"""
+from __future__ import print_function
+
+from absl import app, flags, logging
+from absl.flags import FLAGS
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+
+flags.DEFINE_integer('num_workers', 2,
+                     'The number of training processes.', short_name='n')
+flags.DEFINE_integer('num_servers', 1,
+                     'The number of kvstore server processes.', short_name='s')
+flags.DEFINE_list('gpus', [],
+                  'GPU IDs to spread the training processes over, each process is given one with --gpus. '
+                  'Empty leaves the command as it is.')
+flags.DEFINE_integer('port', 0,
+                     'The scheduler port, 0 picks a free one.')
+
+
+def free_port():
+    """Get a free local port"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def main(argv):
+    command = argv[1:]
+    if not command:
+        logging.error('Give the training command after --, eg. launch_dist.py -n 4 -- python train_yolov3.py ...')
+        return 1
+
+    env = dict(os.environ)
+    env.update({'DMLC_PS_ROOT_URI': '127.0.0.1',
+                'DMLC_PS_ROOT_PORT': str(FLAGS.port or free_port()),
+                'DMLC_NUM_WORKER': str(FLAGS.num_workers),
+                'DMLC_NUM_SERVER': str(FLAGS.num_servers)})
+
+    # the scheduler and servers run in mxnet's import when DMLC_ROLE is set, until the workers finish
+    services = [subprocess.Popen([sys.executable, '-c', 'import mxnet'], env=dict(env, DMLC_ROLE=role))
+                for role in ['scheduler'] + ['server'] * FLAGS.num_servers]
+
+    workers = list()
+    for w in range(FLAGS.num_workers):
+        worker_env = dict(env, DMLC_ROLE='worker')
+        if 'OMP_NUM_THREADS' not in os.environ:  # share the cores rather than each process using all of them
+            worker_env['OMP_NUM_THREADS'] = str(max(1, multiprocessing.cpu_count() // FLAGS.num_workers))
+        worker_command = list(command)
+        if FLAGS.gpus:
+            worker_command += ['--gpus', FLAGS.gpus[w % len(FLAGS.gpus)]]
+        workers.append(subprocess.Popen(worker_command, env=worker_env))
+
+    try:
+        codes = [worker.wait() for worker in workers]
+        for service in services:
+            service.wait(timeout=60)
+    except (KeyboardInterrupt, subprocess.TimeoutExpired):
+        codes = [1]
+    finally:
+        for process in workers + services:
+            if process.poll() is None:
+                process.terminate()
+
+    return max(codes)
+
+
+if __name__ == '__main__':
+    app.run(main)
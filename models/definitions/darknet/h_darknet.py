@@ -8,7 +8,7 @@ from mxnet import gluon
 from mxnet.gluon import nn
 from mxnet.gluon.nn import BatchNorm
 
-from models.definitions.layers import _conv1d, _conv2d, TimeDistributed
+from models.definitions.layers import _conv1d, _conv2d, time_distributed
 
 __all__ = ['HDarknet']
 
@@ -106,7 +106,7 @@ class HDarknet(gluon.HybridBlock):
             x = self.features(x)
             return x
 
-        x = TimeDistributed(self.features[0])(x)  # b,t,c,w,h
+        x = time_distributed(F, self.features[0], x)  # b,t,c,w,h
 
         x = F.swapaxes(x, 1, 2)  # b,c,t,w,h
         x = F.expand_dims(x, axis=2)  # b,c,1,t,w,h
@@ -116,7 +116,7 @@ class HDarknet(gluon.HybridBlock):
         if self.type == 'max':
             x = F.max(x, axis=-3)
         else:
-            x = F.squeeze(TimeDistributed(self.convs1d[0])(x), axis=3)
+            x = F.squeeze(time_distributed(F, self.convs1d[0], x), axis=3)
 
         if self.windows[1] == 1:
             x = F.squeeze(x, axis=1)
@@ -126,7 +126,7 @@ class HDarknet(gluon.HybridBlock):
                 c = self.features[24:](b)
             return a, b, c
 
-        x = TimeDistributed(self.features[1:3])(x)  # b,t,c,w,h
+        x = time_distributed(F, self.features[1:3], x)  # b,t,c,w,h
         x = F.swapaxes(x, 1, 2)  # b,c,t,w,h
         x = F.expand_dims(x, axis=2)  # b,c,1,t,w,h
         x = F.reshape(x, shape=(0, 0, -1, 3, 0, 0))  # correctly ordered # b,c,t',win=3,w,h
@@ -135,7 +135,7 @@ class HDarknet(gluon.HybridBlock):
         if self.type == 'max':
             x = F.max(x, axis=-3)
         else:
-            x = F.squeeze(TimeDistributed(self.convs1d[1])(x), axis=3)
+            x = F.squeeze(time_distributed(F, self.convs1d[1], x), axis=3)
 
         if self.windows[2] == 1:
             x = F.squeeze(x, axis=1)
@@ -145,7 +145,7 @@ class HDarknet(gluon.HybridBlock):
                 c = self.features[24:](b)
             return a, b, c
 
-        x = TimeDistributed(self.features[3:6])(x)
+        x = time_distributed(F, self.features[3:6], x)
         x = F.swapaxes(x, 1, 2)  # b,c,t,w,h
         x = F.expand_dims(x, axis=2)  # b,c,1,t,w,h
         x = F.reshape(x, shape=(0, 0, -1, 3, 0, 0))  # correctly ordered # b,c,t',win=3,w,h
@@ -154,7 +154,7 @@ class HDarknet(gluon.HybridBlock):
         if self.type == 'max':
             x = F.max(x, axis=-3)
         else:
-            x = F.squeeze(TimeDistributed(self.convs1d[2])(x), axis=3)
+            x = F.squeeze(time_distributed(F, self.convs1d[2], x), axis=3)
 
         if self.windows[3] == 1:
             x = F.squeeze(x, axis=1)
@@ -164,7 +164,7 @@ class HDarknet(gluon.HybridBlock):
                 c = self.features[24:](b)
             return a, b, c
 
-        x = TimeDistributed(self.features[6:15])(x)
+        x = time_distributed(F, self.features[6:15], x)
         x = F.swapaxes(x, 1, 2)  # b,c,t,w,h
         x = F.expand_dims(x, axis=2)  # b,c,1,t,w,h
         x = F.reshape(x, shape=(0, 0, -1, 3, 0, 0))  # correctly ordered # b,c,t',win=3,w,h
@@ -173,7 +173,7 @@ class HDarknet(gluon.HybridBlock):
         if self.type == 'max':
             x = F.max(x, axis=-3)
         else:
-            x = F.squeeze(TimeDistributed(self.convs1d[3])(x), axis=3)
+            x = F.squeeze(time_distributed(F, self.convs1d[3], x), axis=3)
 
         if self.windows[4] == 1:
             x = F.squeeze(x, axis=1)
@@ -202,26 +202,29 @@ class Darknet3D(gluon.HybridBlock):
             if not self.return_features:
                 self.output = nn.Dense(classes)
 
+    def feature_ends(self):
+        """
+        Get where the features returned with return_features end in self.features, which depends on where the
+        temporal pool is
+
+        Returns:
+            tuple: the number of blocks in the first feature, and in the first two
+        """
+        if self.conv_swap == -1 or self.conv_swap > 5:  # 2D net, or temporal pool after feats
+            return 15, 24
+        if self.conv_swap <= 4:  # temporal pool in first set of feats
+            return 16, 25
+        return 15, 25  # temporal pool in second set of feats
+
     def hybrid_forward(self, F, x):
         if self.return_features:
-            if self.conv_swap == -1:  # 2D net
-                a = self.features[:15](x)
-                b = self.features[15:24](a)
-                c = self.features[24:](b)
-            elif self.conv_swap <= 4:  # temporal pool in first set of feats
-                a = self.features[:16](x)
-                b = self.features[16:25](a)
-                c = self.features[25:](b)
-            elif self.conv_swap == 5:  # temporal pool in second set of feats
-                a = self.features[:15](x)
-                b = self.features[15:25](a)
-                c = self.features[25:](b)
-                a = F.max(a, axis=-3)  # temporal pool the first feature which still has temporal dim
-            else:  # temporal pool after feats
-                a = self.features[:15](x)
-                b = self.features[15:24](a)
-                c = self.features[24:](b)
+            a_end, b_end = self.feature_ends()
+            a = self.features[:a_end](x)
+            b = self.features[a_end:b_end](a)
+            c = self.features[b_end:](b)
+            if self.conv_swap >= 5:
                 a = F.max(a, axis=-3)  # temporal pool the first feature which still has temporal dim
+            if self.conv_swap > 5:
                 b = F.max(b, axis=-3)  # temporal pool the second feature which still has temporal dim
             return a, b, c
 
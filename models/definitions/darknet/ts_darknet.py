@@ -6,10 +6,28 @@ import mxnet as mx
 from mxnet import gluon
 from mxnet.gluon.nn import BatchNorm
 from models.definitions.darknet.darknet import get_darknet
+from models.definitions.layers import is_frozen, run_frozen
 from models.definitions.flownet.flownet import get_flownet
 from models.definitions.rdnet.r21d import get_r21d
 
 
+def _stream_runner(F, stream):
+    """
+    Get a function applying a stream's blocks, without keeping their activations if the stream is frozen. Only for
+    the blocks of a stream before any input from the other stream, see run_frozen
+
+    Args:
+        F: mxnet.nd or mxnet.sym
+        stream: the stream model
+
+    Returns:
+        a function taking a block of the stream and its inputs, returning its output
+    """
+    if is_frozen(stream):
+        return lambda block, *args: run_frozen(F, block, *args)
+    return lambda block, *args: block(*args)
+
+
 class DarknetFlownet(gluon.HybridBlock):
     def __init__(self, darknet, flownet, t=3, add_type=None, **kwargs):
         """
@@ -32,6 +50,8 @@ class DarknetFlownet(gluon.HybridBlock):
 
     def hybrid_forward(self, F, x):
         input_arr = F.split(x, num_outputs=self.t)
+        flow = _stream_runner(F, self.flownet)
+        dark = _stream_runner(F, self.darknet)
 
         darknet_input = input_arr[int(self.t / 2)]  # b,1,c,w,h
         darknet_input = F.squeeze(darknet_input, axis=1)  # b,c,w,h
@@ -44,13 +64,13 @@ class DarknetFlownet(gluon.HybridBlock):
         if self.add_type in ['add', 'mul']:
             flownet_input = F.reshape(flownet_input, shape=(0, -3, -2))
 
-            out_conv1 = self.flownet.conv1(flownet_input)
-            out_conv2 = self.flownet.conv2(out_conv1)
-            out_conv3 = self.flownet.conv3(out_conv2)
-            out_conv4 = self.flownet.conv4(out_conv3)
+            out_conv1 = flow(self.flownet.conv1, flownet_input)
+            out_conv2 = flow(self.flownet.conv2, out_conv1)
+            out_conv3 = flow(self.flownet.conv3, out_conv2)
+            out_conv4 = flow(self.flownet.conv4, out_conv3)
 
             # Connection 1/4
-            d = self.darknet.features[:2](darknet_input)
+            d = dark(self.darknet.features[:2], darknet_input)
             if self.add_type == 'add':
                 db = self.darknet.features[2].body(d + F.relu(out_conv1))
             elif self.add_type == 'mul':
@@ -95,29 +115,29 @@ class DarknetFlownet(gluon.HybridBlock):
             ret_dc = self.darknet.features[24:](ret_db)
 
             # do the rest of the flownet
-            out_conv5 = self.flownet.conv5(out_conv4)
-            out_conv6 = self.flownet.conv6(out_conv5)
+            out_conv5 = flow(self.flownet.conv5, out_conv4)
+            out_conv6 = flow(self.flownet.conv6, out_conv5)
 
-            flow6 = self.flownet.predict_flow6(out_conv6)
-            flow6_up = self.flownet.upsampled_flow6_to_5(flow6)
-            out_deconv5 = self.flownet.relu11(self.flownet.deconv5(out_conv6))
+            flow6 = flow(self.flownet.predict_flow6, out_conv6)
+            flow6_up = flow(self.flownet.upsampled_flow6_to_5, flow6)
+            out_deconv5 = flow(self.flownet.relu11, flow(self.flownet.deconv5, out_conv6))
 
             concat5 = F.concat(out_conv5, out_deconv5, flow6_up)
-            flow5 = self.flownet.predict_flow5(concat5)
-            flow5_up = self.flownet.upsampled_flow5_to_4(flow5)
-            out_deconv4 = self.flownet.relu12(self.flownet.deconv4(concat5))
+            flow5 = flow(self.flownet.predict_flow5, concat5)
+            flow5_up = flow(self.flownet.upsampled_flow5_to_4, flow5)
+            out_deconv4 = flow(self.flownet.relu12, flow(self.flownet.deconv4, concat5))
 
             concat4 = F.concat(out_conv4, out_deconv4, flow5_up)
-            flow4 = self.flownet.predict_flow4(concat4)
-            flow4_up = self.flownet.upsampled_flow4_to_3(flow4)
-            out_deconv3 = self.flownet.relu13(self.flownet.deconv3(concat4))
+            flow4 = flow(self.flownet.predict_flow4, concat4)
+            flow4_up = flow(self.flownet.upsampled_flow4_to_3, flow4)
+            out_deconv3 = flow(self.flownet.relu13, flow(self.flownet.deconv3, concat4))
 
             concat3 = F.concat(out_conv3, out_deconv3, flow4_up)
         else:
-            concat3, concat4, concat5 = self.flownet(flownet_input)
-            ret_da = self.darknet.features[:15](darknet_input)
-            ret_db = self.darknet.features[15:24](ret_da)
-            ret_dc = self.darknet.features[24:](ret_db)
+            concat3, concat4, concat5 = flow(self.flownet, flownet_input)
+            ret_da = dark(self.darknet.features[:15], darknet_input)
+            ret_db = dark(self.darknet.features[15:24], ret_da)
+            ret_dc = dark(self.darknet.features[24:], ret_db)
 
         return F.concat(ret_da, concat3),  F.concat(ret_db, concat4),  F.concat(ret_dc, concat5)
 
@@ -143,6 +163,7 @@ class DarknetR21D(gluon.HybridBlock):
 
     def hybrid_forward(self, F, x):
         input_arr = F.split(x, num_outputs=self.t)
+        rnet = _stream_runner(F, self.r21d)
 
         darknet_input = input_arr[int(self.t / 2)]  # b,1,c,w,h
         darknet_input = F.squeeze(darknet_input, axis=1)  # b,c,w,h
@@ -152,21 +173,43 @@ class DarknetR21D(gluon.HybridBlock):
         #     # if i != int(self.t / 2):
         #     r21d_input = F.concat(r21d_input, input_arr[i], dim=1)
 
-        r21d_input = x
+        r21d_input = F.swapaxes(x, 1, 2)  # b,t,c,w,h -> b,c,t,w,h
         if self.add_type in ['add', 'mul']:
-            r21d_input = F.swapaxes(r21d_input, 1, 2)  # b,t,c,w,h -> b,c,t,w,h
+            r3 = rnet(self.r21d.features[:4], r21d_input)
+            r7 = rnet(self.r21d.features[4:5], r3)
+        else:  # only the communication uses the first stage
+            r3, r7 = None, rnet(self.r21d.features[:5], r21d_input)
+        r13 = rnet(self.r21d.features[5:6], r7)
+        r16 = rnet(self.r21d.features[6:], r13)
+
+        # temporal - works for any number of timesteps
+        return self.join_streams(F, darknet_input, *[None if r is None else F.max(r, axis=2)
+                                                      for r in [r3, r7, r13, r16]])
+
+    def join_streams(self, F, x, r3, r7, r13, r16):
+        """
+        Run the darknet on the middle frame, communicating with the R(2+1)D features pooled over time, and join them
 
-            r3 = self.r21d.features[:4](r21d_input)
-            r7 = self.r21d.features[4:5](r3)
-            r13 = self.r21d.features[5:6](r7)
-            r16 = self.r21d.features[6:](r13)
+        Args:
+            F: mxnet.nd or mxnet.sym
+            x: the middle frame b,c,w,h
+            r3: the output of the first R(2+1)D stage max pooled over time b,c,w,h, only used with add_type
+            r7: the output of the second stage max pooled over time
+            r13: the output of the third stage max pooled over time
+            r16: the output of the fourth stage max pooled over time
+
+        Returns:
+            the three features
+        """
+        dark = _stream_runner(F, self.darknet)
 
+        if self.add_type in ['add', 'mul']:
             # Connection 1/4
-            d = self.darknet.features[:2](darknet_input)
+            d = dark(self.darknet.features[:2], x)
             if self.add_type == 'add':
-                db = self.darknet.features[2].body(d + F.relu(F.max(r3, axis=2)))
+                db = self.darknet.features[2].body(d + F.relu(r3))
             elif self.add_type == 'mul':
-                db = self.darknet.features[2].body(d * F.relu(F.max(r3, axis=2)))
+                db = self.darknet.features[2].body(d * F.relu(r3))
             else:
                 db = self.darknet.features[2].body(d)  # getting body doesn't do the residual add
             d = d + db  # do our own residual
@@ -174,9 +217,9 @@ class DarknetR21D(gluon.HybridBlock):
             # Connection 2/4
             d = self.darknet.features[3](d)  # do the rest of the darknet, here just the one conv 128
             if self.add_type == 'add':
-                db = self.darknet.features[4].body(d + F.relu(F.max(r7, axis=2)))
+                db = self.darknet.features[4].body(d + F.relu(r7))
             elif self.add_type == 'mul':
-                db = self.darknet.features[4].body(d * F.relu(F.max(r7, axis=2)))
+                db = self.darknet.features[4].body(d * F.relu(r7))
             else:
                 db = self.darknet.features[4].body(d)  # getting body doesn't do the residual add
             d = d + db  # do our own residual
@@ -184,9 +227,9 @@ class DarknetR21D(gluon.HybridBlock):
             # Connection 3/4
             d = self.darknet.features[5:7](d)  # do the rest of the darknet, here another block
             if self.add_type == 'add':
-                db = self.darknet.features[7].body(d + F.relu(F.max(r13, axis=2)))
+                db = self.darknet.features[7].body(d + F.relu(r13))
             elif self.add_type == 'mul':
-                db = self.darknet.features[7].body(d * F.relu(F.max(r13, axis=2)))
+                db = self.darknet.features[7].body(d * F.relu(r13))
             else:
                 db = self.darknet.features[7].body(d)  # getting body doesn't do the residual add
             d = d + db  # do our own residual
@@ -196,27 +239,23 @@ class DarknetR21D(gluon.HybridBlock):
             ret_da = d  # get first output
             d = self.darknet.features[15](d)
             if self.add_type == 'add':
-                db = self.darknet.features[16].body(d + F.relu(F.max(r16, axis=2)))
+                db = self.darknet.features[16].body(d + F.relu(r16))
             elif self.add_type == 'mul':
-                db = self.darknet.features[16].body(d * F.relu(F.max(r16, axis=2)))
+                db = self.darknet.features[16].body(d * F.relu(r16))
             else:
                 db = self.darknet.features[16].body(d)  # getting body doesn't do the residual add
             d = d + db  # do our own residual
 
             ret_db = self.darknet.features[17:24](d)
             ret_dc = self.darknet.features[24:](ret_db)
-
-            r7 = F.Pooling(r7, kernel=(1, 2, 2), stride=(1, 2, 2), pad=(0, 0, 0), global_pool=False, pool_type='max')  # spatial
-            r7 = F.max(r7, axis=2)  # temporal - works for any number of timesteps
-            r13 = F.Pooling(r13, kernel=(1, 2, 2), stride=(1, 2, 2), pad=(0, 0, 0), global_pool=False,  pool_type='max')  # spatial
-            r13 = F.max(r13, axis=2)  # temporal - works for any number of timesteps
-            r16 = F.Pooling(r16, kernel=(1, 2, 2), stride=(1, 2, 2), pad=(0, 0, 0), global_pool=False, pool_type='max')  # spatial
-            r16 = F.max(r16, axis=2)  # temporal - works for any number of timesteps
         else:
-            r7, r13, r16 = self.r21d(r21d_input)
-            ret_da = self.darknet.features[:15](darknet_input)
-            ret_db = self.darknet.features[15:24](ret_da)
-            ret_dc = self.darknet.features[24:](ret_db)
+            ret_da = dark(self.darknet.features[:15], x)
+            ret_db = dark(self.darknet.features[15:24], ret_da)
+            ret_dc = dark(self.darknet.features[24:], ret_db)
+
+        r7 = F.Pooling(r7, kernel=(2, 2), stride=(2, 2), pad=(0, 0), global_pool=False, pool_type='max')  # spatial
+        r13 = F.Pooling(r13, kernel=(2, 2), stride=(2, 2), pad=(0, 0), global_pool=False, pool_type='max')  # spatial
+        r16 = F.Pooling(r16, kernel=(2, 2), stride=(2, 2), pad=(0, 0), global_pool=False, pool_type='max')  # spatial
 
         return F.concat(ret_da, r7), F.concat(ret_db, r13),  F.concat(ret_dc, r16)
 
@@ -0,0 +1,147 @@
+"""
+Inference graph passes: folds each BatchNorm into the convolution feeding it, so at inference every conv-bn-act cell is
+a single conv with a bias and the per channel affine transform no longer reads and writes every feature map again
+"""
+import logging
+
+import mxnet as mx
+import numpy as np
+from mxnet import gluon
+from mxnet.gluon import nn
+from mxnet.gluon.nn.conv_layers import _Conv
+
+__all__ = ['fuse_for_inference', 'check_equivalence']
+
+
+class _Identity(gluon.HybridBlock):
+    """Takes the place of a folded BatchNorm, so the indices of the other blocks in its HybridSequential don't move"""
+    def hybrid_forward(self, F, x):
+        return x
+
+
+def _producing_conv(block):
+    """
+    Get the conv whose output is the output of the block, descending through the last blocks of (Hybrid)Sequentials,
+    so the BatchNorms following the nested _conv3d and _conv21d cells are found
+
+    Args:
+        block: a block of a (Hybrid)Sequential
+
+    Returns:
+        the conv, or None if the block doesn't end with a conv that a BatchNorm can be folded into
+    """
+    while isinstance(block, (nn.HybridSequential, nn.Sequential)) and len(block) > 0:
+        block = block[len(block) - 1]
+    if not isinstance(block, _Conv) or block._op_name != 'Convolution':  # the deconvs' weights are (in, out, ...)
+        return None
+    if block.act is not None or not block._kwargs['layout'].startswith('NC'):
+        return None
+    return block
+
+
+def _fold(conv, bn):
+    """
+    Fold the BatchNorm's running statistics into the conv's weight and bias, adding the bias if the conv has none
+
+    The weight is scaled along its first axis, the output channels, which is the same for grouped and 3D convs.
+
+    Args:
+        conv: the conv
+        bn: the BatchNorm directly following it
+    """
+    weight = conv.weight.data()
+    gamma = bn.gamma.data().asnumpy().astype(np.float64)
+    if bn._kwargs['fix_gamma']:
+        gamma = np.ones_like(gamma)
+    beta = bn.beta.data().asnumpy().astype(np.float64)
+    mean = bn.running_mean.data().asnumpy().astype(np.float64)
+    var = bn.running_var.data().asnumpy().astype(np.float64)
+    scale = gamma / np.sqrt(var + bn._kwargs['eps'])
+
+    if conv.bias is None:
+        conv.bias = conv.params.get('bias', shape=(weight.shape[0],), dtype=weight.dtype, init='zeros',
+                                    grad_req=conv.weight.grad_req)
+        conv.bias.initialize(ctx=conv.weight.list_ctx())
+        conv._kwargs['no_bias'] = False
+    bias = conv.bias.data().asnumpy().astype(np.float64)
+
+    w = weight.asnumpy().astype(np.float64) * scale.reshape((-1,) + (1,) * (weight.ndim - 1))
+    conv.weight.set_data(mx.nd.array(w, dtype=weight.dtype))
+    conv.bias.set_data(mx.nd.array((bias - mean) * scale + beta, dtype=weight.dtype))
+
+
+def _fuse_children(block):
+    fused = 0
+    if isinstance(block, (nn.HybridSequential, nn.Sequential)):
+        keys = list(block._children.keys())
+        for prev, key in zip(keys[:-1], keys[1:]):
+            bn = block._children[key]
+            if not isinstance(bn, nn.BatchNorm) or bn._kwargs['axis'] != 1:
+                continue
+            conv = _producing_conv(block._children[prev])
+            if conv is None:
+                continue
+            _fold(conv, bn)
+            block._children[key] = _Identity(prefix=bn.prefix)
+            fused += 1
+    for child in block._children.values():
+        fused += _fuse_children(child)
+    return fused
+
+
+def _flatten(outputs):
+    if isinstance(outputs, (list, tuple)):
+        return [o for output in outputs for o in _flatten(output)]
+    return [outputs.asnumpy()] if isinstance(outputs, mx.nd.NDArray) else []
+
+
+def check_equivalence(reference, outputs, rtol=1e-3, atol=1e-4):
+    """
+    Check a network's outputs match the reference outputs
+
+    Args:
+        reference: the reference outputs, an NDArray or a (nested) list or tuple of them
+        outputs: the outputs, in the same structure
+        rtol (float): the relative tolerance (default is 1e-3)
+        atol (float): the absolute tolerance (default is 1e-4)
+
+    Raises:
+        ValueError: if the outputs differ from the reference by more than the tolerance
+    """
+    reference, outputs = _flatten(reference), _flatten(outputs)
+    if len(reference) != len(outputs):
+        raise ValueError('Expected {} outputs, got {}'.format(len(reference), len(outputs)))
+    for i, (r, o) in enumerate(zip(reference, outputs)):
+        if r.shape != o.shape or not np.allclose(o, r, rtol=rtol, atol=atol):
+            error = np.abs(o - r).max() if r.shape == o.shape else 'shape {} vs {}'.format(o.shape, r.shape)
+            raise ValueError('Output {} differs from the reference by {}'.format(i, error))
+
+
+def fuse_for_inference(net, x=None, rtol=1e-3, atol=1e-4):
+    """
+    Fold every BatchNorm that directly follows a convolution into it, in place, and remove the BatchNorm
+
+    Works on any of the models in wrappers.py: the conv-bn pairs are found in the (Hybrid)Sequentials of the _conv1d,
+    _conv2d, _conv3d and _conv21d cells, the darknets, R21DV1 and MobileNet. The BatchNorms then use their running
+    statistics, so the net is for inference only, and its parameters only load into a net fused the same way.
+
+    Args:
+        net: the network, with its parameters initialized or loaded
+        x: an input to check the fused network's outputs on, None to not check (default is None). Disable the NMS
+           (set_nms(nms_thresh=-1)) first, as near tied scores can reorder the detections
+        rtol (float): the relative tolerance of the check (default is 1e-3)
+        atol (float): the absolute tolerance of the check (default is 1e-4)
+
+    Returns:
+        int: the number of BatchNorms folded
+
+    Raises:
+        ValueError: if the fused network's outputs differ from the original by more than the tolerance
+    """
+    reference = net(x) if x is not None else None
+    fused = _fuse_children(net)
+    net.apply(lambda block: block._clear_cached_op() if isinstance(block, gluon.HybridBlock) else None)
+    logging.info('Folded {} BatchNorms into their convolutions'.format(fused))
+    if x is not None:
+        check_equivalence(reference, net(x), rtol=rtol, atol=atol)
+    return fused
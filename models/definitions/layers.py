@@ -2,6 +2,8 @@
 File containing the custom layers
 """
 
+import mxnet as mx
+from mxnet import autograd
 from mxnet import gluon
 from mxnet.gluon import nn
 from mxnet.gluon.nn import BatchNorm
@@ -46,6 +48,102 @@ def _temp_pad(F, x, padding=1, zeros=True):
     return x
 
 
+class _Recompute(autograd.Function):
+    """Runs a block without recording it, then records and backpropagates through it again in the backward pass"""
+    def __init__(self, block):
+        super(_Recompute, self).__init__()
+        self._block = block
+        self._x = None
+
+    def forward(self, x):
+        self._x = x
+        with autograd.train_mode():  # Function runs forward paused, which would otherwise use the BN running stats
+            return self._block(x)
+
+    def backward(self, dy):
+        x = self._x.detach()
+        x.attach_grad()
+        with autograd.record():
+            y = self._block(x)
+        autograd.backward(y, head_grads=dy)  # also writes (or adds to) the block's parameter gradients
+        self._x = None
+        return x.grad
+
+
+def recompute(block, x):
+    """
+    Apply a block without keeping its activations for the backward pass, they are recomputed from its input when
+    needed, trading an extra forward of the block for its activation memory (the stages of long temporal windows).
+    Only works imperatively, but the block itself can be hybridized. The BatchNorm running stats are updated by both
+    forwards.
+
+    Args:
+        block: the block
+        x (mxnet.nd.NDArray): the input
+
+    Returns:
+        mxnet.nd.NDArray: the block's output
+    """
+    return _Recompute(block)(x)
+
+
+def is_frozen(block):
+    """
+    Are all of a block's parameters frozen (grad_req 'null')? A block without parameters isn't frozen
+
+    Args:
+        block: the block
+
+    Returns:
+        bool: True if frozen
+    """
+    params = block.collect_params().values()
+    return len(params) > 0 and all(param.grad_req == 'null' for param in params)
+
+
+def frozen_prefix(blocks):
+    """
+    Get the number of frozen blocks at the start of a sequence of blocks, which the backward pass doesn't reach
+
+    Args:
+        blocks: the blocks in the order they're applied eg. the stages of a model
+
+    Returns:
+        int: the number of leading frozen blocks
+    """
+    count = 0
+    for block in blocks:
+        if not is_frozen(block):
+            break
+        count += 1
+    return count
+
+
+def run_frozen(F, block, *args):
+    """
+    Apply a frozen block at the start of a model so none of its activations are kept for the backward pass, which
+    never reaches it. Imperatively the block runs under autograd.pause (in the same train mode, so BatchNorm behaves
+    the same), symbolically its outputs get a BlockGrad so the backward graph stops there. Its inputs mustn't need
+    gradients, so only use it on a prefix of a model.
+
+    Args:
+        F: mxnet.nd or mxnet.sym
+        block: the frozen block
+        *args: the block's inputs
+
+    Returns:
+        the block's output, or a list of its outputs if it has several
+    """
+    with autograd.pause(train_mode=autograd.is_training()):
+        out = block(*args)
+        multiple = not isinstance(out, (mx.nd.NDArray, mx.sym.Symbol))
+        outs = list(out) if multiple else [out]
+
+    if F is not mx.nd:
+        outs = [F.BlockGrad(o) for o in outs]
+    return outs if multiple else outs[0]
+
+
 # HybridSequentials
 def _conv1d(out_channels, kernel, padding, strides, norm_layer=BatchNorm, norm_kwargs=None):
     """1D over t*c for joining temps"""
@@ -205,6 +303,58 @@ class TemporalPooling(gluon.HybridBlock):
                 return F.squeeze(F.mean(x, axis=1, keepdims=True), axis=1)
 
 
+def time_distributed(F, block, x, style='reshape1'):
+    """
+    Apply a block to every timestep of x, as TimeDistributed(block, style) does, for use in hybrid_forward on blocks
+    that are also applied without the time axis, rather than constructing a new TimeDistributed on every call
+
+    Args:
+        F: mxnet.nd or mxnet.sym
+        block: the block to apply to each timestep
+        x: the input of shape (batch, timesteps, ...)
+        style (str): either 'reshape1', 'reshape2' or 'for' for the implementation to use (default is reshape1)
+                     NOTE!!: reshape2 can't be hybridized, and the for style needs the block's outputs to all have
+                     the timesteps
+
+    Returns:
+        the block's output of shape (batch, timesteps, ...), or a tuple (or list) of its outputs if it has several
+    """
+    if style == 'for':
+        # For loop style
+        x = F.swapaxes(x, 0, 1)  # swap batch and seqlen channels
+        x, _ = F.contrib.foreach(lambda xt, _: (block(xt), []), x, [])  # runs on first channel, which is now seqlen
+        if isinstance(x, tuple):  # for handling multiple outputs
+            x = tuple(F.swapaxes(xi, 0, 1) for xi in x)
+        elif isinstance(x, list):
+            x = [F.swapaxes(xi, 0, 1) for xi in x]
+        else:
+            x = F.swapaxes(x, 0, 1)  # swap seqlen and batch channels
+    elif style == 'reshape1':
+        shp = x  # can use this to keep shapes for reshape back to (batch, timesteps, ...)
+        x = F.reshape(x, (-3, -2))  # combines batch and timesteps dims
+        x = block(x)
+        if isinstance(x, tuple):  # for handling multiple outputs
+            x = tuple(F.reshape_like(xi, shp, lhs_end=1, rhs_end=2) for xi in x)
+        elif isinstance(x, list):
+            x = [F.reshape_like(xi, shp, lhs_end=1, rhs_end=2) for xi in x]
+        else:
+            x = F.reshape_like(x, shp, lhs_end=1, rhs_end=2)  # (num_samples, timesteps, ...)
+    else:
+        # Reshape style, doesn't work with symbols cause no shape
+        batch_size = x.shape[0]
+        input_length = x.shape[1]
+        x = F.reshape(x, (-3, -2))  # combines batch and timesteps dims
+        x = block(x)
+        if isinstance(x, tuple):  # for handling multiple outputs
+            x = tuple(F.reshape(xi, (batch_size, input_length,) + xi.shape[1:]) for xi in x)
+        elif isinstance(x, list):
+            x = [F.reshape(xi, (batch_size, input_length,) + xi.shape[1:]) for xi in x]
+        else:
+            x = F.reshape(x, (batch_size, input_length,) + x.shape[1:])  # (num_samples, timesteps, ...)
+
+    return x
+
+
 class TimeDistributed(gluon.HybridBlock):
     def __init__(self, model, style='reshape1', **kwargs):
         """
@@ -217,57 +367,27 @@ class TimeDistributed(gluon.HybridBlock):
         super(TimeDistributed, self).__init__(**kwargs)
         assert style in ['reshape1', 'reshape2', 'for']
 
-        # if style != 'reshape1':
-        #     print("WARNING: net can't be hybridized if {} is used for the TimeDistributed layer style".format(style))
-
         self._style = style
         with self.name_scope():
             self.model = model
 
-    def apply_model(self, x, _):
-        return self.model(x), []
-
     def hybrid_forward(self, F, x):
-        if self._style == 'for':
-            # For loop style
-            x = F.swapaxes(x, 0, 1)  # swap batch and seqlen channels
-            x, _ = F.contrib.foreach(self.apply_model, x, [])  # runs on first channel, which is now seqlen
-            if isinstance(x, tuple):  # for handling multiple outputs
-                x = (F.swapaxes(xi, 0, 1) for xi in x)
-            elif isinstance(x, list):
-                x = [F.swapaxes(xi, 0, 1) for xi in x]
-            else:
-                x = F.swapaxes(x, 0, 1)  # swap seqlen and batch channels
-        elif self._style == 'reshape1':
-            shp = x  # can use this to keep shapes for reshape back to (batch, timesteps, ...)
-            x = F.reshape(x, (-3, -2))  # combines batch and timesteps dims
-            x = self.model(x)
-            if isinstance(x, tuple):  # for handling multiple outputs
-                x = (F.reshape_like(xi, shp, lhs_end=1, rhs_end=2) for xi in x)
-            elif isinstance(x, list):
-                x = [F.reshape_like(xi, shp, lhs_end=1, rhs_end=2) for xi in x]
-            else:
-                x = F.reshape_like(x, shp, lhs_end=1, rhs_end=2)  # (num_samples, timesteps, ...)
-        else:
-            # Reshape style, doesn't work with symbols cause no shape
-            batch_size = x.shape[0]
-            input_length = x.shape[1]
-            x = F.reshape(x, (-3, -2))  # combines batch and timesteps dims
-            x = self.model(x)
-            if isinstance(x, tuple):  # for handling multiple outputs
-                x = (F.reshape(xi, (batch_size, input_length,) + xi.shape[1:]) for xi in x)
-            elif isinstance(x, list):
-                x = [F.reshape(xi, (batch_size, input_length,) + xi.shape[1:]) for xi in x]
-            else:
-                x = F.reshape(x, (batch_size, input_length,) + x.shape[1:])  # (num_samples, timesteps, ...)
-
-        return x
+        return time_distributed(F, self.model, x, style=self._style)
 
 
 class RNN(gluon.HybridBlock):
     def __init__(self, k, input_shape, type='gru', channels=None, kernel=(3,3), bi=True, **kwargs):
         """
-        An RNN Layer
+        An RNN Layer, unrolled over the k timesteps of each window, or stepped one frame at a time when streaming
+
+        Args:
+            k (int): the number of timesteps in a window
+            input_shape (tuple): the (C, H, W) shape of each timestep
+            type (str): the cell, either 'gru' or 'lstm' (default is 'gru')
+            channels (int): the number of hidden channels
+            kernel (tuple): the kernel size of the convolutions (default is (3, 3))
+            bi (bool): bidirectional, averaging the two directions' outputs (default is True). Only a unidirectional
+                       RNN can stream, see stream
         """
         super(RNN, self).__init__(**kwargs)
 
@@ -275,6 +395,8 @@ class RNN(gluon.HybridBlock):
 
         self._k = k
         self._bi = bi
+        self._streaming = False
+        self.reset()
 
         with self.name_scope():
             pad = (0,0)
@@ -298,7 +420,57 @@ class RNN(gluon.HybridBlock):
             else:
                 self.rnn = a
 
+    def stream(self, streaming=True):
+        """
+        Switch to streaming, or back to unrolling over windows. When streaming each call takes only the new timesteps
+        (B, t, C, H, W), usually one, and steps the cell over them from the state left by the last call, then returns
+        the outputs of the last k timesteps as the unrolled RNN would for a window, so the layers after it are
+        unchanged. Each timestep is then computed once rather than in each of the k windows it's in. The state is kept
+        between calls, so reset it between clips, and the layer can't be hybridized while streaming.
+
+        Args:
+            streaming (bool): stream (default is True)
+        """
+        if streaming and self._bi:
+            raise ValueError('Only a unidirectional RNN can stream, as the backward direction needs the future frames')
+        self._streaming = streaming
+        self.reset()
+
+    def reset(self):
+        """Reset the streaming state, at the start of a clip"""
+        self._stream_states = None
+        self._stream_outputs = list()  # the outputs of the last k timesteps
+
+    def step(self, x, states=None):
+        """
+        Run the (unidirectional) cell for one timestep
+
+        Args:
+            x (mxnet.nd.NDArray): the timestep (B, C, H, W)
+            states (list): the cell states returned by the last step, None to begin from zeros (default is None)
+
+        Returns:
+            mxnet.nd.NDArray: the output (B, channels, H, W)
+            list: the cell states to pass to the next step
+        """
+        if self._bi:
+            raise ValueError('Only a unidirectional RNN can be stepped')
+        if states is None:
+            states = self.rnn.begin_state(batch_size=x.shape[0], ctx=x.context)
+        return self.rnn(x, states)
+
     def hybrid_forward(self, F, x):
+        if self._streaming:
+            if F is not mx.nd:
+                raise RuntimeError('A streaming RNN keeps its state between calls, so it can\'t be hybridized')
+            for t in range(x.shape[1]):
+                xt = F.squeeze(F.slice_axis(x, axis=1, begin=t, end=t + 1), axis=1)
+                out, self._stream_states = self.step(xt, self._stream_states)
+                self._stream_outputs = (self._stream_outputs + [out])[-self._k:]
+            # until k timesteps are seen the first output stands in for the earlier ones
+            outputs = [self._stream_outputs[0]] * (self._k - len(self._stream_outputs)) + self._stream_outputs
+            return F.stack(*outputs, axis=1)
+
         x, h = self.rnn.unroll(self._k, x, merge_outputs=True)
         if self._bi:
             x = F.split(x, 2, axis=2)  # avg the two bi dir channels
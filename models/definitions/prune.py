@@ -0,0 +1,261 @@
+"""
+Structured channel pruning for the framewise darknet53 YOLOV3: ranks the output channels of the conv-bn-act cells that
+only feed other convolutions, by the magnitude of their BatchNorm's gamma, and removes the lowest ranked from the cell
+and from the convolutions reading them, so the pruned net is a smaller dense net rather than a masked one.
+
+The prunable cells are the 1x1 reduce of each darknet residual block, the five body cells and the tip of each YOLO
+detection block, and the transitions before the upsampling. The residual stream, the first conv, the downsamples and
+the 3x3 expands of the residual blocks, is left whole as every block of a stage adds to it, so the residual connections
+stay consistent, and so are the stage outputs the detection blocks read.
+"""
+import json
+import logging
+from collections import OrderedDict, namedtuple
+
+import mxnet as mx
+import numpy as np
+from mxnet import gluon
+from mxnet.gluon import nn
+
+from models.definitions.darknet import darknet, three_darknet
+from models.definitions.yolo.yolo3 import YOLODetectionBlockV3
+
+__all__ = ['prune_yolov3', 'apply_channel_spec', 'save_channel_spec', 'load_channel_spec']
+
+# a prunable cell, and the (parent, key) of each conv reading its output as the first of its input channels
+_Group = namedtuple('_Group', ['name', 'cell', 'consumers'])
+
+
+def _is_cell(block):
+    """Is the block a _conv2d conv-bn-act cell"""
+    return isinstance(block, nn.HybridSequential) and len(block) == 3 and \
+        isinstance(block[0], nn.Conv2D) and isinstance(block[1], nn.BatchNorm)
+
+
+def _child(parent, key):
+    return parent._children[key]
+
+
+def _set_child(parent, key, block):
+    """Replace a child, as an attribute if it was registered as one so the parent's forward uses the new block"""
+    if key in parent.__dict__:
+        setattr(parent, key, block)
+    else:
+        parent._children[key] = block
+
+
+def _groups(net):
+    """
+    Get the prunable cells of a YOLOV3 or framewise YOLOV3T, see the module docstring
+
+    Args:
+        net: the network
+
+    Returns:
+        list of _Group: the prunable cells, named by their path in the network
+
+    Raises:
+        ValueError: if the network isn't a framewise darknet53 YOLOV3
+    """
+    supported = all(hasattr(net, attr) for attr in ['stages', 'transitions', 'yolo_blocks', 'yolo_outputs']) and \
+        getattr(net, '_k', None) in [None, 1] and getattr(net, '_rnn_pos', None) is None and \
+        all(isinstance(b, YOLODetectionBlockV3) and b._conv_type == '2' for b in net.yolo_blocks) and \
+        all(isinstance(o.prediction, nn.Conv2D) for o in net.yolo_outputs) and \
+        all(_is_cell(t) for t in net.transitions)
+    if not supported:
+        raise ValueError('Can only prune the framewise (k=1) darknet53 YOLOV3, without RNNs or 3D blocks')
+
+    groups = list()
+    for s, stage in enumerate(net.stages):
+        for j, block in enumerate(stage):
+            if isinstance(block, (darknet.DarknetBasicBlockV3, three_darknet.DarknetBasicBlockV3)) and \
+                    _is_cell(block.body[0]) and _is_cell(block.body[1]):
+                groups.append(_Group('stages.{}.{}.body.0'.format(s, j), block.body[0], [(block.body[1], '0')]))
+
+    num_blocks = len(net.yolo_blocks)
+    for i, block, output in zip(range(num_blocks), net.yolo_blocks, net.yolo_outputs):
+        for j in range(len(block.body) - 1):
+            groups.append(_Group('yolo_blocks.{}.body.{}'.format(i, j), block.body[j], [(block.body[j + 1], '0')]))
+        # the route feeds the tip, and the transition to the next detection block
+        consumers = [(block.tip, '0')]
+        if i < num_blocks - 1:
+            consumers.append((net.transitions[i], '0'))
+        groups.append(_Group('yolo_blocks.{}.body.{}'.format(i, len(block.body) - 1), block.body[len(block.body) - 1],
+                             consumers))
+        groups.append(_Group('yolo_blocks.{}.tip'.format(i), block.tip, [(output, 'prediction')]))
+        if i < num_blocks - 1:
+            # the upsampled transition comes first in the concat with the stage output
+            groups.append(_Group('transitions.{}'.format(i), net.transitions[i],
+                                 [(net.yolo_blocks[i + 1].body[0], '0')]))
+    return groups
+
+
+def _conv_like(conv, channels, in_channels=0):
+    """A Conv2D with the same settings and prefix as conv, with in_channels 0 to infer them"""
+    kwargs = conv._kwargs
+    return nn.Conv2D(channels, kernel_size=kwargs['kernel'], strides=kwargs['stride'], padding=kwargs['pad'],
+                     dilation=kwargs['dilate'], groups=kwargs['num_group'], layout=kwargs['layout'],
+                     activation=conv.act._act_type if conv.act is not None else None,
+                     use_bias=not kwargs['no_bias'], in_channels=in_channels, prefix=conv.prefix)
+
+
+def _bn_like(bn, in_channels=0):
+    """A BatchNorm of the same type, settings and prefix as bn, with in_channels 0 to infer them"""
+    kwargs = dict(momentum=bn._kwargs['momentum'], epsilon=bn._kwargs['eps'], scale=not bn._kwargs['fix_gamma'],
+                  use_global_stats=bn._kwargs['use_global_stats'], in_channels=in_channels, prefix=bn.prefix)
+    if isinstance(bn, gluon.contrib.nn.SyncBatchNorm):
+        kwargs['num_devices'] = bn._kwargs['ndev']
+    else:
+        kwargs['axis'] = bn._kwargs['axis']
+    return type(bn)(**kwargs)
+
+
+def _set_params(old, new, index):
+    """Initialize new's parameters to old's output channels in index, keeping their grad_reqs (eg. frozen)"""
+    new.initialize(ctx=next(iter(old._reg_params.values())).list_ctx())
+    for name, param in new._reg_params.items():
+        data = getattr(old, name).data()
+        param.set_data(mx.nd.array(data.asnumpy()[index], dtype=data.dtype))
+        param.grad_req = getattr(old, name).grad_req
+
+
+def _slice(group, keep):
+    """
+    Keep only the keep output channels of the group's cell, and the matching input channels of its consumers
+
+    Args:
+        group (_Group): the prunable cell
+        keep (numpy.ndarray): the indices of the channels to keep, ascending
+    """
+    conv, bn = group.cell[0], group.cell[1]
+    channels = conv.weight.shape[0]
+
+    pruned = _conv_like(conv, len(keep), conv.weight.shape[1])
+    _set_params(conv, pruned, keep)
+    group.cell._children['0'] = pruned
+    pruned = _bn_like(bn, len(keep))
+    _set_params(bn, pruned, keep)
+    group.cell._children['1'] = pruned
+
+    for parent, key in group.consumers:
+        consumer = _child(parent, key)
+        index = np.concatenate([keep, np.arange(channels, consumer.weight.shape[1])])  # the rest of a concat's inputs
+        pruned = _conv_like(consumer, consumer.weight.shape[0], len(index))
+        pruned.initialize(ctx=consumer.weight.list_ctx())
+        pruned.weight.set_data(mx.nd.array(consumer.weight.data().asnumpy()[:, index],
+                                           dtype=consumer.weight.dtype))
+        pruned.weight.grad_req = consumer.weight.grad_req
+        if consumer.bias is not None:
+            pruned.bias.set_data(consumer.bias.data())
+            pruned.bias.grad_req = consumer.bias.grad_req
+        _set_child(parent, key, pruned)
+
+
+def _scores(cell, criterion):
+    """The importance of each output channel of a cell, the |gamma| of its BatchNorm or the L1 norm of its filter"""
+    if criterion == 'gamma':
+        if cell[1]._kwargs['fix_gamma']:
+            raise ValueError('The BatchNorm gammas are fixed, use the l1 criterion')
+        return np.abs(cell[1].gamma.data().asnumpy())
+    if criterion == 'l1':
+        weight = cell[0].weight.data().asnumpy()
+        return np.abs(weight).reshape((weight.shape[0], -1)).sum(axis=1)
+    raise ValueError('Unknown criterion {}, choose from gamma, l1'.format(criterion))
+
+
+def _num_kept(num_above, channels, min_keep, multiple):
+    """Round the number of channels to keep up to a multiple, keeping at least min_keep of them and at most all"""
+    n = max(num_above, int(np.ceil(min_keep * channels)), 1)
+    n = int(np.ceil(n / float(multiple)) * multiple)
+    return min(n, channels)
+
+
+def prune_yolov3(net, ratio, criterion='gamma', scope='global', min_keep=0.1, multiple=8):
+    """
+    Prune the channels of the prunable cells of a YOLOV3 or framewise YOLOV3T (yolo3_darknet53 with k=1), in place,
+    see the module docstring
+
+    Args:
+        net: the network, with its parameters loaded
+        ratio (float): the fraction of the prunable channels to remove, before rounding
+        criterion (str): rank the channels by the BatchNorm 'gamma' magnitude, or the 'l1' norm of the conv filters
+                         (default is 'gamma')
+        scope (str): rank the channels of all cells together, 'global', which prunes the cells with the least important
+                     channels most, or of each 'layer' separately, removing ratio of each (default is 'global')
+        min_keep (float): the fraction of each cell's channels to keep at least (default is 0.1)
+        multiple (int): round the channels kept in each cell up to a multiple of this, which vectorises better on the
+                        CPU (default is 8)
+
+    Returns:
+        dict: the channel spec, the channels kept in each cell by its path, to rebuild the pruned net with
+              apply_channel_spec before loading its parameters
+
+    Raises:
+        ValueError: if the network can't be pruned
+    """
+    assert 0 <= ratio < 1, 'The ratio must be in [0, 1)'
+    assert scope in ['global', 'layer']
+    groups = _groups(net)
+    scores = [_scores(group.cell, criterion) for group in groups]
+    if scope == 'global':
+        threshold = np.sort(np.concatenate(scores))[int(ratio * sum(len(s) for s in scores))]
+
+    channels = OrderedDict()
+    total, kept = 0, 0
+    for group, score in zip(groups, scores):
+        if scope == 'global':
+            num_above = int((score >= threshold).sum())
+        else:
+            num_above = len(score) - int(ratio * len(score))
+        n = _num_kept(num_above, len(score), min_keep, multiple)
+        if n < len(score):
+            _slice(group, np.sort(np.argsort(-score, kind='stable')[:n]))
+        channels[group.name] = n
+        total += len(score)
+        kept += n
+
+    net.apply(lambda block: block._clear_cached_op() if isinstance(block, gluon.HybridBlock) else None)
+    logging.info('Pruned {} of the {} prunable channels in {} cells'.format(total - kept, total, len(groups)))
+    return {'ratio': ratio, 'criterion': criterion, 'scope': scope, 'channels': channels}
+
+
+def apply_channel_spec(net, spec):
+    """
+    Rebuild the prunable cells of a freshly built network to the channels of a channel spec, so the parameters of the
+    pruned network load into it. The rebuilt cells and their consumers infer their input channels, so are initialized
+    by loading the parameters, or on the first forward pass
+
+    Args:
+        net: the network, built with the same yolo3_darknet53 arguments as the pruned one
+        spec (dict): the channel spec returned by prune_yolov3
+
+    Raises:
+        ValueError: if the network can't be pruned or the spec doesn't match its cells
+    """
+    groups = OrderedDict((group.name, group) for group in _groups(net))
+    if set(groups.keys()) != set(spec['channels'].keys()):
+        raise ValueError('The channel spec is for a different network')
+
+    for name, channels in spec['channels'].items():
+        group = groups[name]
+        if channels == group.cell[0]._channels:
+            continue
+        group.cell._children['0'] = _conv_like(group.cell[0], channels)
+        group.cell._children['1'] = _bn_like(group.cell[1])
+        for parent, key in group.consumers:
+            consumer = _child(parent, key)
+            _set_child(parent, key, _conv_like(consumer, consumer._channels))
+
+    net.apply(lambda block: block._clear_cached_op() if isinstance(block, gluon.HybridBlock) else None)
+
+
+def save_channel_spec(spec, path):
+    """Save a channel spec as JSON"""
+    with open(path, 'w') as f:
+        json.dump(spec, f, indent=2)
+
+
+def load_channel_spec(path):
+    """Load a channel spec saved with save_channel_spec"""
+    with open(path, 'r') as f:
+        return json.load(f, object_pairs_hook=OrderedDict)
@@ -0,0 +1,418 @@
+"""
+Streaming inference for temporal convolutions: runs the 3D and (2+1)D layers of the Darknet3D and R(2+1)D backbones one
+frame at a time, each temporal convolution caching the last (kernel_t - 1) slices of its input, so a new frame computes
+one temporal slice per layer rather than every window recomputing all of its slices
+
+A temporal convolution padded by p outputs the slice centred p slices back, so a stack of them outputs each slice
+delayed by the sum of their paddings. The padding is at the edges of the clip rather than of each window: the cache is
+filled with it at the first frame (zeros, or copies of the first slice for Conv3DRepPad) and flush() pushes it after the
+last, so the streamed slices are those of running the layers on the whole clip at once, see check_temporal_stream.
+
+A temporal stride doesn't skip slices when streaming, as each window has its own grid of strided slices starting at its
+first frame. Every slice is computed and the temporal convolutions after the stride read their inputs that many slices
+apart (dilated), so the slices on a window's grid are those the window computes, up to the padding at its edges.
+
+The backbones pool their outputs over the window, which is done over the streamed slices of each frame's window, so
+like the streaming RNNs the detections approximate the windowed model's, as the layers see past the window's edges.
+"""
+import collections
+
+import mxnet as mx
+from mxnet.gluon import nn
+
+from models.definitions.darknet.three_darknet import Conv3DRepPad, TemporalGlobalMaxPool3D
+from models.definitions.fuse import _Identity, check_equivalence
+
+__all__ = ['TemporalStream', 'Darknet3DStream', 'DarknetR21DStream', 'check_temporal_stream']
+
+# blocks that don't mix the frames, so are applied to each slice on its own
+_FRAMEWISE = (nn.BatchNorm, nn.LeakyReLU, nn.Activation, _Identity)
+
+
+class _Framewise(object):
+    """A block applied to each slice"""
+    def __init__(self, block):
+        self.block = block
+
+    def reset(self):
+        pass
+
+    def push(self, x):
+        return [self.block(x)]
+
+    def flush(self):
+        return []
+
+
+class _CachedConv(object):
+    """A temporal convolution, caching the slices of its input its next output slice reads"""
+    def __init__(self, conv, padding, dilation=1, repeat=False):
+        """
+        Args:
+            conv: the Conv3D, NCDHW
+            padding (int): its temporal padding, on each side
+            dilation (int): the number of slices between the ones it reads (default is 1)
+            repeat (bool): pad with the edge slices rather than zeros, as Conv3DRepPad does (default is False)
+        """
+        kernel = conv._kwargs['kernel'][0]
+        if conv._kwargs['layout'] != 'NCDHW' or conv._kwargs['dilate'][0] != 1:
+            raise ValueError('Can only stream undilated NCDHW temporal convolutions')
+        if kernel != 2 * padding + 1:
+            raise ValueError('Can only stream temporal convolutions keeping the number of slices, kernel {} with '
+                             'padding {}'.format(kernel, padding))
+        if repeat and dilation > 1:
+            raise ValueError('Can only stream a convolution padding with repeats before any temporal stride')
+        self.conv = conv
+        self.dilation = dilation
+        self.repeat = repeat
+        self._pad = padding * dilation
+        self._kwargs = dict(conv._kwargs, stride=(1,) + tuple(conv._kwargs['stride'][1:]),
+                            pad=(0,) + tuple(conv._kwargs['pad'][1:]))
+        self._cache = collections.deque(maxlen=(kernel - 1) * dilation + 1)
+
+    def reset(self):
+        self._cache.clear()
+
+    def _step(self, x):
+        self._cache.append(x)
+        if len(self._cache) < self._cache.maxlen:
+            return []
+        x = mx.nd.concat(*list(self._cache)[::self.dilation], dim=2)
+        weight = self.conv.weight.data(x.context)
+        if self.conv.bias is None:
+            y = mx.nd.Convolution(x, weight, **self._kwargs)
+        else:
+            y = mx.nd.Convolution(x, weight, self.conv.bias.data(x.context), **self._kwargs)
+        return [self.conv.act(y) if self.conv.act is not None else y]
+
+    def push(self, x):
+        if not self._cache:  # the padding before the first slice
+            pad = x if self.repeat else mx.nd.zeros_like(x)
+            for _ in range(self._pad):
+                self._cache.append(pad)
+        return self._step(x)
+
+    def flush(self):
+        if not self._cache:
+            return []
+        # Conv3DRepPad pads the end with the second to last slice
+        pad = self._cache[-2] if self.repeat else mx.nd.zeros_like(self._cache[-1])
+        return [y for _ in range(self._pad) for y in self._step(pad)]
+
+
+class _Sequence(object):
+    """Blocks in order, each flushed after the slices flushed from the ones before it are pushed through it"""
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def reset(self):
+        for node in self.nodes:
+            node.reset()
+
+    def push(self, x):
+        xs = [x]
+        for node in self.nodes:
+            xs = [y for x in xs for y in node.push(x)]
+        return xs
+
+    def flush(self):
+        xs = list()
+        for node in self.nodes:
+            xs = [y for x in xs for y in node.push(x)] + node.flush()
+        return xs
+
+
+class _Residual(object):
+    """A residual block, the shortcut of each slice waiting for the body's output of it"""
+    def __init__(self, body, shortcut=None, act=None):
+        self.body = body
+        self.shortcut = shortcut
+        self.act = act
+        self._queue = collections.deque()
+
+    def reset(self):
+        self.body.reset()
+        self._queue.clear()
+
+    def _add(self, ys):
+        ys = [y + self._queue.popleft() for y in ys]
+        return [self.act(y) for y in ys] if self.act is not None else ys
+
+    def push(self, x):
+        self._queue.append(x if self.shortcut is None else self.shortcut.push(x)[0])
+        return self._add(self.body.push(x))
+
+    def flush(self):
+        return self._add(self.body.flush())
+
+
+def _is_framewise(node):
+    if isinstance(node, _Sequence):
+        return all(_is_framewise(n) for n in node.nodes)
+    return isinstance(node, _Framewise)
+
+
+def _build(block, dilation=1):
+    """
+    Build the streaming version of a block
+
+    Args:
+        block: the block, of the 3D part of a Darknet3D or R21DV1
+        dilation (int): the product of the temporal strides before it (default is 1)
+
+    Returns:
+        the streaming block, with reset(), push(x) and flush()
+        int: the product of the temporal strides up to and including it
+
+    Raises:
+        ValueError: if the block can't be streamed
+    """
+    if isinstance(block, nn.HybridSequential):
+        nodes = list()
+        for child in block._children.values():
+            node, dilation = _build(child, dilation)
+            nodes.append(node)
+        return _Sequence(nodes), dilation
+    if isinstance(block, Conv3DRepPad):
+        if block.t_axis != 2 or block.conv._kwargs['stride'][0] != 1:
+            raise ValueError('Can only stream Conv3DRepPad without a temporal stride')
+        return _CachedConv(block.conv, block.padding, dilation, repeat=True), dilation
+    if isinstance(block, nn.Conv3D):
+        kernel, stride, padding = [block._kwargs[key][0] for key in ['kernel', 'stride', 'pad']]
+        if kernel == 1:
+            return _Framewise(block), dilation * stride
+        return _CachedConv(block, padding, dilation), dilation * stride
+    if hasattr(block, 'body'):  # the residual blocks of Darknet3D and R21DV1
+        body, body_dilation = _build(block.body, dilation)
+        shortcut = None
+        if getattr(block, 'downsample', None) is not None:
+            shortcut, shortcut_dilation = _build(block.downsample, dilation)
+            if shortcut_dilation != body_dilation or not _is_framewise(shortcut):
+                raise ValueError('Can only stream a shortcut with the temporal stride of its block and no temporal '
+                                 'kernel')
+        return _Residual(body, shortcut, getattr(block, 'final_relu', None)), body_dilation
+    if isinstance(block, _FRAMEWISE):
+        return _Framewise(block), dilation
+    raise ValueError("Can't stream a {}".format(type(block).__name__))
+
+
+class TemporalStream(object):
+    """
+    Streams frames through the temporal blocks of a backbone, see the module docstring, taking their outputs at taps
+    and pooling each over the slices of every frame's window
+
+    The frames of a clip are pushed in order, returning the pooled taps of the frames whose windows are streamed, and
+    flush() returns the rest at the end of the clip. A window's slices are clamped to the clip, as the windows are.
+    """
+    def __init__(self, blocks, taps, window):
+        """
+        Args:
+            blocks (list): the temporal blocks, in order
+            taps (list of int): the number of blocks each output is taken after, increasing
+            window (int): the number of frames the backbone takes
+        """
+        self.taps = list(taps)
+        self._segments = list()
+        self.strides = list()  # the temporal stride of each tap
+        begin, dilation = 0, 1
+        for end in self.taps:
+            nodes = list()
+            for block in blocks[begin:end]:
+                node, dilation = _build(block, dilation)
+                nodes.append(node)
+            self._segments.append(_Sequence(nodes))
+            self.strides.append(dilation)
+            begin = end
+        self._window = window
+        self.reset()
+
+    def reset(self):
+        """Reset the caches for a new clip"""
+        for segment in self._segments:
+            segment.reset()
+        self._slices = [dict() for _ in self.taps]  # the slices of each tap still in a window, by frame
+        self._counts = [0 for _ in self.taps]  # the number of slices out of each tap
+        self._frames = 0  # the number of frames pushed
+        self._next = 0  # the next frame to pool
+
+    def _record(self, xs):
+        for slices, count, x in zip(self._slices, list(self._counts), xs):
+            slices.update(enumerate(x, count))
+        self._counts = [count + len(x) for count, x in zip(self._counts, xs)]
+
+    def _positions(self, t, stride, last):
+        """The slices the window of a frame pools, on the strided grid from its first frame, clamped to the clip"""
+        begin = t - int(self._window / 2.0)
+        return [min(max(p, 0), last) for p in range(begin, begin + self._window, stride)]
+
+    def _pool(self, last):
+        pooled = list()
+        while self._next < self._frames:
+            t = self._next
+            positions = [self._positions(t, stride, last) for stride in self.strides]
+            if any(p[-1] >= count for p, count in zip(positions, self._counts)):
+                break
+            pooled.append([mx.nd.max(mx.nd.concat(*[slices[i] for i in p], dim=2), axis=2)
+                           for slices, p in zip(self._slices, positions)])
+            self._next += 1
+            for slices in self._slices:  # the next windows start after these
+                for i in [i for i in slices if i < self._next - int(self._window / 2.0)]:
+                    del slices[i]
+        return pooled
+
+    def push(self, x):
+        """
+        Push the next frame of the clip
+
+        Args:
+            x (mxnet.nd.NDArray): the frame, or its features, (B, C, 1, H, W)
+
+        Returns:
+            list: for each frame now pooled, in order, the list of its pooled taps (B, C, H, W)
+        """
+        self._frames += 1
+        outputs, xs = list(), [x]
+        for segment in self._segments:
+            xs = [y for x in xs for y in segment.push(x)]
+            outputs.append(xs)
+        self._record(outputs)
+        return self._pool(last=float('inf'))
+
+    def flush(self):
+        """
+        Push the padding after the last frame of the clip through
+
+        Returns:
+            list: for each remaining frame, in order, the list of its pooled taps (B, C, H, W)
+        """
+        outputs, xs = list(), list()
+        for segment in self._segments:
+            xs = [y for x in xs for y in segment.push(x)] + segment.flush()
+            outputs.append(xs)
+        self._record(outputs)
+        return self._pool(last=self._frames - 1)
+
+
+class Darknet3DStream(object):
+    """Streams the frames of a clip through a Darknet3D, returning the three features for each frame"""
+    def __init__(self, darknet, window):
+        """
+        Args:
+            darknet (Darknet3D): the darknet, with return_features
+            window (int): the number of frames it was trained with
+        """
+        self._features = list(darknet.features._children.values())
+        pools = [i for i, block in enumerate(self._features) if isinstance(block, TemporalGlobalMaxPool3D)]
+        if not pools or not darknet.return_features:
+            raise ValueError('Can only stream a Darknet3D with 3D convs, returning its features')
+        self._pool = pools[0]
+        self._ends = list(darknet.feature_ends()) + [len(self._features)]
+        self.blocks = self._features[:self._pool]
+        self.taps = sorted(set([end for end in self._ends if end <= self._pool] + [self._pool]))
+        self._stream = TemporalStream(self.blocks, self.taps, window)
+
+    def reset(self):
+        """Reset for a new clip"""
+        self._stream.reset()
+
+    def _features_of(self, pooled):
+        pooled = dict(zip(self.taps, pooled))
+        features, x, begin = list(), pooled[self._pool], self._pool + 1
+        for end in self._ends:
+            if end <= self._pool:  # a feature before the temporal pool is max pooled over the window
+                features.append(pooled[end])
+                continue
+            for block in self._features[begin:end]:
+                x = block(x)
+            features.append(x)
+            begin = max(begin, end)
+        return features
+
+    def push(self, x):
+        """
+        Args:
+            x (mxnet.nd.NDArray): the next frame of the clip (B, 3, 1, H, W)
+
+        Returns:
+            list: the features of each frame now streamed, in order
+        """
+        return [self._features_of(pooled) for pooled in self._stream.push(x)]
+
+    def flush(self):
+        """
+        Returns:
+            list: the features of each remaining frame of the clip, in order
+        """
+        return [self._features_of(pooled) for pooled in self._stream.flush()]
+
+
+class DarknetR21DStream(object):
+    """
+    Streams the frames of a clip through the R(2+1)D of a DarknetR21D, returning the features joined with the
+    darknet's of each frame
+    """
+    def __init__(self, model, window):
+        """
+        Args:
+            model (DarknetR21D): the two stream model
+            window (int): the number of frames it was trained with
+        """
+        self._model = model
+        self.blocks = list(model.r21d.features._children.values())[:7]
+        self.taps = [4, 5, 6, 7]  # the outputs of its four stages
+        self._stream = TemporalStream(self.blocks, self.taps, window)
+        self._frames = collections.deque()  # the frames waiting on the R(2+1)D features of their windows
+
+    def reset(self):
+        """Reset for a new clip"""
+        self._stream.reset()
+        self._frames.clear()
+
+    def push(self, x):
+        """
+        Args:
+            x (mxnet.nd.NDArray): the next frame of the clip (B, 3, 1, H, W)
+
+        Returns:
+            list: the features of each frame now streamed, in order
+        """
+        self._frames.append(x.squeeze(axis=2))
+        return [self._model.join_streams(mx.nd, self._frames.popleft(), *pooled)
+                for pooled in self._stream.push(x)]
+
+    def flush(self):
+        """
+        Returns:
+            list: the features of each remaining frame of the clip, in order
+        """
+        return [self._model.join_streams(mx.nd, self._frames.popleft(), *pooled) for pooled in self._stream.flush()]
+
+
+def check_temporal_stream(blocks, taps, clip, rtol=1e-3, atol=1e-4):
+    """
+    Check streaming the frames of a clip through temporal blocks gives the slices running them on the whole clip does,
+    with its padding at the clip's edges. With a temporal stride the whole clip is only computed on the grid from its
+    first frame, so the streamed slices on it are compared
+
+    Args:
+        blocks (list): the temporal blocks, in order
+        taps (list of int): the number of blocks each output is taken after, increasing
+        clip (mxnet.nd.NDArray): the clip (B, C, T, H, W)
+        rtol (float): the relative tolerance (default is 1e-3)
+        atol (float): the absolute tolerance (default is 1e-4)
+
+    Raises:
+        ValueError: if the streamed slices differ from the whole clip's by more than the tolerance
+    """
+    reference, x, begin = list(), clip, 0
+    for end in taps:
+        for block in blocks[begin:end]:
+            x = block(x)
+        reference.append(x)
+        begin = end
+
+    stream = TemporalStream(blocks, taps, window=1)
+    pooled = [p for t in range(clip.shape[2]) for p in stream.push(clip.slice_axis(axis=2, begin=t, end=t + 1))]
+    pooled += stream.flush()
+    streamed = [mx.nd.stack(*[p[j] for p in pooled[::stride]], axis=2) for j, stride in enumerate(stream.strides)]
+    check_equivalence(reference, streamed, rtol=rtol, atol=atol)
@@ -0,0 +1,200 @@
+"""Deep feature flow inference for YOLO v3
+
+Runs the backbone stages only on keyframes, and on the other frames bilinearly warps the keyframe stage features to the
+current frame with FlowNet flow, then only runs the detection heads. Based on:
+Deep Feature Flow for Video Recognition, Xizhou Zhu et al. https://arxiv.org/abs/1611.07715
+
+The feature scale maps of the paper are not used as the bundled FlowNet doesn't predict them.
+"""
+from __future__ import absolute_import
+from __future__ import division
+
+import time
+
+import cv2
+import mxnet as mx
+import numpy as np
+
+from models.definitions.layers import TimeDistributed
+from models.definitions.yolo.transforms import YOLO3VideoInferenceTransform
+
+
+class FeatureFlowYOLO(object):
+    """
+    Deep feature flow inference engine for YOLOV3 and YOLOV3T models
+
+    Frames of a clip are stepped through in order with step(). With a temporal YOLOV3T (k > 1) the stage features of
+    each frame are buffered until the window centred on a frame is available, so detections are returned with a delay
+    of the window's forward reach, and flush() returns the rest at the end of a clip.
+    """
+    def __init__(self, net, flownet, ctx=mx.cpu(), data_shape=416, window=(1, 1), div_flow=20.0):
+        """
+        Args:
+            net: the YOLOV3 or YOLOV3T model
+            flownet: the FlowNetS model, see models.definitions.flownet.flownet.get_flownet
+            ctx: the context to run on (default is mx.cpu())
+            data_shape (int): the detector input size (default is 416)
+            window (tuple): the temporal window size and step of a YOLOV3T model (default is (1, 1))
+            div_flow (float): the scale the FlowNet flow was trained with (default is 20.0)
+        """
+        assert hasattr(net, 'heads'), 'Feature flow needs a YOLOV3 or YOLOV3T model'
+        self.net = net
+        self.flownet = flownet
+        self.ctx = ctx
+        self.data_shape = data_shape
+        self.flow_shape = max(64, int(round(data_shape / 64.0)) * 64)  # flownet needs a multiple of 64
+        self.div_flow = div_flow
+        self._transform = YOLO3VideoInferenceTransform(data_shape, data_shape)
+
+        # the stages run per frame, so unwrap them if they are time distributed over a window
+        self._stages = [stage.model if isinstance(stage, TimeDistributed) else stage for stage in net.stages]
+
+        k, step = window
+        self._offsets = (np.arange(k) - int(k / 2.0)) * step
+        self.reset()
+        self.reset_stats()
+
+    def reset(self):
+        """Reset the engine for a new clip"""
+        self._key_feats = None
+        self._key_flow_img = None
+        self._features = dict()  # the stage features of the frames still needed for a window
+        self._next = 0  # the next frame to detect on
+        self._count = 0  # the number of frames stepped
+
+    def reset_stats(self):
+        """Reset the frame counts and the seconds spent on the backbone, the warping and the heads"""
+        self.stats = {'frames': 0, 'keyframes': 0, 'key_seconds': 0.0, 'warp_seconds': 0.0, 'head_seconds': 0.0}
+
+    def _inputs(self, frame):
+        """
+        Make the detector and flownet inputs of a frame
+
+        Args:
+            frame (numpy.ndarray): the RGB uint8 frame (h, w, 3)
+
+        Returns:
+            mxnet.nd.NDArray: the normalised detector input (1, 3, data_shape, data_shape)
+            mxnet.nd.NDArray: the flownet input (3, flow_shape, flow_shape), not yet mean subtracted
+        """
+        img, _ = self._transform(mx.nd.array(frame, dtype='uint8'), np.zeros((1, 6)))
+        img = img.expand_dims(0).as_in_context(self.ctx)
+
+        flow_img = cv2.resize(frame, (self.flow_shape, self.flow_shape), interpolation=cv2.INTER_LINEAR)
+        flow_img = mx.nd.array(flow_img.transpose(2, 0, 1), ctx=self.ctx)
+        return img, flow_img
+
+    def _flow(self, flow_img):
+        """
+        Get the flow from the current frame to the keyframe, in pixels of the flownet input
+
+        Args:
+            flow_img (mxnet.nd.NDArray): the flownet input of the current frame
+
+        Returns:
+            mxnet.nd.NDArray: the flow (1, 2, flow_shape/4, flow_shape/4)
+        """
+        imgs = mx.nd.stack(flow_img, self._key_flow_img)
+        imgs = (imgs - imgs.mean(axis=(0, 2, 3), keepdims=True)) / 255.0
+        return self.flownet(imgs.expand_dims(0)) * self.div_flow
+
+    def _warp(self, flow):
+        """
+        Bilinearly warp the keyframe stage features to the current frame
+
+        Args:
+            flow (mxnet.nd.NDArray): the flow from the current frame to the keyframe
+
+        Returns:
+            list: the warped stage features
+        """
+        warped = list()
+        for feat in self._key_feats:
+            h, w = feat.shape[-2:]
+            # resize the flow to the feature map and rescale it from flownet input pixels to feature pixels
+            flow_s = mx.nd.contrib.BilinearResize2D(flow, height=h, width=w)
+            flow_s = flow_s * mx.nd.array([w / self.flow_shape, h / self.flow_shape],
+                                          ctx=self.ctx).reshape((1, 2, 1, 1))
+            grid = mx.nd.GridGenerator(data=flow_s, transform_type='warp')
+            warped.append(mx.nd.BilinearSampler(feat, grid))
+        return warped
+
+    def step(self, frame, keyframe):
+        """
+        Add the next frame of the clip
+
+        Args:
+            frame (numpy.ndarray): the RGB uint8 frame (h, w, 3)
+            keyframe (bool): run the backbone on this frame? The first frame of a clip always is
+
+        Returns:
+            list: (frame index in the clip, (ids, scores, bboxes)) of the frames now detected on
+        """
+        img, flow_img = self._inputs(frame)
+
+        tic = time.time()
+        if keyframe or self._key_feats is None:
+            feats = list()
+            x = img
+            for stage in self._stages:
+                x = stage(x)
+                feats.append(x)
+            self._key_feats = feats
+            self._key_flow_img = flow_img
+            mx.nd.waitall()
+            self.stats['key_seconds'] += time.time() - tic
+            self.stats['keyframes'] += 1
+        else:
+            feats = self._warp(self._flow(flow_img))
+            mx.nd.waitall()
+            self.stats['warp_seconds'] += time.time() - tic
+        self.stats['frames'] += 1
+
+        self._features[self._count] = feats
+        self._count += 1
+
+        # detect on the frames whose windows reach no further than the frames seen so far
+        detections = list()
+        while self._next + self._offsets[-1] < self._count:
+            detections.append(self._detect(self._next))
+        return detections
+
+    def flush(self):
+        """
+        Detect on the frames still waiting on the end of the clip, clamping their windows to the last frame
+
+        Returns:
+            list: (frame index in the clip, (ids, scores, bboxes)) of the remaining frames
+        """
+        detections = list()
+        while self._next < self._count:
+            detections.append(self._detect(self._next))
+        return detections
+
+    def _detect(self, t):
+        """
+        Run the detection heads for a frame, on its window of stage features if the model is temporal
+
+        Args:
+            t (int): the frame index in the clip
+
+        Returns:
+            tuple: (t, (ids, scores, bboxes))
+        """
+        tic = time.time()
+        window = np.clip(t + self._offsets, 0, self._count - 1)
+        if len(window) > 1:
+            feats = [mx.nd.stack(*[self._features[w][s] for w in window], axis=1)
+                     for s in range(len(self._stages))]
+        else:
+            feats = self._features[t]
+        dets = self.net.heads(mx.nd, feats)
+        mx.nd.waitall()
+        self.stats['head_seconds'] += time.time() - tic
+
+        # drop the features no later window needs
+        self._next = t + 1
+        for f in [f for f in self._features if f < self._next + self._offsets[0]]:
+            del self._features[f]
+
+        return t, dets
@@ -0,0 +1,190 @@
+"""Streaming inference for YOLO v3 with unidirectional RNNs, or with 3D and (2+1)D backbones
+
+Sliding window inference runs a YOLOV3T with rnn_pos over the k frames of every window, so each frame goes through the
+per frame layers and the RNN steps k times, once for each window it's in. Streaming runs each frame through them once,
+carrying the RNN states from frame to frame of a clip and resetting them between clips, see YOLOV3T.stream.
+
+The RNN outputs of the last k frames are pooled as the windowed model pools a window, so the detections are for the
+frame at the centre of them, k // 2 frames back. As windows are clamped to a clip, its first frame is stepped k // 2
+extra times before it, and flush() steps its last frame k // 2 times after it. Unlike a window, the RNN states carry
+the frames before the k, so the detections approximate the windowed model's rather than match them.
+
+Sliding window inference with a Darknet3D or DarknetR21D backbone computes the 3D activations of every frame for each
+window it's in. StreamingYOLO3D streams the frames through the temporal convolutions instead, each caching the slices
+of its input the next one needs, see temporal_cache, so each frame computes one temporal slice per layer.
+"""
+from __future__ import absolute_import
+from __future__ import division
+
+import time
+
+import mxnet as mx
+import numpy as np
+
+from models.definitions.darknet.ts_darknet import DarknetR21D
+from models.definitions.temporal_cache import Darknet3DStream, DarknetR21DStream
+from models.definitions.yolo.transforms import YOLO3VideoInferenceTransform
+
+
+class StreamingYOLO(object):
+    """
+    Streaming inference engine for YOLOV3T models with unidirectional RNNs (rnn_bi=False)
+
+    Frames of a clip are stepped through in order with step(), which returns the detections of the frame k // 2
+    frames back, and flush() returns the rest at the end of the clip.
+    """
+    def __init__(self, net, ctx=mx.cpu(), data_shape=416, window=(1, 1)):
+        """
+        Args:
+            net: the YOLOV3T model, with rnn_pos set and unidirectional RNNs
+            ctx: the context to run on (default is mx.cpu())
+            data_shape (int): the detector input size (default is 416)
+            window (tuple): the temporal window size and step the model was trained with (default is (1, 1))
+        """
+        assert hasattr(net, 'stream'), 'Streaming needs a YOLOV3T model with rnn_pos set'
+        k, step = window
+        assert step == 1, 'Streaming steps every frame, so needs a model trained on windows of consecutive frames'
+        self.net = net
+        self.ctx = ctx
+        self.data_shape = data_shape
+        self._delay = int(k / 2.0)
+        self._transform = YOLO3VideoInferenceTransform(data_shape, data_shape)
+
+        self.net.stream()
+        self.reset()
+        self.reset_stats()
+
+    def reset(self):
+        """Reset the engine and the RNN states for a new clip"""
+        self.net.reset_stream()
+        self._last = None  # the input of the last frame, stepped again to flush
+        self._count = 0  # the number of frames stepped
+
+    def reset_stats(self):
+        """Reset the frame count and the seconds spent detecting"""
+        self.stats = {'frames': 0, 'seconds': 0.0}
+
+    def _step(self, img):
+        tic = time.time()
+        dets = self.net(img)
+        mx.nd.waitall()
+        self.stats['seconds'] += time.time() - tic
+        return dets
+
+    def step(self, frame):
+        """
+        Add the next frame of the clip
+
+        Args:
+            frame (numpy.ndarray): the RGB uint8 frame (h, w, 3)
+
+        Returns:
+            list: (frame index in the clip, (ids, scores, bboxes)) of the frame now detected on, if any
+        """
+        img, _ = self._transform(mx.nd.array(frame, dtype='uint8'), np.zeros((1, 6)))
+        img = img.expand_dims(0).expand_dims(0).as_in_context(self.ctx)  # (1, 1, 3, H, W)
+
+        if self._count == 0:  # the window of the first frame is clamped to it
+            for _ in range(self._delay):
+                self._step(img)
+        dets = self._step(img)
+        self._last = img
+        self._count += 1
+        self.stats['frames'] += 1
+
+        t = self._count - 1 - self._delay
+        return [(t, dets)] if t >= 0 else []
+
+    def flush(self):
+        """
+        Detect on the frames still waiting on the end of the clip, stepping its last frame again as the windows are
+        clamped to it
+
+        Returns:
+            list: (frame index in the clip, (ids, scores, bboxes)) of the remaining frames
+        """
+        detections = list()
+        if self._count == 0:
+            return detections
+        for t in range(self._count - self._delay, self._count):
+            dets = self._step(self._last)
+            if t >= 0:  # a clip shorter than the delay centres the first steps on the copies of its first frame
+                detections.append((t, dets))
+        return detections
+
+
+class StreamingYOLO3D(object):
+    """
+    Streaming inference engine for YOLOV3TB models with a Darknet3D backbone (yolo3_3ddarknet), and YOLOV3TS models
+    with the DarknetR21D two stream backbone (motion_stream='r21d')
+
+    Frames of a clip are stepped through in order with step(), which returns the detections of the frames whose
+    windows have been streamed through the temporal convolutions, delayed by their paddings and half the window, and
+    flush() returns the rest at the end of the clip.
+    """
+    def __init__(self, net, ctx=mx.cpu(), data_shape=416, window=(1, 1)):
+        """
+        Args:
+            net: the YOLOV3TB or YOLOV3TS model
+            ctx: the context to run on (default is mx.cpu())
+            data_shape (int): the detector input size (default is 416)
+            window (tuple): the temporal window size and step the model was trained with (default is (1, 1))
+        """
+        k, step = window
+        assert step == 1, 'Streaming steps every frame, so needs a model trained on windows of consecutive frames'
+        self.net = net
+        self.ctx = ctx
+        self.data_shape = data_shape
+        self._transform = YOLO3VideoInferenceTransform(data_shape, data_shape)
+
+        self.net.hybridize(active=False)  # the backbone is run a layer at a time
+        if hasattr(net, 'ts_model') and isinstance(net.ts_model, DarknetR21D):
+            self._backbone = DarknetR21DStream(net.ts_model, k)
+        elif hasattr(net, 'd_model'):
+            self._backbone = Darknet3DStream(net.d_model, k)
+        else:
+            raise ValueError('Can only stream a YOLOV3TB with a Darknet3D or a YOLOV3TS with a DarknetR21D')
+        self.reset()
+        self.reset_stats()
+
+    def reset(self):
+        """Reset the engine and the caches of the temporal convolutions for a new clip"""
+        self._backbone.reset()
+        self._count = 0  # the number of frames detected on
+
+    def reset_stats(self):
+        """Reset the frame count and the seconds spent detecting"""
+        self.stats = {'frames': 0, 'seconds': 0.0}
+
+    def _detect(self, step):
+        tic = time.time()
+        detections = [self.net.detect_routes(mx.nd, routes) for routes in step()]
+        mx.nd.waitall()
+        self.stats['seconds'] += time.time() - tic
+        detections = list(enumerate(detections, self._count))
+        self._count += len(detections)
+        return detections
+
+    def step(self, frame):
+        """
+        Add the next frame of the clip
+
+        Args:
+            frame (numpy.ndarray): the RGB uint8 frame (h, w, 3)
+
+        Returns:
+            list: (frame index in the clip, (ids, scores, bboxes)) of each frame now detected on
+        """
+        img, _ = self._transform(mx.nd.array(frame, dtype='uint8'), np.zeros((1, 6)))
+        img = img.expand_dims(0).expand_dims(2).as_in_context(self.ctx)  # (1, 3, 1, H, W)
+        self.stats['frames'] += 1
+        return self._detect(lambda: self._backbone.push(img))
+
+    def flush(self):
+        """
+        Detect on the frames still waiting on the end of the clip, pushing the padding after it through
+
+        Returns:
+            list: (frame index in the clip, (ids, scores, bboxes)) of the remaining frames
+        """
+        return self._detect(self._backbone.flush)
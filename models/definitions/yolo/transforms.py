@@ -1,16 +1,14 @@
 """Transforms for YOLO series."""
 from __future__ import absolute_import
-import copy
 import numpy as np
 import mxnet as mx
-from mxnet import autograd
 from gluoncv.data.transforms import image as timage
 from gluoncv.data.transforms import experimental
 
 from ...transforms import bbox as tbbox
 from ...transforms import video as tvideo
 
-from models.definitions.yolo.yolo_target import YOLOV3PrefetchTargetGenerator
+from models.definitions.yolo.yolo_target import YOLOV3PrefetchTargetGenerator, YOLOV3TargetGeometry
 
 
 class YOLO3DefaultTrainTransform(object):
@@ -21,8 +19,9 @@ class YOLO3DefaultTrainTransform(object):
         Image width.
     height : int
         Image height.
-    net : mxnet.gluon.HybridBlock, optional
-        The yolo network.
+    net : mxnet.gluon.HybridBlock or YOLOV3TargetGeometry, optional
+        The yolo network, or its geometry from ``YOLOV3TargetGeometry.from_net(net)`` which
+        is cheaper to share between several transforms.
         .. hint::
             If net is ``None``, the transformation will not generate training targets.
             Otherwise it will generate training targets to accelerate the training phase
@@ -47,15 +46,12 @@ class YOLO3DefaultTrainTransform(object):
         if net is None:
             return
 
-        # in case network has reset_ctx to gpu
-        self._fake_x = mx.nd.zeros((1, 3, height, width))
-        net = copy.deepcopy(net)
-        net.collect_params().reset_ctx(None)
-        with autograd.train_mode():
-            _, self._anchors, self._offsets, self._feat_maps, _, _, _, _ = net(self._fake_x)
+        if not isinstance(net, YOLOV3TargetGeometry):
+            net = YOLOV3TargetGeometry.from_net(net)
+        self._fake_x, self._feat_maps, self._anchors, self._offsets = net.layout(width, height)
         # from gluoncv.model_zoo.yolo.yolo_target import YOLOV3PrefetchTargetGenerator
         self._target_generator = YOLOV3PrefetchTargetGenerator(
-            num_class=len(net.classes), **kwargs)
+            num_class=net.num_class, **kwargs)
 
     def __call__(self, src, label):
         """Apply transform to training image/label."""
@@ -149,8 +145,9 @@ class YOLO3VideoTrainTransform(object):
         Image width.
     height : int
         Image height.
-    net : mxnet.gluon.HybridBlock, optional
-        The yolo network.
+    net : mxnet.gluon.HybridBlock or YOLOV3TargetGeometry, optional
+        The yolo network, or its geometry from ``YOLOV3TargetGeometry.from_net(net)`` which
+        is cheaper to share between several transforms.
         .. hint::
             If net is ``None``, the transformation will not generate training targets.
             Otherwise it will generate training targets to accelerate the training phase
@@ -177,24 +174,18 @@ class YOLO3VideoTrainTransform(object):
         if net is None:
             return
 
+        if not isinstance(net, YOLOV3TargetGeometry):
+            net = YOLOV3TargetGeometry.from_net(net)
+
         if num_classes < 0:
-            self._num_classes = len(net.classes)
+            self._num_classes = net.num_class
         else:
             self._num_classes = num_classes
 
-        # in case network has reset_ctx to gpu
-        if k > 1:
-            self._fake_x = mx.nd.zeros((1, k, 3, height, width))
-        else:
-            self._fake_x = mx.nd.zeros((1, 3, height, width))
-        net = copy.deepcopy(net)
-        net.collect_params().reset_ctx(None)
-        with autograd.train_mode():
-            _, self._anchors, self._offsets, self._feat_maps, _, _, _, _ = net(self._fake_x)
-
-        self._fake_x = mx.nd.zeros((1, 3, height, width))
+        # the feature maps are the same size for every frame of the window
+        self._fake_x, self._feat_maps, self._anchors, self._offsets = net.layout(width, height)
         # from gluoncv.model_zoo.yolo.yolo_target import YOLOV3PrefetchTargetGenerator
-        self._target_generator = YOLOV3PrefetchTargetGenerator(num_class=len(net.classes), **kwargs)
+        self._target_generator = YOLOV3PrefetchTargetGenerator(num_class=net.num_class, **kwargs)
 
     def __call__(self, src, label):
         """Apply transform to training image/label."""
@@ -315,26 +306,30 @@ class YOLO3VideoInferenceTransform(object):
 
     def __call__(self, src, label, idx=None):
         """Apply transform to validation image/label."""
-        was_three = False
+        img, bbox = self.resize(src, label)
+        img = self.normalize(img)
+
+        if idx is not None:
+            return img, bbox.astype(img.dtype), idx
+        return img, bbox.astype(img.dtype)
+
+    def resize(self, src, label):
+        """Resize the image(s) and boxes, the part of the transform that can be cached as it's all uint8 images.
+
+        Returns the uint8 image(s) (h, w, c) or (k, h, w, c) and the boxes, padded to (k, n, 5) if multiple temporal
+        outputs."""
         if len(src.shape) == 3:
             src = mx.nd.expand_dims(src, axis=0)
-            was_three = True
-            
+
         # resize
         k, h, w, c = src.shape
-        tmp = mx.nd.ones((k, self._height, self._width, c), ctx=src.context)
+        img = mx.nd.zeros((k, self._height, self._width, c), ctx=src.context, dtype='uint8')
         for i in range(k):
-            tmp[i] = timage.imresize(src[i], self._width, self._height, interp=9)
-        img = tmp
+            img[i] = timage.imresize(src[i], self._width, self._height, interp=9)
         bbox = tbbox.resize(label, in_size=(w, h), out_size=(self._width, self._height))
 
-        img = mx.nd.image.to_tensor(img)  # to tensor, also transforms from k,h,w,c to k,c,h,w
-        # normalise
-        for i in range(k):
-            img[i] = mx.nd.image.normalize(img[i], mean=self._mean, std=self._std)  # normalise
-
-        if was_three:  # remove the k dimension so backwards compat with single frame
-            img = mx.nd.squeeze(img)
+        if k == 1:  # remove the k dimension so backwards compat with single frame
+            img = img[0]
 
         # if multiple temporal outputs
         if isinstance(bbox, list):
@@ -345,9 +340,15 @@ class YOLO3VideoInferenceTransform(object):
                 gt_bboxes_t[t, :bbox[t].shape[0], :] = bbox[t].astype(gt_bboxes_t.dtype)
             bbox = gt_bboxes_t[:, :max_boxes, :]
 
-        if idx is not None:
-            return img, bbox.astype(img.dtype), idx
-        return img, bbox.astype(img.dtype)
+        return img, bbox
+
+    def normalize(self, img):
+        """Convert resized uint8 image(s) (..., h, w, c) into normalised tensors (..., c, h, w), works on batches."""
+        shape = img.shape
+        img = mx.nd.image.to_tensor(img.reshape((-1,) + shape[-3:]))  # to tensor, also transforms n,h,w,c to n,c,h,w
+        img = mx.nd.image.normalize(img, mean=self._mean, std=self._std)  # normalise
+
+        return img.reshape(shape[:-3] + img.shape[1:])
 
 
 class YOLO3NBVideoTrainTransform(object):
@@ -359,8 +360,9 @@ class YOLO3NBVideoTrainTransform(object):
         Image width.
     height : int
         Image height.
-    net : mxnet.gluon.HybridBlock, optional
-        The yolo network.
+    net : mxnet.gluon.HybridBlock or YOLOV3TargetGeometry, optional
+        The yolo network, or its geometry from ``YOLOV3TargetGeometry.from_net(net)`` which
+        is cheaper to share between several transforms.
         .. hint::
             If net is ``None``, the transformation will not generate training targets.
             Otherwise it will generate training targets to accelerate the training phase
@@ -386,16 +388,11 @@ class YOLO3NBVideoTrainTransform(object):
         if net is None:
             return
 
-        # in case network has reset_ctx to gpu
-        self._fake_x = (mx.nd.zeros((1, 256, int(height / 8), int(width / 8))),
-                        mx.nd.zeros((1, 512, int(height / 16), int(width / 16))),
-                        mx.nd.zeros((1, 1024, int(height / 32), int(width / 32))))
-        net = copy.deepcopy(net)
-        net.collect_params().reset_ctx(None)
-        with autograd.train_mode():
-            _, self._anchors, self._offsets, self._feat_maps, _, _, _, _ = net(*self._fake_x)
+        if not isinstance(net, YOLOV3TargetGeometry):
+            net = YOLOV3TargetGeometry.from_net(net)
+        self._fake_x, self._feat_maps, self._anchors, self._offsets = net.layout(width, height)
         # from gluoncv.model_zoo.yolo.yolo_target import YOLOV3PrefetchTargetGenerator
-        self._target_generator = YOLOV3PrefetchTargetGenerator(num_class=len(net.classes), **kwargs)
+        self._target_generator = YOLOV3PrefetchTargetGenerator(num_class=net.num_class, **kwargs)
 
     def __call__(self, img, f1, f2, f3, bbox):
         """Apply transform to training image/label."""
@@ -417,7 +414,7 @@ class YOLO3NBVideoTrainTransform(object):
         else:
             gt_mixratio = None
         objectness, center_targets, scale_targets, weights, class_targets = self._target_generator(
-            mx.nd.zeros((1, 3, self._height, self._width)), self._feat_maps, self._anchors, self._offsets,
+            self._fake_x, self._feat_maps, self._anchors, self._offsets,
             gt_bboxes, gt_ids, gt_mixratio)
         return (f1, f2, f3, objectness[0], center_targets[0], scale_targets[0], weights[0],
                 class_targets[0], gt_bboxes[0])
@@ -5,11 +5,12 @@ from .yolo3_temporal import YOLOV3Temporal
 from ..darknet.three_darknet import get_darknet
 from ..darknet.h_darknet import get_hdarknet
 from ..darknet.ts_darknet import get_darknet_flownet, get_darknet_r21d
+from ..mobilenet.mobilenet import get_mobilenet, get_mobilenet_v2
 
 def yolo3_darknet53(classes, pretrained_base=True, norm_layer=BatchNorm, norm_kwargs=None, freeze_base=False,
                     k=None, k_join_type=None, k_join_pos=None, block_conv_type='2', rnn_pos=None,
                     corr_pos=None, corr_d=None, motion_stream=None, add_type=None, agnostic=False, new_model=False,
-                    hierarchical=[1,1,1,1,1], h_join_type=None, temporal=False, t_out=False, **kwargs):
+                    hierarchical=[1,1,1,1,1], h_join_type=None, temporal=False, t_out=False, rnn_bi=True, **kwargs):
     """YOLO3 multi-scale with darknet53 base network on any dataset. Modified from:
     https://github.com/dmlc/gluon-cv/blob/0dbd05c5eb8537c25b64f0e87c09be979303abf2/gluoncv/model_zoo/yolo/yolo3.py
 
@@ -30,6 +31,8 @@ def yolo3_darknet53(classes, pretrained_base=True, norm_layer=BatchNorm, norm_kw
     norm_kwargs : dict
         Additional `norm_layer` arguments, for example `num_devices=4`
         for :class:`mxnet.gluon.contrib.nn.SyncBatchNorm`.
+    rnn_bi : boolean
+        Whether the RNNs placed with `rnn_pos` are bidirectional, unidirectional ones can be streamed.
     Returns
     -------
     mxnet.gluon.HybridBlock
@@ -92,7 +95,7 @@ def yolo3_darknet53(classes, pretrained_base=True, norm_layer=BatchNorm, norm_kw
                            k_join_type=k_join_type,
                            k_join_pos=k_join_pos, block_conv_type=block_conv_type, rnn_shapes=rnn_shapes,
                            rnn_pos=rnn_pos,
-                           corr_pos=corr_pos, corr_d=corr_d, agnostic=agnostic, **kwargs)
+                           corr_pos=corr_pos, corr_d=corr_d, agnostic=agnostic, rnn_bi=rnn_bi, **kwargs)
         elif temporal or t_out:
             net = YOLOV3Temporal(stages, [512, 256, 128], anchors, strides,
                                  classes=classes, t=k, conv=int(block_conv_type), corr_d=corr_d, t_out=t_out, **kwargs)
@@ -100,7 +103,7 @@ def yolo3_darknet53(classes, pretrained_base=True, norm_layer=BatchNorm, norm_kw
             # OLD CODE
             net = YOLOV3T(stages, [512, 256, 128], anchors, strides, classes=classes, k=k, k_join_type=k_join_type,
                           k_join_pos=k_join_pos, block_conv_type=block_conv_type, rnn_shapes=rnn_shapes, rnn_pos=rnn_pos,
-                          corr_pos=corr_pos, corr_d=corr_d, agnostic=agnostic, **kwargs)
+                          corr_pos=corr_pos, corr_d=corr_d, agnostic=agnostic, rnn_bi=rnn_bi, **kwargs)
 
     else:
         net = YOLOV3TS(ts_model, k, [512, 256, 128], anchors, strides, classes=classes, agnostic=agnostic,
@@ -159,3 +162,120 @@ def yolo3_no_backbone(classes, norm_layer=BatchNorm, norm_kwargs=None, **kwargs)
                         norm_layer=norm_layer, norm_kwargs=norm_kwargs, **kwargs)
     
     return net
+
+
+def _yolo3_stages(stages, channels, classes, k=None, k_join_type=None, k_join_pos=None, block_conv_type='2',
+                  rnn_pos=None, corr_pos=None, corr_d=None, agnostic=False, t_out=False, rnn_bi=True, **kwargs):
+    """Build the YOLO3 heads on the stages of a framewise backbone, with the temporal options of yolo3_darknet53 that
+    only need the stage features: the k joins, correlations and RNNs with YOLOV3T, or multiple outputs with
+    YOLOV3Temporal.
+    """
+    anchors = [
+        [10, 13, 16, 30, 33, 23],
+        [30, 61, 62, 45, 59, 119],
+        [116, 90, 156, 198, 373, 326]]
+    strides = [8, 16, 32]
+    if t_out:
+        return YOLOV3Temporal(stages, channels, anchors, strides, classes=classes, t=k, conv=int(block_conv_type),
+                              corr_d=corr_d, t_out=t_out, agnostic=agnostic, **kwargs)
+
+    rnn_shapes = None
+    if rnn_pos is not None:  # the tip outputs, from deep to shallow, for a 416 input as in yolo3_darknet53
+        rnn_shapes = [(channel * 2, 416 // stride, 416 // stride) for channel, stride in zip(channels, strides[::-1])]
+    return YOLOV3T(stages, channels, anchors, strides, classes=classes, k=k, k_join_type=k_join_type,
+                   k_join_pos=k_join_pos, block_conv_type=block_conv_type, rnn_shapes=rnn_shapes, rnn_pos=rnn_pos,
+                   corr_pos=corr_pos, corr_d=corr_d, agnostic=agnostic, rnn_bi=rnn_bi, **kwargs)
+
+
+def yolo3_mobilenet(classes, multiplier=1.0, pretrained_base=True, norm_layer=BatchNorm, norm_kwargs=None,
+                    freeze_base=False, k=1, **kwargs):
+    """YOLO3 multi-scale with a MobileNet base network on any dataset, optionally temporal. Modified from:
+    https://github.com/dmlc/gluon-cv/blob/0dbd05c5eb8537c25b64f0e87c09be979303abf2/gluoncv/model_zoo/yolo/yolo3.py
+
+    Parameters
+    ----------
+    classes : iterable of str
+        Names of custom foreground classes. `len(classes)` is the number of foreground classes.
+    multiplier : float
+        The MobileNet width multiplier, 1.0, 0.75, 0.5 or 0.25.
+    pretrained_base : boolean
+        Whether fetch and load pretrained weights for base network.
+    norm_layer : object
+        Normalization layer used (default: :class:`mxnet.gluon.nn.BatchNorm`)
+        Can be :class:`mxnet.gluon.nn.BatchNorm` or :class:`mxnet.gluon.contrib.nn.SyncBatchNorm`.
+    norm_kwargs : dict
+        Additional `norm_layer` arguments, for example `num_devices=4`
+        for :class:`mxnet.gluon.contrib.nn.SyncBatchNorm`.
+    freeze_base : boolean
+        Whether to freeze the base network.
+    k : int
+        The number of frames in the input window.
+    **kwargs
+        The temporal options of yolo3_darknet53 that only need the stage features: `k_join_type`, `k_join_pos`,
+        `block_conv_type`, `rnn_pos`, `corr_pos`, `corr_d`, `t_out` (mult_out) and `rnn_bi`, and `agnostic`.
+    Returns
+    -------
+    mxnet.gluon.HybridBlock
+        Fully hybrid yolo3 network.
+    """
+    base_net = get_mobilenet(multiplier, pretrained=pretrained_base, norm_layer=norm_layer, norm_kwargs=norm_kwargs)
+    if freeze_base:
+        for param in base_net.collect_params().values():
+            param.grad_req = 'null'
+    # the stride 8, 16 and 32 features, the same split as extract_base_features.py
+    stages = [base_net.features[:33], base_net.features[33:69], base_net.features[69:-2]]
+    channels = [512, 256, 128] if multiplier >= 0.5 else [256, 128, 128]
+    return _yolo3_stages(stages, channels, classes, k=k, norm_layer=norm_layer, norm_kwargs=norm_kwargs, **kwargs)
+
+
+def yolo3_mobilenet_v2(classes, multiplier=1.0, pretrained_base=True, norm_layer=BatchNorm, norm_kwargs=None,
+                       freeze_base=False, k=1, **kwargs):
+    """YOLO3 multi-scale with a MobileNetV2 base network on any dataset, optionally temporal, see yolo3_mobilenet.
+
+    Parameters
+    ----------
+    classes : iterable of str
+        Names of custom foreground classes. `len(classes)` is the number of foreground classes.
+    multiplier : float
+        The MobileNetV2 width multiplier, 1.0, 0.75, 0.5 or 0.25.
+    pretrained_base : boolean
+        Whether fetch and load pretrained weights for base network.
+    norm_layer : object
+        Normalization layer used (default: :class:`mxnet.gluon.nn.BatchNorm`)
+        Can be :class:`mxnet.gluon.nn.BatchNorm` or :class:`mxnet.gluon.contrib.nn.SyncBatchNorm`.
+    norm_kwargs : dict
+        Additional `norm_layer` arguments, for example `num_devices=4`
+        for :class:`mxnet.gluon.contrib.nn.SyncBatchNorm`.
+    freeze_base : boolean
+        Whether to freeze the base network.
+    k : int
+        The number of frames in the input window.
+    **kwargs
+        The temporal options, see yolo3_mobilenet.
+    Returns
+    -------
+    mxnet.gluon.HybridBlock
+        Fully hybrid yolo3 network.
+    """
+    base_net = get_mobilenet_v2(multiplier, pretrained=pretrained_base, norm_layer=norm_layer,
+                                norm_kwargs=norm_kwargs)
+    if freeze_base:
+        for param in base_net.collect_params().values():
+            param.grad_req = 'null'
+    # the stride 8 and 16 features end after the 6th and 13th bottlenecks, the stride 32 after the last 1x1 conv
+    stages = [base_net.features[:9], base_net.features[9:16], base_net.features[16:-1]]
+    channels = [512, 256, 128] if multiplier >= 0.5 else [256, 128, 128]
+    return _yolo3_stages(stages, channels, classes, k=k, norm_layer=norm_layer, norm_kwargs=norm_kwargs, **kwargs)
+
+
+# the --network names of train_yolov3.py and detect_yolo3.py: (the wrapper, the width multiplier)
+YOLO3_MOBILENETS = {
+    'mobilenet1.0': (yolo3_mobilenet, 1.0),
+    'mobilenet0.75': (yolo3_mobilenet, 0.75),
+    'mobilenet0.5': (yolo3_mobilenet, 0.5),
+    'mobilenet0.25': (yolo3_mobilenet, 0.25),
+    'mobilenetv2_1.0': (yolo3_mobilenet_v2, 1.0),
+    'mobilenetv2_0.75': (yolo3_mobilenet_v2, 0.75),
+    'mobilenetv2_0.5': (yolo3_mobilenet_v2, 0.5),
+    'mobilenetv2_0.25': (yolo3_mobilenet_v2, 0.25),
+}
@@ -3,6 +3,7 @@
 from __future__ import absolute_import
 from __future__ import division
 
+from functools import partial
 import os
 import warnings
 import numpy as np
@@ -14,7 +15,8 @@ from mxnet.gluon.nn import BatchNorm
 from ..darknet.darknet import get_darknet
 from .yolo_target import YOLOV3TargetMerger
 from gluoncv.loss import YOLOV3Loss
-from models.definitions.layers import TemporalPooling, TimeDistributed, Conv, Corr, RNN, _upsample, _conv2d
+from models.definitions.layers import TemporalPooling, TimeDistributed, Conv, Corr, RNN, _upsample, _conv2d, \
+    frozen_prefix, is_frozen, recompute, run_frozen, time_distributed
 
 __all__ = ['YOLOV3',
            'YOLOV3T',
@@ -41,7 +43,8 @@ class YOLOOutputV3(gluon.HybridBlock):
         to export to symbol so we can run it in c++, Scalar, etc.
     """
     def __init__(self, index, num_class, anchors, stride,
-                 alloc_size=(128, 128), k=None, rnn_shape=None, k_join_type='max', agnostic=False, **kwargs):
+                 alloc_size=(128, 128), k=None, rnn_shape=None, k_join_type='max', agnostic=False, rnn_bi=True,
+                 **kwargs):
         super(YOLOOutputV3, self).__init__(**kwargs)
         anchors = np.array(anchors).astype('float32')
         self._classes = num_class
@@ -52,11 +55,14 @@ class YOLOOutputV3(gluon.HybridBlock):
         self._k = k
         self._k_join_type = k_join_type
         self._agnostic = agnostic
+        self._rnn_bi = rnn_bi
+        self.pre_nms_topk = -1  # decode only the top scoring box and class candidates at inference, see set_nms
+        self._score_thresh = 0.01  # candidates scoring less are invalid, the same as the NMS valid_thresh
 
         with self.name_scope():
             all_pred = self._num_pred * self._num_anchors
             if k is not None and rnn_shape is not None:
-                self.prediction = RNN(k=k, input_shape=rnn_shape, channels=all_pred, kernel=(1,1))
+                self.prediction = RNN(k=k, input_shape=rnn_shape, channels=all_pred, kernel=(1,1), bi=rnn_bi)
                 self.pool = TemporalPooling(k=k, type=k_join_type)
             else:
                 self.prediction = nn.Conv2D(all_pred, kernel_size=1, padding=0, strides=1)
@@ -101,7 +107,7 @@ class YOLOOutputV3(gluon.HybridBlock):
 
         if self._k is not None and self._rnn_shape is not None:
             self.prediction = RNN(k=self._k, input_shape=self._rnn_shape, channels=all_pred, kernel=(1,1),
-                                  prefix=old_pred.prefix) # todo not sure this will work espec with weights reuse
+                                  bi=self._rnn_bi, prefix=old_pred.prefix) # todo not sure this will work espec with weights reuse
             self.pool = TemporalPooling(k=self._k, type=self._k_join_type)
         else:
             self.prediction = nn.Conv2D(all_pred, kernel_size=1, padding=0, strides=1, in_channels=in_channels,
@@ -187,6 +193,26 @@ class YOLOOutputV3(gluon.HybridBlock):
             agnostic_detections = F.reshape(agnostic_detections, (0, -1, 6))
             return agnostic_detections  # nms might merge some boxes as they now have same class
 
+        if self.pre_nms_topk > 0:
+            # select the top (box, class) candidates by score then decode only those, rather than a detection for
+            # every box and class, so NMS gets pre_nms_topk rows whatever the number of classes
+            scores = class_score.reshape((0, -1))  # (B, HW * A * C), the class scores of each box are consecutive
+            scores = F.where(scores >= self._score_thresh, scores, F.ones_like(scores) * -1)
+            # pad with invalid candidates, so there are always pre_nms_topk even for small inputs
+            pad = F.ones_like(scores.slice_axis(axis=1, begin=0, end=1)) * -1
+            scores = F.concat(scores, F.tile(pad, reps=(1, self.pre_nms_topk)), dim=1)
+            scores, idx = F.topk(scores, axis=1, k=self.pre_nms_topk, ret_typ='both', dtype='float64')
+            box_idx = F.floor(idx / self._classes)
+            ids = F.cast(idx - box_idx * self._classes, dtype='float32')
+
+            boxes = bbox.reshape((0, -1, 4))
+            pad = F.zeros_like(boxes.slice_axis(axis=1, begin=0, end=1))
+            boxes = F.concat(boxes, F.tile(pad, reps=(1, self.pre_nms_topk, 1)), dim=1)
+            batch_idx = F.cast(F.contrib.index_array(box_idx, axes=(0,)).squeeze(axis=-1), dtype='float64')
+            boxes = F.gather_nd(boxes, F.stack(batch_idx, box_idx))  # (B, pre_nms_topk, 4)
+
+            return F.concat(ids.expand_dims(axis=-1), scores.expand_dims(axis=-1), boxes, dim=-1)
+
         # prediction per class
         bboxes = F.tile(bbox, reps=(self._classes, 1, 1, 1, 1))
         scores = F.transpose(class_score, axes=(3, 0, 1, 2)).expand_dims(axis=-1)
@@ -326,7 +352,7 @@ class YOLOTipBlockV3(gluon.HybridBlock):
         for :class:`mxnet.gluon.contrib.nn.SyncBatchNorm`.
     """
     def __init__(self, channel, conv_type='2', norm_layer=BatchNorm, norm_kwargs=None,
-                 rnn_pos=None, rnn_shape=None, k=None, **kwargs):
+                 rnn_pos=None, rnn_shape=None, k=None, rnn_bi=True, **kwargs):
         super(YOLOTipBlockV3, self).__init__(**kwargs)
 
         self._conv_type = conv_type
@@ -335,7 +361,7 @@ class YOLOTipBlockV3(gluon.HybridBlock):
         with self.name_scope():
 
             if rnn_pos == 'late':
-                self.tip = RNN(k=k, input_shape=rnn_shape, channels=channel * 2, kernel=(3,3))
+                self.tip = RNN(k=k, input_shape=rnn_shape, channels=channel * 2, kernel=(3,3), bi=rnn_bi)
             else:
                 # self.tip = _conv2d(channel * 2, 3, 1, 1, norm_layer=norm_layer, norm_kwargs=norm_kwargs)
                 self.tip = Conv(conv_type, channel * 2, 3, 1, 1, norm_layer=norm_layer, norm_kwargs=norm_kwargs)
@@ -396,6 +422,7 @@ class YOLOV3(gluon.HybridBlock):
                  ignore_iou_thresh=0.7, norm_layer=BatchNorm, norm_kwargs=None, agnostic=False, **kwargs):
         super(YOLOV3, self).__init__(**kwargs)
         self._classes = classes
+        self.recompute = False  # recompute the stage activations in the backward pass, needs the model unhybridized
         self.nms_thresh = nms_thresh
         self.nms_topk = nms_topk
         self.post_nms = post_nms
@@ -464,6 +491,35 @@ class YOLOV3(gluon.HybridBlock):
             with format (cid, score, xmin, ymin, xmax, ymax)
             During training, return losses only: (obj_loss, center_loss, scale_loss, cls_loss).
         """
+        routes = []
+        num_frozen = frozen_prefix(self.stages)  # these are run without keeping their activations
+        for i, stage in enumerate(self.stages):
+            if i < num_frozen:
+                x = run_frozen(F, stage, x)
+            elif self.recompute and F is mx.nd and autograd.is_recording():
+                x = recompute(stage, x)
+            else:
+                x = stage(x)
+            routes.append(x)
+
+        return self.heads(F, routes, *args)
+
+    def heads(self, F, routes, *args):
+        """Run the YOLO detection blocks and outputs on the stage features, used by hybrid_forward and to detect on
+        features that didn't come from the stages (eg. features warped from a keyframe).
+        Parameters
+        ----------
+        F : mxnet.nd or mxnet.sym
+            `F` is mxnet.sym if hybridized or mxnet.nd if not.
+        routes : list of mxnet.nd.NDArray
+            The output of each stage, from shallow to deep.
+        *args : optional, mxnet.nd.NDArray
+            The training targets, see hybrid_forward.
+        Returns
+        -------
+        (tuple of) mxnet.nd.NDArray
+            The same as hybrid_forward.
+        """
         all_box_centers = []
         all_box_scales = []
         all_objectness = []
@@ -472,10 +528,7 @@ class YOLOV3(gluon.HybridBlock):
         all_offsets = []
         all_feat_maps = []
         all_detections = []
-        routes = []
-        for stage, block, output in zip(self.stages, self.yolo_blocks, self.yolo_outputs):
-            x = stage(x)
-            routes.append(x)
+        x = routes[-1]
 
         # the YOLO output layers are used in reverse order, i.e., from very deep layers to shallow
         for i, block, output in zip(range(len(routes)), self.yolo_blocks, self.yolo_outputs):
@@ -533,7 +586,7 @@ class YOLOV3(gluon.HybridBlock):
         bboxes = result.slice_axis(axis=-1, begin=2, end=None)
         return ids, scores, bboxes
 
-    def set_nms(self, nms_thresh=0.45, nms_topk=400, post_nms=100):
+    def set_nms(self, nms_thresh=0.45, nms_topk=400, post_nms=100, pre_nms_topk=-1):
         """Set non-maximum suppression parameters.
         Parameters
         ----------
@@ -546,6 +599,11 @@ class YOLOV3(gluon.HybridBlock):
             Only return top `post_nms` detection results, the rest is discarded. The number is
             based on COCO dataset which has maximum 100 objects per image. You can adjust this
             number if expecting more objects. You can use -1 to return all detections.
+        pre_nms_topk : int, default is -1
+            Each output layer only decodes its top `pre_nms_topk` scoring box and class pairs into
+            detections rather than every box for every class, so NMS time and memory don't grow
+            with the number of classes. The detections are the same if it's at least `nms_topk`.
+            Use -1 to decode every box for every class.
         Returns
         -------
         None
@@ -554,6 +612,8 @@ class YOLOV3(gluon.HybridBlock):
         self.nms_thresh = nms_thresh
         self.nms_topk = nms_topk
         self.post_nms = post_nms
+        for output in self.yolo_outputs:
+            output.pre_nms_topk = pre_nms_topk
 
     def reset_class(self, classes, reuse_weights=None):
         """Reset class categories and class predictors.
@@ -746,6 +806,26 @@ class YOLOV3TS(gluon.HybridBlock):
             with format (cid, score, xmin, ymin, xmax, ymax)
             During training, return losses only: (obj_loss, center_loss, scale_loss, cls_loss).
         """
+        # a frozen two stream model runs without keeping its activations, otherwise it does so for its frozen streams
+        routes = run_frozen(F, self.ts_model, x) if is_frozen(self.ts_model) else self.ts_model(x)
+
+        return self.detect_routes(F, routes, *args)
+
+    def detect_routes(self, F, routes, *args):
+        """Detect on the features of the backbone, the rest of the hybrid forward.
+        Parameters
+        ----------
+        F : mxnet.nd or mxnet.sym
+            `F` is mxnet.sym if hybridized or mxnet.nd if not.
+        routes : list of mxnet.nd.NDArray
+            The features of the backbone, from shallow to deep.
+        *args : optional, mxnet.nd.NDArray
+            During training, the extra inputs of hybrid_forward.
+        Returns
+        -------
+        (tuple of) mxnet.nd.NDArray
+            See hybrid_forward.
+        """
         all_box_centers = []
         all_box_scales = []
         all_objectness = []
@@ -755,8 +835,6 @@ class YOLOV3TS(gluon.HybridBlock):
         all_feat_maps = []
         all_detections = []
 
-        routes = self.ts_model(x)
-
         x = routes[-1]
         # the YOLO output layers are used in reverse order, i.e., from very deep layers to shallow
         for i, block, output in zip(range(len(routes)), self.yolo_blocks, self.yolo_outputs):
@@ -814,7 +892,7 @@ class YOLOV3TS(gluon.HybridBlock):
         bboxes = result.slice_axis(axis=-1, begin=2, end=None)
         return ids, scores, bboxes
 
-    def set_nms(self, nms_thresh=0.45, nms_topk=400, post_nms=100):
+    def set_nms(self, nms_thresh=0.45, nms_topk=400, post_nms=100, pre_nms_topk=-1):
         """Set non-maximum suppression parameters.
         Parameters
         ----------
@@ -827,6 +905,11 @@ class YOLOV3TS(gluon.HybridBlock):
             Only return top `post_nms` detection results, the rest is discarded. The number is
             based on COCO dataset which has maximum 100 objects per image. You can adjust this
             number if expecting more objects. You can use -1 to return all detections.
+        pre_nms_topk : int, default is -1
+            Each output layer only decodes its top `pre_nms_topk` scoring box and class pairs into
+            detections rather than every box for every class, so NMS time and memory don't grow
+            with the number of classes. The detections are the same if it's at least `nms_topk`.
+            Use -1 to decode every box for every class.
         Returns
         -------
         None
@@ -835,6 +918,8 @@ class YOLOV3TS(gluon.HybridBlock):
         self.nms_thresh = nms_thresh
         self.nms_topk = nms_topk
         self.post_nms = post_nms
+        for output in self.yolo_outputs:
+            output.pre_nms_topk = pre_nms_topk
 
     def reset_class(self, classes, reuse_weights=None):
         """Reset class categories and class predictors.
@@ -955,14 +1040,18 @@ class YOLOV3T(gluon.HybridBlock):
     norm_kwargs : dict
         Additional `norm_layer` arguments, for example `num_devices=4`
         for :class:`mxnet.gluon.contrib.nn.SyncBatchNorm`.
+    rnn_bi : bool, default is True
+        Whether the RNNs placed with `rnn_pos` are bidirectional. Unidirectional RNNs can be
+        streamed, see `stream`.
     """
     def __init__(self, stages, channels, anchors, strides, classes, alloc_size=(128, 128),
                  nms_thresh=0.45, nms_topk=400, post_nms=100, pos_iou_thresh=1.0,
                  ignore_iou_thresh=0.7, norm_layer=BatchNorm, norm_kwargs=None,
                  k=None, k_join_type=None, k_join_pos=None, block_conv_type='2',
-                 rnn_shapes=None, rnn_pos=None, corr_pos=None, corr_d=None, agnostic=False, **kwargs):
+                 rnn_shapes=None, rnn_pos=None, corr_pos=None, corr_d=None, agnostic=False, rnn_bi=True, **kwargs):
         super(YOLOV3T, self).__init__(**kwargs)
         self._classes = classes
+        self.recompute = False  # recompute the stage activations in the backward pass, needs the model unhybridized
         self.nms_thresh = nms_thresh
         self.nms_topk = nms_topk
         self.post_nms = post_nms
@@ -1022,7 +1111,8 @@ class YOLOV3T(gluon.HybridBlock):
                 if rnn_pos == 'late':
                     block = YOLODetectionNoTipBlockV3(channel, block_conv_type, norm_layer=norm_layer, norm_kwargs=norm_kwargs)
                     tip = YOLOTipBlockV3(channel, block_conv_type, norm_layer=norm_layer, norm_kwargs=norm_kwargs,
-                                         rnn_pos=rnn_pos, rnn_shape=(int(rnn_shapes[i][0]/2),) + rnn_shapes[i][1:], k=k)
+                                         rnn_pos=rnn_pos, rnn_shape=(int(rnn_shapes[i][0]/2),) + rnn_shapes[i][1:], k=k,
+                                         rnn_bi=rnn_bi)
                 else:
                     block = YOLODetectionBlockV3(channel, block_conv_type, norm_layer=norm_layer, norm_kwargs=norm_kwargs)
 
@@ -1039,7 +1129,8 @@ class YOLOV3T(gluon.HybridBlock):
 
                 if rnn_pos == 'out':
                     output = YOLOOutputV3(i, len(classes), anchor, stride, alloc_size=alloc_size,
-                                          k=k, rnn_shape=rnn_shapes[i], k_join_type=k_join_type, agnostic=agnostic)
+                                          k=k, rnn_shape=rnn_shapes[i], k_join_type=k_join_type, agnostic=agnostic,
+                                          rnn_bi=rnn_bi)
                 else:
                     output = YOLOOutputV3(i, len(classes), anchor, stride, alloc_size=alloc_size, agnostic=agnostic)
                 self.yolo_outputs.add(output)
@@ -1092,6 +1183,35 @@ class YOLOV3T(gluon.HybridBlock):
             with format (cid, score, xmin, ymin, xmax, ymax)
             During training, return losses only: (obj_loss, center_loss, scale_loss, cls_loss).
         """
+        features = []
+        num_frozen = frozen_prefix(self.stages)  # these are run without keeping their activations
+        for i, stage in enumerate(self.stages):
+            if i < num_frozen:
+                x = run_frozen(F, stage, x)
+            elif self.recompute and F is mx.nd and autograd.is_recording():
+                x = recompute(stage, x)
+            else:
+                x = stage(x)
+            features.append(x)
+
+        return self.heads(F, features, *args)
+
+    def heads(self, F, features, *args):
+        """Join the temporal stage features and run the YOLO detection blocks and outputs on them, used by
+        hybrid_forward and to detect on features that didn't come from the stages (eg. features warped from a keyframe).
+        Parameters
+        ----------
+        F : mxnet.nd or mxnet.sym
+            `F` is mxnet.sym if hybridized or mxnet.nd if not.
+        features : list of mxnet.nd.NDArray
+            The output of each stage, from shallow to deep, of shape (B, K, C, H, W) if k > 1.
+        *args : optional, mxnet.nd.NDArray
+            The training targets, see hybrid_forward.
+        Returns
+        -------
+        (tuple of) mxnet.nd.NDArray
+            The same as hybrid_forward.
+        """
         all_box_centers = []
         all_box_scales = []
         all_objectness = []
@@ -1102,8 +1222,7 @@ class YOLOV3T(gluon.HybridBlock):
         all_detections = []
         routes = []
 
-        for stage, block, output in zip(self.stages, self.yolo_blocks, self.yolo_outputs):
-            x = stage(x)
+        for x in features:
             if self._k > 1 and self._k_join_pos == 'early' and self._rnn_pos != 'out':
                 if self._k_join_type == 'cat':
                     routes.append(F.reshape(x,(0,-3,-2)))  # B,K,C,H,W -> B,K*C,H,W
@@ -1113,14 +1232,7 @@ class YOLOV3T(gluon.HybridBlock):
                 routes.append(self.corr(x))
             else:
                 routes.append(x)
-
-        if self._k > 1 and self._k_join_pos == 'early' and self._rnn_pos != 'out':
-            if self._k_join_type == 'cat':
-                x = F.reshape(x,(0,-3,-2))  # B,K,C,H,W -> B,K*C,H,W
-            elif self._k_join_type in ['max', 'mean']:
-                x = self.pool(x)
-        elif self._k > 1 and self._corr_pos == 'early':
-            x = self.corr(x)
+        x = routes[-1]
 
         # the YOLO output layers are used in reverse order, i.e., from very deep layers to shallow
         for i, block, tips, output in zip(range(len(routes)), self.yolo_blocks, self.yolo_tips, self.yolo_outputs):
@@ -1205,7 +1317,7 @@ class YOLOV3T(gluon.HybridBlock):
         bboxes = result.slice_axis(axis=-1, begin=2, end=None)
         return ids, scores, bboxes
 
-    def set_nms(self, nms_thresh=0.45, nms_topk=400, post_nms=100):
+    def set_nms(self, nms_thresh=0.45, nms_topk=400, post_nms=100, pre_nms_topk=-1):
         """Set non-maximum suppression parameters.
         Parameters
         ----------
@@ -1218,6 +1330,11 @@ class YOLOV3T(gluon.HybridBlock):
             Only return top `post_nms` detection results, the rest is discarded. The number is
             based on COCO dataset which has maximum 100 objects per image. You can adjust this
             number if expecting more objects. You can use -1 to return all detections.
+        pre_nms_topk : int, default is -1
+            Each output layer only decodes its top `pre_nms_topk` scoring box and class pairs into
+            detections rather than every box for every class, so NMS time and memory don't grow
+            with the number of classes. The detections are the same if it's at least `nms_topk`.
+            Use -1 to decode every box for every class.
         Returns
         -------
         None
@@ -1226,6 +1343,44 @@ class YOLOV3T(gluon.HybridBlock):
         self.nms_thresh = nms_thresh
         self.nms_topk = nms_topk
         self.post_nms = post_nms
+        for output in self.yolo_outputs:
+            output.pre_nms_topk = pre_nms_topk
+
+    def _rnns(self):
+        rnns = []
+        self.apply(lambda block: rnns.append(block) if isinstance(block, RNN) else None)
+        return rnns
+
+    def stream(self, streaming=True):
+        """Switch the RNNs to streaming, or back to unrolling over windows. When streaming the
+        network takes only the next frame of a clip, (B, 1, 3, H, W), runs the per frame layers on
+        it once, steps the RNNs from the states left by the previous frame, and detects on the RNN
+        outputs of the last k frames, the centre of which is frame k // 2 frames back. See
+        layers.RNN.stream and streaming.StreamingYOLO, which steps through the clips.
+        The network is run imperatively while streaming, as the RNNs keep their states between calls.
+        Parameters
+        ----------
+        streaming : bool, default is True
+            Whether to stream.
+        Returns
+        -------
+        None
+        """
+        rnns = self._rnns()
+        if not rnns:
+            raise ValueError("Only a model with an rnn_pos has RNNs to stream")
+        if streaming and (self._corr_pos is not None or self._k_join_pos == 'early' and self._rnn_pos != 'out'):
+            raise ValueError("Streaming needs every layer before the RNNs to be per frame, so no corr_pos "
+                             "or early k_join_pos")
+        if streaming:
+            self.hybridize(active=False)
+        for rnn in rnns:
+            rnn.stream(streaming)
+
+    def reset_stream(self):
+        """Reset the RNN states, at the start of a clip."""
+        for rnn in self._rnns():
+            rnn.reset()
 
     def reset_class(self, classes, reuse_weights=None):
         """Reset class categories and class predictors.
@@ -1350,7 +1505,7 @@ class YOLOV3TB(gluon.HybridBlock):
                  nms_thresh=0.45, nms_topk=400, post_nms=100, pos_iou_thresh=1.0,
                  ignore_iou_thresh=0.7, norm_layer=BatchNorm, norm_kwargs=None,
                  k=None, k_join_type=None, k_join_pos=None, block_conv_type='2',
-                 rnn_shapes=None, rnn_pos=None, corr_pos=None, corr_d=None, agnostic=False, **kwargs):
+                 rnn_shapes=None, rnn_pos=None, corr_pos=None, corr_d=None, agnostic=False, rnn_bi=True, **kwargs):
         super(YOLOV3TB, self).__init__(**kwargs)
         self.d_model = d_model
         self._classes = classes
@@ -1407,7 +1562,8 @@ class YOLOV3TB(gluon.HybridBlock):
                 if rnn_pos == 'late':
                     block = YOLODetectionNoTipBlockV3(channel, block_conv_type, norm_layer=norm_layer, norm_kwargs=norm_kwargs)
                     tip = YOLOTipBlockV3(channel, block_conv_type, norm_layer=norm_layer, norm_kwargs=norm_kwargs,
-                                         rnn_pos=rnn_pos, rnn_shape=(int(rnn_shapes[i][0]/2),) + rnn_shapes[i][1:], k=k)
+                                         rnn_pos=rnn_pos, rnn_shape=(int(rnn_shapes[i][0]/2),) + rnn_shapes[i][1:], k=k,
+                                         rnn_bi=rnn_bi)
                 else:
                     block = YOLODetectionBlockV3(channel, block_conv_type, norm_layer=norm_layer, norm_kwargs=norm_kwargs)
 
@@ -1424,7 +1580,8 @@ class YOLOV3TB(gluon.HybridBlock):
 
                 if rnn_pos == 'out':
                     output = YOLOOutputV3(i, len(classes), anchor, stride, alloc_size=alloc_size,
-                                          k=k, rnn_shape=rnn_shapes[i], k_join_type=k_join_type, agnostic=agnostic)
+                                          k=k, rnn_shape=rnn_shapes[i], k_join_type=k_join_type, agnostic=agnostic,
+                                          rnn_bi=rnn_bi)
                 else:
                     output = YOLOOutputV3(i, len(classes), anchor, stride, alloc_size=alloc_size, agnostic=agnostic)
                 self.yolo_outputs.add(output)
@@ -1477,18 +1634,12 @@ class YOLOV3TB(gluon.HybridBlock):
             with format (cid, score, xmin, ymin, xmax, ymax)
             During training, return losses only: (obj_loss, center_loss, scale_loss, cls_loss).
         """
-        all_box_centers = []
-        all_box_scales = []
-        all_objectness = []
-        all_class_pred = []
-        all_anchors = []
-        all_offsets = []
-        all_feat_maps = []
-        all_detections = []
+        backbone = partial(time_distributed, F, self.d_model) if self._k > 1 else self.d_model
+        features = run_frozen(F, backbone, x) if is_frozen(self.d_model) else backbone(x)
 
         routes = []
         if self._k > 1:
-            for r in TimeDistributed(self.d_model)(x):
+            for r in features:
                 if self._k_join_pos == 'early' and self._rnn_pos != 'out':
                     if self._k_join_type == 'cat':
                         r = F.reshape(r, (0, -3, -2))  # B,K,C,H,W -> B,K*C,H,W
@@ -1498,7 +1649,33 @@ class YOLOV3TB(gluon.HybridBlock):
                     r = self.corr(r)
                 routes.append(r)
         else:
-            routes = self.d_model(x)
+            routes = features
+
+        return self.detect_routes(F, routes, *args)
+
+    def detect_routes(self, F, routes, *args):
+        """Detect on the features of the backbone, the rest of the hybrid forward.
+        Parameters
+        ----------
+        F : mxnet.nd or mxnet.sym
+            `F` is mxnet.sym if hybridized or mxnet.nd if not.
+        routes : list of mxnet.nd.NDArray
+            The features of the backbone, from shallow to deep.
+        *args : optional, mxnet.nd.NDArray
+            During training, the extra inputs of hybrid_forward.
+        Returns
+        -------
+        (tuple of) mxnet.nd.NDArray
+            See hybrid_forward.
+        """
+        all_box_centers = []
+        all_box_scales = []
+        all_objectness = []
+        all_class_pred = []
+        all_anchors = []
+        all_offsets = []
+        all_feat_maps = []
+        all_detections = []
 
         x = routes[-1]
 
@@ -1585,7 +1762,7 @@ class YOLOV3TB(gluon.HybridBlock):
         bboxes = result.slice_axis(axis=-1, begin=2, end=None)
         return ids, scores, bboxes
 
-    def set_nms(self, nms_thresh=0.45, nms_topk=400, post_nms=100):
+    def set_nms(self, nms_thresh=0.45, nms_topk=400, post_nms=100, pre_nms_topk=-1):
         """Set non-maximum suppression parameters.
         Parameters
         ----------
@@ -1598,6 +1775,11 @@ class YOLOV3TB(gluon.HybridBlock):
             Only return top `post_nms` detection results, the rest is discarded. The number is
             based on COCO dataset which has maximum 100 objects per image. You can adjust this
             number if expecting more objects. You can use -1 to return all detections.
+        pre_nms_topk : int, default is -1
+            Each output layer only decodes its top `pre_nms_topk` scoring box and class pairs into
+            detections rather than every box for every class, so NMS time and memory don't grow
+            with the number of classes. The detections are the same if it's at least `nms_topk`.
+            Use -1 to decode every box for every class.
         Returns
         -------
         None
@@ -1606,6 +1788,8 @@ class YOLOV3TB(gluon.HybridBlock):
         self.nms_thresh = nms_thresh
         self.nms_topk = nms_topk
         self.post_nms = post_nms
+        for output in self.yolo_outputs:
+            output.pre_nms_topk = pre_nms_topk
 
     def reset_class(self, classes, reuse_weights=None):
         """Reset class categories and class predictors.
@@ -1869,7 +2053,7 @@ class YOLOV3_noback(gluon.HybridBlock):
         bboxes = result.slice_axis(axis=-1, begin=2, end=None)
         return ids, scores, bboxes
 
-    def set_nms(self, nms_thresh=0.45, nms_topk=400, post_nms=100):
+    def set_nms(self, nms_thresh=0.45, nms_topk=400, post_nms=100, pre_nms_topk=-1):
         """Set non-maximum suppression parameters.
         Parameters
         ----------
@@ -1882,6 +2066,11 @@ class YOLOV3_noback(gluon.HybridBlock):
             Only return top `post_nms` detection results, the rest is discarded. The number is
             based on COCO dataset which has maximum 100 objects per image. You can adjust this
             number if expecting more objects. You can use -1 to return all detections.
+        pre_nms_topk : int, default is -1
+            Each output layer only decodes its top `pre_nms_topk` scoring box and class pairs into
+            detections rather than every box for every class, so NMS time and memory don't grow
+            with the number of classes. The detections are the same if it's at least `nms_topk`.
+            Use -1 to decode every box for every class.
         Returns
         -------
         None
@@ -1890,6 +2079,8 @@ class YOLOV3_noback(gluon.HybridBlock):
         self.nms_thresh = nms_thresh
         self.nms_topk = nms_topk
         self.post_nms = post_nms
+        for output in self.yolo_outputs:
+            output.pre_nms_topk = pre_nms_topk
 
     def reset_class(self, classes, reuse_weights=None):
         """Reset class categories and class predictors.
@@ -3,6 +3,7 @@
 from __future__ import absolute_import
 from __future__ import division
 
+from functools import partial
 import os
 import warnings
 import numpy as np
@@ -15,7 +16,8 @@ from mxnet.gluon.nn import BatchNorm
 from models.definitions.darknet.darknet import get_darknet
 from models.definitions.yolo.yolo_target import YOLOV3TargetMerger
 
-from models.definitions.layers import TimeDistributed, Conv, Corr, _upsample, _temp_pad, _conv2d, _conv21d
+from models.definitions.layers import time_distributed, Conv, Corr, _upsample, _temp_pad, _conv2d, _conv21d, \
+    frozen_prefix, run_frozen
 from gluoncv.loss import YOLOV3Loss
 
 __all__ = ['YOLOV3Temporal',
@@ -49,6 +51,8 @@ class YOLOOutputV3(gluon.HybridBlock):
         self._num_anchors = anchors.size // 2
         self._stride = stride
         self._agnostic = agnostic
+        self.pre_nms_topk = -1  # decode only the top scoring box and class candidates at inference, see set_nms
+        self._score_thresh = 0.01  # candidates scoring less are invalid, the same as the NMS valid_thresh
         with self.name_scope():
             all_pred = self._num_pred * self._num_anchors
             self.prediction = nn.Conv2D(all_pred, kernel_size=1, padding=0, strides=1)
@@ -168,6 +172,26 @@ class YOLOOutputV3(gluon.HybridBlock):
             agnostic_detections = F.reshape(agnostic_detections, (0, -1, 6))
             return agnostic_detections  # nms might merge some boxes as they now have same class
 
+        if self.pre_nms_topk > 0:
+            # select the top (box, class) candidates by score then decode only those, rather than a detection for
+            # every box and class, so NMS gets pre_nms_topk rows whatever the number of classes
+            scores = class_score.reshape((0, -1))  # (B, HW * A * C), the class scores of each box are consecutive
+            scores = F.where(scores >= self._score_thresh, scores, F.ones_like(scores) * -1)
+            # pad with invalid candidates, so there are always pre_nms_topk even for small inputs
+            pad = F.ones_like(scores.slice_axis(axis=1, begin=0, end=1)) * -1
+            scores = F.concat(scores, F.tile(pad, reps=(1, self.pre_nms_topk)), dim=1)
+            scores, idx = F.topk(scores, axis=1, k=self.pre_nms_topk, ret_typ='both', dtype='float64')
+            box_idx = F.floor(idx / self._classes)
+            ids = F.cast(idx - box_idx * self._classes, dtype='float32')
+
+            boxes = bbox.reshape((0, -1, 4))
+            pad = F.zeros_like(boxes.slice_axis(axis=1, begin=0, end=1))
+            boxes = F.concat(boxes, F.tile(pad, reps=(1, self.pre_nms_topk, 1)), dim=1)
+            batch_idx = F.cast(F.contrib.index_array(box_idx, axes=(0,)).squeeze(axis=-1), dtype='float64')
+            boxes = F.gather_nd(boxes, F.stack(batch_idx, box_idx))  # (B, pre_nms_topk, 4)
+
+            return F.concat(ids.expand_dims(axis=-1), scores.expand_dims(axis=-1), boxes, dim=-1)
+
         # prediction per class
         bboxes = F.tile(bbox, reps=(self._classes, 1, 1, 1, 1))
         scores = F.transpose(class_score, axes=(3, 0, 1, 2)).expand_dims(axis=-1)
@@ -391,55 +415,62 @@ class YOLOV3Temporal(gluon.HybridBlock):
         all_offsets = []
         all_feat_maps = []
         all_detections = []
+        num_frozen = frozen_prefix(self.stages)  # these are run without keeping their activations
+
+        def run_stage(i, x, time_distributed=False):
+            """Run stage i, only call on the stages applied in order to the input"""
+            stage = partial(time_distributed, F, self.stages[i]) if time_distributed else self.stages[i]
+            return run_frozen(F, stage, x) if i < num_frozen else stage(x)
+
         routes = []
         if self.t == 1:
-            for stage in self.stages:
-                x = stage(x)
+            for i in range(len(self.stages)):
+                x = run_stage(i, x)
                 routes.append(x)
         else:
             assert self.t == 5, 'Currently only support t=5 but will increase to more later'
 
             if self.t_out:
                 if self.corr_d:
-                    x = TimeDistributed(self.stages[0])(x)
+                    x = run_stage(0, x, time_distributed=True)
 
                     # get middle feature for further Darknet processing
                     mid = F.squeeze(x.slice_axis(axis=1, begin=int(self.t / 2), end=int(self.t / 2)+1), axis=1)
 
                     x = self.corr(x)  # perform correlations across all timesteps
 
-                    x = TimeDistributed(self.convs1)(x)  # do first conv
+                    x = time_distributed(F, self.convs1, x)  # do first conv
                     mid_rep = F.repeat(F.expand_dims(mid, axis=1), axis=1, repeats=self.t)  # repeat the mid feats t times
                     routes.append(F.concat(mid_rep, x, dim=2))  # concat and pass to YOLO (a,d)
 
-                    mid = self.stages[1](mid)  # pass middle frame through more darknet
+                    mid = run_stage(1, mid)  # pass middle frame through more darknet
                     mid_rep = F.repeat(F.expand_dims(mid, axis=1), axis=1, repeats=self.t)  # repeat the mid feats t times
-                    x = TimeDistributed(self.convs2)(x)  # downscale x with another conv
+                    x = time_distributed(F, self.convs2, x)  # downscale x with another conv
                     routes.append(F.concat(mid_rep, x, dim=2))  # concat and pass to YOLO (b,e)
 
-                    mid = self.stages[2](mid)  # pass middle frame through last bit of darknet
+                    mid = run_stage(2, mid)  # pass middle frame through last bit of darknet
                     mid_rep = F.repeat(F.expand_dims(mid, axis=1), axis=1, repeats=self.t)  # repeat the mid feats t times
-                    x = TimeDistributed(self.convs3)(x)  # downscale x with another conv
+                    x = time_distributed(F, self.convs3, x)  # downscale x with another conv
                     x = F.concat(mid_rep, x, dim=2)
                     routes.append(x)  # concat and pass to YOLO (c,f)
                 else:
-                    x = TimeDistributed(self.stages[0])(x)
+                    x = run_stage(0, x, time_distributed=True)
                     routes.append(x)
-                    x = TimeDistributed(self.stages[1])(x)
+                    x = run_stage(1, x, time_distributed=True)
                     # x = TimeDistributed(self.stages[1])(x.slice_axis(axis=1, begin=1, end=4))  # old code when did heir
                     routes.append(x)
-                    x = TimeDistributed(self.stages[2])(x)
+                    x = run_stage(2, x, time_distributed=True)
                     # x = TimeDistributed(self.stages[2])(x.slice_axis(axis=1, begin=1, end=2))  # old code when did heir
                     routes.append(x)
             else:
-                x = TimeDistributed(self.stages[0])(x)
+                x = run_stage(0, x, time_distributed=True)
                 routes.append(x.slice_axis(axis=1, begin=2, end=3).squeeze(axis=1))
                 cx = F.swapaxes(self.convs1(F.swapaxes(x, 1, 2)), 1, 2)
-                x = TimeDistributed(self.stages[1])(x.slice_axis(axis=1, begin=1, end=4))
+                x = run_stage(1, x.slice_axis(axis=1, begin=1, end=4), time_distributed=True)
                 x = x + cx
                 routes.append(x.slice_axis(axis=1, begin=1, end=2).squeeze(axis=1))
                 cx = F.swapaxes(self.convs2(F.swapaxes(x, 1, 2)), 1, 2)
-                x = TimeDistributed(self.stages[2])(x.slice_axis(axis=1, begin=1, end=2))
+                x = time_distributed(F, self.stages[2], x.slice_axis(axis=1, begin=1, end=2))
                 x = x + cx
                 x = x.squeeze(axis=1)
                 routes.append(x)
@@ -447,13 +478,13 @@ class YOLOV3Temporal(gluon.HybridBlock):
         # the YOLO output layers are used in reverse order, i.e., from very deep layers to shallow
         for i, block, output in zip(range(len(routes)), self.yolo_blocks, self.yolo_outputs):
             if self.t > 1 and self.conv == 2 and self.t_out:
-                x, tip = TimeDistributed(block)(x)
+                x, tip = time_distributed(F, block, x)
             else:
                 x, tip = block(x)
 
             if self.t > 1 and self.t_out:
                 if autograd.is_training():
-                    dets, box_centers, box_scales, objness, class_pred, anchors, offsets = TimeDistributed(output, style='for')(tip)
+                    dets, box_centers, box_scales, objness, class_pred, anchors, offsets = time_distributed(F, output, tip, style='for')
                     all_box_centers.append(box_centers.reshape((0, 0, -3, -1)))
                     all_box_scales.append(box_scales.reshape((0, 0, -3, -1)))
                     all_objectness.append(objness.reshape((0, 0, -3, -1)))
@@ -465,7 +496,7 @@ class YOLOV3Temporal(gluon.HybridBlock):
                         axis=0, begin=0, end=1).slice_axis(axis=2, begin=0, end=1))
                     all_feat_maps.append(fake_featmap)
                 else:
-                    dets = TimeDistributed(output)(tip)
+                    dets = time_distributed(F, output, tip)
             else:
                 if autograd.is_training():
                     dets, box_centers, box_scales, objness, class_pred, anchors, offsets = output(tip)
@@ -489,7 +520,7 @@ class YOLOV3Temporal(gluon.HybridBlock):
 
             # add transition layers
             if self.t > 1 and self.t_out:
-                x = TimeDistributed(self.transitions[i])(x)
+                x = time_distributed(F, self.transitions[i], x)
             else:
                 x = self.transitions[i](x)
 
@@ -554,7 +585,7 @@ class YOLOV3Temporal(gluon.HybridBlock):
         bboxes = result.slice_axis(axis=-1, begin=2, end=None)
         return ids, scores, bboxes
 
-    def set_nms(self, nms_thresh=0.45, nms_topk=400, post_nms=100):
+    def set_nms(self, nms_thresh=0.45, nms_topk=400, post_nms=100, pre_nms_topk=-1):
         """Set non-maximum suppression parameters.
         Parameters
         ----------
@@ -567,6 +598,11 @@ class YOLOV3Temporal(gluon.HybridBlock):
             Only return top `post_nms` detection results, the rest is discarded. The number is
             based on COCO dataset which has maximum 100 objects per image. You can adjust this
             number if expecting more objects. You can use -1 to return all detections.
+        pre_nms_topk : int, default is -1
+            Each output layer only decodes its top `pre_nms_topk` scoring box and class pairs into
+            detections rather than every box for every class, so NMS time and memory don't grow
+            with the number of classes. The detections are the same if it's at least `nms_topk`.
+            Use -1 to decode every box for every class.
         Returns
         -------
         None
@@ -575,6 +611,8 @@ class YOLOV3Temporal(gluon.HybridBlock):
         self.nms_thresh = nms_thresh
         self.nms_topk = nms_topk
         self.post_nms = post_nms
+        for output in self.yolo_outputs:
+            output.pre_nms_topk = pre_nms_topk
 
     def reset_class(self, classes, reuse_weights=None):
         """Reset class categories and class predictors.
@@ -10,6 +10,77 @@ from mxnet import autograd
 from gluoncv.nn.bbox import BBoxCornerToCenter, BBoxCenterToCorner, BBoxBatchIOU
 
 
+class YOLOV3TargetGeometry(object):
+    """The anchors and strides of a YOLO V3 network's output layers, everything the prefetch target generator needs
+    from the network.
+    The anchors, offsets and feature map sizes for an input size are computed from these, rather than from a forward
+    pass of a copy of the network, so the training transforms don't hold a copy of the network.
+
+    Parameters
+    ----------
+    anchors : list of array-like
+        The anchors of each output layer, in the order of the network's `yolo_outputs`.
+    strides : list of int
+        The stride of each output layer.
+    num_class : int
+        Number of foreground classes.
+
+    """
+    def __init__(self, anchors, strides, num_class):
+        assert len(anchors) == len(strides)
+        self.anchors = [np.asarray(a, dtype='float32').reshape((1, 1, -1, 2)) for a in anchors]
+        self.strides = list(strides)
+        self.num_class = num_class
+
+    @classmethod
+    def from_net(cls, net):
+        """Get the geometry of a network, without running it.
+
+        Parameters
+        ----------
+        net : mxnet.gluon.HybridBlock
+            The YOLO V3 network, with `yolo_outputs` and `classes`.
+
+        Returns
+        -------
+        YOLOV3TargetGeometry
+            The network's geometry.
+
+        """
+        return cls([output.anchors.value.asnumpy() for output in net.yolo_outputs],
+                   [output._stride for output in net.yolo_outputs], len(net.classes))
+
+    def layout(self, width, height):
+        """Get the inputs of the prefetch target generator for an input size, as the network returns them in training
+        mode. Each feature map is the input size divided by its stride rounded up, as from the padded stride 2 convs.
+
+        Parameters
+        ----------
+        width : int
+            Input image width.
+        height : int
+            Input image height.
+
+        Returns
+        -------
+        tuple
+            img: a (1, 3, height, width) placeholder image.
+            xs: a placeholder (1, 1, h, w) feature map of each output layer, only the shape is used.
+            anchors: the anchors of each output layer.
+            offsets: the (1, h * w, 1, 2) x and y grid offsets of each output layer.
+
+        """
+        img = nd.zeros((1, 3, height, width))
+        xs, anchors, offsets = [], [], []
+        for anchor, stride in zip(self.anchors, self.strides):
+            h, w = -(-height // stride), -(-width // stride)
+            grid_x, grid_y = np.meshgrid(np.arange(w), np.arange(h))
+            xs.append(nd.zeros((1, 1, h, w)))
+            anchors.append(nd.array(anchor))
+            offsets.append(nd.array(np.stack((grid_x, grid_y), axis=-1).reshape((1, -1, 1, 2))))
+        return img, xs, anchors, offsets
+
+
 class YOLOV3PrefetchTargetGenerator(gluon.Block):
     """YOLO V3 prefetch target generator.
     The target generated by this instance is invariant to network predictions.
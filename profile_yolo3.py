@@ -0,0 +1,196 @@
+"""
+Profile the cost of a model configuration on the CPU, without training it: builds the model from the same flags as
+train_yolov3.py and detect_yolo3.py, and reports the FLOPs, parameters, forward and training activation memory and
+imperative time of each of its blocks, and the latency of the hybridized model, at the data_shape and window given (see
+utils/cost_model.py). The table is logged and saved as JSON, eg. for the framewise and a temporal darknet53:
+
+python profile_yolo3.py --name base --json profiles/base.json
+python profile_yolo3.py --name k_max_late --window 3,1 --k_join_type max --k_join_pos late --json profiles/k_max_late.json
+
+then rank the candidates by their cost:
+
+python profile_yolo3.py --rank profiles/base.json,profiles/k_max_late.json --rank_by latency
+"""
+from __future__ import division
+from __future__ import print_function
+
+from absl import app, flags, logging
+from absl.flags import FLAGS
+import json
+import mxnet as mx
+import os
+
+from utils.cost_model import profile_blocks, measure_latency
+
+flags.DEFINE_string('network', 'darknet53',
+                    'Base network name: darknet53, or mobilenet1.0, mobilenet0.75, mobilenet0.5, mobilenet0.25 or '
+                    'mobilenetv2_ with the same multipliers, which support the k_join, corr, rnn and mult_out options')
+flags.DEFINE_integer('num_classes', 30,
+                     'The number of classes.')
+flags.DEFINE_integer('batch_size', 1,
+                     'Batch size to profile at.')
+flags.DEFINE_integer('data_shape', 416,
+                     'Input data shape.')
+flags.DEFINE_list('window', '1, 1',
+                  'Temporal window size of frames and the frame gap/stride of the windows samples')
+flags.DEFINE_string('k_join_type', None,
+                    'way to fuse k type, either max, mean, cat.')
+flags.DEFINE_string('k_join_pos', None,
+                    'position of k fuse, either early or late.')
+flags.DEFINE_string('block_conv_type', '2',
+                    "convolution type for the YOLO blocks: '2'2D, '3':3D or '21':2+1D, must be used with 'late' joining")
+flags.DEFINE_string('rnn_pos', None,
+                    "position of RNN, currently only supports 'late' or 'out")
+flags.DEFINE_boolean('rnn_bi', True,
+                     'Bidirectional RNNs, --nornn_bi for unidirectional ones.')
+flags.DEFINE_string('corr_pos', None,
+                    "position of correlation features calculation, currently only supports 'early' or 'late")
+flags.DEFINE_integer('corr_d', 4,
+                     'The d value for the correlation filter.')
+flags.DEFINE_string('motion_stream', None,
+                    'Add a motion stream? can be flownet or r21d.')
+flags.DEFINE_string('stream_gating', None,
+                    'Use gating on the appearence stream using the motion stream. can be add or mul.')
+flags.DEFINE_list('conv_types', [2, 2, 2, 2, 2, 2],
+                  'Darknet Conv types for layers, either 2, 21, or 3 D')
+flags.DEFINE_string('h_join_type', None,
+                    'Type to join hierarchical darknet. can be max or conv.')
+flags.DEFINE_list('hier', [1, 1, 1, 1, 1],
+                  'the hierarchical factors, the input must be temporally equal to all these multiplied together')
+flags.DEFINE_boolean('mult_out', False,
+                     'Have one or multiple outs for timeseries data')
+flags.DEFINE_boolean('temp', False,
+                     'Use new temporal model')
+flags.DEFINE_boolean('new_model', False,
+                     'Use new model')
+flags.DEFINE_string('channel_spec', None,
+                    'The channel spec JSON of a pruned darknet53 model, from prune_yolo3.py, to profile it pruned.')
+
+flags.DEFINE_integer('depth', 2,
+                     'The depth of the blocks to report, eg. 2 reports stages.0 or yolo_blocks.1.')
+flags.DEFINE_integer('repeats', 10,
+                     'The number of forward passes of the hybridized model to time.')
+flags.DEFINE_string('name', None,
+                    'The name of the configuration in the table and JSON, default is the network.')
+flags.DEFINE_string('json', None,
+                    'Path to save the profile as JSON to.')
+flags.DEFINE_list('rank', [],
+                  'Rank the configurations of these saved JSON profiles rather than profiling one.')
+flags.DEFINE_enum('rank_by', 'latency', ['latency', 'flops', 'params', 'forward_bytes', 'training_bytes'],
+                  'The cost to rank the configurations by.')
+
+
+def get_net(classes):
+    """Build the configuration of the flags, on the CPU and randomly initialized"""
+    from models.definitions.prune import apply_channel_spec, load_channel_spec
+    from models.definitions.yolo.wrappers import yolo3_darknet53, yolo3_3ddarknet, YOLO3_MOBILENETS
+
+    if FLAGS.network == 'darknet53':
+        if FLAGS.conv_types[0] == 2:
+            net = yolo3_darknet53(classes, pretrained_base=False,
+                                  k=FLAGS.window[0], k_join_type=FLAGS.k_join_type, k_join_pos=FLAGS.k_join_pos,
+                                  block_conv_type=FLAGS.block_conv_type, rnn_pos=FLAGS.rnn_pos,
+                                  corr_pos=FLAGS.corr_pos, corr_d=FLAGS.corr_d, motion_stream=FLAGS.motion_stream,
+                                  add_type=FLAGS.stream_gating, new_model=FLAGS.new_model,
+                                  hierarchical=FLAGS.hier, h_join_type=FLAGS.h_join_type, temporal=FLAGS.temp,
+                                  t_out=FLAGS.mult_out, rnn_bi=FLAGS.rnn_bi)
+        else:
+            net = yolo3_3ddarknet(classes, pretrained_base=False, conv_types=FLAGS.conv_types)
+    elif FLAGS.network in YOLO3_MOBILENETS:
+        yolo3_mobilenet, multiplier = YOLO3_MOBILENETS[FLAGS.network]
+        net = yolo3_mobilenet(classes, multiplier=multiplier, pretrained_base=False,
+                              k=FLAGS.window[0], k_join_type=FLAGS.k_join_type, k_join_pos=FLAGS.k_join_pos,
+                              block_conv_type=FLAGS.block_conv_type, rnn_pos=FLAGS.rnn_pos,
+                              corr_pos=FLAGS.corr_pos, corr_d=FLAGS.corr_d, t_out=FLAGS.mult_out, rnn_bi=FLAGS.rnn_bi)
+    else:
+        raise NotImplementedError('Backbone CNN model {} not implemented.'.format(FLAGS.network))
+    if FLAGS.channel_spec:
+        apply_channel_spec(net, load_channel_spec(FLAGS.channel_spec))
+    net.initialize(ctx=mx.cpu())
+    return net
+
+
+def get_input():
+    """The random input, (B, 3, H, W), or (B, k, 3, H, W) for a temporal model, or (B, 3, k, H, W) for a 3D darknet"""
+    k, size = FLAGS.window[0], FLAGS.data_shape
+    if FLAGS.network == 'darknet53' and FLAGS.conv_types[0] != 2:
+        shape = (FLAGS.batch_size, 3, k, size, size)
+    elif k > 1:
+        shape = (FLAGS.batch_size, k, 3, size, size)
+    else:
+        shape = (FLAGS.batch_size, 3, size, size)
+    return mx.nd.random_normal(shape=shape, ctx=mx.cpu())
+
+
+def log_blocks(blocks, total):
+    """Log the table of the blocks' costs, and their total"""
+    logging.info('{:<24} {:>9} {:>11} {:>9} {:>10} {:>9}'.format(
+        'block', 'GFLOPs', 'params (M)', 'fwd (MB)', 'train (MB)', 'imp (ms)'))
+    for name, s in list(blocks.items()) + [('total', total)]:
+        logging.info('{:<24} {:9.2f} {:11.2f} {:9.1f} {:10.1f} {:9.1f}'.format(
+            name, s['flops'] / 1e9, s['params'] / 1e6, s['forward_bytes'] / 2 ** 20, s['training_bytes'] / 2 ** 20,
+            1000 * s['seconds']))
+
+
+def rank(paths):
+    """Log the configurations of the saved profiles ranked by their cost, cheapest first"""
+    profiles = list()
+    for path in paths:
+        with open(path, 'r') as f:
+            profiles.append(json.load(f))
+    profiles.sort(key=lambda p: p['total'][FLAGS.rank_by])
+
+    logging.info('{:<24} {:>11} {:>9} {:>11} {:>9} {:>10} {:>10}'.format(
+        'configuration', 'data_shape', 'GFLOPs', 'params (M)', 'fwd (MB)', 'train (MB)', 'CPU (ms)'))
+    for p in profiles:
+        t = p['total']
+        logging.info('{:<24} {:>11} {:9.2f} {:11.2f} {:9.1f} {:10.1f} {:10.1f}'.format(
+            p['name'], '{}x{}'.format(p['window'][0], p['data_shape']), t['flops'] / 1e9, t['params'] / 1e6,
+            t['forward_bytes'] / 2 ** 20, t['training_bytes'] / 2 ** 20, 1000 * t['latency']))
+
+
+def main(_argv):
+    if FLAGS.rank:
+        rank(FLAGS.rank)
+        return
+
+    FLAGS.window = [int(s) for s in FLAGS.window]
+    FLAGS.conv_types = [int(s) for s in FLAGS.conv_types]
+    FLAGS.hier = [int(s) for s in FLAGS.hier]
+    if FLAGS.window[0] == 1:  # a single frame has nothing to join
+        FLAGS.k_join_type, FLAGS.k_join_pos = None, None
+    if FLAGS.name is None:
+        FLAGS.name = FLAGS.network
+
+    net = get_net([str(c) for c in range(FLAGS.num_classes)])
+    x = get_input()
+    blocks = profile_blocks(net, [x], depth=FLAGS.depth)
+
+    # the blocks don't overlap, so their costs add up, except the forward memory of the largest block bounds the net's
+    total = {'flops': sum(s['flops'] for s in blocks.values()),
+             'params': sum(p.data().size for p in net.collect_params().values()
+                           if not isinstance(p, mx.gluon.Constant)),
+             'forward_bytes': max(s['forward_bytes'] for s in blocks.values()),
+             'training_bytes': sum(s['training_bytes'] for s in blocks.values()),
+             'seconds': sum(s['seconds'] for s in blocks.values())}
+    total['latency'] = measure_latency(net, [x], repeats=FLAGS.repeats)
+    log_blocks(blocks, total)
+    logging.info('{}: {:.2f} GFLOPs, {:.2f}M params, {:.1f}ms per forward pass on the CPU hybridized'.format(
+        FLAGS.name, total['flops'] / 1e9, total['params'] / 1e6, 1000 * total['latency']))
+
+    if FLAGS.json:
+        if os.path.dirname(FLAGS.json):
+            os.makedirs(os.path.dirname(FLAGS.json), exist_ok=True)
+        with open(FLAGS.json, 'w') as f:
+            json.dump({'name': FLAGS.name, 'network': FLAGS.network, 'window': FLAGS.window,
+                       'data_shape': FLAGS.data_shape, 'batch_size': FLAGS.batch_size,
+                       'flags': {name: FLAGS[name].value for name in
+                                 ['k_join_type', 'k_join_pos', 'block_conv_type', 'rnn_pos', 'rnn_bi', 'corr_pos',
+                                  'corr_d', 'motion_stream', 'stream_gating', 'conv_types', 'h_join_type', 'hier',
+                                  'mult_out', 'temp', 'new_model', 'channel_spec']},
+                       'blocks': blocks, 'total': total}, f, indent=2)
+        logging.info('Saved the profile to {}'.format(FLAGS.json))
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,187 @@
+"""
+Prune a trained framewise darknet53 YOLOV3 at several ratios and tabulate its CPU latency against its accuracy: for each
+ratio prunes the channels of the model (see models/definitions/prune.py), checks the pruned params load back into a
+model rebuilt from the channel spec, saves them to fine-tune, and times the pruned model on the CPU. eg. for VOC:
+
+python prune_yolo3.py --model_path models/experiments/0001/yolo3_darknet53_voc_best.params --dataset voc --ratios 0.25,0.5,0.75
+
+then fine-tune each pruned model, eg. the 0.5 one:
+
+python train_yolov3.py --dataset voc --save_prefix 0101 --epochs 30 --lr_decay_epoch 20,25 \
+    --channel_spec models/experiments/0001/pruned/yolo3_darknet53_voc_p50.json \
+    --resume models/experiments/0001/pruned/yolo3_darknet53_voc_p50.params
+
+and run again with the fine-tuned experiments, in the order of the ratios, to add their best validation mAP to the
+table, which is also saved as JSON in save_dir:
+
+python prune_yolo3.py --model_path models/experiments/0001/yolo3_darknet53_voc_best.params --dataset voc --ratios 0.25,0.5,0.75 --finetuned 0100,0101,0102
+
+For VID the same with --dataset vid, or evaluate the fine-tuned models with detect_yolo3.py --channel_spec for the video
+metrics.
+"""
+from __future__ import division
+from __future__ import print_function
+
+from absl import app, flags, logging
+from absl.flags import FLAGS
+import mxnet as mx
+from mxnet import gluon
+import json
+import os
+import re
+import time
+
+from models.definitions.fuse import check_equivalence
+from models.definitions.prune import prune_yolov3, apply_channel_spec, save_channel_spec
+from models.definitions.yolo.wrappers import yolo3_darknet53
+
+# the --dataset names of train_yolov3.py, and their class names files
+NAMES = {'voc': 'pascalvoc', 'coco': 'coco', 'det': 'imagenetdet', 'vid': 'imagenetvid'}
+
+flags.DEFINE_string('model_path', None,
+                    'The params of the trained framewise darknet53 YOLOV3 to prune.')
+flags.DEFINE_enum('dataset', 'voc', list(NAMES.keys()),
+                  'The dataset the model was trained on.')
+flags.DEFINE_list('ratios', [0.25, 0.5, 0.75],
+                  'The fractions of the prunable channels to remove.')
+flags.DEFINE_enum('criterion', 'gamma', ['gamma', 'l1'],
+                  'Rank the channels by the magnitude of their BatchNorm gamma or the L1 norm of their conv filter.')
+flags.DEFINE_enum('scope', 'global', ['global', 'layer'],
+                  'Rank the channels of all the prunable layers together, or of each layer separately.')
+flags.DEFINE_float('min_keep', 0.1,
+                   'The fraction of the channels of each layer to keep at least.')
+flags.DEFINE_integer('multiple', 8,
+                     'Round the channels kept in each layer up to a multiple of this.')
+flags.DEFINE_integer('data_shape', 416,
+                     'Input data shape to time the models at.')
+flags.DEFINE_integer('repeats', 20,
+                     'The number of forward passes to time.')
+flags.DEFINE_string('save_dir', None,
+                    'Directory to save the pruned params, channel specs and table to, default is a pruned directory '
+                    'next to model_path.')
+flags.DEFINE_list('finetuned', [],
+                  'The save_prefix of the fine-tuning experiment of each ratio, to read their best mAP from.')
+
+flags.mark_flag_as_required('model_path')
+
+
+def get_net(classes):
+    """Get the framewise darknet53 YOLOV3 with the trained params loaded"""
+    net = yolo3_darknet53(classes, pretrained_base=False, k=1)
+    net.load_parameters(FLAGS.model_path, ctx=mx.cpu())
+    return net
+
+
+def best_map(log_path):
+    """
+    Get the best validation mAP of a training run from its _best_map.log
+
+    Args:
+        log_path (str): the path to the _best_map.log
+
+    Returns:
+        float: the best mAP, None if there's no log
+    """
+    if not os.path.exists(log_path):
+        return None
+    with open(log_path, 'r') as f:
+        maps = [float(line.split(':')[1]) for line in f.readlines() if ':' in line]
+    return max(maps) if maps else None
+
+
+def time_cpu(net, x):
+    """
+    Time the hybridized network's forward passes, after one untimed pass that builds and plans the graph
+
+    Args:
+        net: the network
+        x: the input
+
+    Returns:
+        float: the mean seconds per pass
+    """
+    net.hybridize(static_alloc=True, static_shape=True)
+    net(x)
+    mx.nd.waitall()
+    tic = time.time()
+    for _ in range(FLAGS.repeats):
+        net(x)
+    mx.nd.waitall()
+    return (time.time() - tic) / max(FLAGS.repeats, 1)
+
+
+def prune_ratio(classes, ratio, x, name):
+    """
+    Prune the model at a ratio, check its params load into a model rebuilt from its channel spec and save them, and
+    time it
+
+    Args:
+        classes (list): the class names
+        ratio (float): the fraction of the prunable channels to remove, 0 for the unpruned model
+        x: the input to check and time on
+        name (str): the file name to save the params and channel spec to in save_dir, None to not save
+
+    Returns:
+        dict: the ratio, the prunable channels kept, the number of parameters and the seconds per pass
+    """
+    net = get_net(classes)
+    spec = prune_yolov3(net, ratio, criterion=FLAGS.criterion, scope=FLAGS.scope, min_keep=FLAGS.min_keep,
+                        multiple=FLAGS.multiple)
+    net.set_nms(nms_thresh=-1, pre_nms_topk=-1)  # compare the detections in a fixed order
+    if name is not None:
+        params_path = os.path.join(FLAGS.save_dir, name + '.params')
+        net.save_parameters(params_path)
+        save_channel_spec(spec, os.path.join(FLAGS.save_dir, name + '.json'))
+
+        rebuilt = yolo3_darknet53(classes, pretrained_base=False, k=1)
+        apply_channel_spec(rebuilt, spec)
+        rebuilt.load_parameters(params_path, ctx=mx.cpu())
+        rebuilt.set_nms(nms_thresh=-1, pre_nms_topk=-1)
+        check_equivalence(net(x), rebuilt(x))
+
+    net.set_nms(nms_thresh=0.45, nms_topk=400, pre_nms_topk=400)
+    params = sum(p.data().size for p in net.collect_params().values() if not isinstance(p, gluon.Constant))
+    return {'ratio': ratio, 'channels': sum(spec['channels'].values()), 'params': params,
+            'seconds': time_cpu(net, x)}
+
+
+def main(_argv):
+    FLAGS.ratios = [float(r) for r in FLAGS.ratios]
+    if FLAGS.finetuned and len(FLAGS.finetuned) != len(FLAGS.ratios):
+        raise ValueError('Give a fine-tuning experiment for each of the {} ratios'.format(len(FLAGS.ratios)))
+    if FLAGS.save_dir is None:
+        FLAGS.save_dir = os.path.join(os.path.dirname(FLAGS.model_path), 'pruned')
+    os.makedirs(FLAGS.save_dir, exist_ok=True)
+
+    with open(os.path.join('datasets', 'names', NAMES[FLAGS.dataset] + '.names'), 'r') as f:
+        classes = [line.strip() for line in f.readlines()]
+    x = mx.nd.random_normal(shape=(1, 3, FLAGS.data_shape, FLAGS.data_shape))
+
+    # the unpruned model first, its mAP from the run that trained it
+    rows = [prune_ratio(classes, 0, x, None)]
+    rows[0]['map'] = best_map(re.sub(r'_(best|\d{4})\.params$', '', FLAGS.model_path) + '_best_map.log')
+    for i, ratio in enumerate(FLAGS.ratios):
+        name = 'yolo3_darknet53_{}_p{:02d}'.format(FLAGS.dataset, int(round(100 * ratio)))
+        rows.append(prune_ratio(classes, ratio, x, name))
+        rows[-1]['map'] = None
+        if FLAGS.finetuned:
+            rows[-1]['map'] = best_map(os.path.join('models', 'experiments', FLAGS.finetuned[i],
+                                                    'yolo3_darknet53_{}_best_map.log'.format(FLAGS.dataset)))
+        logging.info('Saved {} to {}'.format(name, FLAGS.save_dir))
+
+    logging.info('{:>6} {:>9} {:>11} {:>10} {:>8} {:>7}'.format(
+        'ratio', 'channels', 'params (M)', 'CPU (ms)', 'speedup', 'mAP'))
+    for row in rows:
+        logging.info('{:6.2f} {:8.1f}% {:11.2f} {:10.1f} {:7.2f}x {:>7}'.format(
+            row['ratio'], 100 * row['channels'] / rows[0]['channels'], row['params'] / 1e6, 1000 * row['seconds'],
+            rows[0]['seconds'] / max(row['seconds'], 1e-9), '-' if row['map'] is None else '{:.4f}'.format(row['map'])))
+
+    table_path = os.path.join(FLAGS.save_dir, 'yolo3_darknet53_{}_prune_table.json'.format(FLAGS.dataset))
+    with open(table_path, 'w') as f:
+        json.dump({'dataset': FLAGS.dataset, 'data_shape': FLAGS.data_shape, 'criterion': FLAGS.criterion,
+                   'scope': FLAGS.scope, 'rows': rows}, f, indent=2)
+    logging.info('Saved the table to {}'.format(table_path))
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -3,8 +3,11 @@ from __future__ import print_function
 
 from absl import app, flags, logging
 from absl.flags import FLAGS
+from functools import partial
 import os
 import logging
+import re
+import sys
 import multiprocessing
 import time
 import warnings
@@ -31,11 +34,20 @@ from datasets.combined import CombinedDetection
 from metrics.pascalvoc import VOCMApMetric, VOCMApMetricTemporal
 from metrics.mscoco import COCODetectionMetric
 
-from models.definitions.yolo.wrappers import yolo3_darknet53, yolo3_no_backbone, yolo3_3ddarknet
+from models.definitions.prune import apply_channel_spec, load_channel_spec
+from models.definitions.yolo.wrappers import yolo3_darknet53, yolo3_no_backbone, yolo3_3ddarknet, YOLO3_MOBILENETS
+from models.definitions.yolo.yolo_target import YOLOV3TargetGeometry
 from models.definitions.yolo.transforms import YOLO3DefaultTrainTransform, YOLO3DefaultInferenceTransform, \
     YOLO3VideoTrainTransform, YOLO3VideoInferenceTransform, YOLO3NBVideoTrainTransform, YOLO3NBVideoInferenceTransform
 
+from utils.distributed import ShardedClipSampler, sample_groups
+from utils.checkpoint import ParamsCheckpointWriter, ResumableRandomSampler, TrainStateCheckpointer, \
+    snapshot_params, verify_checksum
 from utils.general import as_numpy
+from utils.loader_tuning import autotune_loader, tuning_key
+from utils.profiler import StepProfiler
+from utils.val_cache import CachedValLoader, cache_key
+from utils.validation import AsyncValidator, stratified_subset
 
 # disable autotune
 os.environ['MXNET_CUDNN_AUTOTUNE_DEFAULT'] = '0'
@@ -43,7 +55,8 @@ os.environ['MXNET_CUDNN_AUTOTUNE_DEFAULT'] = '0'
 logging.basicConfig(level=logging.INFO)
 
 flags.DEFINE_string('network', 'darknet53',
-                    'Base network name: darknet53')
+                    'Base network name: darknet53, or mobilenet1.0, mobilenet0.75, mobilenet0.5, mobilenet0.25 or '
+                    'mobilenetv2_ with the same multipliers, which support the k_join, corr, rnn and mult_out options')
 flags.DEFINE_list('dataset', ['voc'],
                   'Datasets to train on.')
 flags.DEFINE_list('dataset_val', [],
@@ -56,9 +69,29 @@ flags.DEFINE_integer('log_interval', 100,
                      'Logging mini-batch interval.')
 flags.DEFINE_integer('save_interval', -10,
                      'Saving parameters epoch interval, best model will always be saved. '
-                     'Can enter a negative int to save every 1 epochs, but delete after reach -save_interval')
+                     'Can enter a negative int to save every 1 epochs, but only keep the multiples of -save_interval '
+                     'beyond those kept by keep_last_checkpoints and keep_best_checkpoints')
+flags.DEFINE_integer('keep_last_checkpoints', 3,
+                     'The number of most recent epoch checkpoints to keep, -1 keeps all.')
+flags.DEFINE_integer('keep_best_checkpoints', 1,
+                     'The number of best validation mAP epoch checkpoints to keep.')
 flags.DEFINE_integer('val_interval', 1,
                      'Epoch interval for validation.')
+flags.DEFINE_string('val_cache_dir', None,
+                    'Cache the resized uint8 val images and padded labels in memory mapped files in this directory, '
+                    'built on the first validation and reused by later ones and runs with the same dataset config and '
+                    'data_shape. Not used with features_dir.')
+flags.DEFINE_boolean('async_val', False,
+                     'Validate parameter snapshots in a separate worker process while training continues, the mAPs '
+                     'are reported back for best model selection and tensorboard when they finish.')
+flags.DEFINE_list('val_gpus', [],
+                  'GPU IDs for the async_val worker, empty uses the CPU.')
+flags.DEFINE_float('val_subset', 1.0,
+                   'With async_val, the fraction of the val set to evaluate on, a stratified subset (every clip of '
+                   'video datasets) that is the same each time. The full set is used every val_full_interval.')
+flags.DEFINE_integer('val_full_interval', 1,
+                     'With async_val and a val_subset, evaluate on the full val set every this many validations. '
+                     'Only full evaluations are used for best model selection.')
 flags.DEFINE_string('resume', '',
                     'Resume from previously saved parameters if not None.')
 flags.DEFINE_boolean('nd_only', False,
@@ -119,10 +152,27 @@ flags.DEFINE_boolean('temp', False,
 
 flags.DEFINE_list('gpus', [0],
                   'GPU IDs to use. Use comma for multiple eg. 0,1.')
+flags.DEFINE_string('kvstore', 'local',
+                    'The kvstore, dist_sync or dist_device_sync for data parallel training over several processes or '
+                    'machines started with launch_dist.py. Each process trains on its own shard of whole clips with '
+                    'batch_size samples a step, only the first does the logging, validation and saving.')
 flags.DEFINE_integer('num_workers', -1,
                      'The number of workers should be picked so that it’s equal to number of cores on your machine '
                      'for max parallelization. If this number is bigger than your number of cores it will use up '
                      'a bunch of extra CPU memory. -1 is auto.')
+flags.DEFINE_integer('prefetch', -1,
+                     'The number of batches the train loader workers prefetch, -1 is twice num_workers.')
+flags.DEFINE_boolean('thread_pool', False,
+                     'Use threads for the loader workers rather than processes. Not used with the random shape train '
+                     'loader.')
+flags.DEFINE_boolean('autotune_loader', False,
+                     'Tune num_workers, prefetch and thread_pool for the train loader by timing it on its own over the '
+                     'dataset, caching the settings for the dataset, window, data_shape and host in '
+                     'autotune_cache. Logs the samples/sec ceiling of the input pipeline.')
+flags.DEFINE_integer('autotune_batches', 20,
+                     'The number of batches autotune_loader times for each setting.')
+flags.DEFINE_string('autotune_cache', os.path.join('models', 'loader_tuning.json'),
+                    'The json file of the autotune_loader settings.')
 flags.DEFINE_boolean('new_model', False,
                      'Use features Yolo (new) or stages Yolo (old)?')
 
@@ -145,6 +195,8 @@ flags.DEFINE_string('block_conv_type', '2',
                     "convolution type for the YOLO blocks: '2'2D, '3':3D or '21':2+1D, must be used with 'late' joining")
 flags.DEFINE_string('rnn_pos', None,
                     "position of RNN, currently only supports 'late' or 'out")
+flags.DEFINE_boolean('rnn_bi', True,
+                     'Bidirectional RNNs, --nornn_bi for unidirectional ones that can stream at inference.')
 flags.DEFINE_string('corr_pos', None,
                     "position of correlation features calculation, currently only supports 'early' or 'late")
 flags.DEFINE_integer('corr_d', 0,
@@ -160,9 +212,34 @@ flags.DEFINE_string('h_join_type', None,
 flags.DEFINE_list('hier', [1, 1, 1, 1, 1],
                   'the hierarchical factors, the input must be temporally equal to all these multiplied together')
 
+flags.DEFINE_integer('accumulate', 1,
+                     'Accumulate the gradients of this many batches for each update, for an effective batch size of '
+                     'batch_size * accumulate when the activations of long windows only fit small batches.')
+flags.DEFINE_boolean('recompute', False,
+                     'Recompute the backbone stage activations in the backward pass rather than keeping them, '
+                     'trading an extra forward of the stages for their activation memory. Only the blocks within the '
+                     'model are hybridized.')
+flags.DEFINE_string('channel_spec', None,
+                    'The channel spec JSON of a pruned model (see prune_yolo3.py) to build the model to, fine-tune '
+                    'it by also giving its pruned params to --resume. Only for the framewise (window 1) darknet53.')
 flags.DEFINE_integer('max_epoch_time', -1,
                      'Max minutes an epoch can run for before we cut it off')
 
+flags.DEFINE_integer('checkpoint_interval', 0,
+                     'Save a checkpoint of the full training state (trainer, lr schedule, random states, data order '
+                     'and position) every this many steps, written in the background. --resume continues from it at '
+                     'the exact next batch. 0 is off.')
+
+flags.DEFINE_boolean('profile', False,
+                     'Time each phase of the training steps (data wait, load, forward/backward, step, metrics), '
+                     'reporting percentiles every log_interval to tensorboard and a _profile.jsonl log. Adds syncs.')
+flags.DEFINE_integer('profile_window', 100,
+                     'The number of recent steps the profile percentiles are over.')
+flags.DEFINE_integer('profile_trace_start', -1,
+                     'If profile, the global step to start an MXNet profiler trace at. -1 is no trace.')
+flags.DEFINE_integer('profile_trace_steps', 10,
+                     'If profile_trace_start, the number of steps to trace.')
+
 
 def get_dataset(dataset_name, dataset_val_name, save_prefix=''):
     train_datasets = list()
@@ -231,23 +308,31 @@ def get_dataset(dataset_name, dataset_val_name, save_prefix=''):
     return train_dataset, val_dataset, val_metric
 
 
-def get_dataloader(net, train_dataset, val_dataset, batch_size):
+def get_dataloader(net, train_dataset, val_dataset, batch_size, sampler=None):
     """Get dataloader."""
+    return get_train_dataloader(net, train_dataset, batch_size, sampler=sampler), \
+        get_val_dataloader(val_dataset, batch_size)
+
+
+def get_train_dataloader(net, train_dataset, batch_size, sampler=None, num_workers=None, prefetch=None,
+                         thread_pool=None):
+    """Get the train dataloader, with the loader settings from the flags unless given."""
     width, height = FLAGS.data_shape, FLAGS.data_shape
+    shuffle = sampler is None  # otherwise the sampler shuffles
+    geometry = YOLOV3TargetGeometry.from_net(net)  # the transforms only need the anchors and strides, not the network
+    num_workers = FLAGS.num_workers if num_workers is None else num_workers
+    if prefetch is None:
+        prefetch = FLAGS.prefetch if FLAGS.prefetch >= 0 else None
+    thread_pool = FLAGS.thread_pool if thread_pool is None else thread_pool
 
     if FLAGS.features_dir is not None:  # the input is pre-saved features
         batchify_fn = Tuple(*([Stack() for _ in range(8)] + [Pad(axis=0, pad_val=-1) for _ in range(1)]))
         train_loader = gluon.data.DataLoader(
-            train_dataset.transform(YOLO3NBVideoTrainTransform(FLAGS.window[0], width, height, net, mixup=FLAGS.mixup)),
-            batch_size, True, batchify_fn=batchify_fn, last_batch='rollover', num_workers=FLAGS.num_workers)
+            train_dataset.transform(YOLO3NBVideoTrainTransform(FLAGS.window[0], width, height, geometry, mixup=FLAGS.mixup)),
+            batch_size, shuffle, sampler=sampler, batchify_fn=batchify_fn, last_batch='rollover',
+            num_workers=num_workers, prefetch=prefetch, thread_pool=thread_pool)
 
-        val_batchify_fn = Tuple(Stack(), Pad(pad_val=-1))
-        val_batchify_fn = Tuple(*([Stack() for _ in range(3)] + [Pad(axis=0, pad_val=-1) for _ in range(1)]))
-        val_loader = gluon.data.DataLoader(
-            val_dataset.transform(YOLO3NBVideoInferenceTransform(width, height)),
-            batch_size, False, batchify_fn=val_batchify_fn, last_batch='discard', num_workers=FLAGS.num_workers)
-
-        return train_loader, val_loader
+        return train_loader
 
     # stack image, all targets generated
     if FLAGS.mult_out:
@@ -257,72 +342,89 @@ def get_dataloader(net, train_dataset, val_dataset, batch_size):
 
     if FLAGS.no_random_shape:
         train_loader = gluon.data.DataLoader(
-            train_dataset.transform(YOLO3VideoTrainTransform(FLAGS.window[0], width, height, net, mixup=FLAGS.mixup)),
-            # train_dataset.transform(YOLO3DefaultTrainTransform(width, height, net, mixup=FLAGS.mixup)),
-            batch_size, True, batchify_fn=batchify_fn, last_batch='rollover', num_workers=FLAGS.num_workers)
+            train_dataset.transform(YOLO3VideoTrainTransform(FLAGS.window[0], width, height, geometry, mixup=FLAGS.mixup)),
+            # train_dataset.transform(YOLO3DefaultTrainTransform(width, height, geometry, mixup=FLAGS.mixup)),
+            batch_size, shuffle, sampler=sampler, batchify_fn=batchify_fn, last_batch='rollover',
+            num_workers=num_workers, prefetch=prefetch, thread_pool=thread_pool)
     else:
         if FLAGS.motion_stream == 'flownet': # get shape errors for some of the rand shapes as the conv floor messes up on deconv
-            transform_fns = [YOLO3VideoTrainTransform(FLAGS.window[0], x * 32, x * 32, net, mixup=FLAGS.mixup) for x in range(10, 20, 2)]
+            transform_fns = [YOLO3VideoTrainTransform(FLAGS.window[0], x * 32, x * 32, geometry, mixup=FLAGS.mixup) for x in range(10, 20, 2)]
         else:
-            transform_fns = [YOLO3VideoTrainTransform(FLAGS.window[0], x * 32, x * 32, net, mixup=FLAGS.mixup) for x in range(10, 20)]
-        # transform_fns = [YOLO3DefaultTrainTransform(x * 32, x * 32, net, mixup=FLAGS.mixup) for x in range(10, 20)]
+            transform_fns = [YOLO3VideoTrainTransform(FLAGS.window[0], x * 32, x * 32, geometry, mixup=FLAGS.mixup) for x in range(10, 20)]
+        # transform_fns = [YOLO3DefaultTrainTransform(x * 32, x * 32, geometry, mixup=FLAGS.mixup) for x in range(10, 20)]
         train_loader = RandomTransformDataLoader(
             transform_fns, train_dataset, batch_size=batch_size, interval=10, last_batch='rollover',
-            shuffle=True, batchify_fn=batchify_fn, num_workers=FLAGS.num_workers)
+            shuffle=shuffle, sampler=sampler, batchify_fn=batchify_fn, num_workers=num_workers, prefetch=prefetch)
 
-    if FLAGS.mult_out:
-        val_batchify_fn = Tuple(Stack(), Pad(axis=1, pad_val=-1))
+    return train_loader
+
+
+def get_val_dataloader(val_dataset, batch_size, indices=None):
+    """Get the validation dataloader, over only the indices samples if given."""
+    width, height = FLAGS.data_shape, FLAGS.data_shape
+
+    if FLAGS.features_dir is not None:  # the input is pre-saved features
+        val_batchify_fn = Tuple(*([Stack() for _ in range(3)] + [Pad(axis=0, pad_val=-1) for _ in range(1)]))
+        val_transform = YOLO3NBVideoInferenceTransform(width, height)
     else:
-        val_batchify_fn = Tuple(Stack(), Pad(pad_val=-1))
+        if FLAGS.mult_out:
+            val_batchify_fn = Tuple(Stack(), Pad(axis=1, pad_val=-1))
+        else:
+            val_batchify_fn = Tuple(Stack(), Pad(pad_val=-1))
+        val_transform = YOLO3VideoInferenceTransform(width, height)
+        # val_transform = YOLO3DefaultInferenceTransform(width, height)
+
+        if FLAGS.val_cache_dir is not None:  # serve the deterministic resize from the cache
+            key = cache_key(val_dataset, data_shape=FLAGS.data_shape, window=FLAGS.window, every=FLAGS.every,
+                            mult_out=FLAGS.mult_out)
+            return CachedValLoader(val_dataset, val_transform, batch_size, FLAGS.val_cache_dir, key, indices=indices,
+                                   num_workers=FLAGS.num_workers)
+
     val_loader = gluon.data.DataLoader(
-        val_dataset.transform(YOLO3VideoInferenceTransform(width, height)),
-        # val_dataset.transform(YOLO3DefaultInferenceTransform(width, height)),
-        batch_size, False, batchify_fn=val_batchify_fn, last_batch='discard', num_workers=FLAGS.num_workers)
+        val_dataset.transform(val_transform), batch_size, sampler=indices, batchify_fn=val_batchify_fn,
+        last_batch='discard', num_workers=FLAGS.num_workers)
     # NOTE for val batch loader last_batch='keep' changed to last_batch='discard' so exception not thrown
     # when last batch size is smaller than the number of GPUS (which throws exception) this is fixed in gluon
     # PR 14607: https://github.com/apache/incubator-mxnet/pull/14607 - but yet to be in official release
     # discarding last batch will incur minor changes in val results as some val data wont be processed
 
-    return train_loader, val_loader
+    return val_loader
 
 
-def save_params(net, best_map, current_map, epoch, save_interval, prefix):
+def save_params(writer, net, best_map, current_map, epoch, save_interval):
+    """Queue the epoch's checkpoints on the background writer, which applies the retention policy"""
     current_map = float(current_map)
-    if current_map > best_map[0]:
+    best = current_map > best_map[0]
+    if best:
         best_map[0] = current_map
-        net.save_parameters('{:s}_best.params'.format(prefix, epoch, current_map))
-        with open(prefix+'_best_map.log', 'a') as f:
-            f.write('{:04d}:\t{:.4f}\n'.format(epoch, current_map))
-
-    if save_interval > 0 and epoch % save_interval == 0:  # save only these epochs
-        # net.save_parameters('{:s}_{:04d}_{:.4f}.params'.format(prefix, epoch, current_map))
-        net.save_parameters('{:s}_{:04d}.params'.format(prefix, epoch))
 
-    if save_interval < 0:  # save every epoch, but delete nonwanted when reach a desired interval...
-        # good for if training stopped within intervals and dont want to waste space with save_interval = 1
-        net.save_parameters('{:s}_{:04d}.params'.format(prefix, epoch))
-
-        if epoch % -save_interval == 0:  # delete the ones we don't want
-            st = epoch + save_interval + 1
-            for d in range(max(0, st), epoch):
-                if os.path.exists('{:s}_{:04d}.params'.format(prefix, d)):
-                    os.remove('{:s}_{:04d}.params'.format(prefix, d))
+    # save only the interval epochs, or if negative save every epoch but only keep the interval epochs as milestones,
+    # good for if training stopped within intervals and dont want to waste space with save_interval = 1
+    milestone = save_interval != 0 and epoch % abs(save_interval) == 0
+    writer.save(net, epoch, current_map, epoch_file=save_interval < 0 or milestone, best=best, milestone=milestone)
 
 
 def resume(net, async_net, resume, start_epoch):
     """Resume model, can find the latest automatically"""
-    # Requires the first digit of epoch in save string is a 0, otherwise may need to reimplement with .split()
+    # Requires the epoch in save string is 4 digits, otherwise may need to reimplement with .split()
     if start_epoch == -1:
         files = os.listdir(resume.strip())
-        files = [file for file in files if '_0' in file]
-        files = [file for file in files if '.params' in file]
+        files = [file for file in files if re.search(r'_\d{4}\.params$', file)]
         files.sort()
-        resume_file = files[-1]
+        # take the latest that isn't corrupt, a checkpoint without a checksum is trusted
+        for resume_file in reversed(files):
+            if verify_checksum(os.path.join(resume.strip(), resume_file)) is not False:
+                break
+            logging.warning('Checksum mismatch for {}, skipping it'.format(resume_file))
+        else:
+            raise ValueError('No uncorrupted checkpoint to resume from in {}'.format(resume.strip()))
         start_epoch = int(resume_file[:-7].split('_')[-1]) + 1
 
         net.load_parameters(os.path.join(resume.strip(), resume_file))
         async_net.load_parameters(os.path.join(resume.strip(), resume_file))
     else:
+        if verify_checksum(resume.strip()) is False:
+            raise ValueError('Checksum mismatch for {}, the checkpoint is corrupt'.format(resume.strip()))
         net.load_parameters(resume.strip())
         async_net.load_parameters(resume.strip())
 
@@ -357,7 +459,7 @@ def get_net(trained_on_dataset, ctx, definition='ours'):
                                           corr_pos=FLAGS.corr_pos, corr_d=FLAGS.corr_d, motion_stream=FLAGS.motion_stream,
                                           add_type=FLAGS.stream_gating, new_model=FLAGS.new_model,
                                           hierarchical=FLAGS.hier, h_join_type=FLAGS.h_join_type,
-                                          temporal=FLAGS.temp, t_out=FLAGS.mult_out)
+                                          temporal=FLAGS.temp, t_out=FLAGS.mult_out, rnn_bi=FLAGS.rnn_bi)
                     async_net = yolo3_darknet53(trained_on_dataset.classes,
                                                 pretrained_base=False,
                                                 freeze_base=bool(FLAGS.freeze_base),
@@ -367,7 +469,8 @@ def get_net(trained_on_dataset, ctx, definition='ours'):
                                                 motion_stream=FLAGS.motion_stream, add_type=FLAGS.stream_gating,
                                                 new_model=FLAGS.new_model,
                                                 hierarchical=FLAGS.hier, h_join_type=FLAGS.h_join_type,
-                                                temporal=FLAGS.temp, t_out=FLAGS.mult_out)  # used by cpu worker
+                                                temporal=FLAGS.temp, t_out=FLAGS.mult_out,
+                                                rnn_bi=FLAGS.rnn_bi)  # used by cpu worker
                 else:
                     net = yolo3_3ddarknet(trained_on_dataset.classes,
                                           pretrained_base=FLAGS.pretrained_cnn,
@@ -389,7 +492,7 @@ def get_net(trained_on_dataset, ctx, definition='ours'):
                                           corr_pos=FLAGS.corr_pos, corr_d=FLAGS.corr_d, motion_stream=FLAGS.motion_stream,
                                           add_type=FLAGS.stream_gating, new_model=FLAGS.new_model,
                                           hierarchical=FLAGS.hier, h_join_type=FLAGS.h_join_type,
-                                          temporal=FLAGS.temp, t_out=FLAGS.mult_out)
+                                          temporal=FLAGS.temp, t_out=FLAGS.mult_out, rnn_bi=FLAGS.rnn_bi)
                     async_net = net
                 else:
                     net = yolo3_3ddarknet(trained_on_dataset.classes,
@@ -398,6 +501,24 @@ def get_net(trained_on_dataset, ctx, definition='ours'):
                                           conv_types=FLAGS.conv_types)
                     async_net = net
 
+        elif FLAGS.network in YOLO3_MOBILENETS:
+            assert FLAGS.motion_stream is None and not FLAGS.new_model and not FLAGS.temp and FLAGS.hier[0] == 1, \
+                'The MobileNet backbones only support the k_join, corr, rnn and mult_out temporal options'
+            yolo3_mobilenet, multiplier = YOLO3_MOBILENETS[FLAGS.network]
+            kwargs = dict(multiplier=multiplier, freeze_base=bool(FLAGS.freeze_base),
+                          k=FLAGS.window[0], k_join_type=FLAGS.k_join_type, k_join_pos=FLAGS.k_join_pos,
+                          block_conv_type=FLAGS.block_conv_type, rnn_pos=FLAGS.rnn_pos,
+                          corr_pos=FLAGS.corr_pos, corr_d=FLAGS.corr_d, t_out=FLAGS.mult_out, rnn_bi=FLAGS.rnn_bi)
+            if FLAGS.syncbn and len(ctx) > 1:
+                net = yolo3_mobilenet(trained_on_dataset.classes, pretrained_base=FLAGS.pretrained_cnn,
+                                      norm_layer=gluon.contrib.nn.SyncBatchNorm,
+                                      norm_kwargs={'num_devices': len(ctx)}, **kwargs)
+                async_net = yolo3_mobilenet(trained_on_dataset.classes, pretrained_base=False,
+                                            **kwargs)  # used by cpu worker
+            else:
+                net = yolo3_mobilenet(trained_on_dataset.classes, pretrained_base=FLAGS.pretrained_cnn, **kwargs)
+                async_net = net
+
         else:
             raise NotImplementedError('Backbone CNN model {} not implemented.'.format(FLAGS.network))
 
@@ -419,6 +540,12 @@ def get_net(trained_on_dataset, ctx, definition='ours'):
         else:
             raise NotImplementedError('Backbone CNN model {} not implemented.'.format(FLAGS.network))
 
+    if FLAGS.channel_spec:  # rebuild the pruned cells before loading the pruned params into them
+        spec = load_channel_spec(FLAGS.channel_spec)
+        apply_channel_spec(net, spec)
+        if async_net is not net:
+            apply_channel_spec(async_net, spec)
+
     if FLAGS.resume.strip():
         start_epoch = resume(net, async_net, FLAGS.resume, FLAGS.start_epoch)
     else:
@@ -435,7 +562,7 @@ def validate(net, val_data, ctx, eval_metric):
     """Test on validation dataset."""
     eval_metric.reset()
     # set nms threshold and topk constraint
-    net.set_nms(nms_thresh=0.45, nms_topk=400)
+    net.set_nms(nms_thresh=0.45, nms_topk=400, pre_nms_topk=400)  # the same detections, decoding fewer
     mx.nd.waitall()
     if not FLAGS.nd_only:
         net.hybridize()
@@ -489,8 +616,56 @@ def validate(net, val_data, ctx, eval_metric):
     return eval_metric.get()
 
 
-def train(net, train_data, train_dataset, val_data, eval_metric, ctx, save_prefix, start_epoch, num_samples):
+def validation_worker_setup(flag_values, save_prefix):
+    """Set up the async_val worker process, returning its evaluate(params, full) function."""
+    FLAGS([sys.argv[0]])  # the flags aren't parsed in the spawned process, so take the trainer's values
+    for name, value in flag_values.items():
+        setattr(FLAGS, name, value)
+    FLAGS.resume = ''  # the parameters come from the snapshots
+
+    ctx = [mx.gpu(int(i)) for i in FLAGS.val_gpus]
+    ctx = ctx if ctx else [mx.cpu()]
+
+    train_dataset, val_dataset, eval_metric = get_dataset(FLAGS.dataset, FLAGS.dataset_val, save_prefix)
+    trained_on_dataset = train_dataset
+    if FLAGS.trained_on:
+        trained_on_dataset, _, _ = get_dataset(FLAGS.trained_on, FLAGS.trained_on, save_prefix)
+    net = get_val_net(train_dataset, trained_on_dataset, ctx)
+
+    full_data = get_val_dataloader(val_dataset, FLAGS.batch_size)
+    subset_data = full_data
+    if FLAGS.val_subset < 1:
+        subset_data = get_val_dataloader(val_dataset, FLAGS.batch_size,
+                                         stratified_subset(val_dataset, FLAGS.val_subset))
+
+    return snapshot_evaluator(net, full_data, subset_data, eval_metric, ctx)
+
+
+def get_val_net(train_dataset, trained_on_dataset, ctx):
+    """Build the async_val worker's network, with its classes reset as in main so the snapshots' shapes match."""
+    net, _, _ = get_net(trained_on_dataset, ctx)
+    if FLAGS.trained_on:
+        net.reset_class(train_dataset.classes)
+    return net
+
+
+def snapshot_evaluator(net, full_data, subset_data, eval_metric, ctx):
+    """Get the async_val worker's evaluate(params, full), loading a snapshot into net and validating it."""
+    def evaluate(params, full):
+        for name, param in net._collect_params_with_prefix().items():
+            param._load_init(params[name], ctx)
+        return validate(net, full_data if full else subset_data, ctx, eval_metric)
+
+    return evaluate
+
+
+def train(net, train_data, train_dataset, val_data, eval_metric, ctx, save_prefix, start_epoch, num_samples,
+          sampler=None, kv=None):
     """Training pipeline"""
+    # with a distributed kvstore only the first process logs, validates and saves
+    num_parts = kv.num_workers if kv is not None else 1
+    is_master = kv is None or kv.rank == 0
+
     net.collect_params().reset_ctx(ctx)
     if FLAGS.no_wd:
         for k, v in net.collect_params('.*beta|.*gamma|.*bias').items():
@@ -499,6 +674,14 @@ def train(net, train_data, train_dataset, val_data, eval_metric, ctx, save_prefi
     if FLAGS.label_smooth:
         net._target_generator._label_smooth = True
 
+    if FLAGS.accumulate > 1:  # the gradients are added up over the batches of an update, then zeroed
+        for param in net.collect_params().values():
+            if param.grad_req != 'null':
+                param.grad_req = 'add'
+
+    if FLAGS.recompute:
+        net.recompute = True
+
     if FLAGS.lr_decay_period > 0:
         lr_decay_epoch = list(range(FLAGS.lr_decay_period, FLAGS.epochs, FLAGS.lr_decay_period))
     else:
@@ -513,7 +696,7 @@ def train(net, train_data, train_dataset, val_data, eval_metric, ctx, save_prefi
             lr_decay_epoch_tmp.append(int(e) - start_epoch - FLAGS.warmup_epochs)
     lr_decay_epoch = lr_decay_epoch_tmp
 
-    num_batches = num_samples // FLAGS.batch_size
+    num_batches = num_samples // (FLAGS.batch_size * FLAGS.accumulate)  # the updates per epoch
     lr_scheduler = LRSequential([
         LRScheduler('linear', base_lr=0, target_lr=FLAGS.lr,
                     nepochs=FLAGS.warmup_epochs, iters_per_epoch=num_batches),
@@ -527,7 +710,7 @@ def train(net, train_data, train_dataset, val_data, eval_metric, ctx, save_prefi
     trainer = gluon.Trainer(
         net.collect_params(), 'sgd',
         {'wd': FLAGS.wd, 'momentum': FLAGS.momentum, 'lr_scheduler': lr_scheduler},
-        kvstore='local')
+        kvstore=kv if kv is not None else FLAGS.kvstore)
 
     # targets
     sigmoid_ce = gluon.loss.SigmoidBinaryCrossEntropyLoss(from_sigmoid=False)
@@ -542,17 +725,23 @@ def train(net, train_data, train_dataset, val_data, eval_metric, ctx, save_prefi
     # set up logger
     logging.basicConfig()
     logger = logging.getLogger()
-    logger.setLevel(logging.INFO)
+    logger.setLevel(logging.INFO if is_master else logging.WARNING)
     log_file_path = save_prefix + '_train.log'
     log_dir = os.path.dirname(log_file_path)
     if log_dir and not os.path.exists(log_dir):
         os.makedirs(log_dir)
-    fh = logging.FileHandler(log_file_path)
-    logger.addHandler(fh)
+    if is_master:
+        fh = logging.FileHandler(log_file_path)
+        logger.addHandler(fh)
     # logger.info(FLAGS)
 
     # set up tensorboard summary writer
-    tb_sw = SummaryWriter(log_dir=os.path.join(log_dir, 'tb'), comment=FLAGS.save_prefix)
+    tb_sw = SummaryWriter(log_dir=os.path.join(log_dir, 'tb'), comment=FLAGS.save_prefix) if is_master else None
+
+    # set up the per phase step profiler, does nothing unless enabled
+    profiler = StepProfiler(save_prefix + '_profile.jsonl', tb_sw=tb_sw, enabled=FLAGS.profile and is_master,
+                            window=FLAGS.profile_window, trace_start=FLAGS.profile_trace_start,
+                            trace_steps=FLAGS.profile_trace_steps)
 
     # Check if wanting to resume
     logger.info('Start training from [Epoch {}]'.format(start_epoch))
@@ -563,6 +752,44 @@ def train(net, train_data, train_dataset, val_data, eval_metric, ctx, save_prefi
     else:
         best_map = [0]
 
+    # parameter checkpoints are written in the background, as is the full training state
+    writer = ParamsCheckpointWriter(save_prefix, keep_last=FLAGS.keep_last_checkpoints,
+                                    keep_best=FLAGS.keep_best_checkpoints)
+
+    # validate in a worker process, the mAPs are reported back when done
+    validator = None
+    val_snapshots = dict()  # epoch -> the parameters of full validations in progress, to save if they're the best
+    val_count = 0
+    if FLAGS.async_val and is_master:
+        validator = AsyncValidator(validation_worker_setup, (FLAGS.flag_values_dict(), save_prefix))
+
+    def report_val(results):
+        for result in results:
+            val_msg = '\n'.join(['{}={}'.format(k, v) for k, v in zip(result['names'], result['values'])])
+            current_map = result['values'][-1]
+            if result['full']:
+                tb_sw.add_scalar(tag='Validation_mAP', scalar_value=current_map, global_step=result['step'])
+                logger.info('[Epoch {}] Validation ({:.1f}s): \n{}'.format(result['epoch'], result['seconds'],
+                                                                          val_msg))
+                writer.update_map(result['epoch'], current_map)
+                params = val_snapshots.pop(result['epoch'])
+                if current_map > best_map[0]:
+                    best_map[0] = current_map
+                    writer.save_snapshot(params, result['epoch'], current_map, epoch_file=False, best=True)
+            else:
+                tb_sw.add_scalar(tag='Validation_mAP_subset', scalar_value=current_map, global_step=result['step'])
+                logger.info('[Epoch {}] Subset validation ({:.1f}s): \n{}'.format(result['epoch'],
+                                                                                 result['seconds'], val_msg))
+
+    # resume mid epoch from the full training state if there is one
+    checkpointer = TrainStateCheckpointer(save_prefix)
+    start_batch = 0
+    if FLAGS.resume.strip() and FLAGS.checkpoint_interval and checkpointer.exists():
+        state = checkpointer.load(net, trainer, sampler, ctx, seed=FLAGS.seed)
+        start_epoch, start_batch, best_map = state['epoch'], state['batch'], state['best_map']
+        logger.info('Resuming from the training state checkpoint at [Epoch {}][Batch {}]'.format(start_epoch,
+                                                                                              start_batch))
+
     # Training loop
     num_batches = int(len(train_dataset)/FLAGS.batch_size)
     for epoch in range(start_epoch, FLAGS.epochs+1):
@@ -583,63 +810,91 @@ def train(net, train_data, train_dataset, val_data, eval_metric, ctx, save_prefi
         tic = time.time()
         btic = time.time()
         if not FLAGS.nd_only:
-            net.hybridize()
-        for i, batch in enumerate(train_data):
+            if FLAGS.recompute:  # recomputation runs imperatively, so only hybridize the blocks within the model
+                net.hybridize(active=False)  # validate() hybridizes the whole model
+                for block in net._children.values():
+                    block.hybridize()
+            else:
+                net.hybridize()
+        profiler.reset_wait()
+        accumulated = 0  # the samples in the gradients since the last update
+        if FLAGS.accumulate > 1:
+            net.collect_params().zero_grad()
+        for i, batch in enumerate(train_data, start_batch):
             batch_size = batch[0].shape[0]
+            profiler.start_step(epoch * len(train_data) + i)
 
             if FLAGS.max_epoch_time > 0 and (time.time()-st)/60 > FLAGS.max_epoch_time:
                 logger.info('Max epoch time of %d minutes reached after completing %d%% of epoch. '
                             'Moving on to next epoch' % (FLAGS.max_epoch_time, int(100*(i/num_batches))))
                 break
 
-            if FLAGS.features_dir is not None:
-                f1 = gluon.utils.split_and_load(batch[0], ctx_list=ctx, batch_axis=0)
-                f2 = gluon.utils.split_and_load(batch[1], ctx_list=ctx, batch_axis=0)
-                f3 = gluon.utils.split_and_load(batch[2], ctx_list=ctx, batch_axis=0)
-                # objectness, center_targets, scale_targets, weights, class_targets
-                fixed_targets = [gluon.utils.split_and_load(batch[it], ctx_list=ctx, batch_axis=0) for it in range(3, 8)]
-                gt_boxes = gluon.utils.split_and_load(batch[8], ctx_list=ctx, batch_axis=0)
-            else:
-                data = gluon.utils.split_and_load(batch[0], ctx_list=ctx, batch_axis=0)
-                # objectness, center_targets, scale_targets, weights, class_targets
-                fixed_targets = [gluon.utils.split_and_load(batch[it], ctx_list=ctx, batch_axis=0) for it in range(1, 6)]
-                gt_boxes = gluon.utils.split_and_load(batch[6], ctx_list=ctx, batch_axis=0)
+            with profiler.phase('load'):
+                if FLAGS.features_dir is not None:
+                    f1 = gluon.utils.split_and_load(batch[0], ctx_list=ctx, batch_axis=0)
+                    f2 = gluon.utils.split_and_load(batch[1], ctx_list=ctx, batch_axis=0)
+                    f3 = gluon.utils.split_and_load(batch[2], ctx_list=ctx, batch_axis=0)
+                    # objectness, center_targets, scale_targets, weights, class_targets
+                    fixed_targets = [gluon.utils.split_and_load(batch[it], ctx_list=ctx, batch_axis=0) for it in range(3, 8)]
+                    gt_boxes = gluon.utils.split_and_load(batch[8], ctx_list=ctx, batch_axis=0)
+                else:
+                    data = gluon.utils.split_and_load(batch[0], ctx_list=ctx, batch_axis=0)
+                    # objectness, center_targets, scale_targets, weights, class_targets
+                    fixed_targets = [gluon.utils.split_and_load(batch[it], ctx_list=ctx, batch_axis=0) for it in range(1, 6)]
+                    gt_boxes = gluon.utils.split_and_load(batch[6], ctx_list=ctx, batch_axis=0)
             sum_losses = []
             obj_losses = []
             center_losses = []
             scale_losses = []
             cls_losses = []
-            if FLAGS.features_dir is not None:
-                with autograd.record():
-                    for ix, (x1, x2, x3) in enumerate(zip(f1, f2, f3)):
-                        obj_loss, center_loss, scale_loss, cls_loss = net(x1, x2, x3, gt_boxes[ix], *[ft[ix] for ft in fixed_targets])
-                        sum_losses.append(obj_loss + center_loss + scale_loss + cls_loss)
-                        obj_losses.append(obj_loss)
-                        center_losses.append(center_loss)
-                        scale_losses.append(scale_loss)
-                        cls_losses.append(cls_loss)
-                    autograd.backward(sum_losses)
-            else:
-                with autograd.record():
-                    for ix, x in enumerate(data):
-                        obj_loss, center_loss, scale_loss, cls_loss = net(x, gt_boxes[ix], *[ft[ix] for ft in fixed_targets])
-                        sum_losses.append(obj_loss + center_loss + scale_loss + cls_loss)
-                        obj_losses.append(obj_loss)
-                        center_losses.append(center_loss)
-                        scale_losses.append(scale_loss)
-                        cls_losses.append(cls_loss)
-                    autograd.backward(sum_losses)
-
-            if FLAGS.motion_stream is None:
-                trainer.step(batch_size)
-            else:
-                trainer.step(batch_size, ignore_stale_grad=True)  # we don't use all layers of each stream
-            obj_metrics.update(0, obj_losses)
-            center_metrics.update(0, center_losses)
-            scale_metrics.update(0, scale_losses)
-            cls_metrics.update(0, cls_losses)
-
-            if FLAGS.log_interval and not (i + 1) % FLAGS.log_interval:
+            with profiler.phase('forward_backward'):
+                if FLAGS.features_dir is not None:
+                    with autograd.record():
+                        for ix, (x1, x2, x3) in enumerate(zip(f1, f2, f3)):
+                            obj_loss, center_loss, scale_loss, cls_loss = net(x1, x2, x3, gt_boxes[ix], *[ft[ix] for ft in fixed_targets])
+                            sum_losses.append(obj_loss + center_loss + scale_loss + cls_loss)
+                            obj_losses.append(obj_loss)
+                            center_losses.append(center_loss)
+                            scale_losses.append(scale_loss)
+                            cls_losses.append(cls_loss)
+                        autograd.backward(sum_losses)
+                else:
+                    with autograd.record():
+                        for ix, x in enumerate(data):
+                            obj_loss, center_loss, scale_loss, cls_loss = net(x, gt_boxes[ix], *[ft[ix] for ft in fixed_targets])
+                            sum_losses.append(obj_loss + center_loss + scale_loss + cls_loss)
+                            obj_losses.append(obj_loss)
+                            center_losses.append(center_loss)
+                            scale_losses.append(scale_loss)
+                            cls_losses.append(cls_loss)
+                        autograd.backward(sum_losses)
+
+            with profiler.phase('step'):
+                # the gradients are summed over the accumulated batches and the processes, so normalise by the total
+                accumulated += batch_size
+                if not (i + 1) % FLAGS.accumulate:
+                    if FLAGS.motion_stream is None:
+                        trainer.step(accumulated * num_parts)
+                    else:
+                        # we don't use all layers of each stream
+                        trainer.step(accumulated * num_parts, ignore_stale_grad=True)
+                    accumulated = 0
+                    if FLAGS.accumulate > 1:
+                        net.collect_params().zero_grad()
+
+            with profiler.phase('metrics'):
+                obj_metrics.update(0, obj_losses)
+                center_metrics.update(0, center_losses)
+                scale_metrics.update(0, scale_losses)
+                cls_metrics.update(0, cls_losses)
+            profiler.end_step(batch_size)
+
+            if FLAGS.checkpoint_interval and not (epoch * len(train_data) + i + 1) % FLAGS.checkpoint_interval \
+                    and not (i + 1) % FLAGS.accumulate:  # only between updates, the accumulated gradients aren't saved
+                checkpointer.save(net, trainer, sampler, epoch, i + 1, FLAGS.batch_size,
+                                  epoch * len(train_data) + i + 1, best_map)
+
+            if is_master and FLAGS.log_interval and not (i + 1) % FLAGS.log_interval:
                 name1, loss1 = obj_metrics.get()
                 name2, loss2 = center_metrics.get()
                 name3, loss3 = scale_metrics.get()
@@ -652,15 +907,37 @@ def train(net, train_data, train_dataset, val_data, eval_metric, ctx, save_prefi
                 tb_sw.add_scalar(tag='Training_' + name2, scalar_value=loss2, global_step=(epoch * len(train_data) + i))
                 tb_sw.add_scalar(tag='Training_' + name3, scalar_value=loss3, global_step=(epoch * len(train_data) + i))
                 tb_sw.add_scalar(tag='Training_' + name4, scalar_value=loss4, global_step=(epoch * len(train_data) + i))
+                profile = profiler.report(epoch * len(train_data) + i, epoch=epoch, batch=i)
+                if profile is not None:
+                    logger.info('[Epoch {}][Batch {}/{}], Profile (p50 ms): {}'.format(
+                        epoch, i, num_batches, ', '.join(['{}={:.1f}'.format(phase, profile[phase]['p50'])
+                                                          for phase in profile if phase != 'samples_per_sec'])))
             btic = time.time()
 
+        if accumulated:  # update on the partial accumulation at the end of the epoch rather than discard it
+            if FLAGS.motion_stream is None:
+                trainer.step(accumulated * num_parts)
+            else:
+                trainer.step(accumulated * num_parts, ignore_stale_grad=True)
+            accumulated = 0
+
         name1, loss1 = obj_metrics.get()
         name2, loss2 = center_metrics.get()
         name3, loss3 = scale_metrics.get()
         name4, loss4 = cls_metrics.get()
         logger.info('[Epoch {}] Training cost: {:.3f}, {}={:.3f}, {}={:.3f}, {}={:.3f}, {}={:.3f}'.format(
             epoch, (time.time()-tic), name1, loss1, name2, loss2, name3, loss3, name4, loss4))
-        if not (epoch + 1) % FLAGS.val_interval:
+        if validator is not None:
+            current_map = 0.  # the best model is picked when the validation is reported
+            if not (epoch + 1) % FLAGS.val_interval:
+                full = FLAGS.val_subset >= 1 or not val_count % FLAGS.val_full_interval
+                params = snapshot_params(net)
+                if validator.submit(params, epoch, epoch * len(train_data) + i, full=full):
+                    val_count += 1  # only when queued, so a skipped full validation is retried at the next interval
+                    if full:
+                        val_snapshots[epoch] = params
+            report_val(validator.poll())
+        elif is_master and not (epoch + 1) % FLAGS.val_interval:
             # consider reduce the frequency of validation to save time
 
             logger.info('End Epoch {}: # samples: {}, seconds: {}, samples/sec: {:.2f}'.format(
@@ -677,7 +954,17 @@ def train(net, train_data, train_dataset, val_data, eval_metric, ctx, save_prefi
             current_map = float(mean_ap[-1])
         else:
             current_map = 0.
-        save_params(net, best_map, current_map, epoch, FLAGS.save_interval, save_prefix)
+        if is_master:
+            save_params(writer, net, best_map, current_map, epoch, FLAGS.save_interval)
+        start_batch = 0
+        if FLAGS.checkpoint_interval:
+            checkpointer.save(net, trainer, sampler, epoch + 1, 0, FLAGS.batch_size, (epoch + 1) * len(train_data),
+                              best_map)
+
+    if validator is not None:
+        report_val(validator.close())
+    writer.close()
+    checkpointer.wait()
 
 
 def main(_argv):
@@ -694,8 +981,17 @@ def main(_argv):
     if FLAGS.num_workers < 0:
         FLAGS.num_workers = multiprocessing.cpu_count()
 
-    # fix seed for mxnet, numpy and python builtin random generator.
-    gutils.random.seed(FLAGS.seed)
+    # the distributed kvstore, connecting to the other processes
+    kv = None
+    if 'dist' in FLAGS.kvstore:
+        kv = mx.kv.create(FLAGS.kvstore)
+        assert not FLAGS.checkpoint_interval, 'The training state checkpoints are not supported with a dist kvstore'
+        logging.info('Process {} of {}'.format(kv.rank, kv.num_workers))
+    rank = kv.rank if kv is not None else 0
+
+    # fix seed for mxnet, numpy and python builtin random generator. different augmentations on each process, the
+    # initial parameters are the first process's
+    gutils.random.seed(FLAGS.seed + rank)
 
     # training contexts
     ctx = [mx.gpu(int(i)) for i in FLAGS.gpus]
@@ -712,7 +1008,7 @@ def main(_argv):
 
     # network
     if os.path.exists(os.path.join('models', 'experiments', FLAGS.save_prefix)) and not bool(FLAGS.resume.strip()) \
-            and FLAGS.save_prefix != '0000':  # using 0000 for testing
+            and FLAGS.save_prefix != '0000' and rank == 0:  # using 0000 for testing
         logging.error("{} exists so won't overwrite and restart training. You can resume training by using "
                       "--resume".format(os.path.join('models', 'experiments', FLAGS.save_prefix)))
         return
@@ -757,15 +1053,38 @@ def main(_argv):
             #                         save_prefix=save_prefix)
             logging.info(net.summary(mx.nd.ndarray.ones(shape=(FLAGS.batch_size, 3, FLAGS.data_shape, FLAGS.data_shape))))
 
-    # load the dataloader
-    train_data, val_data = get_dataloader(async_net, train_dataset, val_dataset, FLAGS.batch_size)
+    if FLAGS.autotune_loader:  # time the train loader on its own over the real data, or use the cached settings
+        key = tuning_key(mode='train', dataset=FLAGS.dataset, window=FLAGS.window, data_shape=FLAGS.data_shape,
+                         batch_size=FLAGS.batch_size, features_dir=FLAGS.features_dir is not None,
+                         motion_stream=FLAGS.motion_stream, random_shape=not FLAGS.no_random_shape,
+                         mixup=FLAGS.mixup)
+        tuned = autotune_loader(partial(get_train_dataloader, async_net, train_dataset, FLAGS.batch_size), key,
+                                FLAGS.autotune_cache, multiprocessing.cpu_count(), FLAGS.autotune_batches,
+                                thread_pool=FLAGS.no_random_shape or FLAGS.features_dir is not None)
+        FLAGS.num_workers, FLAGS.prefetch, FLAGS.thread_pool = \
+            tuned['num_workers'], tuned['prefetch'], tuned['thread_pool']
+
+    # load the dataloader, with a sampler that can be checkpointed if resuming mid epoch
+    # or with a dist kvstore a sampler over this process's shard of whole clips
+    sampler = None
+    if kv is not None and kv.num_workers > 1:
+        sampler = ShardedClipSampler(sample_groups(train_dataset), kv.num_workers, kv.rank, seed=FLAGS.seed)
+    elif FLAGS.checkpoint_interval:
+        sampler = ResumableRandomSampler(len(train_dataset), seed=FLAGS.seed)
+    if FLAGS.async_val:  # only the validation worker loads the val set
+        train_data = get_train_dataloader(async_net, train_dataset, FLAGS.batch_size, sampler=sampler)
+        val_data = None
+    else:
+        train_data, val_data = get_dataloader(async_net, train_dataset, val_dataset, FLAGS.batch_size,
+                                              sampler=sampler)
 
     num_samples = FLAGS.num_samples
     if num_samples < 0:
-        num_samples = len(train_dataset)
+        num_samples = len(sampler) if sampler is not None else len(train_dataset)
 
     # training
-    train(net, train_data, train_dataset, val_data, eval_metric, ctx, save_prefix, start_epoch, num_samples)
+    train(net, train_data, train_dataset, val_data, eval_metric, ctx, save_prefix, start_epoch, num_samples,
+          sampler=sampler, kv=kv)
 
 
 if __name__ == '__main__':
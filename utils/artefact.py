@@ -0,0 +1,209 @@
+"""
+Compiled model artefacts: a trained detection network exported once as its symbol and params, with everything needed
+to detect with it (the input shape, classes, NMS settings and preprocessing constants), so detection can start from
+the artefact alone, without rebuilding the model from its flags or importing the model definitions
+"""
+import json
+import logging
+import math
+import os
+
+from gluoncv.data.transforms import image as timage
+import mxnet as mx
+import numpy as np
+from mxnet import gluon
+
+from utils.onnx_export import export_onnx
+
+ARTEFACT_VERSION = 1
+SYMBOL_FILE = 'model-symbol.json'
+PARAMS_FILE = 'model-0000.params'
+SPEC_FILE = 'spec.json'
+ONNX_FILE = 'model.onnx'
+
+
+def input_shape(data_shape, window=1):
+    """
+    Get the shape of one input sample, (3, H, W), or (window, 3, H, W) for a temporal model
+
+    Args:
+        data_shape (int): the input height and width
+        window (int): the number of frames the model takes (default is 1)
+
+    Returns:
+        tuple: the shape without the batch axis
+    """
+    if window > 1:
+        return window, 3, data_shape, data_shape
+    return 3, data_shape, data_shape
+
+
+def export_artefact(net, directory, classes, data_shape, window=1, mult_out=False, nms_thresh=0.45, nms_topk=400,
+                    post_nms=100, pre_nms_topk=-1, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225),
+                    config=None, onnx=False):
+    """
+    Export a detection network as an artefact, with the NMS compiled into its graph
+
+    Args:
+        net: the network, with its trained parameters loaded
+        directory (str): the directory to write the artefact to
+        classes (list): the names of the classes the network predicts
+        data_shape (int): the input height and width
+        window (int): the number of frames the model takes (default is 1)
+        mult_out (bool): does the model predict for every frame of its window (default is False)
+        nms_thresh (float): the NMS threshold (default is 0.45)
+        nms_topk (int): the number of detections NMS is applied to (default is 400)
+        post_nms (int): the number of detections kept after NMS (default is 100)
+        pre_nms_topk (int): the candidates each output layer decodes, see set_nms (default is -1, all of them)
+        mean (tuple): the mean pixel values subtracted in preprocessing (default is the imagenet mean)
+        std (tuple): the pixel standard deviations divided by in preprocessing (default is the imagenet std)
+        config (dict): how the model was built eg. the model flags, kept for reference (default is None)
+        onnx (bool): also export the model to ONNX, up to its detections before NMS, for OnnxDetector (default is
+                     False)
+
+    Returns:
+        dict: the artefact's spec
+    """
+    os.makedirs(directory, exist_ok=True)
+    shape = input_shape(data_shape, window)
+    ctx = list(net.collect_params().values())[0].list_ctx()[0]
+
+    if onnx:  # before the NMS is set for the exported graph, as export_onnx switches it off
+        export_onnx(net, [(1,) + shape], os.path.join(directory, ONNX_FILE))
+
+    net.set_nms(nms_thresh=nms_thresh, nms_topk=nms_topk, post_nms=post_nms, pre_nms_topk=pre_nms_topk)
+    net.hybridize()
+    net(mx.nd.zeros((1,) + shape, ctx=ctx))  # traces the graph to export
+    net.export(os.path.join(directory, 'model'))
+
+    spec = {'version': ARTEFACT_VERSION,
+            'input_shape': list(shape),
+            'data_shape': data_shape,
+            'window': window,
+            'mult_out': mult_out,
+            'classes': list(classes),
+            'nms': {'nms_thresh': nms_thresh, 'nms_topk': nms_topk, 'post_nms': post_nms,
+                    'pre_nms_topk': pre_nms_topk},
+            'mean': list(mean),
+            'std': list(std),
+            'config': config or dict(),
+            'onnx': onnx}
+    with open(os.path.join(directory, SPEC_FILE), 'w') as f:
+        json.dump(spec, f, indent=2)
+    logging.info('Exported the model artefact to {}'.format(directory))
+    return spec
+
+
+def load_spec(directory):
+    """
+    Load an artefact's spec, see export_artefact
+
+    Args:
+        directory (str): the artefact's directory
+
+    Returns:
+        dict: the spec
+
+    Raises:
+        ValueError: if the artefact was exported in a different format version
+    """
+    with open(os.path.join(directory, SPEC_FILE), 'r') as f:
+        spec = json.load(f)
+    if spec['version'] != ARTEFACT_VERSION:
+        raise ValueError('The artefact in {} is version {}, expected version {}'.format(
+            directory, spec['version'], ARTEFACT_VERSION))
+    return spec
+
+
+class ArtefactTransform(object):
+    """
+    The inference preprocessing of an artefact, the same as YOLO3VideoInferenceTransform without importing the model
+    definitions: resizes the image(s) and boxes to the data shape and normalises the images by the spec's mean and std
+    """
+    def __init__(self, data_shape, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        """
+        Args:
+            data_shape (int): the input height and width
+            mean (tuple): the mean pixel values to subtract (default is the imagenet mean)
+            std (tuple): the pixel standard deviations to divide by (default is the imagenet std)
+        """
+        self._size = data_shape
+        self._mean = mean
+        self._std = std
+
+    def _resize_boxes(self, bbox, w, h):
+        bbox = bbox.copy()
+        bbox[:, (0, 2)] *= self._size / float(w)
+        bbox[:, (1, 3)] *= self._size / float(h)
+        return bbox
+
+    def __call__(self, src, label, idx=None):
+        """
+        Args:
+            src (mxnet.nd.NDArray): the uint8 image (h, w, c) or window of images (k, h, w, c)
+            label (numpy.ndarray or list): the boxes (n, 5+), or a list of the boxes of each frame of a window
+            idx (int): the sample index, passed through if given (default is None)
+
+        Returns:
+            tuple: the normalised image(s) (c, H, W) or (k, c, H, W), the resized boxes, padded with -1 to (k, n, 5+)
+                   if a list, and the idx if given
+        """
+        frames = src.expand_dims(0) if len(src.shape) == 3 else src
+        _, h, w, _ = frames.shape
+        img = mx.nd.stack(*[timage.imresize(frame, self._size, self._size, interp=9) for frame in frames])
+        img = mx.nd.image.normalize(mx.nd.image.to_tensor(img), mean=self._mean, std=self._std)
+        if len(src.shape) == 3:
+            img = img[0]
+
+        if isinstance(label, list):
+            bboxes = [self._resize_boxes(bbox, w, h) for bbox in label]
+            padded = -np.ones((len(bboxes), max([len(b) for b in bboxes] + [0]), label[0].shape[1]))
+            for t, bbox in enumerate(bboxes):
+                padded[t, :len(bbox)] = bbox
+            bbox = mx.nd.array(padded)
+        else:
+            bbox = self._resize_boxes(label, w, h)
+
+        if idx is not None:
+            return img, bbox.astype(img.dtype), idx
+        return img, bbox.astype(img.dtype)
+
+
+class CompiledDetector(object):
+    """
+    A detection network loaded from an artefact, called like the network it was exported from, returning
+    (ids, scores, bboxes) with the artefact's NMS already applied
+
+    The graph is bound and its memory planned (static_alloc, static_shape) for each context when loaded, by running it
+    on a batch of zeros, rather than on the first real batch.
+    """
+    def __init__(self, directory, ctx=None, batch_size=1):
+        """
+        Args:
+            directory (str): the artefact's directory, see export_artefact
+            ctx: the context or list of contexts to run on (default is None, the cpu)
+            batch_size (int): the batch size that will be split over the contexts, to plan the memory for
+                              (default is 1)
+        """
+        self.spec = load_spec(directory)
+        ctx = [mx.cpu()] if ctx is None else ctx if isinstance(ctx, (list, tuple)) else [ctx]
+        self._block = gluon.SymbolBlock.imports(os.path.join(directory, SYMBOL_FILE), ['data'],
+                                                os.path.join(directory, PARAMS_FILE), ctx=ctx)
+        self._block.hybridize(static_alloc=True, static_shape=True)
+
+        shape = (int(math.ceil(batch_size / len(ctx))),) + tuple(self.spec['input_shape'])
+        for c in ctx:
+            self._block(mx.nd.zeros(shape, ctx=c))
+        mx.nd.waitall()
+        logging.info('Loaded the model artefact from {} for {}'.format(directory, ctx))
+
+    @property
+    def classes(self):
+        return self.spec['classes']
+
+    @property
+    def nms(self):
+        return self.spec['nms']
+
+    def __call__(self, x):
+        return self._block(x)
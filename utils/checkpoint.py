@@ -0,0 +1,447 @@
+"""
+Training checkpoints written in the background: parameter checkpoints with a retention policy and checksums, and the
+full training state so training can be resumed mid epoch from the exact next batch
+"""
+import hashlib
+import json
+import logging
+import os
+import pickle
+import queue
+import random
+import shutil
+import threading
+
+import mxnet as mx
+import numpy as np
+from mxnet import gluon
+
+
+class ResumableRandomSampler(gluon.data.sampler.Sampler):
+    """
+    Random sampler whose permutation and position can be saved and restored
+
+    Each epoch (call to __iter__) draws a new permutation from the sampler's own random state, unless a position was
+    restored with set_state, in which case the restored permutation continues from that position
+    """
+    def __init__(self, length, seed=0):
+        """
+        Args:
+            length (int): the number of samples
+            seed (int): the seed of the permutations (default is 0)
+        """
+        self._length = length
+        self._rng = np.random.RandomState(seed)
+        self._perm = None
+        self._start = 0
+        self._resume = False
+
+    def __iter__(self):
+        if not self._resume:
+            self._perm = self._rng.permutation(self._length)
+            self._start = 0
+        self._resume = False
+        return iter(self._perm[self._start:len(self)].tolist())
+
+    def __len__(self):
+        return self._length
+
+    def get_state(self):
+        """
+        Get the state of the sampler
+
+        Returns:
+            dict: the permutation of the current epoch and the random state for the following epochs
+        """
+        return {'perm': self._perm, 'rng': self._rng.get_state()}
+
+    def set_state(self, state, start=0):
+        """
+        Restore the state of the sampler, the next epoch continues the saved permutation from a position within it,
+        or draws the next permutation from the restored random state at the start of an epoch
+
+        Args:
+            state (dict): the state from get_state()
+            start (int): the position in the permutation to continue from, ie. the number of samples done (default is 0)
+        """
+        self._rng.set_state(state['rng'])
+        self._perm = state['perm']
+        self._start = start
+        self._resume = self._perm is not None and start > 0
+
+
+def _trainer_states(trainer):
+    """
+    Get the trainer states (the optimizer with its lr scheduler and update count, and the momentum) as bytes in host
+    memory, what Trainer.save_states would write to a file
+
+    Args:
+        trainer (gluon.Trainer): the trainer
+
+    Returns:
+        bytes: the states
+    """
+    if not trainer._kv_initialized:
+        trainer._init_kvstore()
+    if trainer._params_to_init:
+        trainer._init_params()
+
+    if trainer._update_on_kvstore:
+        return trainer._kvstore._updater.get_states(dump_optimizer=True)
+    return trainer._updaters[0].get_states(dump_optimizer=True)
+
+
+def _atomic_write(path, write_fn):
+    """
+    Write a file through a temporary file and a rename, so a crash mid write never leaves a partial file at path
+
+    Args:
+        path (str): the file path
+        write_fn: a function taking the temporary path to write to
+    """
+    tmp_path = path + '.tmp'
+    write_fn(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def snapshot_params(net):
+    """
+    Copy the parameters to host memory, the copies are queued on the engine so they read the parameters before any
+    later update writes them
+
+    Args:
+        net: the network
+
+    Returns:
+        dict: the parameter name to NDArray dict, as save_parameters would save
+    """
+    return {name: param._reduce() for name, param in net._collect_params_with_prefix().items()}
+
+
+def file_checksum(path, chunk_size=1 << 20):
+    """
+    Get the sha256 of a file
+
+    Args:
+        path (str): the file path
+        chunk_size (int): the bytes to read at a time (default is 1MB)
+
+    Returns:
+        str: the hex digest
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def write_checksum(path, digest=None):
+    """
+    Write the sha256 of a file next to it, as path.sha256 in the format of sha256sum so it can be checked with
+    sha256sum -c
+
+    Args:
+        path (str): the file path
+        digest (str): the hex digest if already known (default is None)
+
+    Returns:
+        str: the hex digest
+    """
+    if digest is None:
+        digest = file_checksum(path)
+
+    def write(tmp_path):
+        with open(tmp_path, 'w') as f:
+            f.write('{}  {}\n'.format(digest, os.path.basename(path)))
+
+    _atomic_write(path + '.sha256', write)
+    return digest
+
+
+def verify_checksum(path):
+    """
+    Check a file against the sha256 written next to it
+
+    Args:
+        path (str): the file path
+
+    Returns:
+        bool: True if it matches, False if it doesn't, None if there is no checksum (eg. a file saved before checksums)
+    """
+    if not os.path.exists(path + '.sha256'):
+        return None
+    with open(path + '.sha256', 'r') as f:
+        digest = f.read().split()[0]
+    return file_checksum(path) == digest
+
+
+class ParamsCheckpointWriter(object):
+    """
+    Writes parameter checkpoints from a background thread, so training doesn't wait on storage
+
+    save() snapshots the parameters to host memory and queues them, a writer thread then writes each through a
+    temporary file and a rename along with its sha256, and applies the retention policy. Training only blocks if
+    max_pending snapshots are already waiting to be written, which bounds the host memory used.
+
+    Retention keeps the milestone checkpoints, the last keep_last and the best keep_best by mAP, deleting the rest. The
+    checkpoints and their mAPs are recorded in a prefix_checkpoints.json manifest so the policy continues on resume.
+    """
+    def __init__(self, prefix, keep_last=3, keep_best=1, max_pending=2):
+        """
+        Args:
+            prefix (str): the path prefix of the checkpoint files
+            keep_last (int): the number of most recent checkpoints to keep, -1 keeps all (default is 3)
+            keep_best (int): the number of best mAP checkpoints to keep (default is 1)
+            max_pending (int): the number of snapshots that can wait to be written before save blocks (default is 2)
+        """
+        self.prefix = prefix
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.manifest_path = prefix + '_checkpoints.json'
+        self._records = list()
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                self._records = json.load(f)
+        self._error = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def save(self, net, epoch, current_map, epoch_file=True, best=False, milestone=False):
+        """
+        Snapshot the parameters and queue them to be written
+
+        Args:
+            net: the network
+            epoch (int): the epoch
+            current_map (float): the validation mAP of the epoch, 0 if not validated
+            epoch_file (bool): write prefix_epoch.params? (default is True)
+            best (bool): is this the best mAP so far? if so writes prefix_best.params and logs it (default is False)
+            milestone (bool): never delete this epoch's checkpoint (default is False)
+        """
+        if not epoch_file and not best:
+            return
+        self.save_snapshot(snapshot_params(net), epoch, current_map, epoch_file, best, milestone)
+
+    def save_snapshot(self, params, epoch, current_map, epoch_file=True, best=False, milestone=False):
+        """
+        Queue an already taken parameter snapshot to be written, see save()
+
+        Args:
+            params (dict): the parameter name to NDArray dict in host memory
+            epoch (int): the epoch the snapshot was taken at
+            current_map (float): the validation mAP of the snapshot, 0 if not validated
+            epoch_file (bool): write prefix_epoch.params? (default is True)
+            best (bool): is this the best mAP so far? (default is False)
+            milestone (bool): never delete this epoch's checkpoint (default is False)
+        """
+        self._put(self._write, params, epoch, float(current_map), epoch_file, best, milestone)
+
+    def update_map(self, epoch, current_map):
+        """
+        Record the mAP of an epoch checkpoint validated after it was saved, eg. by an asynchronous validator
+
+        Args:
+            epoch (int): the epoch
+            current_map (float): its validation mAP
+        """
+        self._put(self._update_map, epoch, float(current_map))
+
+    def _put(self, fn, *args):
+        if self._error is not None:
+            raise RuntimeError('The checkpoint writer failed: {}'.format(self._error))
+        self._queue.put((fn, args))
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                fn, args = job
+                fn(*args)
+            except Exception as e:  # surfaced on the training thread by the next save or close
+                logging.error('Failed to write checkpoint: {}'.format(e))
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, params, epoch, current_map, epoch_file, best, milestone):
+        path = '{:s}_{:04d}.params'.format(self.prefix, epoch)
+        if epoch_file:
+            _atomic_write(path, lambda tmp_path: mx.nd.save(tmp_path, params))
+            digest = write_checksum(path)
+            self._records = [r for r in self._records if r['epoch'] != epoch]
+            self._records.append({'epoch': epoch, 'path': path, 'map': current_map, 'sha256': digest,
+                                  'milestone': milestone})
+
+        if best:
+            best_path = self.prefix + '_best.params'
+            if epoch_file:
+                _atomic_write(best_path, lambda tmp_path: shutil.copyfile(path, tmp_path))
+                write_checksum(best_path, digest)
+            else:
+                _atomic_write(best_path, lambda tmp_path: mx.nd.save(tmp_path, params))
+                write_checksum(best_path)
+            with open(self.prefix + '_best_map.log', 'a') as f:
+                f.write('{:04d}:\t{:.4f}\n'.format(epoch, current_map))
+
+        if epoch_file:
+            self._retain()
+
+    def _update_map(self, epoch, current_map):
+        for record in self._records:
+            if record['epoch'] == epoch:
+                record['map'] = current_map
+        self._retain()
+
+    def _retain(self):
+        """Delete the checkpoints the retention policy doesn't keep, and update the manifest"""
+        by_epoch = sorted(self._records, key=lambda r: r['epoch'])
+        keep = set(r['epoch'] for r in by_epoch if r['milestone'])
+        if self.keep_last < 0:
+            keep.update(r['epoch'] for r in by_epoch)
+        elif self.keep_last > 0:
+            keep.update(r['epoch'] for r in by_epoch[-self.keep_last:])
+        if self.keep_best > 0:
+            by_map = sorted(by_epoch, key=lambda r: r['map'], reverse=True)
+            keep.update(r['epoch'] for r in by_map[:self.keep_best] if r['map'] > 0)
+
+        for record in by_epoch:
+            if record['epoch'] not in keep:
+                for path in [record['path'], record['path'] + '.sha256']:
+                    if os.path.exists(path):
+                        os.remove(path)
+        self._records = [r for r in by_epoch if r['epoch'] in keep]
+
+        def write_manifest(tmp_path):
+            with open(tmp_path, 'w') as f:
+                json.dump(self._records, f, indent=2)
+
+        _atomic_write(self.manifest_path, write_manifest)
+
+    def wait(self):
+        """Wait for the queued checkpoints to be written"""
+        self._queue.join()
+        if self._error is not None:
+            raise RuntimeError('The checkpoint writer failed: {}'.format(self._error))
+
+    def close(self):
+        """Write the queued checkpoints and stop the writer thread"""
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise RuntimeError('The checkpoint writer failed: {}'.format(self._error))
+
+
+class TrainStateCheckpointer(object):
+    """
+    Saves and loads the full training state so training can resume from the exact next batch:
+    the parameters, the trainer (optimizer momentum, lr scheduler position), the python, numpy and sampler random states,
+    the sampler permutation and position, and the best mAP bookkeeping
+
+    Saving snapshots everything to host memory on the training thread and writes it from a background thread, so
+    training only waits on the previous write if it hasn't finished yet. The parameter and trainer files are named by
+    step and the state file, replaced last, points to them with the parameters' sha256, so a crash mid write leaves the
+    previous checkpoint whole and a corrupted one is caught on load
+    """
+    def __init__(self, prefix):
+        """
+        Args:
+            prefix (str): the path prefix of the checkpoint files
+        """
+        self.prefix = prefix
+        self.state_path = prefix + '_state.pkl'
+        self._thread = None
+
+    def exists(self):
+        return os.path.exists(self.state_path)
+
+    def save(self, net, trainer, sampler, epoch, batch, batch_size, global_step, best_map):
+        """
+        Snapshot the training state and write it in the background
+
+        Args:
+            net: the network
+            trainer (gluon.Trainer): the trainer
+            sampler (ResumableRandomSampler): the training sampler, or None
+            epoch (int): the epoch to resume in
+            batch (int): the batch of the epoch to resume from, ie. the number of batches done
+            batch_size (int): the batch size, to find the sampler position from the batch
+            global_step (int): the global step to resume from
+            best_map (list): the best mAP bookkeeping
+        """
+        self.wait()
+
+        params = snapshot_params(net)
+        trainer_states = _trainer_states(trainer)
+        state = {'epoch': epoch, 'batch': batch, 'batch_size': batch_size, 'global_step': global_step,
+                 'best_map': list(best_map),
+                 'sampler': sampler.get_state() if sampler is not None else None,
+                 'python_random': random.getstate(), 'numpy_random': np.random.get_state()}
+
+        self._thread = threading.Thread(target=self._write, args=(params, trainer_states, state))
+        self._thread.start()
+
+    def _write(self, params, trainer_states, state):
+        previous = None
+        if self.exists():
+            with open(self.state_path, 'rb') as f:
+                previous = pickle.load(f)
+
+        state['params_path'] = '{}_state_{:09d}.params'.format(self.prefix, state['global_step'])
+        state['trainer_path'] = '{}_state_{:09d}.trainer'.format(self.prefix, state['global_step'])
+
+        def write_trainer(path):
+            with open(path, 'wb') as f:
+                f.write(trainer_states)
+
+        def write_state(path):
+            with open(path, 'wb') as f:
+                pickle.dump(state, f)
+
+        _atomic_write(state['params_path'], lambda path: mx.nd.save(path, params))
+        state['params_sha256'] = file_checksum(state['params_path'])
+        _atomic_write(state['trainer_path'], write_trainer)
+        _atomic_write(self.state_path, write_state)  # written last, so it marks a complete checkpoint
+
+        if previous is not None:
+            for path in [previous['params_path'], previous['trainer_path']]:
+                if path not in [state['params_path'], state['trainer_path']] and os.path.exists(path):
+                    os.remove(path)
+
+    def wait(self):
+        """Wait for the write in progress to finish"""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def load(self, net, trainer, sampler, ctx, seed=0):
+        """
+        Restore the training state
+
+        Args:
+            net: the network
+            trainer (gluon.Trainer): the trainer, already built with the same parameters
+            sampler (ResumableRandomSampler): the training sampler, or None
+            ctx: the contexts to load the parameters onto
+            seed (int): the base seed, mxnet's random state can't be saved so is reseeded with seed + global step
+
+        Returns:
+            dict: the epoch, batch, global_step and best_map to resume from
+        """
+        with open(self.state_path, 'rb') as f:
+            state = pickle.load(f)
+
+        if 'params_sha256' in state and file_checksum(state['params_path']) != state['params_sha256']:
+            raise ValueError('Checksum mismatch for {}, the checkpoint is corrupt'.format(state['params_path']))
+        net.load_parameters(state['params_path'], ctx=ctx)
+        trainer.load_states(state['trainer_path'])
+        if sampler is not None and state['sampler'] is not None:
+            sampler.set_state(state['sampler'], start=state['batch'] * state['batch_size'])
+        random.setstate(state['python_random'])
+        np.random.set_state(state['numpy_random'])
+        mx.random.seed(seed + state['global_step'])
+
+        return state
@@ -0,0 +1,193 @@
+"""
+A cost model of the detection networks: the FLOPs, parameters and activation memory of each block, from one imperative
+forward pass with hooks on its layers, and the measured latency of the hybridized network, to rank configurations by
+cost before training them
+
+A multiply-add counts as 2 FLOPs. Convolutions (including the convolutional RNN cells), dense layers, correlations,
+BatchNorms, activations and pooling are counted. Ops applied in a hybrid_forward outside of any layer (concats,
+reshapes, the correlations of FlowNet, the NMS) cost no FLOPs here, but are in the latency.
+
+The forward activation memory of a block is the largest input plus output of any of its layers, the least memory a
+forward pass without autograd needs for it. The training activation memory is the output of every layer, which the
+backward pass keeps, so it's an upper bound as MXNet frees or reuses some (eg. the activations' in place outputs).
+"""
+from collections import OrderedDict
+import time
+
+import mxnet as mx
+import numpy as np
+from mxnet import gluon
+from mxnet.gluon import nn
+from mxnet.gluon.nn.conv_layers import _Pooling
+
+from models.definitions.layers import Corr
+
+__all__ = ['profile_blocks', 'measure_latency']
+
+
+def _arrays(outputs):
+    """Flatten a block's (nested list or tuple of) outputs to its NDArrays"""
+    if isinstance(outputs, (list, tuple)):
+        return [a for output in outputs for a in _arrays(output)]
+    return [outputs] if isinstance(outputs, mx.nd.NDArray) else []
+
+
+def _nbytes(arrays):
+    return sum(a.size * np.dtype(a.dtype).itemsize for a in arrays)
+
+
+def _named_blocks(block, prefix=''):
+    """
+    Get every block under a block by its path of child names, eg. 'stages.0.3.body', each once under the first path
+    it's found at, as the stages share the darknet's blocks
+
+    Args:
+        block: the root block
+        prefix (str): the path of the root block (default is '', the root itself isn't included)
+
+    Returns:
+        OrderedDict: the path of each block: the block
+    """
+    blocks = OrderedDict()
+    for name, child in block._children.items():
+        path = prefix + name
+        if any(child is b for b in blocks.values()):
+            continue
+        blocks[path] = child
+        for sub_path, sub in _named_blocks(child, path + '.').items():
+            if not any(sub is b for b in blocks.values()):
+                blocks[sub_path] = sub
+    return blocks
+
+
+def _leaf_flops(block, inputs, output):
+    """
+    Count the FLOPs of a call of a layer
+
+    Args:
+        block: the layer, a block without children
+        inputs (list): the input NDArrays
+        output: the first output NDArray
+
+    Returns:
+        int: the FLOPs
+    """
+    if isinstance(block, Corr):
+        b, _, c, h, w = inputs[0].shape
+        compared = block._t if block._comp_mid else block._t - 1
+        displacements = (2 * (block._d // block._stride) + 1) ** 2
+        return 2 * compared * b * c * block._kernal_size ** 2 * displacements * \
+            (h // block._stride) * (w // block._stride)
+
+    flops = 0
+    for param in block._reg_params.values():
+        if isinstance(param, gluon.Constant) or param.shape is None:
+            continue
+        size = int(np.prod(param.shape))
+        if len(param.shape) >= 3:  # a conv kernel, or a convolutional RNN cell's i2h or h2h, applied at each position
+            ref = inputs[0] if getattr(block, '_op_name', None) == 'Deconvolution' else output
+            flops += 2 * size * ref.shape[0] * int(np.prod(ref.shape[2:]))
+        elif len(param.shape) == 2:  # a dense weight, applied to each row
+            flops += 2 * size * (inputs[0].size // param.shape[1])
+
+    if isinstance(block, nn.BatchNorm):
+        flops += 2 * output.size
+    elif isinstance(block, (nn.Activation, nn.LeakyReLU)) or type(block).__name__ in ['ReLU6', 'HardSwish']:
+        flops += output.size
+    elif isinstance(block, _Pooling):
+        window = inputs[0].size // output.size if block._kwargs['global_pool'] else int(np.prod(block._kwargs['kernel']))
+        flops += output.size * window
+    return flops
+
+
+def profile_blocks(net, xs, depth=2):
+    """
+    Profile the blocks of a network with one imperative forward pass, see the module docstring
+
+    Args:
+        net: the network, initialized and not hybridized, as the hooks only run imperatively
+        xs (list): the inputs
+        depth (int): the depth of the blocks to report, eg. 2 reports 'stages.0' or 'yolo_blocks.1' (default is 2).
+                     Layers shallower than the depth are reported on their own
+
+    Returns:
+        OrderedDict: for each block in the order they're first called: a dict of its 'flops', 'params',
+                     'forward_bytes', 'training_bytes', the imperative 'seconds' of its calls (synchronised around each
+                     call, so slower than the hybridized network) and its number of 'calls'
+    """
+    blocks = _named_blocks(net)
+    stats = OrderedDict()
+
+    def record(path):
+        if path not in stats:
+            stats[path] = {'flops': 0, 'params': 0, 'forward_bytes': 0, 'training_bytes': 0, 'seconds': 0.0,
+                           'calls': 0}
+        return stats[path]
+
+    def leaf_hook(path):
+        def hook(block, inputs, outputs):
+            inputs, outputs = _arrays(inputs), _arrays(outputs)
+            if not outputs:
+                return
+            s = record(path)
+            s['flops'] += _leaf_flops(block, inputs, outputs[0])
+            s['forward_bytes'] = max(s['forward_bytes'], _nbytes(inputs) + _nbytes(outputs))
+            s['training_bytes'] += _nbytes(outputs)
+        return hook
+
+    def pre_timer(path):
+        def hook(block, inputs):
+            mx.nd.waitall()
+            record(path)['tic'] = time.time()
+        return hook
+
+    def timer(path):
+        def hook(block, inputs, outputs):
+            mx.nd.waitall()
+            s = record(path)
+            s['seconds'] += time.time() - s.pop('tic')
+            s['calls'] += 1
+        return hook
+
+    handles = list()
+    for path, block in blocks.items():
+        names = path.split('.')
+        if len(names) == depth or (len(names) < depth and not block._children):
+            handles.append(block.register_forward_pre_hook(pre_timer(path)))
+            handles.append(block.register_forward_hook(timer(path)))
+        if not block._children:
+            handles.append(block.register_forward_hook(leaf_hook('.'.join(names[:depth]))))
+    try:
+        net(*xs)
+        mx.nd.waitall()
+    finally:
+        for handle in handles:
+            handle.detach()
+
+    for path, s in stats.items():
+        s['params'] = sum(int(np.prod(p.shape)) for p in blocks[path].collect_params().values()
+                          if not isinstance(p, gluon.Constant))
+    return stats
+
+
+def measure_latency(net, xs, repeats=10):
+    """
+    Measure the latency of the hybridized (static_alloc, static_shape) network, after one untimed pass that builds and
+    plans the graph
+
+    Args:
+        net: the network
+        xs (list): the inputs
+        repeats (int): the number of passes to time (default is 10)
+
+    Returns:
+        float: the mean seconds per pass
+    """
+    net.hybridize(static_alloc=True, static_shape=True)
+    net(*xs)
+    mx.nd.waitall()
+    tic = time.time()
+    for _ in range(repeats):
+        net(*xs)
+    mx.nd.waitall()
+    return (time.time() - tic) / max(repeats, 1)
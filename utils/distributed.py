@@ -0,0 +1,84 @@
+"""
+Data parallel training over several processes with a distributed kvstore: clip aware sharding of the training data
+between the processes
+"""
+import heapq
+
+import numpy as np
+
+from utils.checkpoint import ResumableRandomSampler
+
+
+def sample_groups(dataset):
+    """
+    Get the group of each sample that should stay on the same process, the clips of video datasets, otherwise every
+    sample is its own group
+
+    Args:
+        dataset: the dataset, may be wrapped eg. by MixupDetection
+
+    Returns:
+        numpy.ndarray: the group of each sample
+    """
+    while not hasattr(dataset, 'sample_groups') and hasattr(dataset, '_dataset'):
+        dataset = dataset._dataset
+    if hasattr(dataset, 'sample_groups'):
+        return np.asarray(dataset.sample_groups())
+    return np.arange(len(dataset))
+
+
+def shard_groups(groups, num_parts):
+    """
+    Split the samples into shards of whole groups, balancing the number of samples in each. Deterministic, so every
+    process gets the same split
+
+    Args:
+        groups (numpy.ndarray): the group of each sample
+        num_parts (int): the number of shards
+
+    Returns:
+        list: the sorted sample indices of each shard
+    """
+    groups = np.asarray(groups)
+    order = np.argsort(groups, kind='stable')
+    starts = np.flatnonzero(np.r_[True, groups[order][1:] != groups[order][:-1], True])
+    sizes = np.diff(starts)
+
+    # largest groups first, each onto the shard with the fewest samples so far
+    heap = [(0, part) for part in range(num_parts)]
+    shards = [list() for _ in range(num_parts)]
+    for g in np.argsort(-sizes, kind='stable'):
+        size, part = heapq.heappop(heap)
+        shards[part].append(order[starts[g]:starts[g + 1]])
+        heapq.heappush(heap, (size + sizes[g], part))
+
+    return [np.sort(np.concatenate(shard + [np.zeros((0,), np.int64)])) for shard in shards]
+
+
+class ShardedClipSampler(ResumableRandomSampler):
+    """
+    Random sampler over one process's shard of the samples, where shards are made of whole clips so each process reads
+    and decodes its own clips (whose overlapping temporal windows then share the page cache)
+
+    Every process draws the same number of samples each epoch, the size of the smallest shard, as dist_sync needs
+    every process to take the same number of steps. A process with a larger shard draws a different random subset of
+    it each epoch.
+    """
+    def __init__(self, groups, num_parts, part, seed=0):
+        """
+        Args:
+            groups (numpy.ndarray): the group of each sample, see sample_groups
+            num_parts (int): the number of processes
+            part (int): the rank of this process
+            seed (int): the seed of the permutations, offset by the rank (default is 0)
+        """
+        shards = shard_groups(groups, num_parts)
+        self._shard = shards[part]
+        self._epoch_length = min(len(shard) for shard in shards)
+        super(ShardedClipSampler, self).__init__(len(self._shard), seed=seed + part)
+
+    def __iter__(self):
+        return (int(self._shard[i]) for i in super(ShardedClipSampler, self).__iter__())
+
+    def __len__(self):
+        return self._epoch_length
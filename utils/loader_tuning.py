@@ -0,0 +1,132 @@
+"""
+Autotuning of the DataLoader settings: measures the input pipeline on its own, over real samples with a consumer that
+only waits for each batch, searching the number of workers, the prefetch depth and worker threads versus processes,
+and caches the best settings for each dataset, window, data shape and host
+"""
+import json
+import logging
+import os
+import socket
+import time
+
+import mxnet as mx
+
+
+def tuning_key(**config):
+    """
+    Get the cache key of a loader configuration on this host
+
+    Args:
+        **config: what the input pipeline depends on eg. dataset='vid', window=[3, 1], data_shape=416, batch_size=8
+
+    Returns:
+        str: the key
+    """
+    return json.dumps(dict(config, host=socket.gethostname(), cpus=os.cpu_count()), sort_keys=True)
+
+
+def measure_throughput(loader, num_batches, warmup=2):
+    """
+    Measure the samples per second a loader delivers to a consumer that does nothing but wait for each batch
+
+    Args:
+        loader: the DataLoader
+        num_batches (int): the number of batches to time
+        warmup (int): the number of batches to take before timing, covering the worker startup (default is 2)
+
+    Returns:
+        float: the samples per second
+    """
+    tic = time.time()
+    samples = 0
+    for b, batch in enumerate(loader):
+        arrays = batch if isinstance(batch, (list, tuple)) else [batch]
+        for x in arrays:
+            if isinstance(x, mx.nd.NDArray):
+                x.wait_to_read()
+        if b < warmup:
+            tic = time.time()
+            continue
+        samples += arrays[0].shape[0]
+        if b + 1 >= warmup + num_batches:
+            break
+    return samples / max(time.time() - tic, 1e-6)
+
+
+def _load_cache(cache_file):
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file, 'r') as f:
+            return json.load(f)
+    return dict()
+
+
+def _save_cache(cache_file, cache):
+    if os.path.dirname(cache_file):
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with open(cache_file + '.tmp', 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.replace(cache_file + '.tmp', cache_file)
+
+
+def autotune_loader(make_loader, key, cache_file, max_workers, num_batches=20, thread_pool=True):
+    """
+    Find the fastest loader settings, or get them from the cache if this configuration was tuned before
+
+    The number of workers is searched upwards from 0, for worker processes and worker threads, until adding workers
+    stops helping, then the prefetch depth is searched for the best number of workers.
+
+    Args:
+        make_loader: a function taking num_workers, prefetch and thread_pool keyword arguments and returning a loader
+                     over the real dataset
+        key (str): the configuration's key, see tuning_key
+        cache_file (str): the json file of tuned settings, None to not cache
+        max_workers (int): the most workers to try
+        num_batches (int): the number of batches to time for each setting (default is 20)
+        thread_pool (bool): try worker threads as well as processes, the loader must support thread_pool
+                            (default is True)
+
+    Returns:
+        dict: the best settings, num_workers, prefetch and thread_pool, with the samples_per_sec they measured, the
+              ceiling of the input pipeline
+    """
+    cache = _load_cache(cache_file)
+    if key in cache:
+        logging.info('Using the tuned loader settings {} from {}'.format(cache[key], cache_file))
+        return cache[key]
+
+    def measure(num_workers, prefetch, pool):
+        loader = make_loader(num_workers=num_workers, prefetch=prefetch, thread_pool=pool)
+        samples_per_sec = measure_throughput(loader, num_batches)
+        del loader  # stops the workers
+        logging.info('Loader with {} worker {}, prefetch {}: {:.1f} samples/sec'.format(
+            num_workers, 'threads' if pool else 'processes', prefetch, samples_per_sec))
+        return {'num_workers': num_workers, 'prefetch': prefetch, 'thread_pool': pool,
+                'samples_per_sec': samples_per_sec}
+
+    worker_counts = sorted({0, max_workers} | {w for w in (1, 2, 4, 8, 16, 32, 64) if w < max_workers})
+    best = measure(0, 0, False)
+    for pool in ([False, True] if thread_pool else [False]):
+        pool_best = None
+        for num_workers in worker_counts[1:]:
+            result = measure(num_workers, 2 * num_workers, pool)
+            if pool_best is not None and result['samples_per_sec'] < 0.95 * pool_best['samples_per_sec']:
+                break  # more workers are only contending now
+            if pool_best is None or result['samples_per_sec'] > pool_best['samples_per_sec']:
+                pool_best = result
+        if pool_best is not None and pool_best['samples_per_sec'] > best['samples_per_sec']:
+            best = pool_best
+
+    if best['num_workers'] > 0:
+        for prefetch in (best['num_workers'], 4 * best['num_workers']):
+            result = measure(best['num_workers'], prefetch, best['thread_pool'])
+            if result['samples_per_sec'] > best['samples_per_sec']:
+                best = result
+
+    logging.info('The input pipeline ceiling is {:.1f} samples/sec, with {} worker {} and prefetch {}'.format(
+        best['samples_per_sec'], best['num_workers'], 'threads' if best['thread_pool'] else 'processes',
+        best['prefetch']))
+    if cache_file:
+        cache = _load_cache(cache_file)  # another process may have tuned something meanwhile
+        cache[key] = best
+        _save_cache(cache_file, cache)
+    return best
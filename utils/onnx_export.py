@@ -0,0 +1,575 @@
+"""
+ONNX export of the detection networks, and a detector that runs the exported graph with ONNX Runtime, for CPU inference
+outside of MXNet's engine
+
+The graph is converted from the network's hybridized symbol with the shapes inferred for a fixed input shape, so every
+reshape is static and the exported model takes that batch size only. MXNet 1.5's own exporter can't convert the reshape
+codes, slice_like, repeat, SwapAxis, the multi output split or Correlation that the temporal models use, so the
+converters are defined here. The NMS (contrib.box_nms) has no ONNX equivalent with the same semantics, so the graph is
+exported up to the detections before NMS, and OnnxDetector applies box_nms (numpy, with box_nms's semantics) to them.
+
+onnx and onnxruntime are only needed to export and to run, and are imported when first used.
+"""
+import ast
+import json
+import logging
+import os
+
+import mxnet as mx
+import numpy as np
+
+from utils.bbox import bbox_iou
+
+_CONVERTERS = dict()
+
+
+def _converter(*ops):
+    """Register the function as the converter of the MXNet ops"""
+    def register(func):
+        for op in ops:
+            _CONVERTERS[op] = func
+        return func
+    return register
+
+
+def _attr(node, key, default=None):
+    """Get a node attribute parsed from its string, eg. '(3, 3)' -> (3, 3), 'True' -> True, 'None' -> None"""
+    value = node.get('attrs', dict()).get(key)
+    if value is None:
+        return default
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        if value.lower() in ['true', 'false']:
+            return value.lower() == 'true'
+        return value  # eg. an act_type or a dtype
+
+
+def _tuple(value):
+    return tuple(value) if isinstance(value, (list, tuple)) else (value,)
+
+
+class _Graph(object):
+    """The ONNX graph being built"""
+    def __init__(self, onnx):
+        self.onnx = onnx
+        self.nodes = list()
+        self.initializers = list()
+        self.inputs = list()
+        self._count = 0
+
+    def unique(self, name):
+        self._count += 1
+        return '{}__{}'.format(name, self._count)
+
+    def node(self, op_type, inputs, name, **attrs):
+        """Add a node with a single output, returning the output name"""
+        output = self.unique(name)
+        self.nodes.append(self.onnx.helper.make_node(op_type, inputs, [output], name=output, **attrs))
+        return output
+
+    def const(self, name, value):
+        """Add a constant as an initializer, returning its name"""
+        name = self.unique(name)
+        self.initializers.append(self.onnx.numpy_helper.from_array(np.asarray(value), name))
+        return name
+
+
+class _Context(object):
+    """What a converter gets: the graph, the node, its input tensor names and shapes, and its output shapes"""
+    def __init__(self, graph, node, inputs, in_shapes, out_shapes):
+        self.graph = graph
+        self.node = node
+        self.name = node['name']
+        self.inputs = inputs
+        self.in_shapes = in_shapes
+        self.out_shapes = out_shapes
+
+    def attr(self, key, default=None):
+        return _attr(self.node, key, default)
+
+    def add(self, op_type, inputs, **attrs):
+        return self.graph.node(op_type, inputs, self.name, **attrs)
+
+    def const(self, value):
+        return self.graph.const(self.name, value)
+
+    def reshape(self, x, shape):
+        return self.add('Reshape', [x, self.const(np.array(shape, dtype=np.int64))])
+
+
+def _axis(axis, ndim):
+    return axis + ndim if axis < 0 else axis
+
+
+# ops that only change the shape, converted to a reshape to the inferred output shape
+@_converter('Reshape', 'reshape_like', 'Flatten', 'squeeze', 'expand_dims')
+def _convert_reshape(c):
+    return [c.reshape(c.inputs[0], c.out_shapes[0])]
+
+
+@_converter('BlockGrad', '_copy', 'identity', 'Dropout', 'stop_gradient')
+def _convert_identity(c):
+    return [c.add('Identity', [c.inputs[0]])]
+
+
+# ops whose output only depends on the input shapes, which are static, are converted to constants
+@_converter('_arange')
+def _convert_arange(c):
+    values = np.arange(c.attr('start', 0), c.attr('stop'), c.attr('step', 1), dtype=np.float32)
+    values = np.repeat(values, c.attr('repeat', 1))
+    return [c.const(values.reshape(c.out_shapes[0]))]
+
+
+@_converter('zeros_like', '_zeros')
+def _convert_zeros(c):
+    return [c.const(np.zeros(c.out_shapes[0], dtype=np.float32))]
+
+
+@_converter('ones_like', '_ones')
+def _convert_ones(c):
+    return [c.const(np.ones(c.out_shapes[0], dtype=np.float32))]
+
+
+@_converter('_full')
+def _convert_full(c):
+    return [c.const(np.full(c.out_shapes[0], c.attr('value'), dtype=np.float32))]
+
+
+@_converter('Cast', 'cast')
+def _convert_cast(c):
+    if np.dtype(c.attr('dtype')) != np.float32:
+        raise NotImplementedError('{}: only casts to float32 are supported, not {}'.format(c.name, c.attr('dtype')))
+    return [c.add('Identity', [c.inputs[0]])]
+
+
+@_converter('Convolution')
+def _convert_convolution(c):
+    kernel = _tuple(c.attr('kernel'))
+    if not c.attr('layout', 'NCHW' if len(kernel) == 2 else 'NCDHW').startswith('NC'):
+        raise NotImplementedError('{}: only channel first convolutions are supported'.format(c.name))
+    pad = _tuple(c.attr('pad', (0,) * len(kernel))) or (0,) * len(kernel)
+    inputs = c.inputs[:2] if c.attr('no_bias', False) else c.inputs[:3]
+    return [c.add('Conv', inputs, kernel_shape=kernel, pads=pad + pad,
+                  strides=_tuple(c.attr('stride', (1,) * len(kernel))) or (1,) * len(kernel),
+                  dilations=_tuple(c.attr('dilate', (1,) * len(kernel))) or (1,) * len(kernel),
+                  group=c.attr('num_group', 1))]
+
+
+@_converter('BatchNorm')
+def _convert_batchnorm(c):
+    if c.attr('axis', 1) != 1:
+        raise NotImplementedError('{}: only channel first BatchNorms are supported'.format(c.name))
+    data, gamma, beta, mean, var = c.inputs
+    if c.attr('fix_gamma', True):
+        gamma = c.const(np.ones(c.in_shapes[1], dtype=np.float32))
+    return [c.add('BatchNormalization', [data, gamma, beta, mean, var], epsilon=c.attr('eps', 1e-3))]
+
+
+@_converter('LeakyReLU')
+def _convert_leaky_relu(c):
+    act_type = c.attr('act_type', 'leaky')
+    if act_type == 'leaky':
+        return [c.add('LeakyRelu', [c.inputs[0]], alpha=c.attr('slope', 0.25))]
+    if act_type == 'elu':
+        return [c.add('Elu', [c.inputs[0]], alpha=c.attr('slope', 0.25))]
+    if act_type == 'prelu':
+        return [c.add('PRelu', c.inputs[:2])]
+    raise NotImplementedError('{}: LeakyReLU act_type {} is not supported'.format(c.name, act_type))
+
+
+_ACTIVATIONS = {'relu': 'Relu', 'sigmoid': 'Sigmoid', 'tanh': 'Tanh', 'softrelu': 'Softplus', 'softsign': 'Softsign'}
+
+
+@_converter('Activation')
+def _convert_activation(c):
+    return [c.add(_ACTIVATIONS[c.attr('act_type')], [c.inputs[0]])]
+
+
+_UNARY = {'relu': 'Relu', 'sigmoid': 'Sigmoid', 'tanh': 'Tanh', 'exp': 'Exp', 'log': 'Log', 'sqrt': 'Sqrt',
+          'abs': 'Abs', 'floor': 'Floor', 'ceil': 'Ceil', 'negative': 'Neg'}
+
+
+@_converter(*_UNARY.keys())
+def _convert_unary(c):
+    return [c.add(_UNARY[c.node['op']], [c.inputs[0]])]
+
+
+@_converter('softmax', 'SoftmaxActivation')
+def _convert_softmax(c):
+    axis = c.attr('axis', -1)
+    if _axis(axis, len(c.in_shapes[0])) != len(c.in_shapes[0]) - 1:  # opset 11 softmax flattens from the axis
+        raise NotImplementedError('{}: only softmax over the last axis is supported'.format(c.name))
+    return [c.add('Softmax', [c.inputs[0]], axis=axis)]
+
+
+# ONNX broadcasts like numpy, which covers MXNet's elementwise and broadcast ops
+_BINARY = {'elemwise_add': 'Add', '_plus': 'Add', '_Plus': 'Add', '_add': 'Add', 'broadcast_add': 'Add',
+           'broadcast_plus': 'Add',
+           'elemwise_sub': 'Sub', '_minus': 'Sub', '_Minus': 'Sub', '_sub': 'Sub', 'broadcast_sub': 'Sub',
+           'broadcast_minus': 'Sub',
+           'elemwise_mul': 'Mul', '_mul': 'Mul', '_Mul': 'Mul', 'broadcast_mul': 'Mul',
+           'elemwise_div': 'Div', '_div': 'Div', '_Div': 'Div', 'broadcast_div': 'Div',
+           '_maximum': 'Max', 'broadcast_maximum': 'Max', '_minimum': 'Min', 'broadcast_minimum': 'Min'}
+
+
+@_converter(*_BINARY.keys())
+def _convert_binary(c):
+    return [c.add(_BINARY[c.node['op']], c.inputs[:2])]
+
+
+# name: (the ONNX op, does the scalar come first)
+_SCALAR = {'_plus_scalar': ('Add', False), '_minus_scalar': ('Sub', False), '_rminus_scalar': ('Sub', True),
+           '_mul_scalar': ('Mul', False), '_div_scalar': ('Div', False), '_rdiv_scalar': ('Div', True),
+           '_maximum_scalar': ('Max', False), '_minimum_scalar': ('Min', False), '_power_scalar': ('Pow', False)}
+
+
+@_converter(*_SCALAR.keys())
+def _convert_scalar(c):
+    op_type, first = _SCALAR[c.node['op']]
+    scalar = c.const(np.array(c.attr('scalar'), dtype=np.float32))
+    return [c.add(op_type, [scalar, c.inputs[0]] if first else [c.inputs[0], scalar])]
+
+
+@_converter('Concat', 'concat')
+def _convert_concat(c):
+    return [c.add('Concat', c.inputs, axis=c.attr('dim', 1))]
+
+
+@_converter('stack')
+def _convert_stack(c):
+    axis = _axis(c.attr('axis', 0), len(c.out_shapes[0]))
+    shape = c.in_shapes[0][:axis] + (1,) + c.in_shapes[0][axis:]
+    return [c.add('Concat', [c.reshape(x, shape) for x in c.inputs], axis=axis)]
+
+
+@_converter('transpose')
+def _convert_transpose(c):
+    axes = _tuple(c.attr('axes', ())) or tuple(reversed(range(len(c.in_shapes[0]))))
+    return [c.add('Transpose', [c.inputs[0]], perm=[_axis(a, len(axes)) for a in axes])]
+
+
+@_converter('SwapAxis', 'swapaxes')
+def _convert_swapaxes(c):
+    ndim = len(c.in_shapes[0])
+    perm = list(range(ndim))
+    a, b = _axis(c.attr('dim1', 0), ndim), _axis(c.attr('dim2', 0), ndim)
+    perm[a], perm[b] = perm[b], perm[a]
+    return [c.add('Transpose', [c.inputs[0]], perm=perm)]
+
+
+def _slice(c, x, starts, ends, axes):
+    return c.add('Slice', [x, c.const(np.array(starts, dtype=np.int64)), c.const(np.array(ends, dtype=np.int64)),
+                           c.const(np.array(axes, dtype=np.int64))])
+
+
+@_converter('slice_axis')
+def _convert_slice_axis(c):
+    axis = _axis(c.attr('axis'), len(c.in_shapes[0]))
+    size = c.in_shapes[0][axis]
+    begin, end = c.attr('begin'), c.attr('end')
+    begin = begin + size if begin < 0 else begin
+    end = size if end is None else end + size if end < 0 else end
+    return [_slice(c, c.inputs[0], [begin], [end], [axis])]
+
+
+@_converter('slice_like')
+def _convert_slice_like(c):
+    ndim = len(c.in_shapes[0])
+    axes = [_axis(a, ndim) for a in _tuple(c.attr('axes', ()))] or list(range(ndim))
+    return [_slice(c, c.inputs[0], [0] * len(axes), [c.out_shapes[0][a] for a in axes], axes)]
+
+
+@_converter('tile')
+def _convert_tile(c):
+    reps = _tuple(c.attr('reps'))
+    x, shape = c.inputs[0], c.in_shapes[0]
+    if len(reps) > len(shape):  # the input is promoted to the number of reps
+        shape = (1,) * (len(reps) - len(shape)) + tuple(shape)
+        x = c.reshape(x, shape)
+    reps = (1,) * (len(shape) - len(reps)) + reps
+    return [c.add('Tile', [x, c.const(np.array(reps, dtype=np.int64))])]
+
+
+@_converter('repeat')
+def _convert_repeat(c):
+    axis = c.attr('axis')
+    if axis is None:
+        raise NotImplementedError('{}: repeat without an axis is not supported'.format(c.name))
+    shape = tuple(c.in_shapes[0])
+    axis = _axis(axis, len(shape))
+    # repeat each element by tiling along a new axis after it, then merging the two
+    x = c.reshape(c.inputs[0], shape[:axis + 1] + (1,) + shape[axis + 1:])
+    reps = [1] * (len(shape) + 1)
+    reps[axis + 1] = c.attr('repeats')
+    x = c.add('Tile', [x, c.const(np.array(reps, dtype=np.int64))])
+    return [c.reshape(x, c.out_shapes[0])]
+
+
+_REDUCE = {'max': 'ReduceMax', 'min': 'ReduceMin', 'mean': 'ReduceMean', 'sum': 'ReduceSum', 'prod': 'ReduceProd'}
+
+
+@_converter(*_REDUCE.keys())
+def _convert_reduce(c):
+    ndim = len(c.in_shapes[0])
+    axes = c.attr('axis')
+    axes = list(range(ndim)) if axes is None or axes == () else [_axis(a, ndim) for a in _tuple(axes)]
+    if c.attr('exclude', False):
+        axes = [a for a in range(ndim) if a not in axes]
+    x = c.add(_REDUCE[c.node['op']], [c.inputs[0]], axes=axes, keepdims=1)
+    # MXNet keeps the dims or not like ONNX, but a full reduction to a scalar is (1,) rather than ()
+    return [x if c.attr('keepdims', False) else c.reshape(x, c.out_shapes[0])]
+
+
+@_converter('SliceChannel', 'split')
+def _convert_split(c):
+    ndim = len(c.in_shapes[0])
+    axis = _axis(c.attr('axis', 1), ndim)
+    num = c.attr('num_outputs')
+    outputs = [c.graph.unique(c.name) for _ in range(num)]
+    c.graph.nodes.append(c.graph.onnx.helper.make_node('Split', [c.inputs[0]], outputs, name=outputs[0], axis=axis,
+                                                       split=[c.in_shapes[0][axis] // num] * num))
+    if c.attr('squeeze_axis', False):
+        outputs = [c.add('Squeeze', [o], axes=[axis]) for o in outputs]
+    return outputs
+
+
+@_converter('Pooling')
+def _convert_pooling(c):
+    pool_type = c.attr('pool_type', 'max')
+    if pool_type not in ['max', 'avg']:
+        raise NotImplementedError('{}: {} pooling is not supported'.format(c.name, pool_type))
+    layout = c.attr('layout')
+    if layout is not None and not layout.startswith('NC'):
+        raise NotImplementedError('{}: only channel first pooling is supported'.format(c.name))
+    if c.attr('global_pool', False):
+        return [c.add('GlobalMaxPool' if pool_type == 'max' else 'GlobalAveragePool', [c.inputs[0]])]
+    kernel = _tuple(c.attr('kernel'))
+    pad = _tuple(c.attr('pad', ())) or (0,) * len(kernel)
+    attrs = dict(kernel_shape=kernel, pads=pad + pad, strides=_tuple(c.attr('stride', ())) or (1,) * len(kernel),
+                 ceil_mode=int(c.attr('pooling_convention', 'valid') == 'full'))
+    if pool_type == 'max':
+        return [c.add('MaxPool', [c.inputs[0]], **attrs)]
+    return [c.add('AveragePool', [c.inputs[0]], count_include_pad=int(c.attr('count_include_pad', True)), **attrs)]
+
+
+@_converter('Correlation')
+def _convert_correlation(c):
+    """
+    Decompose the correlation of the multiplicative, 1x1 kernel, stride 1 kind Corr uses into a shifted multiply and a
+    channel mean for each displacement, in MXNet's channel order: the vertical displacement outer, the horizontal inner
+    """
+    d = c.attr('max_displacement', 1)
+    if (c.attr('kernel_size', 1) != 1 or c.attr('stride1', 1) != 1 or c.attr('stride2', 1) != 1 or
+            c.attr('pad_size', 0) != d or not c.attr('is_multiply', True)):
+        raise NotImplementedError('{}: only multiplicative 1x1 correlations with stride 1 and pad_size equal to '
+                                  'max_displacement are supported'.format(c.name))
+    x1, x2 = c.inputs[:2]
+    height, width = c.in_shapes[0][2:]
+    pads = c.const(np.array([0, 0, d, d, 0, 0, d, d], dtype=np.int64))
+    x2 = c.add('Pad', [x2, pads], mode='constant')
+    outputs = list()
+    for dy in range(-d, d + 1):
+        for dx in range(-d, d + 1):
+            shifted = _slice(c, x2, [d + dy, d + dx], [d + dy + height, d + dx + width], [2, 3])
+            outputs.append(c.add('ReduceMean', [c.add('Mul', [x1, shifted])], axes=[1], keepdims=1))
+    return [c.add('Concat', outputs, axis=1)]
+
+
+def _flatten(outputs):
+    if isinstance(outputs, (list, tuple)):
+        return [o for output in outputs for o in _flatten(output)]
+    return [outputs]
+
+
+def _entry_shape(shapes, node, index):
+    """Get the inferred shape of a node's output, from the names list_outputs gives the symbol's internals"""
+    if node['op'] == 'null':
+        return shapes[node['name']]
+    names = ['{}_output'.format(node['name'])] if index == 0 else []
+    names.append('{}_output{}'.format(node['name'], index))
+    for name in names:
+        if name in shapes:
+            return shapes[name]
+    raise KeyError('No shape was inferred for output {} of {}'.format(index, node['name']))
+
+
+def export_onnx(net, input_shapes, path=None, opset=11):
+    """
+    Export a detection network to ONNX, up to its detections before NMS, see the module docstring
+
+    Args:
+        net: the network, with its parameters initialized or loaded. Its NMS is switched off (set_nms(nms_thresh=-1,
+             pre_nms_topk=-1)), reset it with set_nms to use the net again
+        input_shapes (list): the shape of each of the network's inputs, including the batch size, named data, or
+                             data0, data1, ... if there are several
+        path (str): the file to save the model to, None to not save it (default is None)
+        opset (int): the ONNX opset version (default is 11)
+
+    Returns:
+        onnx.ModelProto: the model, taking the inputs and returning the outputs of the net, eg. (ids, scores, bboxes)
+
+    Raises:
+        NotImplementedError: if the network has an op, or an op setting, that can't be converted
+    """
+    import onnx
+    from onnx import helper
+
+    net.set_nms(nms_thresh=-1, pre_nms_topk=-1)
+    names = ['data'] if len(input_shapes) == 1 else ['data{}'.format(i) for i in range(len(input_shapes))]
+    sym = mx.sym.Group(_flatten(net(*[mx.sym.var(name) for name in names])))
+    params = {name: p.data().asnumpy() for name, p in net.collect_params().items()}
+
+    known = dict(zip(names, [tuple(s) for s in input_shapes]))
+    known.update({name: params[name].shape for name in sym.list_arguments() if name in params})
+    internals = sym.get_internals()
+    _, out_shapes, _ = internals.infer_shape(**known)
+    shapes = dict(zip(internals.list_outputs(), out_shapes))
+
+    graph = _Graph(onnx)
+    symbol_json = json.loads(sym.tojson())
+    nodes = symbol_json['nodes']
+    tensors = dict()  # (node id, output index): the ONNX tensor name
+    for nid, node in enumerate(nodes):
+        if node['op'] == 'null':
+            if node['name'] in names:
+                graph.inputs.append(helper.make_tensor_value_info(node['name'], onnx.TensorProto.FLOAT,
+                                                                  known[node['name']]))
+            elif node['name'] in params:
+                value = params[node['name']]
+                graph.initializers.append(onnx.numpy_helper.from_array(value.astype(np.float32), node['name']))
+            else:
+                raise ValueError('{} is neither an input nor a parameter of the network'.format(node['name']))
+            tensors[(nid, 0)] = node['name']
+            continue
+
+        if node['op'] not in _CONVERTERS:
+            raise NotImplementedError('{}: {} has no ONNX converter'.format(node['name'], node['op']))
+        entries = [(i[0], i[1]) for i in node['inputs']]
+        context = _Context(graph, node, [tensors[e] for e in entries],
+                           [tuple(_entry_shape(shapes, nodes[e[0]], e[1])) for e in entries],
+                           [tuple(_entry_shape(shapes, node, 0))])
+        for i, output in enumerate(_CONVERTERS[node['op']](context)):
+            tensors[(nid, i)] = output
+
+    outputs = list()
+    for i, (nid, index, _) in enumerate(symbol_json['heads']):
+        name = 'output{}'.format(i)
+        graph.nodes.append(helper.make_node('Identity', [tensors[(nid, index)]], [name], name=name))
+        outputs.append(helper.make_tensor_value_info(name, onnx.TensorProto.FLOAT,
+                                                     _entry_shape(shapes, nodes[nid], index)))
+
+    model = helper.make_model(helper.make_graph(graph.nodes, net.name, graph.inputs, outputs, graph.initializers),
+                              opset_imports=[helper.make_opsetid('', opset)], producer_name='mxnet')
+    onnx.checker.check_model(model)
+    logging.info('Converted {} nodes to {} ONNX nodes'.format(len(nodes), len(graph.nodes)))
+    if path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        onnx.save(model, path)
+        logging.info('Exported the ONNX model to {}'.format(path))
+    return model
+
+
+def box_nms(data, overlap_thresh=0.45, valid_thresh=0.01, topk=400):
+    """
+    Class-wise non-maximum suppression with the semantics of contrib.box_nms(id_index=0, score_index=1, coord_start=2,
+    force_suppress=False) as the models call it: detections scoring more than valid_thresh are sorted by score, only
+    the topk are kept, a detection is suppressed by a higher scoring one of its class overlapping it by more than
+    overlap_thresh, and the kept detections are moved to the front with the rest set to -1
+
+    Args:
+        data (numpy.ndarray): the detections, of shape (..., N, 6) as (cid, score, xmin, ymin, xmax, ymax)
+        overlap_thresh (float): the IoU above which a detection is suppressed (default is 0.45)
+        valid_thresh (float): the score a detection needs to be more than to be kept (default is 0.01)
+        topk (int): the number of highest scoring detections NMS is applied to, -1 for all (default is 400)
+
+    Returns:
+        numpy.ndarray: the detections after NMS, the same shape as data
+    """
+    shape = data.shape
+    data = data.reshape((-1,) + shape[-2:])
+    result = np.full_like(data, -1)
+    for b, dets in enumerate(data):
+        valid = np.where(dets[:, 1] > valid_thresh)[0]
+        order = valid[np.argsort(-dets[valid, 1], kind='stable')]
+        if topk > 0:
+            order = order[:topk]
+        dets = dets[order]
+        keep = np.ones(len(dets), dtype=bool)
+        ious = bbox_iou(dets[:, 2:6], dets[:, 2:6])
+        for i in range(len(dets)):
+            if not keep[i]:
+                continue
+            suppress = (ious[i, i + 1:] > overlap_thresh) & (dets[i + 1:, 0] == dets[i, 0])
+            keep[i + 1:][suppress] = False
+        dets = dets[keep]
+        result[b, :len(dets)] = dets
+    return result.reshape(shape)
+
+
+class OnnxDetector(object):
+    """
+    A detection network exported with export_onnx, run with ONNX Runtime on the CPU, called like the network with an
+    NDArray batch and returning (ids, scores, bboxes) NDArrays with the NMS applied
+
+    The model takes the batch size it was exported with, so smaller batches are padded and larger ones are run in
+    chunks.
+    """
+    def __init__(self, model, nms=None, num_threads=0):
+        """
+        Args:
+            model: the path of the ONNX model, or the model (an onnx.ModelProto) or its serialized bytes
+            nms (dict): the NMS settings as set_nms takes them, nms_thresh, nms_topk and post_nms (default is None, the
+                        set_nms defaults)
+            num_threads (int): the number of threads each op runs on, 0 for ONNX Runtime's default (default is 0)
+        """
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError('The onnxruntime backend needs ONNX Runtime, pip install onnxruntime')
+
+        if hasattr(model, 'SerializeToString'):
+            model = model.SerializeToString()
+        options = onnxruntime.SessionOptions()
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        self._session = onnxruntime.InferenceSession(model, options, providers=['CPUExecutionProvider'])
+        self._input = self._session.get_inputs()[0]
+        self._outputs = [o.name for o in self._session.get_outputs()]
+        self._batch_size = self._input.shape[0]
+
+        self.nms = dict(nms_thresh=0.45, nms_topk=400, post_nms=100)
+        self.nms.update({k: v for k, v in (nms or dict()).items() if k in self.nms})
+        logging.info('Loaded the ONNX model for a batch of {} on {} threads'.format(
+            self._batch_size, num_threads if num_threads > 0 else 'the default'))
+
+    def detections(self, x):
+        """
+        Run the model on a batch, padding it to the model's batch size or running it in chunks
+
+        Args:
+            x (numpy.ndarray): the batch
+
+        Returns:
+            numpy.ndarray: the detections before NMS, of shape (..., N, 6)
+        """
+        chunks = list()
+        for begin in range(0, len(x), self._batch_size):
+            chunk = x[begin:begin + self._batch_size].astype(np.float32)
+            size = len(chunk)
+            if size < self._batch_size:
+                chunk = np.concatenate([chunk, np.zeros((self._batch_size - size,) + chunk.shape[1:], np.float32)])
+            outputs = self._session.run(self._outputs, {self._input.name: chunk})
+            chunks.append(np.concatenate(outputs, axis=-1)[:size])
+        return np.concatenate(chunks)
+
+    def __call__(self, x):
+        ctx = x.context if isinstance(x, mx.nd.NDArray) else mx.cpu()
+        result = self.detections(x.asnumpy() if isinstance(x, mx.nd.NDArray) else np.asarray(x))
+        if 0 < self.nms['nms_thresh'] < 1:
+            result = box_nms(result, overlap_thresh=self.nms['nms_thresh'], topk=self.nms['nms_topk'])
+            if self.nms['post_nms'] > 0:
+                result = result[..., :self.nms['post_nms'], :]
+        result = mx.nd.array(result, ctx=ctx)
+        return (result.slice_axis(axis=-1, begin=0, end=1), result.slice_axis(axis=-1, begin=1, end=2),
+                result.slice_axis(axis=-1, begin=2, end=None))
@@ -0,0 +1,173 @@
+"""
+Per phase timing of training steps, to tell if a configuration is limited by the input pipeline or by compute
+"""
+from collections import deque
+from contextlib import contextmanager
+import json
+import os
+import time
+
+import mxnet as mx
+import numpy as np
+
+
+class StepProfiler(object):
+    """
+    Times each phase of a training step, reporting rolling percentiles to TensorBoard and a JSONL log
+
+    The data phase is the time spent waiting on the DataLoader between the end of one step and the batch arriving. The
+    other phases are timed with a sync point (mx.nd.waitall) at their end, so the asynchronous engine's work is counted
+    in the phase that queued it. The syncs slow training a little, so when not enabled the profiler does nothing.
+
+    Can also capture an MXNet profiler trace of a window of steps, to see the time of each operator.
+    """
+    def __init__(self, log_path, tb_sw=None, enabled=True, window=100, percentiles=(50, 90, 99),
+                 trace_start=-1, trace_steps=10):
+        """
+        Args:
+            log_path (str): the path of the JSONL log, the trace is saved next to it
+            tb_sw (SummaryWriter): the tensorboard writer to report to (default is None)
+            enabled (bool): time the phases? otherwise all calls do nothing (default is True)
+            window (int): the number of recent steps the percentiles are over (default is 100)
+            percentiles (tuple): the percentiles to report (default is (50, 90, 99))
+            trace_start (int): the global step to start the MXNet profiler trace on, -1 is no trace (default is -1)
+            trace_steps (int): the number of steps to trace (default is 10)
+        """
+        self.enabled = enabled
+        self.log_path = log_path
+        self.tb_sw = tb_sw
+        self.percentiles = percentiles
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps
+        self._times = dict()  # phase name -> deque of recent times
+        self._sizes = deque(maxlen=window)  # batch size of recent steps
+        self._window = window
+        self._step = None
+        self._tic = None
+        self._tracing = False
+
+        if self.enabled:
+            log_dir = os.path.dirname(log_path)
+            if log_dir:
+                os.makedirs(log_dir, exist_ok=True)
+            if trace_start >= 0:
+                mx.profiler.set_config(profile_all=True, aggregate_stats=True,
+                                       filename=os.path.splitext(log_path)[0] + '_trace.json')
+
+    def _record(self, phase, seconds):
+        if phase not in self._times:
+            self._times[phase] = deque(maxlen=self._window)
+        self._times[phase].append(seconds)
+
+    def start_step(self, step):
+        """
+        Call as soon as the batch has arrived, records the data phase
+
+        Args:
+            step (int): the global step
+        """
+        if not self.enabled:
+            return
+        now = time.time()
+        if self._tic is not None:
+            self._record('data', now - self._tic)
+        self._step = step
+
+        if step == self.trace_start:
+            mx.nd.waitall()
+            mx.profiler.set_state('run')
+            self._tracing = True
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time a phase of the step, syncing at its end
+
+        Args:
+            name (str): the phase name eg. 'forward_backward'
+        """
+        if not self.enabled:
+            yield
+            return
+        tic = time.time()
+        yield
+        mx.nd.waitall()
+        self._record(name, time.time() - tic)
+
+    def end_step(self, batch_size):
+        """
+        Call at the end of the step, after the last phase
+
+        Args:
+            batch_size (int): the number of samples in the step
+        """
+        if not self.enabled:
+            return
+        self._sizes.append(batch_size)
+
+        if self._tracing and self._step >= self.trace_start + self.trace_steps - 1:
+            mx.nd.waitall()
+            mx.profiler.set_state('stop')
+            mx.profiler.dump()
+            with open(os.path.splitext(self.log_path)[0] + '_trace_stats.txt', 'w') as f:
+                f.write(mx.profiler.dumps())
+            self._tracing = False
+
+        self._tic = time.time()
+
+    def reset_wait(self):
+        """Don't count the time until the next batch as data wait, eg. after validation or at the start of an epoch"""
+        self._tic = None
+
+    def summary(self):
+        """
+        Get the percentiles of the recent steps
+
+        Returns:
+            dict: the percentiles and mean of each phase in milliseconds, the share of the step each phase takes and the
+                  samples/sec of the whole step
+        """
+        summary = dict()
+        step_times = 0
+        for phase, times in self._times.items():
+            times = 1000 * np.array(times)
+            summary[phase] = {'p{}'.format(p): float(v) for p, v in zip(self.percentiles,
+                                                                         np.percentile(times, self.percentiles))}
+            summary[phase]['mean'] = float(np.mean(times))
+            step_times += summary[phase]['mean']
+        for phase in self._times:
+            summary[phase]['share'] = summary[phase]['mean'] / max(step_times, 1e-9)
+        if self._sizes:
+            summary['samples_per_sec'] = 1000 * float(np.mean(self._sizes)) / max(step_times, 1e-9)
+        return summary
+
+    def report(self, global_step, **info):
+        """
+        Write the percentiles to the JSONL log and tensorboard
+
+        Args:
+            global_step (int): the global step
+            **info: extra fields for the JSONL record eg. epoch=1
+
+        Returns:
+            dict: the summary, see summary()
+        """
+        if not self.enabled or not self._times:
+            return None
+        summary = self.summary()
+
+        record = dict(info)
+        record['global_step'] = global_step
+        record.update(summary)
+        with open(self.log_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+        if self.tb_sw is not None:
+            for phase in self._times:
+                for k, v in summary[phase].items():
+                    self.tb_sw.add_scalar(tag='Profile_{}/{}'.format(phase, k), scalar_value=v,
+                                          global_step=global_step)
+            if 'samples_per_sec' in summary:
+                self.tb_sw.add_scalar(tag='Profile/samples_per_sec', scalar_value=summary['samples_per_sec'],
+                                      global_step=global_step)
+        return summary
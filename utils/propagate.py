@@ -0,0 +1,309 @@
+"""
+Keyframe selection and box propagation for keyframe based video detection, requires opencv
+
+The detector is only run on keyframes, the boxes are then carried to the frames in between by a propagator. Boxes are
+in the detect_yolo3 prediction format [cls, score, xmin, ymin, xmax, ymax] with coordinates normalised to [0, 1], and
+frames are RGB uint8 numpy arrays of shape (h, w, 3)
+"""
+import cv2
+import mxnet as mx
+import numpy as np
+
+
+def _gray(frame, scale):
+    """
+    Convert an RGB frame into a downscaled grayscale image
+
+    Args:
+        frame (numpy.ndarray): the RGB frame (h, w, 3)
+        scale (float): the factor to resize the frame by
+
+    Returns:
+        numpy.ndarray: the grayscale frame
+    """
+    gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+    if scale != 1:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return gray
+
+
+def _clip_boxes(boxes, min_size=1e-3):
+    """
+    Clip normalised boxes to the image, dropping any that have left it
+
+    Args:
+        boxes (list): the boxes [[cls, score, xmin, ymin, xmax, ymax], ...]
+        min_size (float): the minimum normalised width and height of a kept box (default is 1e-3)
+
+    Returns:
+        list: the clipped boxes
+    """
+    clipped = list()
+    for box in boxes:
+        coords = list(np.clip(box[2:], 0, 1))
+        if coords[2] - coords[0] > min_size and coords[3] - coords[1] > min_size:
+            clipped.append(box[:2] + coords)
+    return clipped
+
+
+class KeyframeSelector(object):
+    """
+    Decides which frames of a clip are keyframes for the full detector
+
+    In 'fixed' mode every interval'th frame is a keyframe. In 'adaptive' mode the interval is the longest gap
+    allowed, and a keyframe is taken sooner if the frame has changed from the last keyframe by more than diff_thresh
+    (mean absolute difference of downscaled grayscale frames in [0, 1]) or if the most confident propagated box has
+    decayed below conf_thresh, so uncertain detections are refreshed sooner than confident ones
+    """
+    def __init__(self, interval=10, mode='fixed', diff_thresh=0.1, conf_thresh=0.3, diff_size=64):
+        """
+        Args:
+            interval (int): the keyframe interval, or the maximum interval if adaptive (default is 10)
+            mode (str): 'fixed' or 'adaptive' (default is 'fixed')
+            diff_thresh (float): the frame difference that triggers an adaptive keyframe (default is 0.1)
+            conf_thresh (float): the propagated confidence that triggers an adaptive keyframe (default is 0.3)
+            diff_size (int): the side length frames are resized to for the frame difference (default is 64)
+        """
+        assert interval >= 1
+        assert mode in ['fixed', 'adaptive'], 'Keyframe mode {} not implemented.'.format(mode)
+        self.interval = interval
+        self.mode = mode
+        self.diff_thresh = diff_thresh
+        self.conf_thresh = conf_thresh
+        self.diff_size = diff_size
+        self.reset()
+
+    def reset(self):
+        """Reset the selector for a new clip"""
+        self._since_key = None
+        self._key_thumb = None
+        self._key_confident = False
+
+    def _thumb(self, frame):
+        return cv2.resize(cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY), (self.diff_size, self.diff_size),
+                          interpolation=cv2.INTER_AREA).astype(np.float32) / 255.0
+
+    def __call__(self, frame, boxes):
+        """
+        Is this frame a keyframe?
+
+        Args:
+            frame (numpy.ndarray): the RGB frame
+            boxes (list): the boxes of the previous frame, None if this is the first frame of the clip
+
+        Returns:
+            bool: True if the detector should be run on this frame
+        """
+        if boxes is None or self._since_key is None or self._since_key + 1 >= self.interval:
+            return True
+
+        if self.mode == 'adaptive':
+            if np.mean(np.abs(self._thumb(frame) - self._key_thumb)) > self.diff_thresh:
+                return True
+            if self._key_confident and max([box[1] for box in boxes] + [0]) < self.conf_thresh:
+                return True
+
+        return False
+
+    def update(self, frame, boxes, keyframe):
+        """
+        Record the outcome of a frame
+
+        Args:
+            frame (numpy.ndarray): the RGB frame
+            boxes (list): the boxes of this frame, detected if a keyframe otherwise propagated
+            keyframe (bool): was this frame a keyframe?
+        """
+        if keyframe:
+            self._since_key = 0
+            if self.mode == 'adaptive':
+                self._key_thumb = self._thumb(frame)
+                # only use the confidence signal if there is something confident to lose
+                self._key_confident = max([box[1] for box in boxes] + [0]) >= self.conf_thresh
+        else:
+            self._since_key += 1
+
+
+class BoxPropagator(object):
+    """
+    Base class for the propagators, which move the boxes of the previous frame onto the current frame
+
+    Propagated scores are multiplied by decay every frame, so boxes carried further from their keyframe count for less
+    """
+    def __init__(self, decay=0.95):
+        """
+        Args:
+            decay (float): the per frame score decay of propagated boxes (default is 0.95)
+        """
+        self.decay = decay
+
+    def reset(self):
+        """Reset the propagator for a new clip"""
+        pass
+
+    def flow(self, prev, curr):
+        """
+        Get the flow from the previous to the current frame
+
+        Args:
+            prev (numpy.ndarray): the previous RGB frame
+            curr (numpy.ndarray): the current RGB frame
+
+        Returns:
+            numpy.ndarray: the (h, w, 2) flow in pixels of the returned resolution
+        """
+        raise NotImplementedError
+
+    def __call__(self, prev, curr, boxes):
+        """
+        Propagate boxes from the previous frame to the current frame
+
+        Args:
+            prev (numpy.ndarray): the previous RGB frame
+            curr (numpy.ndarray): the current RGB frame
+            boxes (list): the boxes of the previous frame [[cls, score, xmin, ymin, xmax, ymax], ...]
+
+        Returns:
+            list: the boxes on the current frame
+        """
+        if len(boxes) == 0:
+            return boxes
+
+        flow = self.flow(prev, curr)
+        h, w = flow.shape[:2]
+        scale = np.array([w, h, w, h], dtype=np.float32)
+
+        propagated = list()
+        for box in boxes:
+            x0, y0, x1, y1 = np.round(np.array(box[2:]) * scale).astype(int)
+            x0, x1 = min(max(x0, 0), w - 1), min(max(x1, x0 + 1), w)
+            y0, y1 = min(max(y0, 0), h - 1), min(max(y1, y0 + 1), h)
+            xm, ym = int((x0 + x1) / 2), int((y0 + y1) / 2)
+
+            # move each edge by the median flow over its half of the box, so boxes can grow and shrink as well
+            box_flow = flow[y0:y1, x0:x1]
+            dx0 = np.median(box_flow[:, :max(xm - x0, 1), 0])
+            dx1 = np.median(box_flow[:, xm - x0:, 0])
+            dy0 = np.median(box_flow[:max(ym - y0, 1), :, 1])
+            dy1 = np.median(box_flow[ym - y0:, :, 1])
+
+            propagated.append([box[0], box[1] * self.decay] + list(np.array(box[2:]) +
+                                                                   np.array([dx0, dy0, dx1, dy1]) / scale))
+
+        return _clip_boxes(propagated)
+
+
+class FlowPropagator(BoxPropagator):
+    """Propagates boxes with dense Farneback optical flow from opencv"""
+    def __init__(self, scale=0.5, decay=0.95):
+        """
+        Args:
+            scale (float): the factor to resize frames by before calculating the flow (default is 0.5)
+            decay (float): the per frame score decay of propagated boxes (default is 0.95)
+        """
+        super(FlowPropagator, self).__init__(decay=decay)
+        self.scale = scale
+
+    def flow(self, prev, curr):
+        return cv2.calcOpticalFlowFarneback(_gray(prev, self.scale), _gray(curr, self.scale), None,
+                                            pyr_scale=0.5, levels=3, winsize=15, iterations=3,
+                                            poly_n=5, poly_sigma=1.2, flags=0)
+
+
+class FlowNetPropagator(BoxPropagator):
+    """Propagates boxes with the flow from a FlowNetS model"""
+    def __init__(self, net, ctx=mx.cpu(), shape=(384, 512), div_flow=20.0, decay=0.95):
+        """
+        Args:
+            net: the FlowNetS model, see models.definitions.flownet.flownet.get_flownet
+            ctx: the context to run the model on (default is mx.cpu())
+            shape (tuple): the (h, w) frames are resized to, must be divisible by 64 (default is (384, 512))
+            div_flow (float): the scale the model's flow was trained with (default is 20.0)
+            decay (float): the per frame score decay of propagated boxes (default is 0.95)
+        """
+        super(FlowNetPropagator, self).__init__(decay=decay)
+        assert shape[0] % 64 == 0 and shape[1] % 64 == 0
+        self.net = net
+        self.ctx = ctx
+        self.shape = shape
+        self.div_flow = div_flow
+
+    def flow(self, prev, curr):
+        imgs = np.array([cv2.resize(img, (self.shape[1], self.shape[0]), interpolation=cv2.INTER_LINEAR)
+                         for img in [prev, curr]], dtype=np.float32)
+        imgs = np.moveaxis(imgs, -1, 1)
+        imgs = (imgs - np.mean(imgs, axis=(0, 2, 3), keepdims=True)) / 255.0
+        imgs = mx.nd.array(imgs, ctx=self.ctx).expand_dims(0)  # add batch axis
+
+        # flow2 is at a quarter of the input resolution, scaled down by div_flow
+        flow = self.net(imgs)[0].asnumpy().transpose(1, 2, 0)
+        return flow * self.div_flow / 4.0
+
+
+class TemplatePropagator(BoxPropagator):
+    """
+    Propagates boxes by template matching each box of the previous frame within a search region around it in the
+    current frame, only moving the boxes not resizing them
+    """
+    def __init__(self, scale=0.5, search=0.5, min_size=8, decay=0.95):
+        """
+        Args:
+            scale (float): the factor to resize frames by before matching (default is 0.5)
+            search (float): the search region padding each side as a fraction of the box size (default is 0.5)
+            min_size (int): boxes smaller than this many pixels after resizing are left in place (default is 8)
+            decay (float): the per frame score decay of propagated boxes (default is 0.95)
+        """
+        super(TemplatePropagator, self).__init__(decay=decay)
+        self.scale = scale
+        self.search = search
+        self.min_size = min_size
+
+    def __call__(self, prev, curr, boxes):
+        if len(boxes) == 0:
+            return boxes
+
+        prev = _gray(prev, self.scale)
+        curr = _gray(curr, self.scale)
+        h, w = prev.shape
+        scale = np.array([w, h, w, h], dtype=np.float32)
+
+        propagated = list()
+        for box in boxes:
+            x0, y0, x1, y1 = np.round(np.array(box[2:]) * scale).astype(int)
+            x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x1, w), min(y1, h)
+            shift = np.zeros(2)
+            if x1 - x0 >= self.min_size and y1 - y0 >= self.min_size:
+                pw, ph = int((x1 - x0) * self.search), int((y1 - y0) * self.search)
+                sx0, sy0 = max(x0 - pw, 0), max(y0 - ph, 0)
+                sx1, sy1 = min(x1 + pw, w), min(y1 + ph, h)
+                response = cv2.matchTemplate(curr[sy0:sy1, sx0:sx1], prev[y0:y1, x0:x1], cv2.TM_CCOEFF_NORMED)
+                _, _, _, (mx_, my_) = cv2.minMaxLoc(response)
+                shift = np.array([sx0 + mx_ - x0, sy0 + my_ - y0])
+
+            propagated.append([box[0], box[1] * self.decay] + list(np.array(box[2:]) +
+                                                                   np.tile(shift, 2) / scale))
+
+        return _clip_boxes(propagated)
+
+
+def get_propagator(name, ctx=mx.cpu(), decay=0.95):
+    """
+    Get a box propagator by name
+
+    Args:
+        name (str): 'flow', 'template' or 'flownet'
+        ctx: the context to run the FlowNetS model on (default is mx.cpu())
+        decay (float): the per frame score decay of propagated boxes (default is 0.95)
+
+    Returns:
+        BoxPropagator: the propagator
+    """
+    if name == 'flow':
+        return FlowPropagator(decay=decay)
+    elif name == 'template':
+        return TemplatePropagator(decay=decay)
+    elif name == 'flownet':
+        from models.definitions.flownet.flownet import get_flownet
+        return FlowNetPropagator(get_flownet('S', pretrained=True, ctx=ctx), ctx=ctx, decay=decay)
+    else:
+        raise NotImplementedError('Propagator: {} not implemented.'.format(name))
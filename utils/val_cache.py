@@ -0,0 +1,146 @@
+"""
+A memory mapped cache of the deterministic part of the validation transform, so after the first time validation only
+costs the model forward and the metric rather than decoding and resizing every frame from JPEG again
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import mxnet as mx
+import numpy as np
+from mxnet import gluon
+from tqdm import tqdm
+
+
+def cache_key(dataset, **config):
+    """
+    Get the key of a dataset's cache, changing with the dataset's samples and classes and the given config
+
+    Args:
+        dataset: the dataset, needs sample_path(idx)
+        **config: the config the cached tensors depend on eg. data_shape=416, window=[3, 1]
+
+    Returns:
+        str: the key
+    """
+    sha = hashlib.sha1()
+    sha.update(json.dumps({'dataset': dataset.__class__.__name__, 'classes': list(dataset.classes),
+                           'config': config}, sort_keys=True).encode())
+    for idx in range(len(dataset)):
+        sha.update(json.dumps(dataset.sample_path(idx)).encode())
+    return '{}_{}'.format(getattr(dataset, 'name', dataset.__class__.__name__.lower()), sha.hexdigest()[:16])
+
+
+class _Resize(object):
+    """Applies only the resize of a transform, returning numpy arrays for the cache"""
+    def __init__(self, transform):
+        self._transform = transform
+
+    def __call__(self, src, label, *args):
+        img, bbox = self._transform.resize(src, label)
+        if isinstance(bbox, mx.nd.NDArray):
+            bbox = bbox.asnumpy()
+        return img.asnumpy(), np.asarray(bbox, dtype=np.float32)
+
+
+def _as_list(samples):
+    return samples
+
+
+class CachedValLoader(object):
+    """
+    A validation loader serving the resized uint8 images and the padded labels from memory mapped .npy files
+
+    The first time it's made for a dataset it runs the transform's resize over the dataset to build the cache, which is
+    keyed on the dataset and config (see cache_key) so a changed dataset or data_shape gets a new cache. Batches are
+    then read as slices of the memory mapped files, large sequential reads, and normalised with the transform as a
+    batch. It yields the same (images, labels) batches as a DataLoader over the transformed dataset with Stack and
+    Pad(pad_val=-1) batchify, with last_batch='discard'.
+
+    Labels are cached padded to max_boxes boxes, any beyond are dropped (as YOLO3VideoInferenceTransform does for
+    multiple temporal outputs).
+    """
+    def __init__(self, dataset, transform, batch_size, cache_dir, key, indices=None, num_workers=0, max_boxes=100):
+        """
+        Args:
+            dataset: the validation dataset
+            transform: the inference transform, needs resize(src, label) and normalize(imgs) eg.
+                       YOLO3VideoInferenceTransform
+            batch_size (int): the batch size
+            cache_dir (str): the directory to keep the caches in
+            key (str): the cache key, see cache_key
+            indices (list): only serve these samples, in this order (default is None, all samples)
+            num_workers (int): the number of workers building the cache (default is 0)
+            max_boxes (int): the number of boxes labels are padded to (default is 100)
+        """
+        self._transform = transform
+        self._batch_size = batch_size
+        self.path = os.path.join(cache_dir, key)
+        if not os.path.exists(self.path):
+            self._build(dataset, transform, num_workers, max_boxes)
+
+        self._images = np.load(os.path.join(self.path, 'images.npy'), mmap_mode='r')
+        self._labels = np.load(os.path.join(self.path, 'labels.npy'), mmap_mode='r')
+        self._counts = np.load(os.path.join(self.path, 'counts.npy'))
+        self._indices = np.arange(len(self._images)) if indices is None else np.asarray(indices, dtype=np.int64)
+
+    def _build(self, dataset, transform, num_workers, max_boxes):
+        """
+        Run the resize over the dataset and write the cache, into a temporary directory renamed when complete
+
+        Args:
+            dataset: the validation dataset
+            transform: the inference transform
+            num_workers (int): the number of dataloader workers
+            max_boxes (int): the number of boxes labels are padded to
+        """
+        logging.info('Building the validation cache {}'.format(self.path))
+        tmp_path = self.path + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        resize = _Resize(transform)
+        img, bbox = resize(*dataset[0][:2])
+        n = len(dataset)
+        images = np.lib.format.open_memmap(os.path.join(tmp_path, 'images.npy'), mode='w+', dtype=np.uint8,
+                                           shape=(n,) + img.shape)
+        labels = np.lib.format.open_memmap(os.path.join(tmp_path, 'labels.npy'), mode='w+', dtype=np.float32,
+                                           shape=(n,) + bbox.shape[:-2] + (max_boxes, bbox.shape[-1]))
+        labels[:] = -1
+        counts = np.zeros(n, dtype=np.int64)
+
+        loader = gluon.data.DataLoader(dataset.transform(resize), batch_size=self._batch_size, shuffle=False,
+                                       last_batch='keep', batchify_fn=_as_list, num_workers=num_workers)
+        idx = 0
+        for batch in tqdm(loader, total=len(loader), desc='caching val'):
+            for img, bbox in batch:
+                images[idx] = img
+                count = min(bbox.shape[-2], max_boxes)
+                labels[idx, ..., :count, :] = bbox[..., :count, :]
+                counts[idx] = count
+                idx += 1
+
+        images.flush()
+        labels.flush()
+        del images, labels
+        np.save(os.path.join(tmp_path, 'counts.npy'), counts)
+        os.replace(tmp_path, self.path)
+
+    def __len__(self):
+        return len(self._indices) // self._batch_size  # last_batch='discard'
+
+    def __iter__(self):
+        for b in range(len(self)):
+            idxs = self._indices[b * self._batch_size:(b + 1) * self._batch_size]
+            if np.all(np.diff(idxs) == 1):  # a contiguous slice, one sequential read
+                images = self._images[idxs[0]:idxs[-1] + 1]
+                labels = self._labels[idxs[0]:idxs[-1] + 1]
+            else:
+                images = self._images[idxs]
+                labels = self._labels[idxs]
+            labels = labels[..., :max(int(self._counts[idxs].max()), 1), :]  # pad to the batch's max like Pad
+
+            yield self._transform.normalize(mx.nd.array(images, dtype='uint8')), mx.nd.array(labels)
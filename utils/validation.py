@@ -0,0 +1,155 @@
+"""
+Validation out of the training loop: a worker process that evaluates parameter snapshots while training continues, and
+stratified validation subsets for cheap per epoch evaluations
+"""
+import logging
+import multiprocessing
+import queue
+import time
+
+import numpy as np
+
+
+def stratified_subset(dataset, fraction):
+    """
+    Get the indices of a deterministic subset of a dataset, taking evenly spaced samples from every group (eg. every
+    clip of a video dataset) so the subset covers the dataset like the full set does
+
+    Args:
+        dataset: the dataset, groups come from its sample_groups() if it has one, otherwise it's evenly spaced over
+                 the whole dataset
+        fraction (float): the fraction of samples to keep
+
+    Returns:
+        list: the sorted sample indices
+    """
+    n = len(dataset)
+    if fraction >= 1:
+        return list(range(n))
+
+    if hasattr(dataset, 'sample_groups'):
+        groups = np.asarray(dataset.sample_groups())
+    else:
+        groups = np.zeros(n, dtype=np.int64)
+
+    order = np.argsort(groups, kind='stable')
+    starts = np.flatnonzero(np.r_[True, groups[order][1:] != groups[order][:-1], True])
+    indices = list()
+    for start, end in zip(starts[:-1], starts[1:]):
+        k = max(1, int(round(fraction * (end - start))))  # at least one from every group
+        indices.append(order[start + np.round(np.linspace(0, end - start - 1, k)).astype(np.int64)])
+
+    return np.unique(np.concatenate(indices)).tolist()
+
+
+def _worker(setup_fn, setup_args, jobs, results):
+    """
+    The validation worker process loop
+
+    Args:
+        setup_fn: called once with setup_args in the worker, returns evaluate(params, full) -> (names, values)
+        setup_args (tuple): the arguments of setup_fn
+        jobs (multiprocessing.Queue): (params, epoch, step, full) jobs, None stops the worker
+        results (multiprocessing.Queue): the result dicts
+    """
+    evaluate = setup_fn(*setup_args)
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        params, epoch, step, full = job
+        tic = time.time()
+        names, values = evaluate(params, full)
+        results.put({'epoch': epoch, 'step': step, 'full': full, 'names': list(names),
+                     'values': [float(v) for v in values], 'seconds': time.time() - tic})
+
+
+class AsyncValidator(object):
+    """
+    Evaluates parameter snapshots in a separate local process, so training continues while validation runs
+
+    The process is spawned rather than forked, so it gets its own MXNet engine and can run on its own CPU or GPU
+    context. It builds the model and validation data once with setup_fn, then evaluates each submitted snapshot in
+    turn. Snapshots are pickled to the process from the queue's feeder thread, so submit doesn't wait on the transfer.
+    """
+    def __init__(self, setup_fn, setup_args, max_pending=2):
+        """
+        Args:
+            setup_fn: a module level function called in the worker with setup_args, returning
+                      evaluate(params, full) -> (names, values) where params is the parameter name to NDArray dict and
+                      full is whether to evaluate on the full set rather than the subset
+            setup_args (tuple): the picklable arguments of setup_fn
+            max_pending (int): the number of snapshots that can wait behind the one being evaluated, beyond which
+                               submit skips (default is 2)
+        """
+        context = multiprocessing.get_context('spawn')
+        self._jobs = context.Queue(maxsize=max_pending)
+        self._results = context.Queue()
+        self._process = context.Process(target=_worker, args=(setup_fn, setup_args, self._jobs, self._results),
+                                        daemon=True)
+        self._process.start()
+        self._outstanding = 0
+
+    @property
+    def outstanding(self):
+        """int: the number of submitted snapshots not yet reported"""
+        return self._outstanding
+
+    def submit(self, params, epoch, step, full=True):
+        """
+        Queue a snapshot for evaluation
+
+        Args:
+            params (dict): the parameter name to NDArray dict, in host memory
+            epoch (int): the epoch of the snapshot
+            step (int): the global step of the snapshot
+            full (bool): evaluate on the full validation set rather than the subset (default is True)
+
+        Returns:
+            bool: True if queued, False if the worker is too far behind and the snapshot was skipped
+        """
+        if not self._process.is_alive():
+            logging.error('The validation worker has stopped (exit code {})'.format(self._process.exitcode))
+            return False
+        try:
+            self._jobs.put_nowait((params, epoch, step, full))
+        except queue.Full:
+            logging.warning('Validation is behind, skipping the validation of epoch {}'.format(epoch))
+            return False
+        self._outstanding += 1
+        return True
+
+    def poll(self, block=False):
+        """
+        Get the results reported since the last poll
+
+        Args:
+            block (bool): wait for every outstanding snapshot to be reported? (default is False)
+
+        Returns:
+            list: the result dicts, with epoch, step, full, names, values and seconds
+        """
+        results = list()
+        while self._outstanding:
+            try:
+                result = self._results.get(timeout=10) if block else self._results.get_nowait()
+            except queue.Empty:
+                if block and self._process.is_alive():
+                    continue
+                break
+            results.append(result)
+            self._outstanding -= 1
+        return results
+
+    def close(self):
+        """
+        Wait for the outstanding snapshots and stop the worker
+
+        Returns:
+            list: the results not yet polled
+        """
+        results = self.poll(block=True)
+        if self._process.is_alive():
+            self._jobs.put(None)
+        self._process.join()
+        return results